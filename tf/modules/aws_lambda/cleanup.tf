@@ -15,6 +15,14 @@ resource "aws_lambda_function" "cleanup" {
       APPSPEC_BUCKET_NAME     = aws_s3_bucket.codedeploy_appspec.bucket
       CODEDEPLOY_APP_NAME     = aws_codedeploy_app.lambda.name
       CODEDEPLOY_GROUP_NAME   = aws_codedeploy_deployment_group.lambda.deployment_group_name
+      LAMBDA_FUNCTION_NAME    = aws_lambda_function.main.function_name
+      APPSPEC_KEY_LAYOUT      = var.appspec_key_layout
+      CLEANUP_MODE            = var.cleanup_mode
+      FULL_RECONCILE_INTERVAL_HOURS = tostring(var.cleanup_full_reconcile_interval_hours)
+      DRY_RUN                 = tostring(var.cleanup_dry_run)
+      UNTAGGED_GC_ENABLED     = tostring(var.cleanup_untagged_images)
+      UNTAGGED_GRACE_HOURS    = tostring(var.cleanup_untagged_grace_hours)
+      VERSION_GC_ENABLED      = tostring(var.cleanup_lambda_versions)
       RETAIN_COUNT            = "10"
       SUCCESSFUL_DEPLOY_RETAIN = "3"
     }
@@ -78,6 +86,7 @@ resource "aws_iam_role_policy" "cleanup" {
         Action = [
           "ecr:DescribeImages",
           "ecr:ListImages",
+          "ecr:BatchGetImage",
           "ecr:BatchDeleteImage"
         ]
         Resource = [
@@ -97,7 +106,8 @@ resource "aws_iam_role_policy" "cleanup" {
         Effect = "Allow"
         Action = [
           "s3:DeleteObject",
-          "s3:GetObject"
+          "s3:GetObject",
+          "s3:PutObject"
         ]
         Resource = [
           "${aws_s3_bucket.codedeploy_appspec.arn}/*"
@@ -107,12 +117,28 @@ resource "aws_iam_role_policy" "cleanup" {
         Effect = "Allow"
         Action = [
           "codedeploy:ListDeployments",
-          "codedeploy:GetDeployment"
+          "codedeploy:GetDeployment",
+          "codedeploy:BatchGetDeployments"
         ]
         Resource = [
           aws_codedeploy_app.lambda.arn,
           "arn:aws:codedeploy:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:deploymentgroup:${aws_codedeploy_app.lambda.name}/${aws_codedeploy_deployment_group.lambda.deployment_group_name}"
         ]
+      },
+      {
+        # Pruning old published versions (aliases are read so their versions are kept);
+        # GetFunction resolves the image a protected deployment's version runs
+        Effect = "Allow"
+        Action = [
+          "lambda:GetFunction",
+          "lambda:ListVersionsByFunction",
+          "lambda:ListAliases",
+          "lambda:DeleteFunction"
+        ]
+        Resource = [
+          aws_lambda_function.main.arn,
+          "${aws_lambda_function.main.arn}:*"
+        ]
       }
     ]
   })
@@ -166,4 +192,24 @@ data "archive_file" "cleanup_lambda" {
     content  = file("${path.module}/cleanup_lambda/index.py")
     filename = "index.py"
   }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/clients.py")
+    filename = "clients.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/instrumentation.py")
+    filename = "instrumentation.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/state_store.py")
+    filename = "state_store.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/manifest.py")
+    filename = "manifest.py"
+  }
 }
\ No newline at end of file
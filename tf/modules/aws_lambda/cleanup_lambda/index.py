@@ -1,76 +1,426 @@
+import heapq
 import json
-import boto3
 import os
-import re
-from datetime import datetime
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from botocore.exceptions import ClientError
+from datetime import datetime, timezone
 
-# Initialize clients
-ecr_client = boto3.client('ecr')
-s3_client = boto3.client('s3')
-codedeploy_client = boto3.client('codedeploy')
+from clients import get_client, lazy_client
+from instrumentation import describe_event, instrumented
+from manifest import MANIFEST_WRITE_ATTEMPTS, manifest_key, manifest_store
+from state_store import update_json
 
+# batch_delete_image accepts at most 100 image IDs per call
+ECR_BATCH_DELETE_LIMIT = 100
+# delete_objects accepts at most 1000 keys per call
+S3_BATCH_DELETE_LIMIT = 1000
+# batch_get_deployments accepts at most 25 deployment IDs per call
+CODEDEPLOY_BATCH_GET_LIMIT = 25
+
+# AppSpec key layouts written by deploy_lambda
+APPSPEC_FLAT_PREFIX = 'appspec-'
+APPSPEC_PARTITION_ROOT = 'appspec'
+
+# Manifest media types that reference per-platform child manifests
+IMAGE_INDEX_MEDIA_TYPES = (
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json'
+)
+# batch_get_image accepts at most 100 image IDs per call
+ECR_BATCH_GET_LIMIT = 100
+
+# Incremental cleanup cursor (see cursor_key)
+CURSOR_SCHEMA_VERSION = 1
+
+# Alias that CodeDeploy shifts between versions
+LIVE_ALIAS = 'live'
+
+# Clients are built on first use (see lambda_shared/clients.py)
+ecr_client = lazy_client('ecr')
+s3_client = lazy_client('s3')
+codedeploy_client = lazy_client('codedeploy')
+lambda_client = lazy_client('lambda')
+
+@instrumented
 def handler(event, context):
     """
     Cleanup function that retains only the most recent ECR images and AppSpec files.
     Triggered by successful CodeDeploy deployments.
+
+    An event with 'targets', 'tagFilter' or 'resume' runs the multi-repository
+    sweeper instead (see run_sweeper). An event with "dryRun": true (or the
+    DRY_RUN environment variable) reports the delete plan without deleting.
     """
-    print(f"Cleanup triggered with event: {json.dumps(event)}")
+    print(f"Cleanup triggered with event: {describe_event(event)}")
+    
+    if 'targets' in event or 'tagFilter' in event or event.get('resume'):
+        return run_sweeper(event, context)
     
-    repository_name = os.environ['ECR_REPOSITORY_NAME']
-    bucket_name = os.environ['APPSPEC_BUCKET_NAME']
-    codedeploy_app = os.environ['CODEDEPLOY_APP_NAME']
-    codedeploy_group = os.environ['CODEDEPLOY_GROUP_NAME']
-    retain_count = int(os.environ.get('RETAIN_COUNT', '10'))
-    successful_deploy_retain = int(os.environ.get('SUCCESSFUL_DEPLOY_RETAIN', '3'))
+    target = target_from_environment()
+    if event.get('dryRun'):
+        target['dryRun'] = True
+    deployment_id = event.get('detail', {}).get('deploymentId')
+    cleanup_results = run_cleanup_target(target, deployment_id)
+    
+    if cleanup_results['errors']:
+        return {
+            'statusCode': 500,
+            'body': json.dumps({
+                'message': 'Cleanup failed',
+                'results': cleanup_results
+            })
+        }
+    
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': 'Cleanup completed successfully',
+            'results': cleanup_results
+        })
+    }
+
+def target_from_environment(overrides=None):
+    """
+    Build a cleanup target from this function's environment.
+
+    A target names one repository/bucket/CodeDeploy group triple plus its
+    retention settings; overrides (e.g. a sweeper target) take precedence.
+    """
+    target = {
+        'repositoryName': os.environ.get('ECR_REPOSITORY_NAME'),
+        'bucketName': os.environ.get('APPSPEC_BUCKET_NAME'),
+        'codedeployApp': os.environ.get('CODEDEPLOY_APP_NAME'),
+        'codedeployGroup': os.environ.get('CODEDEPLOY_GROUP_NAME'),
+        'functionName': os.environ.get('LAMBDA_FUNCTION_NAME'),
+        'appspecLayout': os.environ.get('APPSPEC_KEY_LAYOUT', 'flat'),
+        'cleanupMode': os.environ.get('CLEANUP_MODE', 'full'),
+        'retainCount': int(os.environ.get('RETAIN_COUNT', '10')),
+        'successfulDeployRetain': int(os.environ.get('SUCCESSFUL_DEPLOY_RETAIN', '3')),
+        'fullReconcileHours': float(os.environ.get('FULL_RECONCILE_INTERVAL_HOURS', '24')),
+        'untaggedGc': os.environ.get('UNTAGGED_GC_ENABLED', 'true').lower() == 'true',
+        'untaggedGraceHours': float(os.environ.get('UNTAGGED_GRACE_HOURS', '24')),
+        'versionGc': os.environ.get('VERSION_GC_ENABLED', 'true').lower() == 'true',
+        'dryRun': os.environ.get('DRY_RUN', 'false').lower() == 'true'
+    }
+    target.update(overrides or {})
+    return target
+
+def run_cleanup_target(target, deployment_id=None):
+    """Run protection, ECR and AppSpec cleanup for one target and return its results."""
+    repository_name = target['repositoryName']
+    bucket_name = target['bucketName']
+    codedeploy_app = target['codedeployApp']
+    codedeploy_group = target['codedeployGroup']
+    retain_count = target['retainCount']
+    successful_deploy_retain = target['successfulDeployRetain']
+    function_name = target.get('functionName')
+    appspec_layout = target.get('appspecLayout', 'flat')
+    cleanup_mode = target.get('cleanupMode', 'full')
+    full_reconcile_hours = target.get('fullReconcileHours', 24)
+    untagged_gc = target.get('untaggedGc', False)
+    untagged_grace_hours = target.get('untaggedGraceHours', 24)
+    version_gc = target.get('versionGc', False)
+    dry_run = target.get('dryRun', False)
     
     cleanup_results = {
+        'mode': 'full',
+        'dry_run': dry_run,
         'ecr_images_deleted': 0,
+        'untagged_images_deleted': 0,
         'appspec_files_deleted': 0,
+        'lambda_versions_deleted': 0,
+        'lambda_version_bytes_freed': 0,
+        'ecr_stats': {},
+        'untagged_stats': {},
+        'appspec_stats': {},
+        'version_stats': {},
+        'protection_stats': {},
         'errors': []
     }
+    started_at = time.monotonic()
     
     try:
-        # Get successful deployment artifacts that must be protected
-        print(f"Getting successful deployment history for protection")
-        protected_artifacts = get_successful_deployment_artifacts(
-            codedeploy_app, codedeploy_group, successful_deploy_retain
-        )
+        # Mark this deployment as succeeded in the manifest and protect from it
+        protected_artifacts = None
+        manifest = None
+        if function_name:
+            manifest = mark_manifest_deployment_succeeded(
+                bucket_name, function_name, deployment_id, cleanup_results['protection_stats'],
+                dry_run=dry_run
+            )
+            protected_artifacts = get_manifest_protected_artifacts(manifest, successful_deploy_retain)
+        
+        # Fall back to CodeDeploy history when the manifest is missing or too short
+        if protected_artifacts is None:
+            print(f"Getting successful deployment history for protection")
+            protected_artifacts = get_successful_deployment_artifacts(
+                codedeploy_app, codedeploy_group, successful_deploy_retain,
+                stats=cleanup_results['protection_stats'], manifest=manifest,
+                resolve_images=version_gc
+            )
         print(f"Protected artifacts: {json.dumps(protected_artifacts, default=str)}")
         
-        # Cleanup ECR images
-        print(f"Cleaning up ECR repository: {repository_name}")
-        ecr_deleted = cleanup_ecr_images(repository_name, retain_count, protected_artifacts['image_tags'])
-        cleanup_results['ecr_images_deleted'] = ecr_deleted
+        # Incremental mode only looks at artifacts deployed since the cursor.
+        # A dry run always plans a full reconcile and leaves the cursor alone.
+        cursor = None
+        if cleanup_mode == 'incremental' and manifest is not None and not dry_run:
+            cursor = load_cleanup_cursor(bucket_name, repository_name, cleanup_results['protection_stats'])
+            if cursor_needs_full_reconcile(cursor, retain_count, time.time(), full_reconcile_hours):
+                cursor = None
+            else:
+                cursor = run_incremental_cleanup(
+                    repository_name, bucket_name, retain_count, protected_artifacts,
+                    manifest, cursor, cleanup_results
+                )
+                if cursor is not None:
+                    cleanup_results['mode'] = 'incremental'
         
-        # Cleanup AppSpec files
-        print(f"Cleaning up S3 bucket: {bucket_name}")
-        s3_deleted = cleanup_appspec_files(bucket_name, retain_count, protected_artifacts['appspec_keys'])
-        cleanup_results['appspec_files_deleted'] = s3_deleted
+        if cleanup_results['mode'] == 'full':
+            ecr_window = [] if cleanup_mode == 'incremental' else None
+            appspec_window = [] if cleanup_mode == 'incremental' else None
+            
+            # Cleanup ECR images
+            print(f"Cleaning up ECR repository: {repository_name}")
+            ecr_deleted = cleanup_ecr_images(
+                repository_name, retain_count, protected_artifacts['image_tags'],
+                stats=cleanup_results['ecr_stats'],
+                protected_image_digests=protected_artifacts.get('image_digests', []),
+                window=ecr_window,
+                dry_run=dry_run
+            )
+            cleanup_results['ecr_images_deleted'] = ecr_deleted
+            
+            # Collect untagged manifests no live image index references
+            if untagged_gc:
+                print(f"Collecting unreferenced untagged images in: {repository_name}")
+                cleanup_results['untagged_images_deleted'] = cleanup_untagged_images(
+                    repository_name, protected_artifacts.get('image_digests', []),
+                    untagged_grace_hours, stats=cleanup_results['untagged_stats'],
+                    dry_run=dry_run
+                )
+            
+            # Cleanup AppSpec files
+            print(f"Cleaning up S3 bucket: {bucket_name}")
+            s3_deleted = cleanup_appspec_files(
+                bucket_name, retain_count, protected_artifacts['appspec_keys'],
+                stats=cleanup_results['appspec_stats'],
+                function_name=function_name,
+                layout=appspec_layout,
+                window=appspec_window,
+                dry_run=dry_run
+            )
+            cleanup_results['appspec_files_deleted'] = s3_deleted
+            
+            if dry_run:
+                cleanup_results['plan'] = {
+                    'ecr_images': cleanup_results['ecr_stats'].get('planned_deletes', 0),
+                    'untagged_images': cleanup_results['untagged_stats'].get('planned_deletes', 0),
+                    'appspec_files': cleanup_results['appspec_stats'].get('planned_deletes', 0)
+                }
+            elif cleanup_mode == 'incremental':
+                cursor = build_cleanup_cursor(ecr_window, appspec_window, manifest, retain_count,
+                                              full_reconcile_at=time.time())
         
-        print(f"Cleanup completed: {json.dumps(cleanup_results)}")
+        # Published versions are pruned in both modes; listing them is a few pages at most
+        if function_name and version_gc:
+            print(f"Cleaning up published versions of: {function_name}")
+            cleanup_results['lambda_versions_deleted'] = cleanup_lambda_versions(
+                function_name, bucket_name, retain_count, protected_artifacts, manifest,
+                stats=cleanup_results['version_stats'], dry_run=dry_run
+            )
+            cleanup_results['lambda_version_bytes_freed'] = cleanup_results['version_stats'].get('bytes_freed', 0)
+            if dry_run:
+                cleanup_results.setdefault('plan', {})['lambda_versions'] = \
+                    cleanup_results['version_stats'].get('planned_deletes', 0)
         
-        return {
-            'statusCode': 200,
-            'body': json.dumps({
-                'message': 'Cleanup completed successfully',
-                'results': cleanup_results
-            })
-        }
+        if cursor is not None:
+            save_cleanup_cursor(bucket_name, repository_name, cursor, cleanup_results['protection_stats'])
+        cleanup_results['duration_seconds'] = round(time.monotonic() - started_at, 3)
+        
+        print(f"Cleanup completed: {json.dumps(cleanup_results)}")
+        return cleanup_results
         
     except Exception as e:
         error_msg = f"Cleanup failed: {str(e)}"
         print(error_msg)
         cleanup_results['errors'].append(error_msg)
-        
-        return {
-            'statusCode': 500,
-            'body': json.dumps({
-                'message': 'Cleanup failed',
-                'results': cleanup_results
-            })
-        }
+        cleanup_results['duration_seconds'] = round(time.monotonic() - started_at, 3)
+        return cleanup_results
+
+def run_sweeper(event, context):
+    """
+    Clean up many repository/bucket/CodeDeploy-group targets in one invocation.
+
+    Targets come from event['targets'] (dicts using the target_from_environment
+    keys), from event['tagFilter'] (ECR repositories discovered by tag), or from
+    the checkpoint of a previous run when event['resume'] is set. They run on a
+    bounded thread pool with a per-account API rate limit. New targets stop being
+    started once the remaining time drops below SWEEPER_MIN_REMAINING_MS; those
+    are checkpointed so the next invocation with {"resume": true} picks them up.
+    """
+    max_workers = int(os.environ.get('SWEEPER_MAX_WORKERS', '4'))
+    min_remaining_ms = int(os.environ.get('SWEEPER_MIN_REMAINING_MS', '60000'))
+    calls_per_second = float(os.environ.get('SWEEPER_MAX_CALLS_PER_SECOND', '10'))
+    state_bucket = os.environ.get('SWEEPER_STATE_BUCKET') or os.environ.get('APPSPEC_BUCKET_NAME')
+    
+    if event.get('resume'):
+        targets = load_sweeper_checkpoint(state_bucket)
+    elif 'tagFilter' in event:
+        targets = discover_tagged_targets(event['tagFilter'])
+    else:
+        targets = [target_from_environment(t) for t in event['targets']]
+    print(f"Sweeper running {len(targets)} targets with {max_workers} workers")
+    
+    # Only version GC calls Lambda, and hooking a client builds it
+    install_rate_limiter(calls_per_second, lambda_calls=any(t.get('versionGc') for t in targets))
+    report = {'targets': [], 'pending': [], 'succeeded': 0, 'failed': 0}
+    queue = list(targets)
+    running = {}
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while queue or running:
+            while queue and len(running) < max_workers:
+                if context.get_remaining_time_in_millis() < min_remaining_ms:
+                    print(f"Time budget nearly spent, checkpointing {len(queue)} targets")
+                    report['pending'] = queue
+                    queue = []
+                    break
+                target = queue.pop(0)
+                running[pool.submit(run_rate_limited_target, target)] = target
+            
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                target = running.pop(future)
+                results = future.result()
+                status = 'failed' if results['errors'] else 'succeeded'
+                report[status] += 1
+                report['targets'].append({
+                    'repositoryName': target['repositoryName'],
+                    'status': status,
+                    'results': results
+                })
+    
+    if state_bucket:
+        save_sweeper_checkpoint(state_bucket, report['pending'])
+    report['checkpointed'] = bool(report['pending'])
+    print(f"Sweeper finished: {report['succeeded']} succeeded, {report['failed']} failed, "
+          f"{len(report['pending'])} pending")
+    
+    return {
+        'statusCode': 500 if report['failed'] else 200,
+        'body': json.dumps(report, default=str)
+    }
+
+def discover_tagged_targets(tag_filter):
+    """
+    Find hoist ECR repositories matching tag_filter ({tag: value or [values]}).
+
+    The bucket, CodeDeploy group and function names follow the aws_lambda module's
+    <app>-<env> naming conventions for each repository.
+    """
+    tagging_client = get_client('resourcegroupstaggingapi')
+    account_id = get_client('sts').get_caller_identity()['Account']
+    tag_filters = [
+        {'Key': key, 'Values': values if isinstance(values, list) else [values]}
+        for key, values in tag_filter.items()
+    ]
+    
+    targets = []
+    paginator = tagging_client.get_paginator('get_resources')
+    for page in paginator.paginate(ResourceTypeFilters=['ecr:repository'], TagFilters=tag_filters):
+        for resource in page.get('ResourceTagMappingList', []):
+            name = resource['ResourceARN'].split('repository/', 1)[1]
+            targets.append(target_from_environment({
+                'repositoryName': name,
+                'bucketName': f"{name}-codedeploy-appspec-{account_id}",
+                'codedeployApp': name,
+                'codedeployGroup': name,
+                'functionName': name,
+                'accountId': account_id
+            }))
+    return targets
+
+def sweeper_checkpoint_key():
+    """S3 key holding the targets a sweeper run could not start."""
+    return 'cleanup/sweeper-checkpoint.json'
+
+def load_sweeper_checkpoint(bucket_name):
+    """Load checkpointed targets, or an empty list if there are none."""
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=sweeper_checkpoint_key())
+        return json.loads(response['Body'].read()).get('pending', [])
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return []
+        raise
+
+def save_sweeper_checkpoint(bucket_name, pending):
+    """Persist targets still to be swept (an empty list clears the checkpoint)."""
+    s3_client.put_object(
+        Bucket=bucket_name,
+        Key=sweeper_checkpoint_key(),
+        Body=json.dumps({'pending': pending}),
+        ContentType='application/json'
+    )
+
+class RateLimiter:
+    """Thread-safe token bucket allowing `rate` calls per second with bursts up to `rate`."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+# Rate limiters keyed by account ID; sweeper worker threads record their target's account
+_rate_limiters = {}
+_rate_limiter_lock = threading.Lock()
+_sweeper_thread = threading.local()
+
+def install_rate_limiter(calls_per_second, lambda_calls=False):
+    """
+    Throttle every call made by this module's clients through the per-account limiter.
+
+    lambda_client is only hooked (and so built) when lambda_calls is set.
+    """
+    def before_call(**kwargs):
+        account_id = getattr(_sweeper_thread, 'account_id', None)
+        if account_id is None:
+            return
+        with _rate_limiter_lock:
+            limiter = _rate_limiters.setdefault(account_id, RateLimiter(calls_per_second))
+        limiter.acquire()
+    
+    clients = [ecr_client, s3_client, codedeploy_client] + ([lambda_client] if lambda_calls else [])
+    for client in clients:
+        client.meta.events.register('before-call', before_call, unique_id='hoist-sweeper-rate-limit')
+
+def run_rate_limited_target(target):
+    """Run one sweeper target with its account's rate limiter active on this thread."""
+    _sweeper_thread.account_id = target.get('accountId', 'default')
+    try:
+        return run_cleanup_target(target)
+    finally:
+        _sweeper_thread.account_id = None
 
-def get_successful_deployment_artifacts(app_name, deployment_group, retain_count):
+def get_successful_deployment_artifacts(app_name, deployment_group, retain_count, stats=None,
+                                        manifest=None, resolve_images=False):
     """
     Get ECR image tags and S3 AppSpec keys from the last N successful deployments.
     
@@ -83,184 +433,980 @@ def get_successful_deployment_artifacts(app_name, deployment_group, retain_count
     
     This function ensures we NEVER delete artifacts from the last N successful deployments,
     regardless of how many failed deployments happened in between.
+
+    Deployment details are resolved with batch_get_deployments (25 per call), so a
+    protection window of 50 deployments costs a couple of list calls and 2 batch calls.
+
+    Each deployment's image comes from its manifest record when there is one, else
+    (with resolve_images) from the version its AppSpec targets via get_function.
+    The image URI at the end of the description is only read for deployments
+    neither can resolve, e.g. ones made before the manifest existed.
     """
+    if stats is None:
+        stats = {}
     try:
         protected_artifacts = {
             'image_tags': set(),
-            'appspec_keys': set()
+            'image_digests': set(),
+            'appspec_keys': set(),
+            'lambda_versions': set()
         }
+        records = {r.get('deploymentId'): r for r in (manifest or {}).get('deployments', [])}
+        versions_complete = True
         
-        # Get deployment history
-        deployments_response = codedeploy_client.list_deployments(
-            applicationName=app_name,
-            deploymentGroupName=deployment_group,
-            includeOnlyStatuses=['Succeeded'],
-            maxItems=retain_count
+        successful_deployment_ids = list_successful_deployment_ids(
+            app_name, deployment_group, retain_count, stats
         )
-        
-        successful_deployment_ids = deployments_response.get('deployments', [])
         print(f"Found {len(successful_deployment_ids)} recent successful deployments")
         
-        # Get details for each successful deployment
-        for deployment_id in successful_deployment_ids:
-            try:
-                deployment_details = codedeploy_client.get_deployment(deploymentId=deployment_id)
-                deployment_info = deployment_details['deploymentInfo']
-                
-                # Extract image tag from deployment description
-                # Description format: "Automated deployment triggered via lambda by ECR push: {account}.dkr.ecr.{region}.amazonaws.com/{repo}:{tag}"
-                description = deployment_info.get('description', '')
-                image_tag_match = re.search(r':([^:]+)$', description)
-                if image_tag_match:
-                    image_tag = image_tag_match.group(1)
-                    protected_artifacts['image_tags'].add(image_tag)
-                    print(f"Protected image tag from deployment {deployment_id}: {image_tag}")
-                
-                # Extract AppSpec S3 key if using S3 revision
-                revision = deployment_info.get('revision', {})
-                if revision.get('revisionType') == 'S3':
-                    s3_location = revision.get('s3Location', {})
-                    appspec_key = s3_location.get('key')
-                    if appspec_key:
-                        protected_artifacts['appspec_keys'].add(appspec_key)
-                        print(f"Protected AppSpec key from deployment {deployment_id}: {appspec_key}")
-                        
-            except Exception as e:
-                print(f"Error getting details for deployment {deployment_id}: {e}")
-                continue
+        for deployment_info in batch_get_deployment_info(successful_deployment_ids, stats):
+            deployment_id = deployment_info.get('deploymentId')
+            
+            # Extract AppSpec S3 key if using S3 revision
+            revision = deployment_info.get('revision', {})
+            s3_location = revision.get('s3Location', {}) if revision.get('revisionType') == 'S3' else {}
+            appspec_key = s3_location.get('key')
+            if appspec_key:
+                protected_artifacts['appspec_keys'].add(appspec_key)
+                print(f"Protected AppSpec key from deployment {deployment_id}: {appspec_key}")
+            
+            image = None
+            if deployment_id in records:
+                record = records[deployment_id]
+                image = {'tag': record.get('imageTag'), 'digest': record.get('imageDigest'),
+                         'version': record.get('lambdaVersion')}
+            elif resolve_images and appspec_key:
+                image = resolve_deployment_image(s3_location.get('bucket'), appspec_key, stats)
+            if image is None:
+                # Legacy fallback: the deploy lambda ends the description with the image URI
+                image = parse_image_reference(deployment_info.get('description', ''))
+            
+            if image.get('tag'):
+                protected_artifacts['image_tags'].add(image['tag'])
+                print(f"Protected image tag from deployment {deployment_id}: {image['tag']}")
+            if image.get('digest'):
+                protected_artifacts['image_digests'].add(image['digest'])
+            if image.get('version'):
+                protected_artifacts['lambda_versions'].add(str(image['version']))
+            else:
+                versions_complete = False
         
-        # Convert sets to lists for JSON serialization
-        protected_artifacts['image_tags'] = list(protected_artifacts['image_tags'])
-        protected_artifacts['appspec_keys'] = list(protected_artifacts['appspec_keys'])
+        # Without every version, version cleanup reads them from the AppSpecs itself
+        if not versions_complete:
+            del protected_artifacts['lambda_versions']
         
-        return protected_artifacts
+        # Convert sets to lists for JSON serialization
+        return {name: list(values) for name, values in protected_artifacts.items()}
         
     except Exception as e:
         print(f"Error getting successful deployment artifacts: {e}")
         # Return empty protection list on error - better to over-delete than under-delete
-        return {'image_tags': [], 'appspec_keys': []}
+        return {'image_tags': [], 'image_digests': [], 'appspec_keys': []}
+
+def resolve_deployment_image(bucket_name, appspec_key, stats):
+    """
+    Image tag, digest and version of the Lambda version an AppSpec deployed.
 
-def cleanup_ecr_images(repository_name, retain_count, protected_image_tags):
-    """Clean up old ECR images, keeping only the most recent ones."""
+    Reads TargetVersion from the AppSpec and the version's ImageUri (the tag it
+    was deployed from) and ResolvedImageUri (its digest) from get_function.
+    Returns None when either cannot be read.
+    """
     try:
-        # Get all images
-        response = ecr_client.describe_images(
-            repositoryName=repository_name,
-            filter={'tagStatus': 'TAGGED'}
-        )
-        
-        images = response.get('imageDetails', [])
-        print(f"Found {len(images)} tagged images in ECR")
+        response = s3_client.get_object(Bucket=bucket_name, Key=appspec_key)
+        record_api_call(stats, 's3:GetObject')
+        properties = json.loads(response['Body'].read())['Resources'][0]['TargetService']['Properties']
         
-        if len(images) <= retain_count:
-            print(f"Only {len(images)} images found, keeping all (retain_count: {retain_count})")
-            return 0
-        
-        # Sort by push date (newest first)
-        sorted_images = sorted(images, key=lambda x: x['imagePushedAt'], reverse=True)
-        
-        # Filter out images that are protected (from successful deployments)
-        images_to_consider_deleting = []
-        images_protected = []
-        
-        for image in sorted_images[retain_count:]:  # Only consider images beyond retain_count
-            image_tags = image.get('imageTags', [])
-            is_protected = any(tag in protected_image_tags for tag in image_tags)
-            
-            if is_protected:
-                images_protected.append(image)
-                print(f"PROTECTED: Image with tags {image_tags} (successful deployment artifact)")
-            else:
-                images_to_consider_deleting.append(image)
-        
-        print(f"Keeping {retain_count} most recent images")
-        print(f"Protecting {len(images_protected)} images from successful deployments")
-        print(f"Deleting {len(images_to_consider_deleting)} old images")
+        code = lambda_client.get_function(
+            FunctionName=properties['Name'], Qualifier=str(properties['TargetVersion'])
+        )['Code']
+        record_api_call(stats, 'lambda:GetFunction')
+    except Exception as e:
+        print(f"Could not resolve the image deployed by AppSpec {appspec_key}: {e}")
+        return None
+    
+    return {
+        'tag': split_image_uri(code.get('ImageUri', '')).get('tag'),
+        'digest': split_image_uri(code.get('ResolvedImageUri', '')).get('digest'),
+        'version': str(properties['TargetVersion'])
+    }
+
+def mark_manifest_deployment_succeeded(bucket_name, function_name, deployment_id, stats, dry_run=False):
+    """
+    Mark deployment_id as succeeded in the manifest and return the updated manifest.
+
+    Returns None when there is no manifest yet or it cannot be read, so the caller
+    can fall back to the CodeDeploy history scan. With dry_run the record is only
+    marked in the returned copy, not written back.
+    """
+    def mark(manifest):
+        for record in manifest.get('deployments', []):
+            if record.get('deploymentId') == deployment_id:
+                if record.get('status') == 'Succeeded':
+                    return False
+                record['status'] = 'Succeeded'
+                record['succeededAt'] = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+                return not dry_run
+        if deployment_id:
+            print(f"Deployment {deployment_id} not found in manifest")
+        return False
+
+    try:
+        return update_deployment_manifest(bucket_name, function_name, mark, stats)
+    except Exception as e:
+        print(f"Error updating deployment manifest: {e}")
+        return None
+
+def update_deployment_manifest(bucket_name, function_name, mutate, stats):
+    """
+    Read-modify-write the manifest with S3 conditional writes.
+
+    mutate(manifest) returns True when it changed something; unchanged manifests
+    are not written back. Returns None if the manifest does not exist.
+    """
+    def change(manifest):
+        record_api_call(stats, 's3:GetObject')
+        if manifest is None:
+            print(f"No deployment manifest at s3://{bucket_name}/{manifest_key(function_name)}")
+            return None
+        if not mutate(manifest):
+            return None
+        record_api_call(stats, 's3:PutObject')
+        return manifest
+    
+    return update_json(manifest_store(s3_client, bucket_name), function_name, change,
+                       attempts=MANIFEST_WRITE_ATTEMPTS, label=f"Manifest of {function_name}")
+
+def get_manifest_protected_artifacts(manifest, retain_count):
+    """
+    Compute protected artifacts from the newest retain_count succeeded manifest records.
+
+    Returns None if the manifest holds fewer than retain_count successes (e.g. it was
+    only recently introduced), since older successes may then be missing from it.
+    """
+    if manifest is None:
+        return None
+    
+    succeeded = [r for r in manifest.get('deployments', []) if r.get('status') == 'Succeeded']
+    if len(succeeded) < retain_count:
+        print(f"Manifest has {len(succeeded)} successful deployments, need {retain_count}")
+        return None
+    
+    protected_artifacts = {'image_tags': set(), 'image_digests': set(), 'appspec_keys': set(),
+                           'lambda_versions': set()}
+    for record in succeeded[:retain_count]:
+        if record.get('imageTag'):
+            protected_artifacts['image_tags'].add(record['imageTag'])
+        if record.get('imageDigest'):
+            protected_artifacts['image_digests'].add(record['imageDigest'])
+        if record.get('appspecKey'):
+            protected_artifacts['appspec_keys'].add(record['appspecKey'])
+        if record.get('lambdaVersion'):
+            protected_artifacts['lambda_versions'].add(str(record['lambdaVersion']))
+    
+    print(f"Protecting artifacts from the last {retain_count} successful deployments in the manifest")
+    return {name: list(values) for name, values in protected_artifacts.items()}
+
+def list_successful_deployment_ids(app_name, deployment_group, retain_count, stats):
+    """Page through list_deployments until retain_count successful deployment IDs are found."""
+    deployment_ids = []
+    request = {
+        'applicationName': app_name,
+        'deploymentGroupName': deployment_group,
+        'includeOnlyStatuses': ['Succeeded']
+    }
+    
+    while len(deployment_ids) < retain_count:
+        response = codedeploy_client.list_deployments(**request)
+        record_api_call(stats, 'codedeploy:ListDeployments')
+        deployment_ids.extend(response.get('deployments', []))
         
-        deleted_count = 0
-        for image in images_to_consider_deleting:
-            try:
-                # Prepare image identifiers for deletion
-                image_ids = []
-                
-                # Add by digest
-                if 'imageDigest' in image:
-                    image_ids.append({'imageDigest': image['imageDigest']})
-                
-                # Add by tags
-                for tag in image.get('imageTags', []):
-                    image_ids.append({'imageTag': tag})
-                
-                if image_ids:
-                    print(f"Deleting image pushed at {image['imagePushedAt']} with tags {image.get('imageTags', [])}")
-                    
-                    ecr_client.batch_delete_image(
-                        repositoryName=repository_name,
-                        imageIds=image_ids
-                    )
-                    deleted_count += 1
-                    
-            except Exception as e:
-                print(f"Error deleting ECR image: {e}")
-                continue
+        next_token = response.get('nextToken')
+        if not next_token:
+            break
+        request['nextToken'] = next_token
+    
+    return deployment_ids[:retain_count]
+
+def batch_get_deployment_info(deployment_ids, stats):
+    """Resolve deployment details in batch_get_deployments chunks, newest first."""
+    deployments = []
+    for i in range(0, len(deployment_ids), CODEDEPLOY_BATCH_GET_LIMIT):
+        response = codedeploy_client.batch_get_deployments(
+            deploymentIds=deployment_ids[i:i + CODEDEPLOY_BATCH_GET_LIMIT]
+        )
+        record_api_call(stats, 'codedeploy:BatchGetDeployments')
+        deployments.extend(response.get('deploymentsInfo', []))
+    
+    return sorted(
+        deployments,
+        key=lambda d: d['createTime'].timestamp() if d.get('createTime') else 0,
+        reverse=True
+    )
+
+def parse_image_reference(description):
+    """
+    Split the image URI at the end of a deployment description into its parts.
+
+    Only used for deployments the manifest and AppSpec cannot resolve; see
+    split_image_uri for the returned dict.
+    """
+    tokens = description.split()
+    if not tokens or '/' not in tokens[-1]:
+        return {}
+    return split_image_uri(tokens[-1])
+
+def split_image_uri(image_uri):
+    """
+    Split an ECR image URI into its parts.
+
+    Handles both <registry>/<repo>:<tag> and <registry>/<repo>@sha256:<digest>
+    references, returning a dict with 'repository', 'tag' and 'digest'.
+    """
+    if not image_uri:
+        return {}
+    
+    reference = {'repository': None, 'tag': None, 'digest': None}
+    if '@' in image_uri:
+        image_uri, reference['digest'] = image_uri.split('@', 1)
+    
+    _, _, last_segment = image_uri.rpartition('/')
+    if ':' in last_segment:
+        last_segment, reference['tag'] = last_segment.split(':', 1)
+    reference['repository'] = last_segment
+    return reference
+
+def cursor_key(repository_name):
+    """S3 key of the incremental cleanup cursor for repository_name."""
+    return f"cleanup/cursors/{repository_name}.json"
+
+def load_cleanup_cursor(bucket_name, repository_name, stats):
+    """Load the incremental cleanup cursor, or None if there is none yet."""
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=cursor_key(repository_name))
+        record_api_call(stats, 's3:GetObject')
+        return json.loads(response['Body'].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            print(f"No cleanup cursor for {repository_name}, running a full reconcile")
+            return None
+        raise
+
+def save_cleanup_cursor(bucket_name, repository_name, cursor, stats):
+    """Persist the incremental cleanup cursor."""
+    s3_client.put_object(
+        Bucket=bucket_name,
+        Key=cursor_key(repository_name),
+        Body=json.dumps(cursor, separators=(',', ':')),
+        ContentType='application/json'
+    )
+    record_api_call(stats, 's3:PutObject')
+
+def cursor_needs_full_reconcile(cursor, retain_count, now, full_reconcile_hours):
+    """A missing, outdated or differently-sized cursor forces a full reconcile."""
+    if not cursor or cursor.get('schemaVersion') != CURSOR_SCHEMA_VERSION:
+        return True
+    if cursor.get('retainCount') != retain_count:
+        print(f"RETAIN_COUNT changed from {cursor.get('retainCount')} to {retain_count}, running a full reconcile")
+        return True
+    if now - cursor.get('lastFullReconcileAt', 0) >= full_reconcile_hours * 3600:
+        print(f"Last full reconcile is older than {full_reconcile_hours}h, running a full reconcile")
+        return True
+    return False
+
+def build_cleanup_cursor(ecr_window, appspec_window, manifest, retain_count, full_reconcile_at):
+    """
+    Build the cursor persisted between incremental runs.
+
+    It records the newest push seen, the retained windows and the manifest
+    high-water mark, i.e. the creation time of the newest deployment record
+    whose artifacts have been folded into the windows.
+    """
+    newest = ecr_window[0] if ecr_window else {}
+    manifest_times = [manifest_record_time(r) for r in (manifest or {}).get('deployments', [])]
+    return {
+        'schemaVersion': CURSOR_SCHEMA_VERSION,
+        'retainCount': retain_count,
+        'lastPushedAt': newest.get('pushedAt', 0),
+        'lastDigest': newest.get('digest'),
+        'manifestHighWater': max(manifest_times, default=0),
+        'lastFullReconcileAt': full_reconcile_at,
+        'retainedImages': ecr_window,
+        'retainedAppspecs': appspec_window
+    }
+
+def manifest_record_time(record):
+    """Epoch seconds of a manifest record's createdAt timestamp."""
+    created_at = record.get('createdAt')
+    if not created_at:
+        return 0
+    return datetime.strptime(created_at, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp()
+
+def run_incremental_cleanup(repository_name, bucket_name, retain_count, protected_artifacts,
+                            manifest, cursor, cleanup_results):
+    """
+    Fold artifacts deployed since the cursor into the retained windows and delete
+    whatever they push out, without listing the repository or the bucket.
+
+    New artifacts come from manifest records newer than the cursor's high-water
+    mark. Images pushed but never deployed are not seen here; the periodic full
+    reconcile picks them up. Returns the updated cursor, or None if the windows
+    could not be updated and a full reconcile should run instead.
+    """
+    high_water = cursor.get('manifestHighWater', 0)
+    new_records = [r for r in manifest.get('deployments', []) if manifest_record_time(r) > high_water]
+    print(f"Incremental cleanup: {len(new_records)} deployments since the last run")
+    
+    ecr_stats = cleanup_results['ecr_stats']
+    ecr_stats.setdefault('failures', [])
+    image_window = list(cursor.get('retainedImages', []))
+    known_digests = {entry['digest'] for entry in image_window}
+    image_ids = []
+    for record in new_records:
+        if record.get('imageDigest'):
+            if record['imageDigest'] not in known_digests:
+                image_ids.append({'imageDigest': record['imageDigest']})
+        elif record.get('imageTag'):
+            image_ids.append({'imageTag': record['imageTag']})
+    
+    try:
+        for i in range(0, len(image_ids), ECR_BATCH_DELETE_LIMIT):
+            response = ecr_client.describe_images(
+                repositoryName=repository_name,
+                imageIds=image_ids[i:i + ECR_BATCH_DELETE_LIMIT]
+            )
+            record_api_call(ecr_stats, 'ecr:DescribeImages')
+            for image in response.get('imageDetails', []):
+                if image['imageDigest'] in known_digests:
+                    continue
+                known_digests.add(image['imageDigest'])
+                image_window.append({
+                    'digest': image['imageDigest'],
+                    'pushedAt': image['imagePushedAt'].timestamp(),
+                    'tags': image.get('imageTags', [])
+                })
+    except ClientError as e:
+        print(f"Could not describe new images ({e}), falling back to a full reconcile")
+        return None
+    
+    image_window.sort(key=lambda entry: entry['pushedAt'], reverse=True)
+    protected_tags = set(protected_artifacts['image_tags'])
+    protected_digests = set(protected_artifacts.get('image_digests', []))
+    image_deletes = []
+    for entry in image_window[retain_count:]:
+        if entry['digest'] in protected_digests or any(tag in protected_tags for tag in entry['tags']):
+            print(f"PROTECTED: Image with tags {entry['tags']} (successful deployment artifact)")
+            continue
+        image_deletes.append({'imageDigest': entry['digest']})
+    del image_window[retain_count:]
+    
+    ecr_deleted = 0
+    for i in range(0, len(image_deletes), ECR_BATCH_DELETE_LIMIT):
+        ecr_deleted += delete_ecr_image_batch(repository_name, image_deletes[i:i + ECR_BATCH_DELETE_LIMIT], ecr_stats)
+    
+    appspec_stats = cleanup_results['appspec_stats']
+    appspec_stats.setdefault('failures', [])
+    appspec_window = list(cursor.get('retainedAppspecs', []))
+    known_keys = {entry['key'] for entry in appspec_window}
+    for record in new_records:
+        if record.get('appspecKey') and record['appspecKey'] not in known_keys:
+            known_keys.add(record['appspecKey'])
+            appspec_window.append({'key': record['appspecKey'], 'lastModified': manifest_record_time(record)})
+    
+    appspec_window.sort(key=lambda entry: entry['lastModified'], reverse=True)
+    protected_keys = set(protected_artifacts['appspec_keys'])
+    appspec_deletes = [entry['key'] for entry in appspec_window[retain_count:] if entry['key'] not in protected_keys]
+    del appspec_window[retain_count:]
+    
+    s3_deleted = 0
+    for i in range(0, len(appspec_deletes), S3_BATCH_DELETE_LIMIT):
+        s3_deleted += delete_appspec_batch(bucket_name, appspec_deletes[i:i + S3_BATCH_DELETE_LIMIT], appspec_stats)
+    
+    print(f"Incremental cleanup deleted {ecr_deleted} images and {s3_deleted} AppSpec files")
+    cleanup_results['ecr_images_deleted'] = ecr_deleted
+    cleanup_results['appspec_files_deleted'] = s3_deleted
+    
+    updated = build_cleanup_cursor(image_window, appspec_window, manifest, retain_count,
+                                   full_reconcile_at=cursor.get('lastFullReconcileAt', 0))
+    if not image_window:
+        updated['lastPushedAt'] = cursor.get('lastPushedAt', 0)
+        updated['lastDigest'] = cursor.get('lastDigest')
+    return updated
+
+def cleanup_ecr_images(repository_name, retain_count, protected_image_tags, stats=None,
+                       protected_image_digests=(), window=None, dry_run=False):
+    """
+    Clean up old ECR images, keeping only the most recent ones.
+
+    Streams every describe_images page into plan_ecr_cleanup, then hands the
+    plan to execute_ecr_plan. With dry_run the plan is logged and counted in
+    stats instead of executed.
+
+    If window is a list, it is filled with the retained images (newest first) so
+    incremental mode can seed its cursor.
+    """
+    if stats is None:
+        stats = {}
+    stats.setdefault('api_calls', {})
+    stats.setdefault('failures', [])
+    started_at = time.monotonic()
+
+    try:
+        plan = plan_ecr_cleanup(
+            iter_tagged_images(repository_name, stats), retain_count,
+            protected_image_tags, protected_image_digests
+        )
+        deleted_count = execute_ecr_plan(repository_name, plan, stats, dry_run=dry_run)
+
+        print(f"Found {plan['images_scanned']} tagged images in ECR")
+        print(f"Keeping {len(plan['retained'])} most recent images")
+        print(f"Protecting {plan['images_protected']} images from successful deployments")
+        print(f"Deleted {deleted_count} old images")
+
+        if window is not None:
+            window.extend(plan['retained'])
         
+        stats['images_scanned'] = plan['images_scanned']
+        stats['images_protected'] = plan['images_protected']
+        stats['images_deleted'] = deleted_count
         return deleted_count
-        
+
     except Exception as e:
         print(f"Error in ECR cleanup: {e}")
         raise
+    finally:
+        stats['duration_seconds'] = round(time.monotonic() - started_at, 3)
+
+def iter_tagged_images(repository_name, stats):
+    """Yield every tagged image in the repository, one describe_images page at a time."""
+    paginator = ecr_client.get_paginator('describe_images')
+    pages = paginator.paginate(
+        repositoryName=repository_name,
+        filter={'tagStatus': 'TAGGED'}
+    )
+    for page in pages:
+        record_api_call(stats, 'ecr:DescribeImages')
+        yield from page.get('imageDetails', [])
+
+def plan_ecr_cleanup(images, retain_count, protected_image_tags, protected_image_digests=()):
+    """
+    Decide which tagged images to delete. Makes no AWS calls.
+
+    images is any iterable of describe_images imageDetails entries, in any
+    order, and is consumed once. A min-heap holds the newest retain_count
+    images seen so far; an image pushed out of the heap can never be among the
+    newest, so only its digest is kept when it is not protected. Memory is
+    bounded by retain_count plus the delete list, not by the inventory.
+
+    Returns delete (digests, in the order decided), retained (window entries,
+    newest first), images_scanned and images_protected.
+    """
+    protected_tags = set(protected_image_tags)
+    protected_digests = set(protected_image_digests)
+    retained = []  # min-heap of (imagePushedAt, imageDigest, imageTags)
+    delete = []
+    images_scanned = 0
+    images_protected = 0
+
+    for image in images:
+        images_scanned += 1
+        entry = (image['imagePushedAt'], image['imageDigest'], image.get('imageTags', []))
+
+        # Keep the newest retain_count images; whatever falls out is old
+        if retain_count <= 0:
+            evicted = entry
+        elif len(retained) < retain_count:
+            heapq.heappush(retained, entry)
+            continue
+        else:
+            evicted = heapq.heappushpop(retained, entry)
+
+        pushed_at, digest, image_tags = evicted
+        if digest in protected_digests or any(tag in protected_tags for tag in image_tags):
+            images_protected += 1
+            print(f"PROTECTED: Image with tags {image_tags} (successful deployment artifact)")
+            continue
+        delete.append(digest)
+
+    return {
+        'delete': delete,
+        'retained': [
+            {'digest': digest, 'pushedAt': pushed_at.timestamp(), 'tags': image_tags}
+            for pushed_at, digest, image_tags in sorted(retained, reverse=True)
+        ],
+        'images_scanned': images_scanned,
+        'images_protected': images_protected
+    }
+
+def execute_ecr_plan(repository_name, plan, stats, dry_run=False):
+    """Delete the plan's digests in full batch_delete_image chunks and return the count deleted."""
+    deleted_count = 0
+    digests = plan['delete']
+    for i in range(0, len(digests), ECR_BATCH_DELETE_LIMIT):
+        batch = [{'imageDigest': digest} for digest in digests[i:i + ECR_BATCH_DELETE_LIMIT]]
+        deleted_count += delete_ecr_image_batch(repository_name, batch, stats, dry_run=dry_run)
+    return deleted_count
+
+def cleanup_untagged_images(repository_name, protected_image_digests, grace_hours, stats=None, dry_run=False):
+    """
+    Delete untagged images that no live image index references.
+
+    Lists every image in the repository, fetches the manifest of each image
+    index (multi-arch manifest list) and hands both to plan_untagged_gc. Indexes
+    are deleted before the children they referenced, since ECR refuses to delete
+    a manifest that an existing index still points to.
+    """
+    if stats is None:
+        stats = {}
+    stats.setdefault('api_calls', {})
+    stats.setdefault('failures', [])
+    started_at = time.monotonic()
 
-def cleanup_appspec_files(bucket_name, retain_count, protected_appspec_keys):
-    """Clean up old AppSpec files, keeping only the most recent ones."""
     try:
-        # List all objects in the bucket
-        response = s3_client.list_objects_v2(
-            Bucket=bucket_name,
-            Prefix='appspec-'
+        image_details = []
+        paginator = ecr_client.get_paginator('describe_images')
+        for page in paginator.paginate(repositoryName=repository_name):
+            record_api_call(stats, 'ecr:DescribeImages')
+            for image in page.get('imageDetails', []):
+                image_details.append({
+                    'imageDigest': image['imageDigest'],
+                    'imageTags': image.get('imageTags', []),
+                    'imagePushedAt': image['imagePushedAt'],
+                    'imageManifestMediaType': image.get('imageManifestMediaType')
+                })
+
+        index_digests = [
+            image['imageDigest'] for image in image_details
+            if image['imageManifestMediaType'] in IMAGE_INDEX_MEDIA_TYPES
+        ]
+        index_manifests = get_image_manifests(repository_name, index_digests, stats)
+
+        plan = plan_untagged_gc(
+            image_details, index_manifests, protected_image_digests,
+            datetime.now(timezone.utc), grace_hours * 3600
         )
-        
-        objects = response.get('Contents', [])
-        print(f"Found {len(objects)} AppSpec files in S3")
-        
-        if len(objects) <= retain_count:
-            print(f"Only {len(objects)} files found, keeping all (retain_count: {retain_count})")
-            return 0
-        
-        # Sort by last modified date (newest first)
-        sorted_objects = sorted(objects, key=lambda x: x['LastModified'], reverse=True)
-        
-        # Filter out AppSpec files that are protected (from successful deployments)
-        files_to_consider_deleting = []
-        files_protected = []
-        
-        for obj in sorted_objects[retain_count:]:  # Only consider files beyond retain_count
-            if obj['Key'] in protected_appspec_keys:
-                files_protected.append(obj)
-                print(f"PROTECTED: AppSpec file {obj['Key']} (successful deployment artifact)")
-            else:
-                files_to_consider_deleting.append(obj)
-        
-        print(f"Keeping {retain_count} most recent AppSpec files")
-        print(f"Protecting {len(files_protected)} AppSpec files from successful deployments")
-        print(f"Deleting {len(files_to_consider_deleting)} old AppSpec files")
-        
+        print(f"Found {len(image_details)} images, {len(index_digests)} image indexes, "
+              f"{len(plan['referenced'])} referenced children, {len(plan['in_grace'])} in grace period")
+
         deleted_count = 0
-        for obj in files_to_consider_deleting:
+        for digests in (plan['delete_indexes'], plan['delete_manifests']):
+            for i in range(0, len(digests), ECR_BATCH_DELETE_LIMIT):
+                batch = [{'imageDigest': digest} for digest in digests[i:i + ECR_BATCH_DELETE_LIMIT]]
+                deleted_count += delete_ecr_image_batch(repository_name, batch, stats, dry_run=dry_run)
+        print(f"Deleted {deleted_count} unreferenced untagged images")
+
+        stats['images_scanned'] = len(image_details)
+        stats['indexes_scanned'] = len(index_digests)
+        stats['children_referenced'] = len(plan['referenced'])
+        stats['images_in_grace'] = len(plan['in_grace'])
+        stats['images_deleted'] = deleted_count
+        return deleted_count
+
+    except Exception as e:
+        print(f"Error in untagged image cleanup: {e}")
+        raise
+    finally:
+        stats['duration_seconds'] = round(time.monotonic() - started_at, 3)
+
+def get_image_manifests(repository_name, image_digests, stats):
+    """Fetch and parse the manifests of the given digests with batched batch_get_image calls."""
+    manifests = {}
+    for i in range(0, len(image_digests), ECR_BATCH_GET_LIMIT):
+        response = ecr_client.batch_get_image(
+            repositoryName=repository_name,
+            imageIds=[{'imageDigest': digest} for digest in image_digests[i:i + ECR_BATCH_GET_LIMIT]],
+            acceptedMediaTypes=list(IMAGE_INDEX_MEDIA_TYPES)
+        )
+        record_api_call(stats, 'ecr:BatchGetImage')
+        for image in response.get('images', []):
+            manifests[image['imageId']['imageDigest']] = json.loads(image['imageManifest'])
+        for failure in response.get('failures', []):
+            print(f"Failed to get manifest {failure.get('imageId')}: {failure.get('failureReason')}")
+    return manifests
+
+def plan_untagged_gc(image_details, index_manifests, protected_image_digests, now, grace_seconds):
+    """
+    Decide which untagged images to delete. Makes no AWS calls.
+
+    image_details is describe_images output (imageDetails entries) for the whole
+    repository and index_manifests maps image index digests to their parsed
+    manifests (batch_get_image imageManifest). An index is live when it is
+    tagged, protected or younger than grace_seconds; every child it lists is
+    kept. Other untagged images are deleted once they are older than
+    grace_seconds, so a multi-arch push whose children land before its index
+    is not collected mid-push.
+
+    Returns delete_indexes (untagged indexes to delete first), delete_manifests,
+    referenced (children of live indexes) and in_grace, each a sorted digest list.
+    """
+    protected = set(protected_image_digests)
+    live_indexes = set()
+    untagged = []
+    for image in image_details:
+        digest = image['imageDigest']
+        in_grace = (now - image['imagePushedAt']).total_seconds() < grace_seconds
+        if image.get('imageTags') or digest in protected or in_grace:
+            # An index kept for now (even untagged) keeps its children
+            if digest in index_manifests:
+                live_indexes.add(digest)
+        if not image.get('imageTags') and digest not in protected:
+            untagged.append(image)
+
+    referenced = set()
+    for digest in live_indexes:
+        for child in index_manifests[digest].get('manifests', []):
+            referenced.add(child['digest'])
+
+    delete_indexes = []
+    delete_manifests = []
+    in_grace = []
+    for image in untagged:
+        digest = image['imageDigest']
+        if digest in referenced:
+            continue
+        if (now - image['imagePushedAt']).total_seconds() < grace_seconds:
+            in_grace.append(digest)
+        elif image.get('imageManifestMediaType') in IMAGE_INDEX_MEDIA_TYPES or digest in index_manifests:
+            delete_indexes.append(digest)
+        else:
+            delete_manifests.append(digest)
+
+    return {
+        'delete_indexes': sorted(delete_indexes),
+        'delete_manifests': sorted(delete_manifests),
+        'referenced': sorted(referenced),
+        'in_grace': sorted(in_grace)
+    }
+
+def delete_ecr_image_batch(repository_name, image_ids, stats, dry_run=False):
+    """Delete up to ECR_BATCH_DELETE_LIMIT images in one call and report per-ID failures."""
+    if dry_run:
+        print(f"DRY RUN: would delete {len(image_ids)} images from {repository_name}: "
+              f"{[image_id['imageDigest'] for image_id in image_ids]}")
+        stats['planned_deletes'] = stats.get('planned_deletes', 0) + len(image_ids)
+        return 0
+
+    print(f"Deleting batch of {len(image_ids)} images from {repository_name}")
+    response = ecr_client.batch_delete_image(
+        repositoryName=repository_name,
+        imageIds=image_ids
+    )
+    record_api_call(stats, 'ecr:BatchDeleteImage')
+
+    failures = response.get('failures', [])
+    for failure in failures:
+        print(f"Failed to delete image {failure.get('imageId')}: "
+              f"{failure.get('failureCode')} {failure.get('failureReason')}")
+        stats['failures'].append({
+            'imageId': failure.get('imageId'),
+            'failureCode': failure.get('failureCode'),
+            'failureReason': failure.get('failureReason')
+        })
+
+    return len(image_ids) - len(failures)
+
+def record_api_call(stats, operation, count=1):
+    """Count an AWS API call against the given stats dict."""
+    api_calls = stats.setdefault('api_calls', {})
+    api_calls[operation] = api_calls.get(operation, 0) + count
+
+def cleanup_lambda_versions(function_name, bucket_name, retain_count, protected_artifacts, manifest,
+                            stats=None, dry_run=False):
+    """
+    Delete old published versions of function_name.
+
+    Kept are every version an alias points or routes traffic to (the live
+    alias's current and canary target version), the versions of the protected
+    successful deployments (by recorded version, AppSpec target or image
+    digest), versions of deployments the manifest still shows in flight, and
+    the newest retain_count. Returns the number of versions deleted; stats gets
+    the counts and bytes_freed (CodeSize, which is 0 for container images).
+    """
+    if stats is None:
+        stats = {}
+    stats.setdefault('api_calls', {})
+    stats.setdefault('failures', [])
+    started_at = time.monotonic()
+
+    try:
+        protected_versions = protected_lambda_versions(
+            function_name, bucket_name, protected_artifacts, manifest, stats
+        )
+        protected_digests = protected_artifacts.get('image_digests', [])
+        if not protected_versions['deployments'] and not protected_digests:
+            # Without the successful deployments a rollback target could be deleted
+            print(f"No successful deployment versions resolved for {function_name}, skipping version cleanup")
+            stats['skipped'] = True
+            return 0
+
+        plan = plan_version_cleanup(
+            iter_function_versions(function_name, stats), retain_count,
+            protected_versions['deployments'] | protected_versions['aliases'], protected_digests
+        )
+        deleted_count = execute_version_plan(function_name, plan, stats, dry_run=dry_run)
+
+        print(f"Found {plan['versions_scanned']} published versions of {function_name}")
+        print(f"Protecting {plan['versions_protected']} versions from aliases and successful deployments")
+        print(f"Deleted {deleted_count} old versions, freeing {stats.get('bytes_freed', 0)} bytes")
+
+        stats['versions_scanned'] = plan['versions_scanned']
+        stats['versions_protected'] = plan['versions_protected']
+        stats['versions_deleted'] = deleted_count
+        return deleted_count
+
+    except Exception as e:
+        print(f"Error in Lambda version cleanup: {e}")
+        raise
+    finally:
+        stats['duration_seconds'] = round(time.monotonic() - started_at, 3)
+
+def protected_lambda_versions(function_name, bucket_name, protected_artifacts, manifest, stats):
+    """
+    Versions that must survive cleanup: {'aliases': set, 'deployments': set}.
+
+    The manifest records each deployment's version; on the CodeDeploy history
+    fallback the version is read from the protected AppSpec files instead.
+    """
+    aliases = set()
+    paginator = lambda_client.get_paginator('list_aliases')
+    for page in paginator.paginate(FunctionName=function_name):
+        record_api_call(stats, 'lambda:ListAliases')
+        for alias in page.get('Aliases', []):
+            aliases.add(alias['FunctionVersion'])
+            aliases.update(alias.get('RoutingConfig', {}).get('AdditionalVersionWeights', {}).keys())
+
+    deployments = set(protected_artifacts.get('lambda_versions', []))
+    if 'lambda_versions' not in protected_artifacts:
+        for key in protected_artifacts.get('appspec_keys', []):
             try:
-                print(f"Deleting S3 object: {obj['Key']} (modified: {obj['LastModified']})")
-                
-                s3_client.delete_object(
-                    Bucket=bucket_name,
-                    Key=obj['Key']
-                )
-                deleted_count += 1
-                
+                response = s3_client.get_object(Bucket=bucket_name, Key=key)
+                record_api_call(stats, 's3:GetObject')
+                appspec = json.loads(response['Body'].read())
+                deployments.add(str(appspec['Resources'][0]['TargetService']['Properties']['TargetVersion']))
             except Exception as e:
-                print(f"Error deleting S3 object {obj['Key']}: {e}")
+                print(f"Could not read target version from AppSpec {key}: {e}")
+
+    # A deployment still in flight may not have moved any alias yet
+    for record in (manifest or {}).get('deployments', []):
+        if record.get('status') == 'Created' and record.get('lambdaVersion'):
+            deployments.add(str(record['lambdaVersion']))
+
+    print(f"Protected versions: aliases {sorted(aliases)}, deployments {sorted(deployments)}")
+    return {'aliases': aliases, 'deployments': deployments}
+
+def iter_function_versions(function_name, stats):
+    """Yield every published version's configuration, one list_versions_by_function page at a time."""
+    paginator = lambda_client.get_paginator('list_versions_by_function')
+    for page in paginator.paginate(FunctionName=function_name):
+        record_api_call(stats, 'lambda:ListVersionsByFunction')
+        for config in page.get('Versions', []):
+            if config['Version'] != '$LATEST':
+                yield config
+
+def plan_version_cleanup(versions, retain_count, protected_versions, protected_image_digests=()):
+    """
+    Decide which published versions to delete. Makes no AWS calls.
+
+    versions is any iterable of version configurations. The newest
+    retain_count versions (by version number) are kept, as is any version in
+    protected_versions or whose CodeSha256 is a protected image digest.
+
+    Returns delete ([(version, code_size)], oldest first), versions_scanned and
+    versions_protected.
+    """
+    protected_versions = {str(version) for version in protected_versions}
+    protected_shas = {digest.split(':', 1)[-1] for digest in protected_image_digests}
+    ordered = sorted(versions, key=lambda config: int(config['Version']), reverse=True)
+
+    delete = []
+    versions_protected = 0
+    for config in ordered[max(retain_count, 0):]:
+        if config['Version'] in protected_versions or config.get('CodeSha256') in protected_shas:
+            versions_protected += 1
+            print(f"PROTECTED: Version {config['Version']} (alias or successful deployment)")
+            continue
+        delete.append((config['Version'], config.get('CodeSize', 0)))
+
+    return {
+        'delete': list(reversed(delete)),
+        'versions_scanned': len(ordered),
+        'versions_protected': versions_protected
+    }
+
+def execute_version_plan(function_name, plan, stats, dry_run=False):
+    """Delete the plan's versions one delete_function call each and return the count deleted."""
+    deleted_count = 0
+    for version, code_size in plan['delete']:
+        if dry_run:
+            print(f"DRY RUN: would delete version {version} of {function_name}")
+            stats['planned_deletes'] = stats.get('planned_deletes', 0) + 1
+            continue
+        try:
+            lambda_client.delete_function(FunctionName=function_name, Qualifier=version)
+            record_api_call(stats, 'lambda:DeleteFunction')
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code != 'ResourceNotFoundException':
+                # e.g. ResourceConflictException: an alias moved onto it since the listing
+                print(f"Failed to delete version {version}: {code}")
+                stats['failures'].append({'version': version, 'failureCode': code})
                 continue
+        deleted_count += 1
+        stats['bytes_freed'] = stats.get('bytes_freed', 0) + code_size
+    return deleted_count
+
+def cleanup_appspec_files(bucket_name, retain_count, protected_appspec_keys, stats=None,
+                          function_name=None, layout='flat', window=None, dry_run=False):
+    """
+    Clean up old AppSpec files, keeping only the most recent ones.
+
+    With the flat layout every `appspec-` key is listed and sorted. With the
+    partitioned layout (appspec/<function>/<yyyy>/<mm>/...) month partitions are
+    walked newest first and only listed and sorted until the retained window is
+    full. Every older partition, and the legacy flat keys (older than any
+    partitioned key), is deleted whole apart from protected keys, page by page
+    as it is listed. Emptied partitions drop out of later walks. If window is a
+    list, it is filled with the retained files (newest first). With dry_run
+    nothing is deleted; the batches are logged and counted in stats.
+    """
+    if stats is None:
+        stats = {}
+    stats.setdefault('api_calls', {})
+    stats.setdefault('failures', [])
+    started_at = time.monotonic()
+
+    protected_keys = set(protected_appspec_keys)
+    state = {'retained': 0, 'protected': 0, 'deleted': 0, 'seen': 0, 'pending': [], 'window': [],
+             'dry_run': dry_run}
+
+    try:
+        if layout == 'partitioned':
+            if not function_name:
+                raise ValueError("function_name is required for the partitioned AppSpec layout")
+            stats['partitions_swept'] = 0
+            stats['partitions_dropped'] = 0
+            for partition in iter_appspec_partitions(bucket_name, function_name, stats):
+                if state['retained'] < retain_count:
+                    objects = list_appspec_objects(bucket_name, partition, stats)
+                    sweep_appspec_objects(bucket_name, objects, retain_count, protected_keys, state, stats)
+                    stats['partitions_swept'] += 1
+                else:
+                    drop_appspec_prefix(bucket_name, partition, protected_keys, state, stats)
+                    stats['partitions_dropped'] += 1
+            print(f"Swept {stats['partitions_swept']} and dropped {stats['partitions_dropped']} "
+                  f"AppSpec partitions for {function_name}")
+
+        # Flat keys: the only layout, or legacy keys written before partitioning
+        if layout == 'partitioned' and state['retained'] >= retain_count:
+            drop_appspec_prefix(bucket_name, APPSPEC_FLAT_PREFIX, protected_keys, state, stats)
+        else:
+            objects = list_appspec_objects(bucket_name, APPSPEC_FLAT_PREFIX, stats)
+            sweep_appspec_objects(bucket_name, objects, retain_count, protected_keys, state, stats)
+
+        if state['pending']:
+            state['deleted'] += delete_appspec_batch(bucket_name, state['pending'], stats, dry_run=dry_run)
+            state['pending'] = []
+
+        print(f"Found {state['seen']} AppSpec files in S3")
+        print(f"Keeping {state['retained']} most recent AppSpec files")
+        print(f"Protecting {state['protected']} AppSpec files from successful deployments")
+        print(f"Deleted {state['deleted']} old AppSpec files")
+
+        if window is not None:
+            window.extend(state['window'])
         
-        return deleted_count
-        
+        stats['files_scanned'] = state['seen']
+        stats['files_protected'] = state['protected']
+        stats['files_deleted'] = state['deleted']
+        return state['deleted']
+
     except Exception as e:
         print(f"Error in S3 cleanup: {e}")
-        raise
\ No newline at end of file
+        raise
+    finally:
+        stats['duration_seconds'] = round(time.monotonic() - started_at, 3)
+
+def sweep_appspec_objects(bucket_name, objects, retain_count, protected_keys, state, stats):
+    """Apply retention to one listing, newest first, queueing deletes into full batches."""
+    for obj in sorted(objects, key=lambda x: x['LastModified'], reverse=True):
+        state['seen'] += 1
+        if state['retained'] < retain_count:
+            state['retained'] += 1
+            state['window'].append({'key': obj['Key'], 'lastModified': obj['LastModified'].timestamp()})
+            continue
+        queue_appspec_delete(bucket_name, obj['Key'], protected_keys, state, stats)
+
+def drop_appspec_prefix(bucket_name, prefix, protected_keys, state, stats):
+    """Delete everything under a prefix older than the retained window, page by page, unsorted."""
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        record_api_call(stats, 's3:ListObjectsV2')
+        for obj in page.get('Contents', []):
+            state['seen'] += 1
+            queue_appspec_delete(bucket_name, obj['Key'], protected_keys, state, stats)
+
+def queue_appspec_delete(bucket_name, key, protected_keys, state, stats):
+    """Queue key for deletion unless it is protected, flushing full batches."""
+    if key in protected_keys:
+        state['protected'] += 1
+        print(f"PROTECTED: AppSpec file {key} (successful deployment artifact)")
+        return
+
+    state['pending'].append(key)
+    if len(state['pending']) >= S3_BATCH_DELETE_LIMIT:
+        state['deleted'] += delete_appspec_batch(bucket_name, state['pending'], stats,
+                                                 dry_run=state['dry_run'])
+        state['pending'] = []
+
+def list_appspec_objects(bucket_name, prefix, stats):
+    """List every object under prefix, following continuation tokens."""
+    objects = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        record_api_call(stats, 's3:ListObjectsV2')
+        objects.extend(page.get('Contents', []))
+    return objects
+
+def iter_appspec_partitions(bucket_name, function_name, stats):
+    """
+    Yield the appspec/<function>/<yyyy>/<mm>/ prefixes that hold objects, newest
+    first. A year's months are only listed once the walk reaches that year.
+    """
+    for year in list_common_prefixes(bucket_name, f"{APPSPEC_PARTITION_ROOT}/{function_name}/", stats):
+        yield from list_common_prefixes(bucket_name, year, stats)
+
+def list_common_prefixes(bucket_name, prefix, stats):
+    """The child prefixes of prefix, newest (highest) first."""
+    children = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+        record_api_call(stats, 's3:ListObjectsV2')
+        children.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+    return sorted(children, reverse=True)
+
+def delete_appspec_batch(bucket_name, keys, stats, dry_run=False):
+    """Delete up to S3_BATCH_DELETE_LIMIT keys with one delete_objects call."""
+    if dry_run:
+        print(f"DRY RUN: would delete {len(keys)} AppSpec files from {bucket_name}: {keys}")
+        stats['planned_deletes'] = stats.get('planned_deletes', 0) + len(keys)
+        return 0
+
+    print(f"Deleting batch of {len(keys)} AppSpec files from {bucket_name}")
+    response = s3_client.delete_objects(
+        Bucket=bucket_name,
+        Delete={
+            'Objects': [{'Key': key} for key in keys],
+            'Quiet': True
+        }
+    )
+    record_api_call(stats, 's3:DeleteObjects')
+
+    errors = response.get('Errors', [])
+    for error in errors:
+        print(f"Failed to delete S3 object {error.get('Key')}: {error.get('Code')} {error.get('Message')}")
+        stats['failures'].append({
+            'key': error.get('Key'),
+            'code': error.get('Code'),
+            'message': error.get('Message')
+        })
+
+    return len(keys) - len(errors)
@@ -1,16 +1,44 @@
 import unittest
-from unittest.mock import Mock, patch, MagicMock
+from unittest.mock import ANY, Mock, patch, MagicMock
 import json
 import os
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 import sys
 
+from botocore.exceptions import ClientError
+
 # Add the current directory to the path so we can import the module
 sys.path.insert(0, os.path.dirname(__file__))
+# Shared modules Terraform packages alongside index.py
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lambda_shared'))
 
 # Import the module under test
 import index
 
+
+class FakeListObjectsPaginator:
+    """Minimal list_objects_v2 paginator honoring Prefix, Delimiter and a 1000-key page size."""
+
+    def __init__(self, objects):
+        self.objects = sorted(objects, key=lambda obj: obj['Key'])
+        self.calls = []
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None):
+        kwargs = {'Bucket': Bucket, 'Prefix': Prefix}
+        if Delimiter:
+            kwargs['Delimiter'] = Delimiter
+        self.calls.append(kwargs)
+
+        matching = [obj for obj in self.objects if obj['Key'].startswith(Prefix)]
+        if Delimiter:
+            prefixes = sorted({
+                Prefix + obj['Key'][len(Prefix):].split(Delimiter)[0] + Delimiter
+                for obj in matching if Delimiter in obj['Key'][len(Prefix):]
+            })
+            return [{'CommonPrefixes': [{'Prefix': prefix} for prefix in prefixes]}]
+        return [{'Contents': matching[i:i + 1000]} for i in range(0, max(len(matching), 1), 1000)]
+
+
 class TestCleanupLambda(unittest.TestCase):
     def setUp(self):
         """Set up test fixtures."""
@@ -29,15 +57,18 @@ class TestCleanupLambda(unittest.TestCase):
         self.mock_ecr = Mock()
         self.mock_s3 = Mock()
         self.mock_codedeploy = Mock()
+        self.mock_lambda = Mock()
         
         # Patch boto3 clients
         self.ecr_patcher = patch('index.ecr_client', self.mock_ecr)
         self.s3_patcher = patch('index.s3_client', self.mock_s3)
         self.codedeploy_patcher = patch('index.codedeploy_client', self.mock_codedeploy)
+        self.lambda_patcher = patch('index.lambda_client', self.mock_lambda)
         
         self.ecr_patcher.start()
         self.s3_patcher.start()
         self.codedeploy_patcher.start()
+        self.lambda_patcher.start()
 
     def tearDown(self):
         """Clean up after tests."""
@@ -45,6 +76,7 @@ class TestCleanupLambda(unittest.TestCase):
         self.ecr_patcher.stop()
         self.s3_patcher.stop()
         self.codedeploy_patcher.stop()
+        self.lambda_patcher.stop()
 
     def test_get_successful_deployment_artifacts_success(self):
         """Test successful extraction of deployment artifacts."""
@@ -56,44 +88,38 @@ class TestCleanupLambda(unittest.TestCase):
         # Mock deployment details
         deployment_details = [
             {
-                'deploymentInfo': {
-                    'description': 'Automated deployment triggered via lambda by ECR push: 123456789.dkr.ecr.us-east-1.amazonaws.com/test-repo:v1.0.0',
-                    'revision': {
-                        'revisionType': 'S3',
-                        's3Location': {
-                            'bucket': 'test-bucket',
-                            'key': 'appspec-v1.0.0-20240101-120000.json'
-                        }
+                'description': 'Automated deployment triggered via lambda by ECR push: 123456789.dkr.ecr.us-east-1.amazonaws.com/test-repo:v1.0.0',
+                'revision': {
+                    'revisionType': 'S3',
+                    's3Location': {
+                        'bucket': 'test-bucket',
+                        'key': 'appspec-v1.0.0-20240101-120000.json'
                     }
                 }
             },
             {
-                'deploymentInfo': {
-                    'description': 'Automated deployment triggered via lambda by ECR push: 123456789.dkr.ecr.us-east-1.amazonaws.com/test-repo:v2.0.0',
-                    'revision': {
-                        'revisionType': 'S3',
-                        's3Location': {
-                            'bucket': 'test-bucket', 
-                            'key': 'appspec-v2.0.0-20240102-120000.json'
-                        }
+                'description': 'Automated deployment triggered via lambda by ECR push: 123456789.dkr.ecr.us-east-1.amazonaws.com/test-repo:v2.0.0',
+                'revision': {
+                    'revisionType': 'S3',
+                    's3Location': {
+                        'bucket': 'test-bucket', 
+                        'key': 'appspec-v2.0.0-20240102-120000.json'
                     }
                 }
             },
             {
-                'deploymentInfo': {
-                    'description': 'Automated deployment triggered via lambda by ECR push: 123456789.dkr.ecr.us-east-1.amazonaws.com/test-repo:v3.0.0',
-                    'revision': {
-                        'revisionType': 'S3',
-                        's3Location': {
-                            'bucket': 'test-bucket',
-                            'key': 'appspec-v3.0.0-20240103-120000.json'
-                        }
+                'description': 'Automated deployment triggered via lambda by ECR push: 123456789.dkr.ecr.us-east-1.amazonaws.com/test-repo:v3.0.0',
+                'revision': {
+                    'revisionType': 'S3',
+                    's3Location': {
+                        'bucket': 'test-bucket',
+                        'key': 'appspec-v3.0.0-20240103-120000.json'
                     }
                 }
             }
         ]
         
-        self.mock_codedeploy.get_deployment.side_effect = deployment_details
+        self.mock_codedeploy.batch_get_deployments.return_value = {'deploymentsInfo': deployment_details}
         
         # Call the function
         result = index.get_successful_deployment_artifacts('test-app', 'test-group', 3)
@@ -115,10 +141,58 @@ class TestCleanupLambda(unittest.TestCase):
         self.mock_codedeploy.list_deployments.assert_called_once_with(
             applicationName='test-app',
             deploymentGroupName='test-group',
-            includeOnlyStatuses=['Succeeded'],
-            maxItems=3
+            includeOnlyStatuses=['Succeeded']
+        )
+        self.mock_codedeploy.batch_get_deployments.assert_called_once_with(
+            deploymentIds=['deploy-1', 'deploy-2', 'deploy-3']
+        )
+        self.mock_codedeploy.get_deployment.assert_not_called()
+
+    def test_get_successful_deployment_artifacts_paginates_and_batches(self):
+        """Test a deep protection window pages list_deployments and batches lookups by 25."""
+        self.mock_codedeploy.list_deployments.side_effect = [
+            {'deployments': [f'd-{i}' for i in range(0, 40)], 'nextToken': 'page-2'},
+            {'deployments': [f'd-{i}' for i in range(40, 80)], 'nextToken': 'page-3'},
+        ]
+        self.mock_codedeploy.batch_get_deployments.side_effect = lambda deploymentIds: {
+            'deploymentsInfo': [
+                {
+                    'deploymentId': deployment_id,
+                    'description': f'Automated deployment triggered via lambda by ECR push: '
+                                   f'123456789.dkr.ecr.us-east-1.amazonaws.com/test-repo:{deployment_id}',
+                    'revision': {'revisionType': 'S3', 's3Location': {'key': f'appspec-{deployment_id}.json'}}
+                }
+                for deployment_id in deploymentIds
+            ]
+        }
+        
+        stats = {}
+        result = index.get_successful_deployment_artifacts('test-app', 'test-group', 60, stats=stats)
+        
+        self.assertEqual(len(result['image_tags']), 60)
+        self.assertIn('d-59', result['image_tags'])
+        self.assertNotIn('d-60', result['image_tags'])
+        self.assertEqual(self.mock_codedeploy.list_deployments.call_count, 2)
+        self.assertEqual(self.mock_codedeploy.list_deployments.call_args_list[1][1]['nextToken'], 'page-2')
+        batch_sizes = [len(call[1]['deploymentIds'])
+                       for call in self.mock_codedeploy.batch_get_deployments.call_args_list]
+        self.assertEqual(batch_sizes, [25, 25, 10])
+        self.assertEqual(stats['api_calls'], {
+            'codedeploy:ListDeployments': 2,
+            'codedeploy:BatchGetDeployments': 3
+        })
+
+    def test_parse_image_reference(self):
+        """Test image references are split into repository, tag and digest."""
+        self.assertEqual(
+            index.parse_image_reference('ECR push: 123.dkr.ecr.us-east-1.amazonaws.com/test-repo:v1.0.0'),
+            {'repository': 'test-repo', 'tag': 'v1.0.0', 'digest': None}
+        )
+        self.assertEqual(
+            index.parse_image_reference('ECR push: 123.dkr.ecr.us-east-1.amazonaws.com/test-repo@sha256:abc'),
+            {'repository': 'test-repo', 'tag': None, 'digest': 'sha256:abc'}
         )
-        self.assertEqual(self.mock_codedeploy.get_deployment.call_count, 3)
+        self.assertEqual(index.parse_image_reference('Manual deployment'), {})
 
     def test_get_successful_deployment_artifacts_no_deployments(self):
         """Test when no successful deployments are found."""
@@ -126,9 +200,41 @@ class TestCleanupLambda(unittest.TestCase):
         
         result = index.get_successful_deployment_artifacts('test-app', 'test-group', 3)
         
-        expected = {'image_tags': [], 'appspec_keys': []}
+        expected = {'image_tags': [], 'image_digests': [], 'appspec_keys': [], 'lambda_versions': []}
         self.assertEqual(result, expected)
 
+    def test_get_successful_deployment_artifacts_prefers_structured_images(self):
+        """Test images come from manifest records, then AppSpec versions, and descriptions last."""
+        self.mock_codedeploy.list_deployments.return_value = {'deployments': ['d-1', 'd-2', 'd-3']}
+        self.mock_codedeploy.batch_get_deployments.return_value = {'deploymentsInfo': [
+            {'deploymentId': deployment_id, 'description': f'Rollback to 123.dkr.ecr.us-east-1.amazonaws.com/repo:{tag}',
+             'revision': {'revisionType': 'S3', 's3Location': {'bucket': 'test-bucket', 'key': key}}}
+            for deployment_id, tag, key in [('d-1', 'wrong-1', 'appspec-1.json'), ('d-2', 'wrong-2', 'appspec-2.json'),
+                                            ('d-3', 'legacy', 'appspec-3.json')]
+        ]}
+        manifest = {'deployments': [{'deploymentId': 'd-1', 'imageTag': 'v1', 'imageDigest': 'sha256:one',
+                                     'lambdaVersion': '7', 'status': 'Succeeded'}]}
+        appspec = Mock()
+        appspec.read.return_value = json.dumps({'Resources': [{'TargetService': {'Properties': {
+            'Name': 'fn', 'TargetVersion': '6'}}}]})
+        self.mock_s3.get_object.side_effect = [
+            {'Body': appspec}, ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        ]
+        mock_lambda = Mock()
+        mock_lambda.get_function.return_value = {'Code': {
+            'ImageUri': '123.dkr.ecr.us-east-1.amazonaws.com/repo:v2',
+            'ResolvedImageUri': '123.dkr.ecr.us-east-1.amazonaws.com/repo@sha256:two'}}
+
+        with patch('index.lambda_client', mock_lambda):
+            result = index.get_successful_deployment_artifacts('test-app', 'test-group', 3, manifest=manifest,
+                                                               resolve_images=True)
+
+        self.assertEqual(set(result['image_tags']), {'v1', 'v2', 'legacy'})
+        self.assertEqual(set(result['image_digests']), {'sha256:one', 'sha256:two'})
+        # d-3's version is unknown, so version cleanup reads the AppSpecs itself
+        self.assertNotIn('lambda_versions', result)
+        mock_lambda.get_function.assert_called_once_with(FunctionName='fn', Qualifier='6')
+
     def test_get_successful_deployment_artifacts_error_handling(self):
         """Test error handling in get_successful_deployment_artifacts."""
         self.mock_codedeploy.list_deployments.side_effect = Exception("API Error")
@@ -136,9 +242,147 @@ class TestCleanupLambda(unittest.TestCase):
         result = index.get_successful_deployment_artifacts('test-app', 'test-group', 3)
         
         # Should return empty lists on error
-        expected = {'image_tags': [], 'appspec_keys': []}
+        expected = {'image_tags': [], 'image_digests': [], 'appspec_keys': []}
         self.assertEqual(result, expected)
 
+    def _manifest_response(self, deployments, etag='"etag-1"'):
+        """Build a get_object response for a deployment manifest."""
+        body = Mock()
+        body.read.return_value = json.dumps({
+            'schemaVersion': 1,
+            'functionName': 'test-function',
+            'deployments': deployments
+        }).encode('utf-8')
+        return {'Body': body, 'ETag': etag}
+
+    def test_mark_manifest_deployment_succeeded_and_protect(self):
+        """Test the success event marks the manifest record and protection comes from it."""
+        deployments = [
+            {'deploymentId': 'd-4', 'imageTag': 'v4', 'imageDigest': 'sha256:4',
+             'appspecKey': 'appspec-4.json', 'lambdaVersion': '4', 'status': 'Created'},
+            {'deploymentId': 'd-3', 'imageTag': 'v3', 'imageDigest': 'sha256:3',
+             'appspecKey': 'appspec-3.json', 'lambdaVersion': '3', 'status': 'Created'},
+            {'deploymentId': 'd-2', 'imageTag': 'v2', 'imageDigest': 'sha256:2',
+             'appspecKey': 'appspec-2.json', 'lambdaVersion': '2', 'status': 'Succeeded'},
+            {'deploymentId': 'd-1', 'imageTag': 'v1', 'imageDigest': 'sha256:1',
+             'appspecKey': 'appspec-1.json', 'lambdaVersion': '1', 'status': 'Succeeded'},
+        ]
+        self.mock_s3.get_object.return_value = self._manifest_response(deployments)
+        
+        stats = {}
+        manifest = index.mark_manifest_deployment_succeeded('test-bucket', 'test-function', 'd-4', stats)
+        
+        put_kwargs = self.mock_s3.put_object.call_args[1]
+        self.assertEqual(put_kwargs['Key'], 'manifests/test-function.json')
+        self.assertEqual(put_kwargs['IfMatch'], '"etag-1"')
+        written = json.loads(put_kwargs['Body'])
+        self.assertEqual(written['deployments'][0]['status'], 'Succeeded')
+        self.assertEqual(stats['api_calls'], {'s3:GetObject': 1, 's3:PutObject': 1})
+        
+        protected = index.get_manifest_protected_artifacts(manifest, 3)
+        self.assertEqual(set(protected['image_tags']), {'v4', 'v2', 'v1'})
+        self.assertEqual(set(protected['image_digests']), {'sha256:4', 'sha256:2', 'sha256:1'})
+        self.assertEqual(set(protected['appspec_keys']), {'appspec-4.json', 'appspec-2.json', 'appspec-1.json'})
+        self.assertEqual(set(protected['lambda_versions']), {'4', '2', '1'})
+        
+        # Too few successes in the manifest means fall back to CodeDeploy history
+        self.assertIsNone(index.get_manifest_protected_artifacts(manifest, 4))
+
+    def test_mark_manifest_deployment_succeeded_retries_on_conflict(self):
+        """Test a concurrent manifest write is retried with the fresh ETag."""
+        deployments = [{'deploymentId': 'd-1', 'status': 'Created'}]
+        self.mock_s3.get_object.side_effect = [
+            self._manifest_response(deployments, etag='"etag-1"'),
+            self._manifest_response(deployments, etag='"etag-2"'),
+        ]
+        self.mock_s3.put_object.side_effect = [
+            ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject'),
+            {}
+        ]
+        
+        manifest = index.mark_manifest_deployment_succeeded('test-bucket', 'test-function', 'd-1', {})
+        
+        self.assertEqual(manifest['deployments'][0]['status'], 'Succeeded')
+        self.assertEqual(self.mock_s3.put_object.call_args_list[1][1]['IfMatch'], '"etag-2"')
+
+    def test_mark_manifest_deployment_succeeded_without_manifest(self):
+        """Test a missing manifest returns None so cleanup scans CodeDeploy history."""
+        self.mock_s3.get_object.side_effect = ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        
+        result = index.mark_manifest_deployment_succeeded('test-bucket', 'test-function', 'd-1', {})
+        
+        self.assertIsNone(result)
+        self.mock_s3.put_object.assert_not_called()
+
+    def test_cursor_needs_full_reconcile(self):
+        """Test when incremental mode falls back to a full reconcile."""
+        now = datetime(2024, 1, 2, tzinfo=timezone.utc).timestamp()
+        cursor = {
+            'schemaVersion': index.CURSOR_SCHEMA_VERSION,
+            'retainCount': 10,
+            'lastFullReconcileAt': now - 3600
+        }
+        self.assertFalse(index.cursor_needs_full_reconcile(cursor, 10, now, 24))
+        self.assertTrue(index.cursor_needs_full_reconcile(None, 10, now, 24))
+        self.assertTrue(index.cursor_needs_full_reconcile(cursor, 5, now, 24))
+        self.assertTrue(index.cursor_needs_full_reconcile(cursor, 10, now + 86400, 24))
+
+    def test_run_incremental_cleanup(self):
+        """Test incremental cleanup only describes new images and deletes what leaves the window."""
+        day = lambda d: datetime(2024, 1, d, tzinfo=timezone.utc).timestamp()
+        cursor = {
+            'schemaVersion': index.CURSOR_SCHEMA_VERSION,
+            'retainCount': 3,
+            'manifestHighWater': day(3),
+            'lastFullReconcileAt': day(1),
+            'retainedImages': [
+                {'digest': 'sha256:3', 'pushedAt': day(3), 'tags': ['v3']},
+                {'digest': 'sha256:2', 'pushedAt': day(2), 'tags': ['v2']},
+                {'digest': 'sha256:1', 'pushedAt': day(1), 'tags': ['v1']},
+            ],
+            'retainedAppspecs': [
+                {'key': 'appspec-3.json', 'lastModified': day(3)},
+                {'key': 'appspec-2.json', 'lastModified': day(2)},
+                {'key': 'appspec-1.json', 'lastModified': day(1)},
+            ]
+        }
+        manifest = {'deployments': [
+            {'deploymentId': 'd-5', 'imageTag': 'v5', 'imageDigest': 'sha256:5',
+             'appspecKey': 'appspec-5.json', 'createdAt': '2024-01-05T00:00:00Z', 'status': 'Succeeded'},
+            {'deploymentId': 'd-4', 'imageTag': 'v4', 'imageDigest': 'sha256:4',
+             'appspecKey': 'appspec-4.json', 'createdAt': '2024-01-04T00:00:00Z', 'status': 'Created'},
+            {'deploymentId': 'd-3', 'imageTag': 'v3', 'imageDigest': 'sha256:3',
+             'appspecKey': 'appspec-3.json', 'createdAt': '2024-01-03T00:00:00Z', 'status': 'Succeeded'},
+        ]}
+        self.mock_ecr.describe_images.return_value = {'imageDetails': [
+            {'imageDigest': 'sha256:5', 'imageTags': ['v5'], 'imagePushedAt': datetime(2024, 1, 5, tzinfo=timezone.utc)},
+            {'imageDigest': 'sha256:4', 'imageTags': ['v4'], 'imagePushedAt': datetime(2024, 1, 4, tzinfo=timezone.utc)},
+        ]}
+        self.mock_ecr.batch_delete_image.return_value = {'failures': []}
+        self.mock_s3.delete_objects.return_value = {}
+        results = {'ecr_stats': {}, 'appspec_stats': {}}
+        protected = {'image_tags': ['v1'], 'image_digests': [], 'appspec_keys': []}
+        
+        updated = index.run_incremental_cleanup('test-repo', 'test-bucket', 3, protected, manifest, cursor, results)
+        
+        self.mock_ecr.describe_images.assert_called_once_with(
+            repositoryName='test-repo',
+            imageIds=[{'imageDigest': 'sha256:5'}, {'imageDigest': 'sha256:4'}]
+        )
+        self.mock_ecr.get_paginator.assert_not_called()
+        self.mock_s3.get_paginator.assert_not_called()
+        self.assertEqual(self.mock_ecr.batch_delete_image.call_args[1]['imageIds'], [{'imageDigest': 'sha256:2'}])
+        self.assertEqual(
+            self.mock_s3.delete_objects.call_args[1]['Delete']['Objects'],
+            [{'Key': 'appspec-2.json'}, {'Key': 'appspec-1.json'}]
+        )
+        self.assertEqual(results['ecr_images_deleted'], 1)
+        self.assertEqual(results['appspec_files_deleted'], 2)
+        self.assertEqual([entry['digest'] for entry in updated['retainedImages']], ['sha256:5', 'sha256:4', 'sha256:3'])
+        self.assertEqual(updated['lastDigest'], 'sha256:5')
+        self.assertEqual(updated['manifestHighWater'], day(5))
+        self.assertEqual(updated['lastFullReconcileAt'], day(1))
+
     def test_cleanup_ecr_images_with_protection(self):
         """Test ECR cleanup with protected images."""
         # Create test images (newest first)
@@ -149,9 +393,11 @@ class TestCleanupLambda(unittest.TestCase):
                 'imageDigest': f'sha256:digest{i+1}',
                 'imagePushedAt': datetime(2024, 1, i+1, tzinfo=timezone.utc)
             })
+        digest_to_tag = {image['imageDigest']: image['imageTags'][0] for image in test_images}
         
-        # Mock ECR response
-        self.mock_ecr.describe_images.return_value = {'imageDetails': test_images}
+        # Mock ECR paginated response
+        self.mock_ecr.get_paginator.return_value.paginate.return_value = [{'imageDetails': test_images}]
+        self.mock_ecr.batch_delete_image.return_value = {'imageIds': [], 'failures': []}
         
         # Protect the last 3 successful deployment images
         protected_tags = ['v1.0.0', 'v5.0.0', 'v8.0.0']  # Scattered throughout history
@@ -171,8 +417,7 @@ class TestCleanupLambda(unittest.TestCase):
         for call in delete_calls:
             args, kwargs = call
             for image_id in kwargs['imageIds']:
-                if 'imageTag' in image_id:
-                    deleted_tags.append(image_id['imageTag'])
+                deleted_tags.append(digest_to_tag[image_id['imageDigest']])
         
         # v1.0.0 should be protected, others should be deleted
         self.assertNotIn('v1.0.0', deleted_tags)  # Protected
@@ -183,6 +428,127 @@ class TestCleanupLambda(unittest.TestCase):
         self.assertIn('v4.0.0', deleted_tags)
         self.assertIn('v3.0.0', deleted_tags)
         self.assertIn('v2.0.0', deleted_tags)
+        self.assertEqual(result, 3)
+
+    def test_cleanup_ecr_images_paginates_and_batches_deletes(self):
+        """Test ECR cleanup walks every page and deletes in chunks of 100."""
+        test_images = []
+        for i in range(260):
+            test_images.append({
+                'imageTags': [f'build-{i}'],
+                'imageDigest': f'sha256:digest{i}',
+                'imagePushedAt': datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=i)
+            })
+        # Pages are not ordered by push date
+        shuffled = list(reversed(test_images[:130])) + test_images[130:]
+        pages = [{'imageDetails': shuffled[i:i + 100]} for i in range(0, 260, 100)]
+        self.mock_ecr.get_paginator.return_value.paginate.return_value = pages
+        self.mock_ecr.batch_delete_image.return_value = {'imageIds': [], 'failures': []}
+        
+        stats = {}
+        result = index.cleanup_ecr_images('test-repo', 10, [], stats=stats)
+        
+        batch_sizes = [len(call[1]['imageIds']) for call in self.mock_ecr.batch_delete_image.call_args_list]
+        self.assertEqual(batch_sizes, [100, 100, 50])
+        
+        deleted = {image_id['imageDigest'] for call in self.mock_ecr.batch_delete_image.call_args_list
+                   for image_id in call[1]['imageIds']}
+        newest = {image['imageDigest'] for image in test_images[-10:]}
+        self.assertEqual(len(deleted), 250)
+        self.assertFalse(deleted & newest)
+        
+        self.assertEqual(result, 250)
+        self.assertEqual(stats['images_scanned'], 260)
+        self.assertEqual(stats['api_calls'], {'ecr:DescribeImages': 3, 'ecr:BatchDeleteImage': 3})
+        self.assertIn('duration_seconds', stats)
+
+    def test_cleanup_ecr_images_reports_batch_failures(self):
+        """Test per-ID failures from batch_delete_image are reported."""
+        test_images = []
+        for i in range(5):
+            test_images.append({
+                'imageTags': [f'v{i}'],
+                'imageDigest': f'sha256:digest{i}',
+                'imagePushedAt': datetime(2024, 1, i+1, tzinfo=timezone.utc)
+            })
+        self.mock_ecr.get_paginator.return_value.paginate.return_value = [{'imageDetails': test_images}]
+        self.mock_ecr.batch_delete_image.return_value = {
+            'imageIds': [{'imageDigest': 'sha256:digest0'}],
+            'failures': [{
+                'imageId': {'imageDigest': 'sha256:digest1'},
+                'failureCode': 'ImageReferencedByManifestList',
+                'failureReason': 'Requested image referenced by manifest list'
+            }]
+        }
+        
+        stats = {}
+        result = index.cleanup_ecr_images('test-repo', 3, [], stats=stats)
+        
+        self.assertEqual(result, 1)
+        self.assertEqual(len(stats['failures']), 1)
+        self.assertEqual(stats['failures'][0]['imageId'], {'imageDigest': 'sha256:digest1'})
+        self.assertEqual(stats['failures'][0]['failureCode'], 'ImageReferencedByManifestList')
+
+    def test_plan_untagged_gc(self):
+        """Test the untagged GC plan keeps children of live indexes and honours the grace period."""
+        now = datetime(2024, 2, 1, tzinfo=timezone.utc)
+        old = now - timedelta(days=7)
+        index_type = 'application/vnd.oci.image.index.v1+json'
+        manifest_type = 'application/vnd.oci.image.manifest.v1+json'
+        image_details = [
+            # Tagged multi-arch index and its two platform children
+            {'imageDigest': 'sha256:idx-live', 'imageTags': ['v2'], 'imagePushedAt': old,
+             'imageManifestMediaType': index_type},
+            {'imageDigest': 'sha256:amd64-live', 'imagePushedAt': old, 'imageManifestMediaType': manifest_type},
+            {'imageDigest': 'sha256:arm64-live', 'imagePushedAt': old, 'imageManifestMediaType': manifest_type},
+            # Superseded untagged index; one child is shared with the live index
+            {'imageDigest': 'sha256:idx-old', 'imagePushedAt': old, 'imageManifestMediaType': index_type},
+            {'imageDigest': 'sha256:amd64-old', 'imagePushedAt': old, 'imageManifestMediaType': manifest_type},
+            # Protected untagged index keeps its child
+            {'imageDigest': 'sha256:idx-protected', 'imagePushedAt': old, 'imageManifestMediaType': index_type},
+            {'imageDigest': 'sha256:amd64-protected', 'imagePushedAt': old, 'imageManifestMediaType': manifest_type},
+            # Superseded single-arch push, and one still inside the grace period
+            {'imageDigest': 'sha256:orphan', 'imagePushedAt': old, 'imageManifestMediaType': manifest_type},
+            {'imageDigest': 'sha256:fresh', 'imagePushedAt': now - timedelta(hours=1),
+             'imageManifestMediaType': manifest_type}
+        ]
+        index_manifests = {
+            'sha256:idx-live': {'manifests': [{'digest': 'sha256:amd64-live'}, {'digest': 'sha256:arm64-live'}]},
+            'sha256:idx-old': {'manifests': [{'digest': 'sha256:amd64-old'}, {'digest': 'sha256:arm64-live'}]},
+            'sha256:idx-protected': {'manifests': [{'digest': 'sha256:amd64-protected'}]}
+        }
+        
+        plan = index.plan_untagged_gc(image_details, index_manifests, ['sha256:idx-protected'], now, 24 * 3600)
+        
+        self.assertEqual(plan['delete_indexes'], ['sha256:idx-old'])
+        self.assertEqual(plan['delete_manifests'], ['sha256:amd64-old', 'sha256:orphan'])
+        self.assertEqual(plan['referenced'], ['sha256:amd64-live', 'sha256:amd64-protected', 'sha256:arm64-live'])
+        self.assertEqual(plan['in_grace'], ['sha256:fresh'])
+
+    def test_cleanup_untagged_images_deletes_indexes_before_children(self):
+        """Test untagged GC fetches index manifests and deletes indexes first."""
+        pushed_at = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        index_type = 'application/vnd.docker.distribution.manifest.list.v2+json'
+        self.mock_ecr.get_paginator.return_value.paginate.return_value = [
+            {'imageDetails': [
+                {'imageDigest': 'sha256:idx-old', 'imagePushedAt': pushed_at, 'imageManifestMediaType': index_type},
+                {'imageDigest': 'sha256:child-old', 'imagePushedAt': pushed_at}
+            ]}
+        ]
+        self.mock_ecr.batch_get_image.return_value = {'images': [{
+            'imageId': {'imageDigest': 'sha256:idx-old'},
+            'imageManifest': json.dumps({'manifests': [{'digest': 'sha256:child-old'}]})
+        }]}
+        self.mock_ecr.batch_delete_image.return_value = {'failures': []}
+        
+        stats = {}
+        deleted = index.cleanup_untagged_images('test-repo', [], 24, stats=stats)
+        
+        self.assertEqual(deleted, 2)
+        self.mock_ecr.get_paginator.return_value.paginate.assert_called_once_with(repositoryName='test-repo')
+        deleted_batches = [c[1]['imageIds'] for c in self.mock_ecr.batch_delete_image.call_args_list]
+        self.assertEqual(deleted_batches, [[{'imageDigest': 'sha256:idx-old'}], [{'imageDigest': 'sha256:child-old'}]])
+        self.assertEqual(stats['api_calls']['ecr:BatchGetImage'], 1)
 
     def test_cleanup_appspec_files_with_protection(self):
         """Test S3 AppSpec cleanup with protected files."""
@@ -194,8 +560,9 @@ class TestCleanupLambda(unittest.TestCase):
                 'LastModified': datetime(2024, 1, i+1, tzinfo=timezone.utc)
             })
         
-        # Mock S3 response
-        self.mock_s3.list_objects_v2.return_value = {'Contents': test_objects}
+        # Mock S3 paginated response
+        self.mock_s3.get_paginator.return_value = FakeListObjectsPaginator(test_objects)
+        self.mock_s3.delete_objects.return_value = {}
         
         # Protect specific AppSpec files
         protected_keys = [
@@ -207,9 +574,9 @@ class TestCleanupLambda(unittest.TestCase):
         # Call cleanup (retain 10, so normally would delete files 11-15)
         result = index.cleanup_appspec_files('test-bucket', 10, protected_keys)
         
-        # Verify delete_object calls
-        delete_calls = self.mock_s3.delete_object.call_args_list
-        deleted_keys = [call[1]['Key'] for call in delete_calls]
+        # Verify delete_objects calls
+        delete_calls = self.mock_s3.delete_objects.call_args_list
+        deleted_keys = [obj['Key'] for call in delete_calls for obj in call[1]['Delete']['Objects']]
         
         # Protected files should not be deleted
         for protected_key in protected_keys:
@@ -219,6 +586,92 @@ class TestCleanupLambda(unittest.TestCase):
         self.assertIn('appspec-v4.0.0-20240101-120000.json', deleted_keys)
         self.assertIn('appspec-v3.0.0-20240101-120000.json', deleted_keys)
         self.assertIn('appspec-v2.0.0-20240101-120000.json', deleted_keys)
+        self.assertEqual(len(delete_calls), 1)
+        self.assertEqual(result, 3)
+
+    def test_cleanup_appspec_files_paginates_and_batches_deletes(self):
+        """Test AppSpec cleanup sees more than 1000 keys and deletes in 1000-key batches."""
+        base = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        test_objects = [
+            {'Key': f'appspec-app-{i}-20240101-120000.json', 'LastModified': base + timedelta(minutes=i)}
+            for i in range(2510)
+        ]
+        self.mock_s3.get_paginator.return_value = FakeListObjectsPaginator(test_objects)
+        self.mock_s3.delete_objects.return_value = {
+            'Errors': [{'Key': 'appspec-app-0-20240101-120000.json', 'Code': 'AccessDenied', 'Message': 'Access Denied'}]
+        }
+        
+        stats = {}
+        result = index.cleanup_appspec_files('test-bucket', 10, [], stats=stats)
+        
+        batch_sizes = [len(call[1]['Delete']['Objects']) for call in self.mock_s3.delete_objects.call_args_list]
+        self.assertEqual(batch_sizes, [1000, 1000, 500])
+        self.assertEqual(result, 2497)
+        self.assertEqual(stats['files_scanned'], 2510)
+        self.assertEqual(stats['api_calls']['s3:ListObjectsV2'], 3)
+        self.assertEqual(stats['api_calls']['s3:DeleteObjects'], 3)
+        self.assertEqual(stats['failures'][0]['code'], 'AccessDenied')
+
+    def test_cleanup_appspec_files_partitioned_layout(self):
+        """Test partitioned layout walks month partitions newest first and sweeps legacy keys."""
+        test_objects = [
+            {'Key': 'appspec/fn/2024/02/appspec-fn-5-20240202-120000.json',
+             'LastModified': datetime(2024, 2, 2, tzinfo=timezone.utc)},
+            {'Key': 'appspec/fn/2024/02/appspec-fn-4-20240201-120000.json',
+             'LastModified': datetime(2024, 2, 1, tzinfo=timezone.utc)},
+            {'Key': 'appspec/fn/2024/01/appspec-fn-3-20240131-120000.json',
+             'LastModified': datetime(2024, 1, 31, tzinfo=timezone.utc)},
+            {'Key': 'appspec/fn/2023/12/appspec-fn-2-20231231-120000.json',
+             'LastModified': datetime(2023, 12, 31, tzinfo=timezone.utc)},
+            {'Key': 'appspec-fn-1-20231101-120000.json',
+             'LastModified': datetime(2023, 11, 1, tzinfo=timezone.utc)},
+        ]
+        paginator = FakeListObjectsPaginator(test_objects)
+        self.mock_s3.get_paginator.return_value = paginator
+        self.mock_s3.delete_objects.return_value = {}
+        
+        stats = {}
+        result = index.cleanup_appspec_files(
+            'test-bucket', 2, ['appspec/fn/2023/12/appspec-fn-2-20231231-120000.json'],
+            stats=stats, function_name='fn', layout='partitioned'
+        )
+        
+        deleted_keys = [obj['Key'] for call in self.mock_s3.delete_objects.call_args_list
+                        for obj in call[1]['Delete']['Objects']]
+        self.assertEqual(deleted_keys, [
+            'appspec/fn/2024/01/appspec-fn-3-20240131-120000.json',
+            'appspec-fn-1-20231101-120000.json'
+        ])
+        self.assertEqual(result, 2)
+        
+        listed_prefixes = [kwargs['Prefix'] for kwargs in paginator.calls if 'Delimiter' not in kwargs]
+        self.assertEqual(listed_prefixes, [
+            'appspec/fn/2024/02/', 'appspec/fn/2024/01/', 'appspec/fn/2023/12/', 'appspec-'
+        ])
+        # Only the partition holding the retained window is sorted; older ones are dropped whole
+        self.assertEqual((stats['partitions_swept'], stats['partitions_dropped']), (1, 2))
+        self.assertEqual(stats['files_protected'], 1)
+
+    def test_cleanup_appspec_files_partitioned_walk_is_lazy(self):
+        """Test a year's months are only listed once the newest-first walk reaches that year."""
+        test_objects = [
+            {'Key': f'appspec/fn/{year}/{month:02d}/appspec-fn-{year}{month:02d}-{year}{month:02d}01-120000.json',
+             'LastModified': datetime(year, month, 1, tzinfo=timezone.utc)}
+            for year in (2022, 2023, 2024) for month in range(1, 13)
+        ]
+        paginator = FakeListObjectsPaginator(test_objects)
+        self.mock_s3.get_paginator.return_value = paginator
+        self.mock_s3.delete_objects.return_value = {}
+
+        stats = {}
+        result = index.cleanup_appspec_files('test-bucket', 3, [], stats=stats, function_name='fn',
+                                             layout='partitioned')
+
+        self.assertEqual(result, 33)
+        self.assertEqual((stats['partitions_swept'], stats['partitions_dropped']), (3, 33))
+        delimited = [kwargs['Prefix'] for kwargs in paginator.calls if 'Delimiter' in kwargs]
+        self.assertEqual(delimited, ['appspec/fn/', 'appspec/fn/2024/', 'appspec/fn/2023/', 'appspec/fn/2022/'])
+        self.assertEqual(self.mock_s3.delete_objects.call_count, 1)
 
     def test_handler_integration(self):
         """Test the main handler function integration."""
@@ -246,9 +699,11 @@ class TestCleanupLambda(unittest.TestCase):
             
             # Mock cleanup functions
             with patch('index.cleanup_ecr_images') as mock_ecr_cleanup, \
+                 patch('index.cleanup_untagged_images') as mock_untagged_cleanup, \
                  patch('index.cleanup_appspec_files') as mock_s3_cleanup:
                 
                 mock_ecr_cleanup.return_value = 3
+                mock_untagged_cleanup.return_value = 4
                 mock_s3_cleanup.return_value = 2
                 
                 # Call the handler
@@ -258,12 +713,60 @@ class TestCleanupLambda(unittest.TestCase):
                 self.assertEqual(result['statusCode'], 200)
                 body = json.loads(result['body'])
                 self.assertEqual(body['results']['ecr_images_deleted'], 3)
+                self.assertEqual(body['results']['untagged_images_deleted'], 4)
                 self.assertEqual(body['results']['appspec_files_deleted'], 2)
                 
                 # Verify function calls
-                mock_get_artifacts.assert_called_once_with('test-app', 'test-group', 3)
-                mock_ecr_cleanup.assert_called_once_with('test-repo', 10, ['v1.0.0', 'v2.0.0'])
-                mock_s3_cleanup.assert_called_once_with('test-bucket', 10, ['appspec-v1.json', 'appspec-v2.json'])
+                mock_get_artifacts.assert_called_once_with('test-app', 'test-group', 3, stats=ANY,
+                                                              manifest=None, resolve_images=True)
+                mock_ecr_cleanup.assert_called_once_with(
+                    'test-repo', 10, ['v1.0.0', 'v2.0.0'], stats=ANY, protected_image_digests=[], window=None,
+                    dry_run=False
+                )
+                mock_untagged_cleanup.assert_called_once_with('test-repo', [], 24.0, stats=ANY, dry_run=False)
+                mock_s3_cleanup.assert_called_once_with(
+                    'test-bucket', 10, ['appspec-v1.json', 'appspec-v2.json'],
+                    stats=ANY, function_name=None, layout='flat', window=None, dry_run=False
+                )
+
+    def test_plan_ecr_cleanup(self):
+        """Test the ECR plan retains the newest images regardless of inventory order."""
+        images = [
+            {'imageTags': [f'v{i}'], 'imageDigest': f'sha256:{i}',
+             'imagePushedAt': datetime(2024, 1, i, tzinfo=timezone.utc)}
+            for i in (3, 1, 5, 2, 4, 6)
+        ]
+        
+        plan = index.plan_ecr_cleanup(iter(images), 2, ['v1'], ['sha256:2'])
+        
+        self.assertEqual(sorted(plan['delete']), ['sha256:3', 'sha256:4'])
+        self.assertEqual([entry['digest'] for entry in plan['retained']], ['sha256:6', 'sha256:5'])
+        self.assertEqual(plan['images_scanned'], 6)
+        self.assertEqual(plan['images_protected'], 2)
+
+    def test_handler_dry_run_reports_plan_without_deleting(self):
+        """Test a dry run plans every sweep but makes no delete or write calls."""
+        images = [
+            {'imageTags': [f'v{i}'], 'imageDigest': f'sha256:{i}',
+             'imagePushedAt': datetime(2024, 1, i, tzinfo=timezone.utc)}
+            for i in range(1, 13)
+        ]
+        self.mock_ecr.get_paginator.return_value.paginate.return_value = [{'imageDetails': images}]
+        self.mock_s3.get_paginator.return_value = FakeListObjectsPaginator([])
+        
+        with patch.dict(os.environ, {'UNTAGGED_GC_ENABLED': 'false'}), \
+             patch('index.get_successful_deployment_artifacts') as mock_get_artifacts:
+            mock_get_artifacts.return_value = {'image_tags': [], 'image_digests': [], 'appspec_keys': []}
+            result = index.handler({'dryRun': True}, Mock())
+        
+        self.assertEqual(result['statusCode'], 200)
+        results = json.loads(result['body'])['results']
+        self.assertTrue(results['dry_run'])
+        self.assertEqual(results['plan'], {'ecr_images': 2, 'untagged_images': 0, 'appspec_files': 0})
+        self.assertEqual(results['ecr_images_deleted'], 0)
+        self.mock_ecr.batch_delete_image.assert_not_called()
+        self.mock_s3.delete_objects.assert_not_called()
+        self.mock_s3.put_object.assert_not_called()
 
     def test_handler_error_handling(self):
         """Test handler error handling."""
@@ -281,6 +784,153 @@ class TestCleanupLambda(unittest.TestCase):
             self.assertIn('Test error', body['results']['errors'][0])
 
 
+    def test_sweeper_runs_targets_and_checkpoints_when_out_of_time(self):
+        """Test the sweeper aggregates per-target results and checkpoints unstarted targets."""
+        mock_context = Mock()
+        mock_context.get_remaining_time_in_millis.side_effect = [120000, 120000, 1000]
+        event = {'targets': [
+            {'repositoryName': 'repo-a'},
+            {'repositoryName': 'repo-b'},
+            {'repositoryName': 'repo-c'}
+        ]}
+        
+        def run_target(target):
+            errors = ['Cleanup failed: boom'] if target['repositoryName'] == 'repo-b' else []
+            return {'ecr_images_deleted': 1, 'errors': errors}
+        
+        with patch('index.run_cleanup_target', side_effect=run_target) as mock_run:
+            result = index.handler(event, mock_context)
+        
+        self.assertEqual(result['statusCode'], 500)
+        body = json.loads(result['body'])
+        self.assertEqual(body['succeeded'], 1)
+        self.assertEqual(body['failed'], 1)
+        self.assertTrue(body['checkpointed'])
+        self.assertEqual([t['repositoryName'] for t in body['pending']], ['repo-c'])
+        self.assertEqual(mock_run.call_count, 2)
+        # Unspecified target settings come from the environment
+        self.assertEqual(mock_run.call_args_list[0][0][0]['retainCount'], 10)
+        
+        checkpoint = self.mock_s3.put_object.call_args[1]
+        self.assertEqual(checkpoint['Key'], 'cleanup/sweeper-checkpoint.json')
+        self.assertEqual(json.loads(checkpoint['Body'])['pending'][0]['repositoryName'], 'repo-c')
+
+    def test_sweeper_resumes_from_checkpoint(self):
+        """Test a resume event runs the checkpointed targets."""
+        mock_context = Mock()
+        mock_context.get_remaining_time_in_millis.return_value = 600000
+        self.mock_s3.get_object.return_value = {
+            'Body': Mock(read=Mock(return_value=json.dumps({
+                'pending': [index.target_from_environment({'repositoryName': 'repo-c', 'versionGc': False})]
+            }).encode()))
+        }
+        
+        with patch('index.run_cleanup_target', return_value={'errors': []}) as mock_run:
+            result = index.handler({'resume': True}, mock_context)
+        
+        self.assertEqual(result['statusCode'], 200)
+        # Without version GC no target calls Lambda, so its client is not hooked (or built)
+        self.mock_lambda.meta.events.register.assert_not_called()
+        self.mock_ecr.meta.events.register.assert_called_once()
+        self.assertEqual(mock_run.call_args[0][0]['repositoryName'], 'repo-c')
+        self.assertEqual(json.loads(self.mock_s3.put_object.call_args[1]['Body']), {'pending': []})
+
+    def test_discovered_targets_carry_their_account(self):
+        """Test tag discovery names each stack's resources and keys its rate limit by account."""
+        mock_tagging = Mock()
+        mock_tagging.get_paginator.return_value.paginate.return_value = [{'ResourceTagMappingList': [
+            {'ResourceARN': 'arn:aws:ecr:us-east-1:123456789012:repository/app-dev'}
+        ]}]
+        mock_sts = Mock()
+        mock_sts.get_caller_identity.return_value = {'Account': '123456789012'}
+        clients = {'resourcegroupstaggingapi': mock_tagging, 'sts': mock_sts}
+
+        with patch('index.get_client', side_effect=clients.get):
+            target, = index.discover_tagged_targets({'Module': 'hoist_lambda'})
+
+        self.assertEqual(target['bucketName'], 'app-dev-codedeploy-appspec-123456789012')
+        self.assertEqual(target['functionName'], 'app-dev')
+        self.assertEqual(target['accountId'], '123456789012')
+        mock_tagging.get_paginator.return_value.paginate.assert_called_once_with(
+            ResourceTypeFilters=['ecr:repository'], TagFilters=[{'Key': 'Module', 'Values': ['hoist_lambda']}])
+
+
+def version_config(version, code_sha='', code_size=0):
+    """Build a list_versions_by_function entry."""
+    return {'Version': str(version), 'CodeSha256': code_sha or f"sha-{version}", 'CodeSize': code_size}
+
+
+class TestLambdaVersionCleanup(unittest.TestCase):
+    def setUp(self):
+        """Set up test fixtures."""
+        self.mock_lambda = Mock()
+        self.mock_s3 = Mock()
+        self.lambda_patcher = patch('index.lambda_client', self.mock_lambda)
+        self.s3_patcher = patch('index.s3_client', self.mock_s3)
+        self.lambda_patcher.start()
+        self.s3_patcher.start()
+
+        versions_paginator = Mock()
+        versions_paginator.paginate.return_value = [
+            {'Versions': [{'Version': '$LATEST'}] + [version_config(v, code_size=100) for v in range(1, 6)]},
+            {'Versions': [version_config(v, code_size=100) for v in range(6, 11)]}
+        ]
+        aliases_paginator = Mock()
+        aliases_paginator.paginate.return_value = [{'Aliases': [
+            {'Name': 'live', 'FunctionVersion': '3',
+             'RoutingConfig': {'AdditionalVersionWeights': {'9': 0.01}}}
+        ]}]
+        self.mock_lambda.get_paginator.side_effect = lambda name: {
+            'list_versions_by_function': versions_paginator,
+            'list_aliases': aliases_paginator
+        }[name]
+
+    def tearDown(self):
+        """Clean up after tests."""
+        self.lambda_patcher.stop()
+        self.s3_patcher.stop()
+
+    def test_plan_keeps_newest_and_protected_versions(self):
+        """Test planning keeps the newest versions plus protected versions and digests."""
+        versions = [version_config(v) for v in range(1, 11)]
+
+        plan = index.plan_version_cleanup(versions, 3, {'2'}, ['sha256:sha-5'])
+
+        self.assertEqual([version for version, _ in plan['delete']], ['1', '3', '4', '6', '7'])
+        self.assertEqual(plan['versions_scanned'], 10)
+        self.assertEqual(plan['versions_protected'], 2)
+
+    def test_cleanup_keeps_alias_inflight_and_successful_versions(self):
+        """Test live's current and canary versions, in-flight and successful deployments survive."""
+        manifest = {'deployments': [{'deploymentId': 'd-8', 'lambdaVersion': '8', 'status': 'Created'}]}
+        protected = {'image_tags': [], 'image_digests': [], 'appspec_keys': [], 'lambda_versions': ['2']}
+        stats = {}
+
+        deleted = index.cleanup_lambda_versions('test-function', 'test-bucket', 1, protected, manifest, stats=stats)
+
+        deleted_versions = [c[1]['Qualifier'] for c in self.mock_lambda.delete_function.call_args_list]
+        self.assertEqual(deleted_versions, ['1', '4', '5', '6', '7'])
+        self.assertEqual(deleted, 5)
+        self.assertEqual(stats['bytes_freed'], 500)
+        self.assertEqual(stats['api_calls']['lambda:ListVersionsByFunction'], 2)
+
+    def test_cleanup_reads_versions_from_appspecs_on_history_fallback(self):
+        """Test protection from CodeDeploy history resolves versions through the AppSpec files."""
+        body = Mock()
+        body.read.return_value = json.dumps({'Resources': [
+            {'TargetService': {'Properties': {'TargetVersion': '4'}}}
+        ]}).encode('utf-8')
+        self.mock_s3.get_object.return_value = {'Body': body}
+        protected = {'image_tags': ['v4'], 'image_digests': [], 'appspec_keys': ['appspec-4.json']}
+
+        index.cleanup_lambda_versions('test-function', 'test-bucket', 10, protected, None, dry_run=True)
+
+        self.mock_lambda.delete_function.assert_not_called()
+        versions = index.protected_lambda_versions('test-function', 'test-bucket', protected, None, {})
+        self.assertEqual(versions['deployments'], {'4'})
+        self.assertEqual(versions['aliases'], {'3', '9'})
+
+
 if __name__ == '__main__':
     # Run the tests
     unittest.main(verbosity=2)
\ No newline at end of file
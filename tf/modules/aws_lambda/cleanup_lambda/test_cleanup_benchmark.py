@@ -0,0 +1,167 @@
+import unittest
+from unittest.mock import Mock, patch
+import math
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+# Add the current directory to the path so we can import the module
+sys.path.insert(0, os.path.dirname(__file__))
+# Shared modules Terraform packages alongside index.py
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lambda_shared'))
+
+# Import the module under test
+import index
+
+# Inventory sizes to benchmark; CLEANUP_BENCHMARK_MAX_IMAGES trims the list for quick runs
+INVENTORY_SIZES = [100, 1000, 10000, 100000]
+MAX_IMAGES = int(os.environ.get('CLEANUP_BENCHMARK_MAX_IMAGES', '100000'))
+
+# Regression thresholds. Planning is linear in the inventory: time and memory
+# budgets are a fixed allowance plus a per-image cost well above what the
+# planners need today, so only a real regression (e.g. a sort of the whole
+# inventory per page, or keeping full image records) trips them.
+PLAN_SECONDS_FIXED = 0.05
+PLAN_SECONDS_PER_IMAGE = 0.00002
+PLAN_BYTES_FIXED = 2 * 1024 * 1024
+PLAN_BYTES_PER_IMAGE = 256
+
+# describe_images returns up to 1000 images per page
+DESCRIBE_IMAGES_PAGE_SIZE = 1000
+RETAIN_COUNT = 10
+PROTECTED_COUNT = 3
+EPOCH = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+
+def synthetic_images(count):
+    """Yield count tagged images in shuffled push order, as describe_images would."""
+    for i in range(count):
+        # A fixed stride coprime with count scatters push times across pages
+        n = (i * 7919) % count
+        yield {
+            'imageDigest': f"sha256:{n:064x}",
+            'imageTags': [f"build-{n}"],
+            'imagePushedAt': EPOCH + timedelta(minutes=n)
+        }
+
+
+def synthetic_untagged_inventory(count):
+    """Build a repository where every tenth image is a multi-arch index with two children."""
+    image_details = []
+    index_manifests = {}
+    for n in range(0, count, 10):
+        pushed_at = EPOCH + timedelta(minutes=n)
+        children = [f"sha256:{n + 1:064x}", f"sha256:{n + 2:064x}"]
+        index_digest = f"sha256:{n:064x}"
+        image_details.append({
+            'imageDigest': index_digest,
+            # Only the newest quarter of the indexes is still tagged
+            'imageTags': [f"build-{n}"] if n >= count * 3 // 4 else [],
+            'imagePushedAt': pushed_at,
+            'imageManifestMediaType': index.IMAGE_INDEX_MEDIA_TYPES[0]
+        })
+        index_manifests[index_digest] = {'manifests': [{'digest': digest} for digest in children]}
+        for offset in range(1, 10):
+            if n + offset < count:
+                image_details.append({
+                    'imageDigest': f"sha256:{n + offset:064x}",
+                    'imagePushedAt': pushed_at,
+                    'imageManifestMediaType': 'application/vnd.oci.image.manifest.v1+json'
+                })
+    return image_details, index_manifests
+
+
+def measure(plan_function):
+    """
+    Run plan_function twice and return (result, seconds, peak traced bytes).
+
+    tracemalloc slows allocation down considerably, so time is taken from an
+    untraced run and memory from a traced one.
+    """
+    started_at = time.perf_counter()
+    result = plan_function()
+    elapsed = time.perf_counter() - started_at
+
+    tracemalloc.start()
+    try:
+        plan_function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+class TestCleanupBenchmark(unittest.TestCase):
+    def sizes(self):
+        return [size for size in INVENTORY_SIZES if size <= MAX_IMAGES]
+
+    def assert_within_budget(self, size, elapsed, peak):
+        time_budget = PLAN_SECONDS_FIXED + PLAN_SECONDS_PER_IMAGE * size
+        memory_budget = PLAN_BYTES_FIXED + PLAN_BYTES_PER_IMAGE * size
+        print(f"{size} images: planned in {elapsed:.3f}s (budget {time_budget:.3f}s), "
+              f"peak {peak / 1024:.0f} KiB (budget {memory_budget / 1024:.0f} KiB)")
+        self.assertLess(elapsed, time_budget)
+        self.assertLess(peak, memory_budget)
+
+    def test_plan_ecr_cleanup_scales_linearly(self):
+        """Test tagged-image planning time and memory stay within budget up to 100k images."""
+        for size in self.sizes():
+            with self.subTest(images=size):
+                protected = [f"sha256:{n:064x}" for n in range(PROTECTED_COUNT)]
+                plan, elapsed, peak = measure(
+                    lambda: index.plan_ecr_cleanup(synthetic_images(size), RETAIN_COUNT, [], protected)
+                )
+
+                self.assertEqual(plan['images_scanned'], size)
+                self.assertEqual(len(plan['delete']), size - RETAIN_COUNT - PROTECTED_COUNT)
+                self.assert_within_budget(size, elapsed, peak)
+
+    def test_plan_untagged_gc_scales_linearly(self):
+        """Test untagged GC planning time and memory stay within budget up to 100k images."""
+        now = EPOCH + timedelta(days=365)
+        for size in self.sizes():
+            with self.subTest(images=size):
+                image_details, index_manifests = synthetic_untagged_inventory(size)
+                plan, elapsed, peak = measure(
+                    lambda: index.plan_untagged_gc(image_details, index_manifests, [], now, 24 * 3600)
+                )
+
+                self.assertEqual(len(plan['referenced']), 2 * len(
+                    [image for image in image_details if image.get('imageTags')]
+                ))
+                self.assert_within_budget(size, elapsed, peak)
+
+    def test_executor_api_calls_are_batched(self):
+        """Test the ECR sweep makes one call per page and one per 100 deletes."""
+        for size in self.sizes():
+            with self.subTest(images=size):
+                mock_ecr = Mock()
+                mock_ecr.batch_delete_image.return_value = {'failures': []}
+
+                def pages(**kwargs):
+                    page = []
+                    for image in synthetic_images(size):
+                        page.append(image)
+                        if len(page) == DESCRIBE_IMAGES_PAGE_SIZE:
+                            yield {'imageDetails': page}
+                            page = []
+                    if page:
+                        yield {'imageDetails': page}
+                mock_ecr.get_paginator.return_value.paginate.side_effect = pages
+
+                stats = {}
+                with patch('index.ecr_client', mock_ecr):
+                    deleted = index.cleanup_ecr_images('bench-repo', RETAIN_COUNT, [], stats=stats)
+
+                expected_deletes = size - RETAIN_COUNT
+                self.assertEqual(deleted, expected_deletes)
+                self.assertEqual(stats['api_calls']['ecr:DescribeImages'],
+                                 math.ceil(size / DESCRIBE_IMAGES_PAGE_SIZE))
+                self.assertEqual(stats['api_calls']['ecr:BatchDeleteImage'],
+                                 math.ceil(expected_deletes / index.ECR_BATCH_DELETE_LIMIT))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,217 @@
+# Account-wide cleanup sweeper: the cleanup Lambda's code run on a schedule over every
+# hoist stack whose ECR repository carries the sweeper tags (see run_sweeper)
+locals {
+  cleanup_sweeper_name = "${var.app}-${var.env}-cleanup-sweeper"
+}
+
+resource "aws_lambda_function" "cleanup_sweeper" {
+  count         = var.cleanup_sweeper_enabled ? 1 : 0
+  function_name = local.cleanup_sweeper_name
+  role          = aws_iam_role.cleanup_sweeper[0].arn
+  handler       = "index.handler"
+  runtime       = "python3.11"
+  timeout       = 900 # Unfinished stacks are checkpointed and resumed by the next run
+
+  filename         = data.archive_file.cleanup_lambda.output_path
+  source_code_hash = data.archive_file.cleanup_lambda.output_base64sha256
+
+  environment {
+    variables = {
+      # Discovered stacks follow this module's naming; these settings apply to all of them
+      APPSPEC_KEY_LAYOUT            = var.appspec_key_layout
+      CLEANUP_MODE                  = var.cleanup_mode
+      FULL_RECONCILE_INTERVAL_HOURS = tostring(var.cleanup_full_reconcile_interval_hours)
+      DRY_RUN                       = tostring(var.cleanup_dry_run)
+      UNTAGGED_GC_ENABLED           = tostring(var.cleanup_untagged_images)
+      UNTAGGED_GRACE_HOURS          = tostring(var.cleanup_untagged_grace_hours)
+      # Each stack's own cleanup Lambda prunes its function versions
+      VERSION_GC_ENABLED            = "false"
+      RETAIN_COUNT                  = "10"
+      SUCCESSFUL_DEPLOY_RETAIN      = "3"
+      SWEEPER_MAX_WORKERS           = tostring(var.cleanup_sweeper_max_workers)
+      SWEEPER_MAX_CALLS_PER_SECOND  = tostring(var.cleanup_sweeper_max_calls_per_second)
+      SWEEPER_MIN_REMAINING_MS      = "60000"
+      SWEEPER_STATE_BUCKET          = aws_s3_bucket.codedeploy_appspec.bucket
+    }
+  }
+
+  tags = {
+    Application = var.app
+    Environment = var.env
+    Module      = "aws_lambda"
+    Description = "Cleanup sweeper for all hoist stacks in the account"
+  }
+}
+
+resource "aws_iam_role" "cleanup_sweeper" {
+  count = var.cleanup_sweeper_enabled ? 1 : 0
+  name  = local.cleanup_sweeper_name
+
+  assume_role_policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Action = "sts:AssumeRole"
+        Effect = "Allow"
+        Principal = {
+          Service = "lambda.amazonaws.com"
+        }
+      }
+    ]
+  })
+
+  tags = {
+    Application = var.app
+    Environment = var.env
+    Module      = "aws_lambda"
+    Description = "Role for the cleanup sweeper Lambda"
+  }
+}
+
+resource "aws_iam_role_policy" "cleanup_sweeper" {
+  count = var.cleanup_sweeper_enabled ? 1 : 0
+  name  = local.cleanup_sweeper_name
+  role  = aws_iam_role.cleanup_sweeper[0].id
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect = "Allow"
+        Action = [
+          "logs:CreateLogGroup",
+          "logs:CreateLogStream",
+          "logs:PutLogEvents"
+        ]
+        Resource = [
+          "arn:aws:logs:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:log-group:/aws/lambda/${local.cleanup_sweeper_name}",
+          "arn:aws:logs:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:log-group:/aws/lambda/${local.cleanup_sweeper_name}:*"
+        ]
+      },
+      {
+        # Discovering the stacks to clean
+        Effect = "Allow"
+        Action = [
+          "tag:GetResources"
+        ]
+        Resource = ["*"]
+      },
+      {
+        # Only repositories carrying the sweeper tags
+        Effect = "Allow"
+        Action = [
+          "ecr:DescribeImages",
+          "ecr:ListImages",
+          "ecr:BatchGetImage",
+          "ecr:BatchDeleteImage"
+        ]
+        Resource = [
+          "arn:aws:ecr:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:repository/*"
+        ]
+        Condition = {
+          StringEquals = {
+            for key, value in var.cleanup_sweeper_tag_filter : "aws:ResourceTag/${key}" => value
+          }
+        }
+      },
+      {
+        # AppSpec buckets of every stack (and the checkpoint in this stack's bucket)
+        Effect = "Allow"
+        Action = [
+          "s3:ListBucket"
+        ]
+        Resource = [
+          "arn:aws:s3:::*-codedeploy-appspec-${data.aws_caller_identity.current.account_id}"
+        ]
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "s3:DeleteObject",
+          "s3:GetObject",
+          "s3:PutObject"
+        ]
+        Resource = [
+          "arn:aws:s3:::*-codedeploy-appspec-${data.aws_caller_identity.current.account_id}/*"
+        ]
+      },
+      {
+        # Read-only: successful deployments protect their images and AppSpecs
+        Effect = "Allow"
+        Action = [
+          "codedeploy:ListDeployments",
+          "codedeploy:GetDeployment",
+          "codedeploy:BatchGetDeployments"
+        ]
+        Resource = [
+          "arn:aws:codedeploy:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:application:*",
+          "arn:aws:codedeploy:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:deploymentgroup:*/*"
+        ]
+      }
+    ]
+  })
+}
+
+# Full sweep over the tagged stacks
+resource "aws_cloudwatch_event_rule" "cleanup_sweeper" {
+  count               = var.cleanup_sweeper_enabled ? 1 : 0
+  name                = local.cleanup_sweeper_name
+  description         = "Run the cleanup sweeper over all tagged hoist stacks"
+  schedule_expression = var.cleanup_sweeper_schedule
+
+  tags = {
+    Application = var.app
+    Environment = var.env
+    Module      = "aws_lambda"
+    Description = "Cleanup sweeper schedule"
+  }
+}
+
+resource "aws_cloudwatch_event_target" "cleanup_sweeper" {
+  count     = var.cleanup_sweeper_enabled ? 1 : 0
+  rule      = aws_cloudwatch_event_rule.cleanup_sweeper[0].name
+  target_id = "CleanupSweeper"
+  arn       = aws_lambda_function.cleanup_sweeper[0].arn
+  input     = jsonencode({ tagFilter = var.cleanup_sweeper_tag_filter })
+}
+
+# Picks up stacks a sweep checkpointed when it ran out of time (a no-op otherwise)
+resource "aws_cloudwatch_event_rule" "cleanup_sweeper_resume" {
+  count               = var.cleanup_sweeper_enabled ? 1 : 0
+  name                = "${local.cleanup_sweeper_name}-resume"
+  description         = "Resume a checkpointed cleanup sweep"
+  schedule_expression = "rate(1 hour)"
+
+  tags = {
+    Application = var.app
+    Environment = var.env
+    Module      = "aws_lambda"
+    Description = "Cleanup sweeper resume schedule"
+  }
+}
+
+resource "aws_cloudwatch_event_target" "cleanup_sweeper_resume" {
+  count     = var.cleanup_sweeper_enabled ? 1 : 0
+  rule      = aws_cloudwatch_event_rule.cleanup_sweeper_resume[0].name
+  target_id = "CleanupSweeperResume"
+  arn       = aws_lambda_function.cleanup_sweeper[0].arn
+  input     = jsonencode({ resume = true })
+}
+
+resource "aws_lambda_permission" "cleanup_sweeper_eventbridge" {
+  count         = var.cleanup_sweeper_enabled ? 1 : 0
+  statement_id  = "AllowEventBridgeInvokeCleanupSweeper"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.cleanup_sweeper[0].function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.cleanup_sweeper[0].arn
+}
+
+resource "aws_lambda_permission" "cleanup_sweeper_resume_eventbridge" {
+  count         = var.cleanup_sweeper_enabled ? 1 : 0
+  statement_id  = "AllowEventBridgeInvokeCleanupSweeperResume"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.cleanup_sweeper[0].function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.cleanup_sweeper_resume[0].arn
+}
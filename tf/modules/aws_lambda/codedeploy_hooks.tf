@@ -80,6 +80,34 @@ resource "aws_iam_role_policy" "codedeploy_hook_lambda" {
         Resource = [
           "${aws_s3_bucket.codedeploy_appspec.arn}/*"
         ]
+      },
+      {
+        # Listing captured requests to replay
+        Effect = "Allow"
+        Action = [
+          "s3:ListBucket"
+        ]
+        Resource = [
+          aws_s3_bucket.codedeploy_appspec.arn
+        ]
+      },
+      {
+        # Rolling Init Duration baseline written after each accepted version
+        Effect = "Allow"
+        Action = [
+          "s3:PutObject"
+        ]
+        Resource = [
+          "${aws_s3_bucket.codedeploy_appspec.arn}/baselines/*"
+        ]
+      },
+      {
+        # Live alias concurrency, used to size the pre-warm
+        Effect = "Allow"
+        Action = [
+          "cloudwatch:GetMetricStatistics"
+        ]
+        Resource = ["*"]
       }
     ]
   })
@@ -91,14 +119,29 @@ resource "aws_lambda_function" "health_check" {
   role          = aws_iam_role.codedeploy_hook_lambda.arn
   handler       = "index.handler"
   runtime       = "python3.11"
-  timeout       = 60
+  timeout       = 300  # pre-warming waits on cold starts of the new version
   
   filename         = data.archive_file.health_check_lambda.output_path
   source_code_hash = data.archive_file.health_check_lambda.output_base64sha256
 
   environment {
     variables = {
-      FUNCTION_NAME = aws_lambda_function.main.function_name
+      FUNCTION_NAME            = aws_lambda_function.main.function_name
+      PREWARM_MAX_ENVIRONMENTS = tostring(var.prewarm_max_environments)
+      PREWARM_FACTOR           = tostring(var.prewarm_factor)
+      PREWARM_MIN_WARM_FRACTION = tostring(var.prewarm_min_warm_fraction)
+      PROBE_REQUESTS           = tostring(var.probe_requests)
+      PROBE_PATHS              = join(",", var.probe_paths)
+      PROBE_CONCURRENCY        = tostring(var.probe_concurrency)
+      LATENCY_BUDGET_PERCENT   = tostring(var.latency_budget_percent)
+      PROBE_GATE_PERCENTILE    = var.latency_gate_percentile
+      COLD_START_SAMPLES        = tostring(var.cold_start_samples)
+      COLD_START_BUDGET_PERCENT = tostring(var.cold_start_budget_percent)
+      COLD_START_GATE_MODE      = var.cold_start_gate_mode
+      BASELINE_BUCKET           = aws_s3_bucket.codedeploy_appspec.bucket
+      REPLAY_EVENTS             = local.request_capture_enabled ? tostring(var.replay_events) : "0"
+      REPLAY_MAX_ERROR_DELTA    = tostring(var.replay_max_error_delta)
+      CAPTURE_BUCKET            = aws_s3_bucket.codedeploy_appspec.bucket
     }
   }
 
@@ -119,4 +162,19 @@ data "archive_file" "health_check_lambda" {
     content  = file("${path.module}/health_check_lambda/index.py")
     filename = "index.py"
   }
+
+  source {
+    content  = file("${path.module}/health_check_lambda/replay.py")
+    filename = "replay.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/clients.py")
+    filename = "clients.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/instrumentation.py")
+    filename = "instrumentation.py"
+  }
 }
\ No newline at end of file
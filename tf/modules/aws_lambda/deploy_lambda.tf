@@ -52,6 +52,7 @@ resource "aws_iam_role_policy" "deploy_lambda" {
         Effect = "Allow"
         Action = [
           "codedeploy:CreateDeployment",
+          "codedeploy:GetDeployment",
           "codedeploy:GetDeploymentConfig",
           "codedeploy:GetApplicationRevision",
           "codedeploy:RegisterApplicationRevision"
@@ -66,6 +67,7 @@ resource "aws_iam_role_policy" "deploy_lambda" {
       {
         Effect = "Allow"
         Action = [
+          "s3:GetObject",
           "s3:PutObject",
           "s3:PutObjectAcl"
         ]
@@ -73,11 +75,22 @@ resource "aws_iam_role_policy" "deploy_lambda" {
           "${aws_s3_bucket.codedeploy_appspec.arn}/*"
         ]
       },
+      {
+        # Distinguish a missing manifest, version index or queue (NoSuchKey) from access denied
+        Effect = "Allow"
+        Action = [
+          "s3:ListBucket"
+        ]
+        Resource = [
+          aws_s3_bucket.codedeploy_appspec.arn
+        ]
+      },
       {
         Effect = "Allow"
         Action = [
           "lambda:GetFunction",
           "lambda:GetFunctionConfiguration",
+          "lambda:ListVersionsByFunction",
           "lambda:UpdateFunctionCode",
           "lambda:PublishVersion",
           "lambda:GetAlias",
@@ -87,6 +100,16 @@ resource "aws_iam_role_policy" "deploy_lambda" {
           "arn:aws:lambda:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:function:${var.app}-${var.env}",
           "arn:aws:lambda:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:function:${var.app}-${var.env}:*"
         ]
+      },
+      {
+        # Asynchronous continuations of a slow code update re-invoke this function
+        Effect = "Allow"
+        Action = [
+          "lambda:InvokeFunction"
+        ]
+        Resource = [
+          "arn:aws:lambda:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:function:${local.deploy_lambda_name}"
+        ]
       }
     ]
   })
@@ -109,6 +132,8 @@ resource "aws_lambda_function" "deploy" {
       LAMBDA_FUNCTION_NAME   = "${var.app}-${var.env}"
       HEALTH_CHECK_FUNCTION_NAME = aws_lambda_function.health_check.function_name
       APPSPEC_BUCKET = aws_s3_bucket.codedeploy_appspec.bucket
+      APPSPEC_KEY_LAYOUT = var.appspec_key_layout
+      DEPLOY_QUEUE_MAX_WAIT_SECONDS = tostring(var.deploy_queue_max_wait_seconds)
     }
   }
 
@@ -123,8 +148,74 @@ resource "aws_lambda_function" "deploy" {
 # Archive the Lambda function
 data "archive_file" "deploy_lambda" {
   type        = "zip"
-  source_dir  = "${path.module}/deploy_lambda"
   output_path = "${path.module}/deploy_lambda.zip"
+
+  source {
+    content  = file("${path.module}/deploy_lambda/index.py")
+    filename = "index.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/clients.py")
+    filename = "clients.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/instrumentation.py")
+    filename = "instrumentation.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/state_store.py")
+    filename = "state_store.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/manifest.py")
+    filename = "manifest.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/deploy_train.py")
+    filename = "deploy_train.py"
+  }
+}
+
+# ECR push rule and automatic triggers removed - deployments are only requested by pipeline or manual_deploy
+
+# Finished deployments release the deploy queue lease of their deployment group
+resource "aws_cloudwatch_event_rule" "deploy_queue_release" {
+  name        = "${var.app}-${var.env}-deploy-queue-release"
+  description = "Release the deploy queue lease when a CodeDeploy deployment finishes"
+
+  event_pattern = jsonencode({
+    source      = ["aws.codedeploy"]
+    detail-type = ["CodeDeploy Deployment State-change Notification"]
+    detail = {
+      state           = ["SUCCESS", "FAILURE", "STOP"]
+      application     = [aws_codedeploy_app.lambda.name]
+      deploymentGroup = [aws_codedeploy_deployment_group.lambda.deployment_group_name]
+    }
+  })
+
+  tags = {
+    Application = var.app
+    Environment = var.env
+    Module      = "aws_lambda"
+    Description = "Deploy queue lease release rule"
+  }
 }
 
-# EventBridge rule and automatic triggers removed - deploy_lambda is now only called by pipeline or manual_deploy
+resource "aws_cloudwatch_event_target" "deploy_queue_release" {
+  rule      = aws_cloudwatch_event_rule.deploy_queue_release.name
+  target_id = "DeployLambda"
+  arn       = aws_lambda_function.deploy.arn
+}
+
+resource "aws_lambda_permission" "deploy_queue_release" {
+  statement_id  = "AllowEventBridgeReleaseDeployQueue"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.deploy.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.deploy_queue_release.arn
+}
@@ -1,15 +1,67 @@
 import json
-import boto3
 import os
+import time
 import uuid
+from botocore.exceptions import ClientError
+from contextlib import contextmanager
 from datetime import datetime
 
-codedeploy = boto3.client('codedeploy')
-lambda_client = boto3.client('lambda')
-s3_client = boto3.client('s3')
+from clients import lazy_client
+from instrumentation import describe_event, emit_metrics, instrumented, record_phase, set_dimensions
+from manifest import build_appspec_key, record_deployment_manifest
+from deploy_train import codedeploy_deploy_train
 
+# Image digest -> published version index, kept in the AppSpec bucket next to the manifest
+VERSION_INDEX_SCHEMA_VERSION = 1
+# Missing permissions are a setup error, not a stale index to fall back from
+ACCESS_DENIED_ERROR_CODES = ('AccessDenied', 'AccessDeniedException')
+
+# Adaptive polling of LastUpdateStatus while the code update is in progress
+POLL_INITIAL_DELAY_SECONDS = 0.5
+POLL_MAX_DELAY_SECONDS = 5
+POLL_BACKOFF = 1.5
+# Time kept free for publish, AppSpec and create_deployment before handing off
+CONTINUATION_BUFFER_SECONDS = 15
+
+# Deploy train (see lambda_shared/deploy_train.py): queued requests check the lease this often
+DEPLOYMENT_STATE_CHANGE = 'CodeDeploy Deployment State-change Notification'
+DEPLOY_QUEUE_POLL_SECONDS = 5
+
+codedeploy = lazy_client('codedeploy')
+lambda_client = lazy_client('lambda')
+s3_client = lazy_client('s3')
+
+@instrumented
 def handler(event, context):
-    print(f"Received event: {json.dumps(event)}")
+    print(f"Received event: {describe_event(event)}")
+    
+    # A finished deployment hands the group's lease to the newest queued request
+    if event.get('detail-type') == DEPLOYMENT_STATE_CHANGE:
+        return release_deploy_lease(event)
+    
+    # A caller that gave up on a queued request takes it out of the deploy queue
+    if 'withdraw' in event:
+        release_deploy_lease_of(event['withdraw'])
+        return {'statusCode': 200, 'body': json.dumps({'withdrawn': True})}
+    
+    # Callers that poll again themselves (deploy_from_pipeline) get queued requests back at once
+    wait_in_queue = event.get('waitInQueue', True)
+    
+    # A continuation resumes a deployment whose code update outlived the previous invocation
+    if 'continuation' in event:
+        state = event['continuation']
+        print(f"Resuming deployment of {state['imageUri']} at phase '{state['phase']}'")
+        result = run_deployment(state, context, wait_in_queue)
+        
+        # Asynchronous continuations have no caller to hand back to, so re-invoke ourselves
+        if event.get('continueAsync') and result['statusCode'] == 202:
+            lambda_client.invoke(
+                FunctionName=context.function_name,
+                InvocationType='Event',
+                Payload=json.dumps({'continuation': json.loads(result['body'])['continuation'],
+                                    'continueAsync': True})
+            )
+        return result
     
     # Parse ECR push event
     detail = event['detail']
@@ -22,41 +74,118 @@ def handler(event, context):
     image_tag = detail['image-tag']
     image_uri = f"{event['account']}.dkr.ecr.{event['region']}.amazonaws.com/{repository_name}:{image_tag}"
     
+    state = {
+        'imageUri': image_uri,
+        'imageTag': image_tag,
+        'imageDigest': detail.get('image-digest'),
+        'ticket': uuid.uuid4().hex,
+        # Set by deploy_from_pipeline; kept in continuations for the metrics dimensions
+        'pipelineExecutionId': event.get('pipelineExecutionId'),
+        'phase': 'queue',
+        'version': None,
+        'phases': {}
+    }
+    return run_deployment(state, context, wait_in_queue)
+
+def run_deployment(state, context, wait_in_queue=True):
+    """
+    Update, publish and roll out the image described by state.
+
+    state['phase'] records how far a previous invocation got ('queue', 'update',
+    'wait' or 'publish') and state['phases'] accumulates per-phase seconds, so a
+    deployment handed off mid-update keeps its timings. Nothing touches the
+    function before the request holds the deployment group's lease; without
+    wait_in_queue a queued request is handed back right after joining.
+    """
     # Get Lambda function configuration
     function_name = os.environ['LAMBDA_FUNCTION_NAME']
+    bucket_name = os.environ['APPSPEC_BUCKET']
+    image_uri = state['imageUri']
+    image_digest = state.get('imageDigest')
+    phases = state['phases']
     
     try:
-        # First, update the Lambda function with the new image
-        print(f"Updating Lambda function {function_name} with image: {image_uri}")
-        lambda_client.update_function_code(
-            FunctionName=function_name,
-            ImageUri=image_uri
-        )
+        if state['phase'] == 'queue':
+            with timed_phase(phases, 'queue_wait'):
+                response = wait_in_deploy_queue(state, context, wait_in_queue)
+            if response:
+                return response
+            state['phase'] = 'update'
         
-        # Wait for the update to complete
-        waiter = lambda_client.get_waiter('function_updated')
-        waiter.wait(FunctionName=function_name)
+        if state['phase'] == 'update':
+            # Reuse the version already published from this digest (retries, redeploys, promotions)
+            state['version'] = find_published_version(bucket_name, function_name, image_digest)
+            if state['version']:
+                print(f"Image {image_digest} is already published as version {state['version']}, skipping update")
+                state['phase'] = 'alias'
+            else:
+                # First, update the Lambda function with the new image
+                print(f"Updating Lambda function {function_name} with image: {image_uri}")
+                with timed_phase(phases, 'code_update'):
+                    lambda_client.update_function_code(
+                        FunctionName=function_name,
+                        ImageUri=image_uri
+                    )
+                state['phase'] = 'wait'
         
-        # Publish a new version
-        version_response = lambda_client.publish_version(
-            FunctionName=function_name,
-            Description=f'Deployed from {image_uri}'
-        )
-        new_version = version_response['Version']
-        print(f"Published Lambda version: {new_version}")
+        if state['phase'] == 'wait':
+            # Wait for the update to complete, or hand off before the time budget runs out
+            with timed_phase(phases, 'code_update'):
+                updated = wait_for_function_updated(function_name, context)
+            if not updated:
+                print("Code update still in progress, handing off to a continuation")
+                emit_deploy_outcome('Continued')
+                return {
+                    'statusCode': 202,
+                    'body': json.dumps({
+                        'continuation': state,
+                        'phases': phases,
+                        'message': f'Code update for {image_uri} still in progress'
+                    })
+                }
+            state['phase'] = 'publish'
+        
+        if state['phase'] == 'publish':
+            # Publish a new version
+            with timed_phase(phases, 'publish'):
+                version_response = lambda_client.publish_version(
+                    FunctionName=function_name,
+                    Description=f'Deployed from {image_uri}'
+                )
+            state['version'] = version_response['Version']
+            print(f"Published Lambda version: {state['version']}")
+            record_published_version(bucket_name, function_name, version_response['CodeSha256'], state['version'])
+        
+        new_version = state['version']
         
         # Get the current version that the alias points to
         try:
-            alias_response = lambda_client.get_alias(
-                FunctionName=function_name,
-                Name='live'
-            )
+            with timed_phase(phases, 'alias_lookup'):
+                alias_response = lambda_client.get_alias(
+                    FunctionName=function_name,
+                    Name='live'
+                )
             current_version = alias_response['FunctionVersion']
             print(f"Current alias version: {current_version}")
         except Exception as e:
             print(f"Error getting alias: {str(e)}")
             raise ValueError(f"Could not get 'live' alias for function {function_name}. Make sure it exists.")
         
+        if current_version == new_version:
+            print(f"Alias 'live' already points to version {new_version}, nothing to deploy")
+            emit_deploy_outcome('AlreadyDeployed')
+            release_deploy_lease_of(state)
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'deploymentId': None,
+                    'alreadyDeployed': True,
+                    'lambdaVersion': new_version,
+                    'phases': phases,
+                    'message': f'{image_uri} is already live as version {new_version}'
+                })
+            }
+        
         # Create AppSpec content
         appspec_content = {
             'version': 0.0,
@@ -79,42 +208,336 @@ def handler(event, context):
         }
         
         # Store AppSpec in S3
-        bucket_name = os.environ['APPSPEC_BUCKET']
-        timestamp = datetime.utcnow().strftime('%Y%m%d-%H%M%S')
-        appspec_key = f"appspec-{function_name}-{new_version}-{timestamp}.json"
+        appspec_key = build_appspec_key(
+            function_name, new_version, datetime.utcnow(),
+            os.environ.get('APPSPEC_KEY_LAYOUT', 'flat')
+        )
         
         print(f"Storing AppSpec in S3: s3://{bucket_name}/{appspec_key}")
-        s3_client.put_object(
-            Bucket=bucket_name,
-            Key=appspec_key,
-            Body=json.dumps(appspec_content, indent=2),
-            ContentType='application/json'
-        )
+        with timed_phase(phases, 'appspec_write'):
+            s3_client.put_object(
+                Bucket=bucket_name,
+                Key=appspec_key,
+                Body=json.dumps(appspec_content, indent=2),
+                ContentType='application/json'
+            )
         
         # Create CodeDeploy deployment with S3 reference
-        response = codedeploy.create_deployment(
-            applicationName=os.environ['CODEDEPLOY_APP_NAME'],
-            deploymentGroupName=os.environ['DEPLOYMENT_GROUP_NAME'],
-            description=f'Automated deployment triggered via lambda by ECR push: {image_uri}',
-            revision={
-                'revisionType': 'S3',
-                's3Location': {
-                    'bucket': bucket_name,
-                    'key': appspec_key,
-                    'bundleType': 'JSON'
+        with timed_phase(phases, 'create_deployment'):
+            response = codedeploy.create_deployment(
+                applicationName=os.environ['CODEDEPLOY_APP_NAME'],
+                deploymentGroupName=os.environ['DEPLOYMENT_GROUP_NAME'],
+                description=f'Automated deployment triggered via lambda by ECR push: {image_uri}',
+                revision={
+                    'revisionType': 'S3',
+                    's3Location': {
+                        'bucket': bucket_name,
+                        'key': appspec_key,
+                        'bundleType': 'JSON'
+                    }
                 }
-            }
-        )
+            )
         
         print(f"Started deployment: {response['deploymentId']}")
+        set_dimensions(deployment_id=response['deploymentId'])
+        if state.get('ticket'):
+            try:
+                held = deploy_train_from_environment().started(deploy_group_key(), state['ticket'],
+                                                              response['deploymentId'])
+            except Exception as e:
+                # The lease still expires, and a finished deployment is reclaimed on the next join
+                print(f"Warning: could not record deployment on the lease: {str(e)}")
+                held = True
+            if not held:
+                # A rollback (or an expired lease) handed the group on while the code updated
+                codedeploy.stop_deployment(deploymentId=response['deploymentId'], autoRollbackEnabled=True)
+                print(f"Stopped deployment {response['deploymentId']}: it no longer holds the lease")
+                emit_deploy_outcome('Preempted')
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps({
+                        'deploymentId': response['deploymentId'],
+                        'preempted': True,
+                        'message': f'Deployment of {image_uri} stopped: the deploy lease was taken over'
+                    })
+                }
+        emit_deploy_outcome('Started')
+        
+        record_deployment_manifest(s3_client, bucket_name, function_name, {
+            'deploymentId': response['deploymentId'],
+            'imageUri': image_uri,
+            'imageTag': state['imageTag'],
+            'imageDigest': image_digest,
+            'lambdaVersion': new_version,
+            'appspecKey': appspec_key,
+            'createdAt': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'status': 'Created'
+        })
         return {
             'statusCode': 200,
             'body': json.dumps({
                 'deploymentId': response['deploymentId'],
+                'phases': phases,
+                'queue': state.get('queue'),
                 'message': f'Deployment started for {image_uri}'
             })
         }
         
     except Exception as e:
         print(f"Error creating deployment: {str(e)}")
+        release_deploy_lease_of(state)
+        raise
+
+def wait_for_function_updated(function_name, context):
+    """
+    Poll LastUpdateStatus until the code update finishes.
+
+    Polling starts at POLL_INITIAL_DELAY_SECONDS and backs off by POLL_BACKOFF
+    up to POLL_MAX_DELAY_SECONDS while the status is unchanged; a status
+    transition drops back to the fast interval. Returns True once the update
+    succeeded, False if less than CONTINUATION_BUFFER_SECONDS of the
+    invocation would remain after the next sleep, and raises if it failed.
+    """
+    delay = POLL_INITIAL_DELAY_SECONDS
+    last_status = None
+    polls = 0
+    while True:
+        config = lambda_client.get_function_configuration(FunctionName=function_name)
+        polls += 1
+        status = config.get('LastUpdateStatus')
+        if status == 'Successful':
+            print(f"Function update completed after {polls} polls")
+            return True
+        if status == 'Failed':
+            raise RuntimeError(
+                f"Function update failed: {config.get('LastUpdateStatusReasonCode')} "
+                f"{config.get('LastUpdateStatusReason')}"
+            )
+        
+        if polls == 1 or status != last_status:
+            delay = POLL_INITIAL_DELAY_SECONDS
+        else:
+            delay = min(delay * POLL_BACKOFF, POLL_MAX_DELAY_SECONDS)
+        last_status = status
+        
+        if context.get_remaining_time_in_millis() / 1000 - delay < CONTINUATION_BUFFER_SECONDS:
+            print(f"Function update still {status} after {polls} polls")
+            return False
+        time.sleep(delay)
+
+@contextmanager
+def timed_phase(phases, name):
+    """
+    Time the block as a phase of this invocation's metrics and add it to
+    phases[name] (seconds), which continuations carry across invocations.
+    """
+    started_at = time.monotonic()
+    try:
+        yield
+    finally:
+        seconds = time.monotonic() - started_at
+        record_phase(name, seconds)
+        phases[name] = round(phases.get(name, 0) + seconds, 3)
+
+def emit_deploy_outcome(outcome):
+    """Count how a deploy request ended (the phase timings are in the invocation record)."""
+    emit_metrics({'DeployRequests': 1}, [['FunctionName', 'Outcome']], {'Outcome': outcome})
+
+def version_index_key(function_name):
+    """S3 key of the image digest -> version index for function_name."""
+    return f"indexes/{function_name}/versions.json"
+
+def find_published_version(bucket_name, function_name, image_digest):
+    """
+    Return the published version built from image_digest, or None.
+
+    For container image functions a version's CodeSha256 is the image manifest
+    digest, so the index maps those hashes to version numbers. It is rebuilt
+    from list_versions_by_function when missing, and every hit is confirmed
+    with get_function_configuration, so a stale or lost index only costs the
+    normal update/publish path. Access denied errors are raised.
+    """
+    if not image_digest:
+        return None
+    code_sha = image_digest.split(':', 1)[-1]
+    
+    try:
+        index = load_version_index(bucket_name, function_name)
+        if index is None:
+            index = build_version_index(function_name)
+            save_version_index(bucket_name, function_name, index)
+        
+        version = index['versions'].get(code_sha)
+        if not version:
+            return None
+        
+        config = lambda_client.get_function_configuration(FunctionName=function_name, Qualifier=version)
+        if config.get('CodeSha256') == code_sha and config.get('State', 'Active') == 'Active':
+            return version
+        print(f"Version index entry {code_sha} -> {version} is stale, ignoring it")
+    except ClientError as e:
+        if e.response['Error']['Code'] in ACCESS_DENIED_ERROR_CODES:
+            raise
+        print(f"Warning: could not use version index: {str(e)}")
+    except (ValueError, KeyError) as e:
+        # A corrupt index falls back to the normal update/publish path
+        print(f"Warning: could not use version index: {str(e)}")
+    return None
+
+def load_version_index(bucket_name, function_name):
+    """Load the version index, or None if it has not been built yet."""
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=version_index_key(function_name))
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return None
         raise
+    index = json.loads(response['Body'].read())
+    if index.get('schemaVersion') != VERSION_INDEX_SCHEMA_VERSION:
+        return None
+    return index
+
+def build_version_index(function_name):
+    """Map CodeSha256 to the newest published version carrying it."""
+    versions = {}
+    paginator = lambda_client.get_paginator('list_versions_by_function')
+    for page in paginator.paginate(FunctionName=function_name):
+        for config in page.get('Versions', []):
+            if config['Version'] == '$LATEST':
+                continue
+            current = versions.get(config['CodeSha256'])
+            if current is None or int(config['Version']) > int(current):
+                versions[config['CodeSha256']] = config['Version']
+    print(f"Built version index for {function_name} with {len(versions)} digests")
+    return {'schemaVersion': VERSION_INDEX_SCHEMA_VERSION, 'functionName': function_name, 'versions': versions}
+
+def save_version_index(bucket_name, function_name, index):
+    """Write the version index. Concurrent writers may drop an entry; lookups verify hits anyway."""
+    s3_client.put_object(
+        Bucket=bucket_name,
+        Key=version_index_key(function_name),
+        Body=json.dumps(index, separators=(',', ':')),
+        ContentType='application/json'
+    )
+
+def record_published_version(bucket_name, function_name, code_sha, version):
+    """Add a freshly published version to the index; failures are only logged."""
+    try:
+        index = load_version_index(bucket_name, function_name)
+        if index is None:
+            index = build_version_index(function_name)
+        index['versions'][code_sha] = version
+        save_version_index(bucket_name, function_name, index)
+    except Exception as e:
+        print(f"Warning: could not update version index: {str(e)}")
+
+def deploy_group_key():
+    """Queue key of this function's CodeDeploy deployment group."""
+    return f"{os.environ['CODEDEPLOY_APP_NAME']}/{os.environ['DEPLOYMENT_GROUP_NAME']}"
+
+def deploy_train_from_environment():
+    """Deploy train for this function, with its lock state in the AppSpec bucket."""
+    return codedeploy_deploy_train(s3_client, codedeploy, os.environ['APPSPEC_BUCKET'])
+
+def wait_in_deploy_queue(state, context, wait=True):
+    """
+    Join the deployment group's queue and wait for the lease.
+
+    Returns None once the lease is granted, a 202 continuation if the time
+    budget runs out while still queued (or right away without wait), or a 200
+    response without a deployment if a newer request was deployed instead.
+    Raises after DEPLOY_QUEUE_MAX_WAIT_SECONDS in the queue.
+    """
+    if not state.get('ticket'):
+        # Continuations started before the deploy train existed carry no ticket
+        return None
+    
+    train = deploy_train_from_environment()
+    group = deploy_group_key()
+    max_wait = float(os.environ.get('DEPLOY_QUEUE_MAX_WAIT_SECONDS', '600'))
+    entry = {'ticket': state['ticket'], 'imageDigest': state.get('imageDigest') or state['imageUri']}
+    state.setdefault('queuedAt', train.clock.now())
+    
+    reported = state.get('queueReported', False)
+    while True:
+        status = train.join(group, entry)
+        if status['result'] == 'granted':
+            print(f"Holding the {group} lease after {status['waitSeconds']}s in the queue")
+            emit_queue_metrics(group, status['queueDepth'], status['waitSeconds'])
+            state['queue'] = {'waitSeconds': status['waitSeconds'], 'queueDepth': status['queueDepth']}
+            return None
+        
+        if status['result'] == 'superseded':
+            print(f"Superseded in the {group} queue by {status['supersededBy']}")
+            emit_queue_metrics(group, status['queueDepth'], status['waitSeconds'], outcome='Superseded')
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'deploymentId': None,
+                    'superseded': True,
+                    'supersededBy': status['supersededBy'],
+                    'queue': {'waitSeconds': status['waitSeconds'], 'queueDepth': status['queueDepth']},
+                    'message': f"{state['imageUri']} was superseded by {status['supersededBy']} while queued"
+                })
+            }
+        
+        behind = status['activeDeploymentId'] or 'a deployment being prepared'
+        if not reported:
+            print(f"Queued behind {behind} ({status['queueDepth']} waiting)")
+            emit_queue_metrics(group, status['queueDepth'], outcome='Queued')
+            state['queueReported'] = reported = True
+        
+        waited = train.clock.now() - state['queuedAt']
+        if waited > max_wait:
+            raise TimeoutError(
+                f"Waited {waited:.0f}s in the {group} queue behind {behind}"
+            )
+        if not wait or context.get_remaining_time_in_millis() / 1000 - DEPLOY_QUEUE_POLL_SECONDS < CONTINUATION_BUFFER_SECONDS:
+            return {
+                'statusCode': 202,
+                'body': json.dumps({
+                    'continuation': state,
+                    'queued': True,
+                    'queueDepth': status['queueDepth'],
+                    'message': f"{state['imageUri']} is queued behind {behind}"
+                })
+            }
+        train.clock.sleep(DEPLOY_QUEUE_POLL_SECONDS)
+
+def release_deploy_lease_of(state):
+    """Give up the lease or queue place of a request that will not create a deployment."""
+    if not state.get('ticket'):
+        return
+    try:
+        deploy_train_from_environment().release(deploy_group_key(), ticket=state['ticket'])
+    except Exception as e:
+        print(f"Warning: could not release the deploy lease: {str(e)}")
+
+def release_deploy_lease(event):
+    """Hand the lease of a finished CodeDeploy deployment to the newest queued request."""
+    detail = event['detail']
+    group = deploy_group_key()
+    outcome = deploy_train_from_environment().release(group, deployment_id=detail['deploymentId'])
+    if not outcome['released']:
+        print(f"Deployment {detail['deploymentId']} does not hold the {group} lease")
+    elif outcome['promoted']:
+        print(f"Deployment {detail['deploymentId']} {detail.get('state')}, lease passed to "
+              f"{outcome['promoted']['imageDigest']} ({outcome['superseded']} superseded)")
+    else:
+        print(f"Deployment {detail['deploymentId']} {detail.get('state')}, {group} is idle")
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'released': outcome['released'],
+            'promoted': outcome['promoted'] and outcome['promoted']['imageDigest'],
+            'superseded': outcome['superseded']
+        })
+    }
+
+def emit_queue_metrics(group, depth, wait_seconds=None, outcome='Granted'):
+    """Record deploy queue depth, and the wait time once it is known."""
+    metrics = {'DeployQueueDepth': depth}
+    if wait_seconds is not None:
+        metrics['DeployQueueWait'] = round(wait_seconds * 1000, 1)
+    emit_metrics(metrics, [['DeploymentGroup'], ['DeploymentGroup', 'Outcome']],
+                 {'DeploymentGroup': group, 'Outcome': outcome}, units={'DeployQueueWait': 'Milliseconds'})
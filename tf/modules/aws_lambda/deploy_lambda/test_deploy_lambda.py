@@ -0,0 +1,440 @@
+import unittest
+from unittest.mock import Mock, patch
+import io
+import json
+import os
+import sys
+from contextlib import redirect_stdout
+
+from botocore.exceptions import ClientError
+
+# Add the current directory to the path so we can import the module
+sys.path.insert(0, os.path.dirname(__file__))
+# Shared modules Terraform packages alongside index.py
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lambda_shared'))
+
+# Import the module under test
+import index
+import deploy_train
+import state_store
+
+
+class SimulatedClock:
+    """Clock whose sleep only advances time."""
+
+    def __init__(self):
+        self.time = 1000.0
+
+    def now(self):
+        return self.time
+
+    def sleep(self, seconds):
+        self.time += seconds
+
+
+class SimulatedContext:
+    """Lambda context whose remaining time follows a SimulatedClock."""
+
+    def __init__(self, clock, remaining_seconds):
+        self.clock = clock
+        self.deadline = clock.time + remaining_seconds
+        self.function_name = 'app-dev-deploy'
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - self.clock.time) * 1000)
+
+
+class TestDeployTrain(unittest.TestCase):
+    def setUp(self):
+        """Set up test fixtures."""
+        self.clock = SimulatedClock()
+        self.store = state_store.MemoryJsonStore()
+        self.finished = set()
+        self.train = deploy_train.DeployTrain(self.store, self.clock, start_seconds=900, lease_seconds=3600,
+                                       deployment_finished=lambda deployment_id: deployment_id in self.finished)
+
+    def join(self, ticket, digest=None):
+        return self.train.join('app/group', {'ticket': ticket, 'imageDigest': digest or f"sha256:{ticket}"})
+
+    def test_idle_group_grants_and_busy_group_queues(self):
+        """Test the first request gets the lease and later ones wait behind it."""
+        self.assertEqual(self.join('a')['result'], 'granted')
+        self.train.started('app/group', 'a', 'd-a')
+
+        status = self.join('b')
+
+        self.assertEqual(status['result'], 'queued')
+        self.assertEqual(status['queueDepth'], 1)
+        self.assertEqual(status['activeDeploymentId'], 'd-a')
+
+    def test_release_deploys_only_the_newest_waiting_request(self):
+        """Test a finished deployment passes the lease to the newest request and supersedes the rest."""
+        self.join('a')
+        self.train.started('app/group', 'a', 'd-a')
+        for ticket in ('b', 'c', 'd'):
+            self.join(ticket)
+            self.clock.sleep(10)
+
+        outcome = self.train.release('app/group', deployment_id='d-a')
+
+        self.assertTrue(outcome['released'])
+        self.assertEqual(outcome['promoted']['imageDigest'], 'sha256:d')
+        self.assertEqual(outcome['superseded'], 2)
+        granted = self.join('d')
+        self.assertEqual(granted['result'], 'granted')
+        self.assertEqual(granted['waitSeconds'], 10)
+        superseded = self.join('b')
+        self.assertEqual(superseded['result'], 'superseded')
+        self.assertEqual(superseded['supersededBy'], 'sha256:d')
+        self.assertEqual(superseded['waitSeconds'], 30)
+
+    def test_newer_request_for_waiting_image_takes_its_place(self):
+        """Test re-requesting an image that is already queued keeps one place in the queue."""
+        self.join('a')
+        self.join('b', digest='sha256:same')
+
+        status = self.join('c', digest='sha256:same')
+
+        self.assertEqual(status['queueDepth'], 1)
+        self.assertEqual(self.join('b', digest='sha256:same')['result'], 'superseded')
+
+    def test_stale_leases_are_reclaimed(self):
+        """Test an expired lease and a finished deployment without a release both free the group."""
+        self.join('a')
+        self.join('b')
+        self.clock.sleep(901)
+
+        self.assertEqual(self.join('b')['result'], 'granted')
+
+        self.train.started('app/group', 'b', 'd-b')
+        self.join('c')
+        self.finished.add('d-b')
+
+        self.assertEqual(self.join('c')['result'], 'granted')
+
+
+    def test_preempt_takes_the_lease_ahead_of_the_queue(self):
+        """Test a rollback's lease supersedes waiting requests and outlives the preempted deployment."""
+        self.join('a')
+        self.join('b')
+
+        outcome = self.train.preempt('app/group', {'ticket': 'rollback', 'imageDigest': 'sha256:good'})
+
+        self.assertEqual((outcome['preempted']['ticket'], outcome['superseded']), ('a', 1))
+        self.assertFalse(self.train.started('app/group', 'a', 'd-a'))
+        self.assertFalse(self.train.release('app/group', deployment_id='d-a')['released'])
+        self.assertEqual(self.join('b')['supersededBy'], 'sha256:good')
+        self.assertTrue(self.train.started('app/group', 'rollback', 'd-rollback'))
+        self.assertEqual(self.join('c')['result'], 'queued')
+
+class TestDeployQueue(unittest.TestCase):
+    def setUp(self):
+        """Set up test fixtures."""
+        self.env_patcher = patch.dict(os.environ, {
+            'CODEDEPLOY_APP_NAME': 'app',
+            'DEPLOYMENT_GROUP_NAME': 'app-dev',
+            'LAMBDA_FUNCTION_NAME': 'app-dev',
+            'APPSPEC_BUCKET': 'appspec-bucket'
+        })
+        self.env_patcher.start()
+        self.train = deploy_train.DeployTrain(state_store.MemoryJsonStore(), SimulatedClock())
+        self.train_patcher = patch.object(index, 'deploy_train_from_environment', return_value=self.train)
+        self.train_patcher.start()
+        self.lambda_patcher = patch.object(index, 'lambda_client', Mock())
+        self.mock_lambda = self.lambda_patcher.start()
+
+    def tearDown(self):
+        """Clean up test fixtures."""
+        self.env_patcher.stop()
+        self.train_patcher.stop()
+        self.lambda_patcher.stop()
+
+    def test_queued_request_hands_off_without_touching_the_function(self):
+        """Test a queued request returns a continuation and leaves the function alone."""
+        self.train.join('app/app-dev', {'ticket': 'active', 'imageDigest': 'sha256:old'})
+        state = {'imageUri': 'repo:new', 'imageTag': 'new', 'imageDigest': 'sha256:new',
+                 'ticket': 'new', 'phase': 'queue', 'version': None, 'phases': {}}
+        context = Mock()
+        context.get_remaining_time_in_millis.return_value = 18000
+
+        result = index.run_deployment(state, context)
+
+        self.assertEqual(result['statusCode'], 202)
+        body = json.loads(result['body'])
+        self.assertTrue(body['queued'])
+        self.assertEqual(body['continuation']['phase'], 'queue')
+        self.mock_lambda.update_function_code.assert_not_called()
+
+    def test_queued_request_returns_at_once_without_wait(self):
+        """Test a caller that polls itself gets the queued continuation without any wait."""
+        self.train.join('app/app-dev', {'ticket': 'active', 'imageDigest': 'sha256:old'})
+        event = {'account': '123456789012', 'region': 'us-east-1', 'waitInQueue': False,
+                 'detail': {'repository-name': 'repo', 'image-tag': 'new', 'image-digest': 'sha256:new'}}
+        context = SimulatedContext(self.train.clock, 600)
+
+        result = index.handler(event, context)
+
+        self.assertEqual(result['statusCode'], 202)
+        self.assertEqual(self.train.clock.time, 1000.0)
+        continuation = json.loads(result['body'])['continuation']
+
+        # Withdrawing the continuation leaves the queue to the active request alone
+        index.handler({'withdraw': continuation}, context)
+        self.assertEqual(self.train.store.get('app/app-dev')[0]['waiting'], [])
+
+    def test_state_change_event_releases_the_lease(self):
+        """Test a finished deployment event passes the lease on to the queued request."""
+        self.train.join('app/app-dev', {'ticket': 'active', 'imageDigest': 'sha256:old'})
+        self.train.started('app/app-dev', 'active', 'd-1')
+        self.train.join('app/app-dev', {'ticket': 'next', 'imageDigest': 'sha256:new'})
+
+        result = index.handler({
+            'detail-type': index.DEPLOYMENT_STATE_CHANGE,
+            'detail': {'deploymentId': 'd-1', 'state': 'SUCCESS'}
+        }, Mock())
+
+        self.assertEqual(json.loads(result['body'])['promoted'], 'sha256:new')
+
+
+def client_error(code, operation='GetObject'):
+    """Build a botocore ClientError with the given error code."""
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+class TestDeployQueueStore(unittest.TestCase):
+    def setUp(self):
+        """Set up test fixtures."""
+        self.env_patcher = patch.dict(os.environ, {
+            'CODEDEPLOY_APP_NAME': 'app',
+            'DEPLOYMENT_GROUP_NAME': 'app-dev',
+            'LAMBDA_FUNCTION_NAME': 'app-dev',
+            'APPSPEC_BUCKET': 'appspec-bucket'
+        })
+        self.env_patcher.start()
+        self.s3_patcher = patch.object(index, 's3_client', Mock())
+        self.mock_s3 = self.s3_patcher.start()
+        self.lambda_patcher = patch.object(index, 'lambda_client', Mock())
+        self.mock_lambda = self.lambda_patcher.start()
+
+    def tearDown(self):
+        """Clean up test fixtures."""
+        self.env_patcher.stop()
+        self.s3_patcher.stop()
+        self.lambda_patcher.stop()
+
+    def test_missing_queue_is_empty(self):
+        """Test a group without a queue object has no state yet."""
+        self.mock_s3.get_object.side_effect = client_error('NoSuchKey')
+
+        self.assertEqual(deploy_train.deploy_queue_store(index.s3_client, 'appspec-bucket').get('app/app-dev'), (None, None))
+
+    def test_access_denied_fails_the_deployment(self):
+        """Test an S3 permission error on the queue fails the request instead of reading as an idle group."""
+        self.mock_s3.get_object.side_effect = client_error('AccessDenied')
+        state = {'imageUri': 'repo:new', 'imageTag': 'new', 'imageDigest': 'sha256:new',
+                 'ticket': 'new', 'phase': 'queue', 'version': None, 'phases': {}}
+
+        with self.assertRaises(ClientError) as raised:
+            index.run_deployment(state, Mock())
+
+        self.assertEqual(raised.exception.response['Error']['Code'], 'AccessDenied')
+        self.mock_s3.put_object.assert_not_called()
+        self.mock_lambda.update_function_code.assert_not_called()
+
+
+class TestVersionIndex(unittest.TestCase):
+    def setUp(self):
+        """Set up test fixtures."""
+        self.s3_patcher = patch.object(index, 's3_client', Mock())
+        self.mock_s3 = self.s3_patcher.start()
+        self.lambda_patcher = patch.object(index, 'lambda_client', Mock())
+        self.mock_lambda = self.lambda_patcher.start()
+
+    def tearDown(self):
+        """Clean up test fixtures."""
+        self.s3_patcher.stop()
+        self.lambda_patcher.stop()
+
+    def stored_index(self, versions):
+        self.mock_s3.get_object.return_value = {'Body': Mock(read=Mock(return_value=json.dumps({
+            'schemaVersion': index.VERSION_INDEX_SCHEMA_VERSION, 'functionName': 'app-dev', 'versions': versions
+        }).encode()))}
+
+    def test_indexed_digest_reuses_its_version(self):
+        """Test a digest in the index is reused once its version is confirmed."""
+        self.stored_index({'abc': '7'})
+        self.mock_lambda.get_function_configuration.return_value = {'CodeSha256': 'abc', 'State': 'Active'}
+
+        version = index.find_published_version('bucket', 'app-dev', 'sha256:abc')
+
+        self.assertEqual(version, '7')
+        self.mock_lambda.get_function_configuration.assert_called_once_with(FunctionName='app-dev', Qualifier='7')
+        self.mock_s3.put_object.assert_not_called()
+
+    def test_stale_index_entry_is_ignored(self):
+        """Test an entry whose version no longer carries the digest falls back to a new publish."""
+        self.stored_index({'abc': '7'})
+        self.mock_lambda.get_function_configuration.return_value = {'CodeSha256': 'other', 'State': 'Active'}
+
+        self.assertIsNone(index.find_published_version('bucket', 'app-dev', 'sha256:abc'))
+
+    def test_missing_index_is_rebuilt_from_published_versions(self):
+        """Test a missing index is rebuilt from list_versions_by_function, newest version first."""
+        self.mock_s3.get_object.side_effect = client_error('NoSuchKey')
+        self.mock_lambda.get_paginator.return_value.paginate.return_value = [{'Versions': [
+            {'Version': '$LATEST', 'CodeSha256': 'abc'},
+            {'Version': '3', 'CodeSha256': 'abc'},
+            {'Version': '12', 'CodeSha256': 'abc'},
+            {'Version': '5', 'CodeSha256': 'def'}
+        ]}]
+        self.mock_lambda.get_function_configuration.return_value = {'CodeSha256': 'abc', 'State': 'Active'}
+
+        version = index.find_published_version('bucket', 'app-dev', 'sha256:abc')
+
+        self.assertEqual(version, '12')
+        saved = self.mock_s3.put_object.call_args[1]
+        self.assertEqual(saved['Key'], 'indexes/app-dev/versions.json')
+        self.assertEqual(json.loads(saved['Body'])['versions'], {'abc': '12', 'def': '5'})
+
+    def test_access_denied_is_raised(self):
+        """Test missing S3 permissions surface instead of silently skipping the index."""
+        self.mock_s3.get_object.side_effect = client_error('AccessDenied')
+
+        with self.assertRaises(ClientError):
+            index.find_published_version('bucket', 'app-dev', 'sha256:abc')
+        self.mock_lambda.get_paginator.assert_not_called()
+
+
+def update_status(status, reason=None):
+    """Build a get_function_configuration response for a code update in status."""
+    config = {'LastUpdateStatus': status} if status else {}
+    if reason:
+        config.update(LastUpdateStatusReasonCode='ImageAccessDenied', LastUpdateStatusReason=reason)
+    return config
+
+
+class TestCodeUpdate(unittest.TestCase):
+    def setUp(self):
+        """Set up test fixtures."""
+        self.env_patcher = patch.dict(os.environ, {
+            'CODEDEPLOY_APP_NAME': 'app',
+            'DEPLOYMENT_GROUP_NAME': 'app-dev',
+            'LAMBDA_FUNCTION_NAME': 'app-dev',
+            'APPSPEC_BUCKET': 'appspec-bucket'
+        })
+        self.env_patcher.start()
+        self.clock = SimulatedClock()
+        self.sleep_patcher = patch('index.time.sleep', side_effect=self.clock.sleep)
+        self.mock_sleep = self.sleep_patcher.start()
+        self.lambda_patcher = patch.object(index, 'lambda_client', Mock())
+        self.mock_lambda = self.lambda_patcher.start()
+        self.s3_patcher = patch.object(index, 's3_client', Mock())
+        self.mock_s3 = self.s3_patcher.start()
+        self.codedeploy_patcher = patch.object(index, 'codedeploy', Mock())
+        self.mock_codedeploy = self.codedeploy_patcher.start()
+
+    def tearDown(self):
+        """Clean up test fixtures."""
+        self.env_patcher.stop()
+        self.sleep_patcher.stop()
+        self.lambda_patcher.stop()
+        self.s3_patcher.stop()
+        self.codedeploy_patcher.stop()
+
+    def sleeps(self):
+        return [call[0][0] for call in self.mock_sleep.call_args_list]
+
+    def test_backoff_resets_when_the_status_changes(self):
+        """Test polling backs off while the status holds and drops to the fast interval on a change."""
+        self.mock_lambda.get_function_configuration.side_effect = [
+            update_status(None), update_status(None), update_status(None),
+            update_status('InProgress'), update_status('InProgress'), update_status('Successful')
+        ]
+
+        updated = index.wait_for_function_updated('app-dev', SimulatedContext(self.clock, 60))
+
+        self.assertTrue(updated)
+        self.assertEqual(self.sleeps(), [0.5, 0.75, 1.125, 0.5, 0.75])
+
+    def test_backoff_is_capped(self):
+        """Test the poll interval never exceeds POLL_MAX_DELAY_SECONDS."""
+        self.mock_lambda.get_function_configuration.side_effect = (
+            [update_status('InProgress')] * 10 + [update_status('Successful')])
+
+        index.wait_for_function_updated('app-dev', SimulatedContext(self.clock, 300))
+
+        self.assertEqual(max(self.sleeps()), index.POLL_MAX_DELAY_SECONDS)
+
+    def test_failed_update_raises(self):
+        """Test a Failed status raises with the update's reason."""
+        self.mock_lambda.get_function_configuration.side_effect = [
+            update_status('InProgress'), update_status('Failed', reason='no pull access')
+        ]
+
+        with self.assertRaises(RuntimeError) as raised:
+            index.wait_for_function_updated('app-dev', SimulatedContext(self.clock, 60))
+        self.assertIn('ImageAccessDenied no pull access', str(raised.exception))
+
+    def test_slow_update_hands_off_to_an_async_continuation(self):
+        """Test a running update is handed off before less than CONTINUATION_BUFFER_SECONDS remain."""
+        self.mock_lambda.get_function_configuration.return_value = update_status('InProgress')
+        context = SimulatedContext(self.clock, index.CONTINUATION_BUFFER_SECONDS + 5)
+        state = {'imageUri': 'repo:new', 'imageTag': 'new', 'imageDigest': 'sha256:new',
+                 'phase': 'wait', 'version': None, 'phases': {'code_update': 40.0}}
+
+        result = index.handler({'continuation': state, 'continueAsync': True}, context)
+
+        self.assertEqual(result['statusCode'], 202)
+        self.assertGreaterEqual(context.get_remaining_time_in_millis() / 1000, index.CONTINUATION_BUFFER_SECONDS)
+        self.mock_lambda.publish_version.assert_not_called()
+        invoke = self.mock_lambda.invoke.call_args[1]
+        self.assertEqual(invoke['FunctionName'], 'app-dev-deploy')
+        self.assertEqual(invoke['InvocationType'], 'Event')
+        payload = json.loads(invoke['Payload'])
+        self.assertTrue(payload['continueAsync'])
+        self.assertEqual(payload['continuation']['phase'], 'wait')
+
+    def test_continuation_resumes_at_the_update_phase(self):
+        """Test a continuation at the update phase updates, publishes and starts the deployment."""
+        self.mock_s3.get_object.side_effect = client_error('NoSuchKey')
+        self.mock_lambda.get_paginator.return_value.paginate.return_value = [{'Versions': []}]
+        self.mock_lambda.get_function_configuration.side_effect = [
+            update_status('InProgress'), update_status('Successful')
+        ]
+        self.mock_lambda.publish_version.return_value = {'Version': '8', 'CodeSha256': 'new'}
+        self.mock_lambda.get_alias.return_value = {'FunctionVersion': '7'}
+        self.mock_codedeploy.create_deployment.return_value = {'deploymentId': 'd-8'}
+        state = {'imageUri': 'repo:new', 'imageTag': 'new', 'imageDigest': 'sha256:new',
+                 'phase': 'update', 'version': None, 'phases': {'queue_wait': 2.0}}
+
+        result = index.handler({'continuation': state}, SimulatedContext(self.clock, 60))
+
+        self.assertEqual(result['statusCode'], 200)
+        body = json.loads(result['body'])
+        self.assertEqual(body['deploymentId'], 'd-8')
+        self.assertEqual(body['phases']['queue_wait'], 2.0)
+        self.mock_lambda.update_function_code.assert_called_once_with(FunctionName='app-dev', ImageUri='repo:new')
+        appspec, = [json.loads(call[1]['Body']) for call in self.mock_s3.put_object.call_args_list
+                    if call[1]['Key'].startswith('appspec-')]
+        self.assertEqual(appspec['Resources'][0]['TargetService']['Properties']['TargetVersion'], '8')
+
+    def test_phases_and_outcome_are_recorded_under_the_deploy_function(self):
+        """Test phase timings go to the invocation record and every record names the deploy function."""
+        self.mock_lambda.get_function_configuration.return_value = update_status('InProgress')
+        state = {'imageUri': 'repo:new', 'imageTag': 'new', 'imageDigest': None,
+                 'phase': 'update', 'version': None, 'phases': {}}
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            index.handler({'continuation': state}, SimulatedContext(self.clock, 20))
+
+        records = [json.loads(line) for line in output.getvalue().splitlines() if line.startswith('{"_aws"')]
+        outcome, = [record for record in records if 'DeployRequests' in record]
+        invocation, = [record for record in records if 'Duration' in record]
+        self.assertEqual(outcome['Outcome'], 'Continued')
+        self.assertIn('code_update_duration', invocation)
+        self.assertEqual({record['FunctionName'] for record in records}, {'app-dev-deploy'})
+
+
+if __name__ == '__main__':
+    unittest.main()
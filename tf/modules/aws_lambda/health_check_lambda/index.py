@@ -1,18 +1,60 @@
 import json
 import os
-import boto3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
-# Initialize clients
-lambda_client = boto3.client('lambda')
-codedeploy = boto3.client('codedeploy')
-s3_client = boto3.client('s3')
+import replay
+from replay import http_status, invoke_version, nearest_rank
+from clients import lazy_client
+from instrumentation import describe_event, emit_metrics, instrumented, phase
 
+# Clients are built on first use (see lambda_shared/clients.py)
+lambda_client = lazy_client('lambda')
+codedeploy = lazy_client('codedeploy')
+s3_client = lazy_client('s3')
+cloudwatch = lazy_client('cloudwatch')
+
+def http_request_payload(path):
+    """API Gateway REST API proxy integration (payload v1) GET request for path."""
+    # The root path has its own resource; everything else goes through {proxy+} (see api_gateway.tf)
+    resource = "/" if path == "/" else "/{proxy+}"
+    return {
+        "resource": resource,
+        "path": path,
+        "httpMethod": "GET",
+        "headers": {
+            "Accept": "*/*",
+            "User-Agent": "hoist-health-check"
+        },
+        "queryStringParameters": None,
+        "pathParameters": None if path == "/" else {"proxy": path.lstrip("/")},
+        "body": None,
+        "isBase64Encoded": False,
+        "requestContext": {
+            "resourcePath": resource,
+            "httpMethod": "GET",
+            "path": path
+        }
+    }
+
+# Invocation used for health checks and warm-up requests
+HEALTH_CHECK_PAYLOAD = http_request_payload("/health")
+
+# Rolling cold-start baseline kept in the AppSpec bucket (see init_baseline_key)
+INIT_BASELINE_SCHEMA_VERSION = 1
+INIT_BASELINE_WINDOW = 10
+
+# Time the gates leave for reporting the hook status to CodeDeploy
+GATE_RESERVE_MS = 30000
+
+@instrumented
 def handler(event, context):
     """
     BeforeAllowTraffic hook to verify the new Lambda version is healthy
     before routing traffic to it.
     """
-    print(f"Received event: {json.dumps(event)}")
+    print(f"Received event: {describe_event(event)}")
     
     deployment_id = event['DeploymentId']
     lifecycle_event_hook_execution_id = event['LifecycleEventHookExecutionId']
@@ -34,7 +76,6 @@ def handler(event, context):
             try:
                 # Get deployment details
                 deployment_response = codedeploy.get_deployment(deploymentId=deployment_id)
-                print(f"Deployment response: {json.dumps(deployment_response, default=str)}")
                 
                 # Extract S3 location from deployment
                 revision = deployment_response['deploymentInfo']['revision']
@@ -50,8 +91,6 @@ def handler(event, context):
                     appspec_content = response['Body'].read().decode('utf-8')
                     app_spec = json.loads(appspec_content)
                     
-                    print(f"AppSpec content: {json.dumps(app_spec, indent=2)}")
-                    
                     # Extract target version
                     target_version = app_spec['Resources'][0]['TargetService']['Properties']['TargetVersion']
                     print(f"Extracted target version: {target_version}")
@@ -64,53 +103,401 @@ def handler(event, context):
         
         print(f"Testing version: {target_version}")
         
-        # Invoke the specific version of the Lambda function
-        invoke_response = lambda_client.invoke(
-            FunctionName=function_name,
-            Qualifier=target_version,
-            InvocationType='RequestResponse',
-            Payload=json.dumps({
-                "rawPath": "/health",
-                "requestContext": {
-                    "http": {
-                        "method": "GET"
-                    }
-                }
-            })
-        )
+        # Invoke the specific version of the Lambda function. A 200 from the invoke API only
+        # means the call went through, so the HTTP status in the payload decides.
+        with phase('health_check'):
+            invocation = invoke_with_report(function_name, target_version)
+        status_code = http_status(invocation)
+        if invocation['error'] or status_code >= 400:
+            print(f"Health check failed with HTTP status {status_code}")
+            return report_hook_status(deployment_id, lifecycle_event_hook_execution_id, False,
+                                      {'message': 'Health check failed', 'httpStatus': status_code})
+        print("Health check passed!")
         
-        # Check if the function returned successfully (200 status code)
-        if invoke_response.get('StatusCode') == 200:
-            print("Health check passed!")
-            codedeploy.put_lifecycle_event_hook_execution_status(
-                deploymentId=deployment_id,
-                lifecycleEventHookExecutionId=lifecycle_event_hook_execution_id,
-                status='Succeeded'
-            )
-            return {
-                'statusCode': 200,
-                'body': json.dumps('Health check passed')
-            }
-        else:
-            print(f"Health check failed with status code: {invoke_response.get('StatusCode')}")
-            codedeploy.put_lifecycle_event_hook_execution_status(
-                deploymentId=deployment_id,
-                lifecycleEventHookExecutionId=lifecycle_event_hook_execution_id,
-                status='Failed'
-            )
-            return {
-                'statusCode': 500,
-                'body': json.dumps('Health check failed')
-            }
+        # Warm enough environments for the canary's traffic share before releasing the hook;
+        # the health check's own cold start already left one behind
+        with phase('prewarm'):
+            prewarm = prewarm_version(function_name, target_version, context,
+                                      already_warm=1 if invocation['initDuration'] is not None else 0)
+        if not prewarm['passed']:
+            return report_hook_status(deployment_id, lifecycle_event_hook_execution_id, False,
+                                      {'message': prewarm['reason'], 'prewarm': prewarm})
+        
+        # Compare cold-start cost with the rolling baseline of previously accepted versions
+        init_samples = [invocation['initDuration']] if invocation['initDuration'] is not None else []
+        init_samples += prewarm.get('initDurations', [])
+        with phase('cold_start_gate'):
+            cold_start = run_cold_start_gate(function_name, target_version, init_samples, context)
+        
+        # Compare the new version's latency under concurrent load with the live version's
+        with phase('performance_gate'):
+            probe = run_performance_gate(function_name, target_version, context)
+        
+        # Replay sampled production requests against both versions
+        with phase('replay_gate'):
+            shadow = run_replay_gate(function_name, target_version, context)
+        
+        passed = cold_start['passed'] and probe['passed'] and shadow['passed']
+        if passed and cold_start['enabled']:
+            record_init_baseline(function_name, target_version, cold_start['target'])
+        result = {
+            'message': '; '.join([cold_start['reason'], probe['reason'], shadow['reason']]),
+            'prewarm': prewarm,
+            'coldStart': cold_start,
+            'probe': probe,
+            'replay': shadow
+        }
+        return report_hook_status(deployment_id, lifecycle_event_hook_execution_id, passed, result)
         
     except Exception as e:
         print(f"Error during health check: {str(e)}")
-        codedeploy.put_lifecycle_event_hook_execution_status(
-            deploymentId=deployment_id,
-            lifecycleEventHookExecutionId=lifecycle_event_hook_execution_id,
-            status='Failed'
+        return report_hook_status(deployment_id, lifecycle_event_hook_execution_id, False,
+                                  f'Error: {str(e)}')
+
+def report_hook_status(deployment_id, lifecycle_event_hook_execution_id, passed, body):
+    """Tell CodeDeploy whether the hook passed and build the matching response."""
+    codedeploy.put_lifecycle_event_hook_execution_status(
+        deploymentId=deployment_id,
+        lifecycleEventHookExecutionId=lifecycle_event_hook_execution_id,
+        status='Succeeded' if passed else 'Failed'
+    )
+    return {
+        'statusCode': 200 if passed else 500,
+        'body': json.dumps(body)
+    }
+
+def time_budget_spent(context):
+    """Whether a gate should stop sending requests to leave time for the hook status call."""
+    return context.get_remaining_time_in_millis() < GATE_RESERVE_MS
+
+def prewarm_version(function_name, target_version, context, already_warm=0):
+    """
+    Invoke the target version concurrently until enough environments are warm.
+
+    The target is the live alias's peak ConcurrentExecutions over the last
+    PREWARM_LOOKBACK_MINUTES, scaled by PREWARM_FACTOR and clamped to
+    PREWARM_MIN_ENVIRONMENTS..PREWARM_MAX_ENVIRONMENTS. Each wave sends that
+    many simultaneous health requests; an invocation whose REPORT line has an
+    Init Duration started a new environment, on top of the already_warm ones.
+    Waves repeat until the target is reached, PREWARM_MAX_WAVES have run, or
+    the hook's time budget is nearly spent. Ending below PREWARM_MIN_WARM_FRACTION
+    of the target fails the check, since the canary would then shift traffic
+    onto mostly cold environments; a smaller shortfall only logs a warning.
+    """
+    max_environments = int(os.environ.get('PREWARM_MAX_ENVIRONMENTS', '0'))
+    if max_environments <= 0:
+        return {'enabled': False, 'passed': True}
+    min_warm_fraction = float(os.environ.get('PREWARM_MIN_WARM_FRACTION', '0.5'))
+    min_environments = int(os.environ.get('PREWARM_MIN_ENVIRONMENTS', '1'))
+    factor = float(os.environ.get('PREWARM_FACTOR', '1.0'))
+    max_waves = int(os.environ.get('PREWARM_MAX_WAVES', '5'))
+    
+    peak = get_live_peak_concurrency(function_name, int(os.environ.get('PREWARM_LOOKBACK_MINUTES', '60')))
+    desired = max(min_environments, min(max_environments, int(peak * factor + 0.999)))
+    print(f"Pre-warming {desired} environments of version {target_version} (live peak concurrency {peak})")
+    
+    result = {'enabled': True, 'livePeakConcurrency': peak, 'desired': desired, 'warm': already_warm,
+              'waves': 0, 'initDurations': [], 'errors': 0}
+    started_at = time.monotonic()
+    with ThreadPoolExecutor(max_workers=desired) as pool:
+        while result['warm'] < desired and result['waves'] < max_waves:
+            # Keep a minute for the remaining checks and the hook status call
+            if context.get_remaining_time_in_millis() < 60000:
+                print("Time budget nearly spent, stopping pre-warm")
+                break
+            result['waves'] += 1
+            for invocation in pool.map(lambda _: invoke_with_report(function_name, target_version), range(desired)):
+                if invocation['error']:
+                    result['errors'] += 1
+                if invocation['initDuration'] is not None:
+                    result['warm'] += 1
+                    result['initDurations'].append(invocation['initDuration'])
+    
+    result['durationSeconds'] = round(time.monotonic() - started_at, 3)
+    result['passed'] = result['warm'] >= desired * min_warm_fraction
+    if result['warm'] < desired:
+        result['reason'] = f"Only {result['warm']} of {desired} environments started after {result['waves']} waves"
+        print(f"{'Warning' if result['passed'] else 'Failing'}: {result['reason']}")
+    else:
+        result['reason'] = f"Pre-warmed {result['warm']} environments in {result['waves']} waves"
+        print(result['reason'])
+    return result
+
+def get_live_peak_concurrency(function_name, lookback_minutes):
+    """Peak ConcurrentExecutions of the live alias over the lookback window (0 without data)."""
+    now = datetime.utcnow()
+    try:
+        response = cloudwatch.get_metric_statistics(
+            Namespace='AWS/Lambda',
+            MetricName='ConcurrentExecutions',
+            Dimensions=[
+                {'Name': 'FunctionName', 'Value': function_name},
+                {'Name': 'Resource', 'Value': f"{function_name}:live"}
+            ],
+            StartTime=now - timedelta(minutes=lookback_minutes),
+            EndTime=now,
+            Period=60,
+            Statistics=['Maximum']
         )
-        return {
-            'statusCode': 500,
-            'body': json.dumps(f'Error: {str(e)}')
-        }
\ No newline at end of file
+    except Exception as e:
+        print(f"Could not read live concurrency, using the minimum: {e}")
+        return 0
+    return max((point['Maximum'] for point in response.get('Datapoints', [])), default=0)
+
+def invoke_with_report(function_name, qualifier, payload=None):
+    """Invoke one version of the function under test (see replay.invoke_version)."""
+    return invoke_version(lambda_client, function_name, qualifier, payload or HEALTH_CHECK_PAYLOAD)
+
+def run_performance_gate(function_name, target_version, context):
+    """
+    Load-probe the target and live versions and apply the latency budget.
+
+    Sends PROBE_REQUESTS requests to each of PROBE_PATHS (comma separated) on
+    both versions, PROBE_CONCURRENCY at a time, with target and live requests
+    interleaved so both see the same conditions. The gate fails when the
+    target's error rate exceeds PROBE_MAX_ERROR_RATE, or when its
+    PROBE_GATE_PERCENTILE latency is more than LATENCY_BUDGET_PERCENT (plus
+    LATENCY_BUDGET_FLOOR_MS of noise allowance) above the live version's.
+    The probe is skipped, or cut short and judged on the requests made so far,
+    when the hook's time budget runs low.
+    """
+    requests = int(os.environ.get('PROBE_REQUESTS', '0'))
+    if requests <= 0:
+        return {'enabled': False, 'passed': True, 'reason': 'Health check passed'}
+    if time_budget_spent(context):
+        print("Time budget nearly spent, skipping the load probe")
+        return {'enabled': True, 'skipped': True, 'passed': True,
+                'reason': 'Load probe skipped, hook time budget nearly spent'}
+    paths = [path.strip() for path in os.environ.get('PROBE_PATHS', '/health').split(',') if path.strip()]
+    concurrency = int(os.environ.get('PROBE_CONCURRENCY', '5'))
+    
+    samples = run_load_probe(function_name, [target_version, 'live'], paths, requests, concurrency, context)
+    target = summarize_latencies(samples[target_version])
+    live = summarize_latencies(samples['live'])
+    passed, reason = evaluate_latency_budget(
+        target, live,
+        budget_percent=float(os.environ.get('LATENCY_BUDGET_PERCENT', '20')),
+        floor_ms=float(os.environ.get('LATENCY_BUDGET_FLOOR_MS', '25')),
+        percentile_key=os.environ.get('PROBE_GATE_PERCENTILE', 'p95'),
+        max_error_rate=float(os.environ.get('PROBE_MAX_ERROR_RATE', '0'))
+    )
+    print(f"Load probe target={json.dumps(target)} live={json.dumps(live)}: {reason}")
+    return {'enabled': True, 'passed': passed, 'reason': reason, 'paths': paths, 'target': target, 'live': live}
+
+def run_load_probe(function_name, qualifiers, paths, requests, concurrency, context):
+    """
+    Invoke every qualifier requests times per path, concurrently; returns invocations per qualifier.
+
+    Requests not yet sent when the hook's time budget runs low are dropped.
+    """
+    def probe(job):
+        if time_budget_spent(context):
+            return None
+        return invoke_with_report(function_name, job[0], http_request_payload(job[1]))
+
+    jobs = [(qualifier, path) for path in paths for _ in range(requests) for qualifier in qualifiers]
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        invocations = list(pool.map(probe, jobs))
+    
+    samples = {qualifier: [] for qualifier in qualifiers}
+    for (qualifier, path), invocation in zip(jobs, invocations):
+        if invocation is None:
+            continue
+        invocation['path'] = path
+        samples[qualifier].append(invocation)
+    return samples
+
+def summarize_latencies(invocations):
+    """Count, error count and p50/p95/p99 latency (ms) of a list of invocations."""
+    latencies = sorted(invocation['latencyMs'] for invocation in invocations)
+    return {
+        'count': len(invocations),
+        'errors': sum(1 for invocation in invocations if http_status(invocation) >= 500),
+        'p50': round(nearest_rank(latencies, 50), 1),
+        'p95': round(nearest_rank(latencies, 95), 1),
+        'p99': round(nearest_rank(latencies, 99), 1)
+    }
+
+def evaluate_latency_budget(target, live, budget_percent, floor_ms, percentile_key='p95', max_error_rate=0):
+    """Return (passed, reason) for the target's latency summary against the live one."""
+    if target['count'] and target['errors'] / target['count'] > max_error_rate:
+        return False, f"Target returned {target['errors']} server errors in {target['count']} requests"
+    
+    if not live['count'] or live['errors'] == live['count']:
+        return True, "No live baseline to compare against, latency gate skipped"
+    
+    allowed = live[percentile_key] * (1 + budget_percent / 100) + floor_ms
+    if target[percentile_key] > allowed:
+        return False, (f"Target {percentile_key} {target[percentile_key]}ms exceeds live "
+                       f"{live[percentile_key]}ms + {budget_percent:g}% budget ({allowed:.1f}ms)")
+    return True, f"Target {percentile_key} {target[percentile_key]}ms within budget ({allowed:.1f}ms)"
+
+def run_cold_start_gate(function_name, target_version, init_samples, context):
+    """
+    Measure the target version's Init Duration and compare it with the baseline.
+
+    init_samples holds Init Durations already observed (health check and
+    pre-warm). If there are fewer than COLD_START_SAMPLES, concurrent bursts
+    larger than the environments started so far force fresh ones. The median
+    is compared with the median of the rolling baseline; a regression beyond
+    COLD_START_BUDGET_PERCENT fails the hook when COLD_START_GATE_MODE is
+    'fail' and only warns when it is 'warn'. No burst starts once the hook's
+    time budget runs low.
+    """
+    wanted = int(os.environ.get('COLD_START_SAMPLES', '0'))
+    if wanted <= 0:
+        return {'enabled': False, 'passed': True, 'reason': 'Cold-start gate disabled'}
+    budget_percent = float(os.environ.get('COLD_START_BUDGET_PERCENT', '25'))
+    mode = os.environ.get('COLD_START_GATE_MODE', 'warn')
+    
+    samples = list(init_samples)
+    for _ in range(int(os.environ.get('COLD_START_MAX_BURSTS', '3'))):
+        if len(samples) >= wanted:
+            break
+        if time_budget_spent(context):
+            print("Time budget nearly spent, no more cold-start bursts")
+            break
+        # Each environment started so far can absorb one request; the rest need fresh ones
+        burst = len(samples) + wanted
+        with ThreadPoolExecutor(max_workers=burst) as pool:
+            for invocation in pool.map(lambda _: invoke_with_report(function_name, target_version), range(burst)):
+                if invocation['initDuration'] is not None:
+                    samples.append(invocation['initDuration'])
+    
+    target = summarize_init_durations(samples)
+    baseline = load_init_baseline(function_name)
+    baseline_p50 = baseline_median(baseline)
+    emit_cold_start_metrics(function_name, target_version, target, baseline_p50)
+    
+    result = {'enabled': True, 'passed': True, 'target': target, 'baselineP50': baseline_p50, 'mode': mode}
+    if not samples:
+        result['reason'] = 'No cold starts observed, cold-start gate skipped'
+    elif baseline_p50 is None:
+        result['reason'] = f"Init p50 {target['p50']}ms recorded as the first baseline"
+    else:
+        allowed = baseline_p50 * (1 + budget_percent / 100)
+        if target['p50'] > allowed:
+            result['regressed'] = True
+            result['passed'] = mode != 'fail'
+            result['reason'] = (f"Init p50 {target['p50']}ms exceeds baseline {baseline_p50}ms "
+                                f"+ {budget_percent:g}% ({allowed:.1f}ms)")
+            print(f"{'Failing' if mode == 'fail' else 'Warning'}: {result['reason']}")
+        else:
+            result['reason'] = f"Init p50 {target['p50']}ms within baseline budget ({allowed:.1f}ms)"
+    print(f"Cold-start gate: {json.dumps(result)}")
+    return result
+
+def summarize_init_durations(samples):
+    """Sample count, p50 and max of Init Durations (ms)."""
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'p50': round(nearest_rank(ordered, 50), 1),
+        'max': round(ordered[-1], 1) if ordered else 0
+    }
+
+def init_baseline_key(function_name):
+    """S3 key of the rolling Init Duration baseline for function_name."""
+    return f"baselines/{function_name}/init-duration.json"
+
+def load_init_baseline(function_name):
+    """Load the rolling baseline, or an empty one when there is none yet."""
+    empty = {'schemaVersion': INIT_BASELINE_SCHEMA_VERSION, 'functionName': function_name, 'versions': []}
+    bucket_name = os.environ.get('BASELINE_BUCKET')
+    if not bucket_name:
+        return empty
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=init_baseline_key(function_name))
+        baseline = json.loads(response['Body'].read())
+    except Exception as e:
+        print(f"No Init Duration baseline available: {e}")
+        return empty
+    if baseline.get('schemaVersion') != INIT_BASELINE_SCHEMA_VERSION:
+        return empty
+    return baseline
+
+def baseline_median(baseline):
+    """Median of the per-version Init p50s in the baseline, or None when it is empty."""
+    values = sorted(entry['p50'] for entry in baseline.get('versions', []))
+    if not values:
+        return None
+    return round(nearest_rank(values, 50), 1)
+
+def record_init_baseline(function_name, version, measurement):
+    """Add an accepted version's measurement to the rolling baseline; failures are only logged."""
+    bucket_name = os.environ.get('BASELINE_BUCKET')
+    if not bucket_name or not measurement['count']:
+        return
+    try:
+        baseline = load_init_baseline(function_name)
+        entries = [entry for entry in baseline['versions'] if entry['version'] != version]
+        entries.insert(0, {
+            'version': version,
+            'p50': measurement['p50'],
+            'max': measurement['max'],
+            'count': measurement['count'],
+            'recordedAt': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        })
+        baseline['versions'] = entries[:INIT_BASELINE_WINDOW]
+        s3_client.put_object(
+            Bucket=bucket_name,
+            Key=init_baseline_key(function_name),
+            Body=json.dumps(baseline, separators=(',', ':')),
+            ContentType='application/json'
+        )
+    except Exception as e:
+        print(f"Warning: could not record Init Duration baseline: {e}")
+
+def emit_cold_start_metrics(function_name, version, measurement, baseline_p50):
+    """Record the Init Duration measurement of the version under test."""
+    metrics = {
+        'InitDurationP50': measurement['p50'],
+        'InitDurationMax': measurement['max'],
+        'ColdStartSamples': measurement['count']
+    }
+    emit_metrics(metrics, [['FunctionName']], {
+        'TargetFunction': function_name,
+        'Version': version,
+        'BaselineInitDurationP50': baseline_p50
+    }, units={'InitDurationP50': 'Milliseconds', 'InitDurationMax': 'Milliseconds'})
+
+def run_replay_gate(function_name, target_version, context):
+    """
+    Replay captured production requests against the target and live versions.
+
+    Loads the REPLAY_EVENTS most recent events captured under
+    captures/<function>/ in CAPTURE_BUCKET and replays each against both
+    versions, REPLAY_CONCURRENCY at a time. The gate fails when any route's
+    5xx rate rises by more than REPLAY_MAX_ERROR_DELTA or its p95 latency
+    exceeds live by more than LATENCY_BUDGET_PERCENT (see replay.compare_routes).
+    Like the load probe it is skipped or cut short when the time budget runs low.
+    """
+    limit = int(os.environ.get('REPLAY_EVENTS', '0'))
+    bucket_name = os.environ.get('CAPTURE_BUCKET')
+    if limit <= 0 or not bucket_name:
+        return {'enabled': False, 'passed': True, 'reason': 'Replay disabled'}
+    if time_budget_spent(context):
+        print("Time budget nearly spent, skipping the replay")
+        return {'enabled': True, 'skipped': True, 'passed': True,
+                'reason': 'Replay skipped, hook time budget nearly spent'}
+    
+    events = replay.load_captured_events(s3_client, bucket_name, f"captures/{function_name}/", limit)
+    if not events:
+        return {'enabled': True, 'passed': True, 'events': 0, 'reason': 'No captured requests to replay'}
+    
+    results = replay.replay_events(events, {
+        target_version: replay.lambda_invoker(lambda_client, function_name, target_version),
+        'live': replay.lambda_invoker(lambda_client, function_name, 'live')
+    }, int(os.environ.get('REPLAY_CONCURRENCY', '5')), should_stop=lambda: time_budget_spent(context))
+    passed, routes = replay.compare_routes(
+        results, 'live', target_version,
+        max_error_delta=float(os.environ.get('REPLAY_MAX_ERROR_DELTA', '0')),
+        latency_budget_percent=float(os.environ.get('LATENCY_BUDGET_PERCENT', '20')),
+        floor_ms=float(os.environ.get('LATENCY_BUDGET_FLOOR_MS', '25'))
+    )
+    failed = [f"{route} ({entry['reason']})" for route, entry in routes.items() if not entry['passed']]
+    reason = f"Replayed {len(events)} requests over {len(routes)} routes"
+    if failed:
+        reason += f", regressed: {', '.join(failed)}"
+    print(f"Replay gate: {reason}")
+    return {'enabled': True, 'passed': passed, 'events': len(events), 'routes': routes, 'reason': reason}
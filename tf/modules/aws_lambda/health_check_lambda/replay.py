@@ -0,0 +1,241 @@
+"""
+Replay captured API Gateway proxy events against two handlers and compare them.
+
+The health check hook replays against the target version and the live alias
+through lambda_invoker. The same engine runs locally against stand-in handlers:
+
+    python replay.py --events ./captures --baseline app:handler --candidate app_new:handler
+
+where --events is a directory of captured event JSON files (as written by
+request_capture_lambda) and each handler is a module:function importable from
+the current directory.
+"""
+import argparse
+import base64
+import importlib
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Path segments that identify a resource rather than a route
+ID_SEGMENT_PATTERN = re.compile(
+    r'^([0-9]+|[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}|[0-9a-fA-F]{24,})$'
+)
+
+# Matches the platform REPORT line of an invocation that started a new environment
+INIT_DURATION_PATTERN = re.compile(r'Init Duration: ([0-9.]+) ms')
+
+def route_key(event):
+    """Group an event by method and path, with ID-like segments collapsed to {id}."""
+    path = event.get('path') or event.get('rawPath') or '/'
+    segments = ['{id}' if ID_SEGMENT_PATTERN.match(segment) else segment for segment in path.split('/')]
+    method = event.get('httpMethod') or event.get('requestContext', {}).get('http', {}).get('method', 'GET')
+    return f"{method} {'/'.join(segments) or '/'}"
+
+def response_status(response):
+    """HTTP status of a proxy integration response (a bare non-dict response counts as 200)."""
+    if isinstance(response, dict) and 'statusCode' in response:
+        try:
+            return int(response['statusCode'])
+        except (TypeError, ValueError):
+            return 502
+    return 200
+
+def http_status(invocation):
+    """
+    HTTP status of an invoke_version result, as API Gateway would see it.
+
+    Function errors and unparseable payloads count as 502.
+    """
+    if invocation['error']:
+        return 502
+    return response_status(invocation['payload'])
+
+def invoke_version(lambda_client, function_name, qualifier, event):
+    """
+    Invoke one version with LogType=Tail and return what the platform reported.
+
+    Returns the wall-clock latency in milliseconds, the Init Duration from the
+    REPORT line (None when a warm environment served the request), the parsed
+    response payload and whether the invocation errored.
+    """
+    started_at = time.monotonic()
+    response = lambda_client.invoke(
+        FunctionName=function_name,
+        Qualifier=qualifier,
+        InvocationType='RequestResponse',
+        LogType='Tail',
+        Payload=json.dumps(event)
+    )
+    latency_ms = (time.monotonic() - started_at) * 1000
+
+    log_tail = base64.b64decode(response.get('LogResult', '')).decode('utf-8', 'replace')
+    match = INIT_DURATION_PATTERN.search(log_tail)
+    body = response['Payload'].read()
+    error = response.get('StatusCode') != 200 or 'FunctionError' in response
+    try:
+        payload = json.loads(body) if body else None
+    except ValueError:
+        payload, error = None, True
+
+    return {
+        'latencyMs': latency_ms,
+        'initDuration': float(match.group(1)) if match else None,
+        'payload': payload,
+        'error': error
+    }
+
+def lambda_invoker(lambda_client, function_name, qualifier):
+    """Invoker that sends an event to one version of a deployed function."""
+    def invoke(event):
+        invocation = invoke_version(lambda_client, function_name, qualifier, event)
+        return http_status(invocation), invocation['latencyMs']
+    return invoke
+
+def local_invoker(handler):
+    """Invoker that calls a handler function in this process."""
+    def invoke(event):
+        started_at = time.monotonic()
+        try:
+            status = response_status(handler(event, LocalContext()))
+        except Exception as e:
+            print(f"Local handler raised: {e}")
+            status = 502
+        return status, (time.monotonic() - started_at) * 1000
+    return invoke
+
+class LocalContext:
+    """Minimal stand-in for the Lambda context object."""
+    function_name = 'local'
+    aws_request_id = 'local-replay'
+
+    def get_remaining_time_in_millis(self):
+        return 300000
+
+def replay_events(events, invokers, concurrency, should_stop=None):
+    """
+    Send every event to every invoker, concurrency requests at a time.
+
+    Events are interleaved across invokers so both sides see the same
+    conditions. Once should_stop() returns true no further requests are sent
+    and only the outcomes so far are kept.
+    Returns {invoker name: {route: [(status, latency_ms), ...]}}.
+    """
+    def run(job):
+        if should_stop and should_stop():
+            return None
+        return invokers[job[0]](job[1])
+
+    jobs = [(name, event) for event in events for name in invokers]
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        outcomes = list(pool.map(run, jobs))
+
+    results = {name: {} for name in invokers}
+    for (name, event), outcome in zip(jobs, outcomes):
+        if outcome is not None:
+            results[name].setdefault(route_key(event), []).append(outcome)
+    return results
+
+def summarize_route(outcomes):
+    """Request count, error rate (5xx) and p50/p95 latency for one route."""
+    latencies = sorted(latency for _, latency in outcomes)
+    errors = sum(1 for status, _ in outcomes if status >= 500)
+    return {
+        'count': len(outcomes),
+        'errorRate': round(errors / len(outcomes), 3) if outcomes else 0,
+        'p50': round(nearest_rank(latencies, 50), 1),
+        'p95': round(nearest_rank(latencies, 95), 1)
+    }
+
+def nearest_rank(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list (0 when empty)."""
+    if not sorted_values:
+        return 0
+    rank = max(1, int(-(-pct * len(sorted_values) // 100)))
+    return sorted_values[rank - 1]
+
+def compare_routes(results, baseline, candidate, max_error_delta, latency_budget_percent, floor_ms):
+    """
+    Compare the candidate with the baseline route by route.
+
+    A route fails when the candidate's 5xx rate exceeds the baseline's by more
+    than max_error_delta, or its p95 exceeds the baseline's p95 by more than
+    latency_budget_percent plus floor_ms. Returns (passed, per-route report).
+    """
+    report = {}
+    passed = True
+    for route in sorted(results[candidate]):
+        base = summarize_route(results[baseline].get(route, []))
+        cand = summarize_route(results[candidate][route])
+        entry = {
+            'baseline': base,
+            'candidate': cand,
+            'errorDelta': round(cand['errorRate'] - base['errorRate'], 3),
+            'p95DeltaMs': round(cand['p95'] - base['p95'], 1),
+            'passed': True
+        }
+        if entry['errorDelta'] > max_error_delta:
+            entry['passed'] = False
+            entry['reason'] = f"error rate up {entry['errorDelta']:.1%}"
+        elif base['count'] and cand['p95'] > base['p95'] * (1 + latency_budget_percent / 100) + floor_ms:
+            entry['passed'] = False
+            entry['reason'] = f"p95 {cand['p95']}ms vs {base['p95']}ms"
+        passed = passed and entry['passed']
+        report[route] = entry
+    return passed, report
+
+def load_captured_events(s3_client, bucket_name, prefix, limit):
+    """Load up to limit of the most recently captured events under prefix."""
+    objects = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        objects.extend(page.get('Contents', []))
+    objects.sort(key=lambda obj: obj['LastModified'], reverse=True)
+
+    events = []
+    for obj in objects[:limit]:
+        response = s3_client.get_object(Bucket=bucket_name, Key=obj['Key'])
+        events.append(json.loads(response['Body'].read()))
+    return events
+
+def load_event_directory(directory):
+    """Load every *.json event in a local directory."""
+    events = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.json'):
+            with open(os.path.join(directory, name)) as f:
+                events.append(json.load(f))
+    return events
+
+def import_handler(spec):
+    """Import 'module:function' relative to the current directory."""
+    module_name, _, function_name = spec.partition(':')
+    sys.path.insert(0, os.getcwd())
+    return getattr(importlib.import_module(module_name), function_name or 'handler')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay captured requests against two handlers')
+    parser.add_argument('--events', required=True, help='directory of captured event JSON files')
+    parser.add_argument('--baseline', required=True, help='module:function of the current handler')
+    parser.add_argument('--candidate', required=True, help='module:function of the new handler')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--max-error-delta', type=float, default=0.0)
+    parser.add_argument('--latency-budget-percent', type=float, default=20)
+    parser.add_argument('--latency-floor-ms', type=float, default=5)
+    args = parser.parse_args(argv)
+
+    events = load_event_directory(args.events)
+    results = replay_events(events, {
+        'baseline': local_invoker(import_handler(args.baseline)),
+        'candidate': local_invoker(import_handler(args.candidate))
+    }, args.concurrency)
+    passed, report = compare_routes(results, 'baseline', 'candidate', args.max_error_delta,
+                                    args.latency_budget_percent, args.latency_floor_ms)
+    print(json.dumps({'passed': passed, 'events': len(events), 'routes': report}, indent=2))
+    return 0 if passed else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
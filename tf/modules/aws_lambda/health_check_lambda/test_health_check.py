@@ -0,0 +1,376 @@
+import unittest
+from unittest.mock import Mock, patch
+import base64
+import io
+import json
+import os
+import sys
+
+# Add the current directory to the path so we can import the module
+sys.path.insert(0, os.path.dirname(__file__))
+# Shared modules Terraform packages alongside index.py
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lambda_shared'))
+
+# Import the module under test
+import index
+import replay
+
+
+def invoke_response(payload, init_duration=None, status_code=200, function_error=None):
+    """Build a lambda invoke response with a LogType=Tail log."""
+    report = "REPORT RequestId: test Duration: 2.00 ms"
+    if init_duration is not None:
+        report += f"\tInit Duration: {init_duration} ms"
+    response = {
+        'StatusCode': status_code,
+        'LogResult': base64.b64encode(report.encode()).decode(),
+        'Payload': io.BytesIO(json.dumps(payload).encode())
+    }
+    if function_error:
+        response['FunctionError'] = function_error
+    return response
+
+
+class TestHealthCheckLambda(unittest.TestCase):
+    def setUp(self):
+        """Set up test fixtures."""
+        self.env_patcher = patch.dict(os.environ, {
+            'FUNCTION_NAME': 'test-function',
+            'PREWARM_MAX_ENVIRONMENTS': '0',
+            'PROBE_REQUESTS': '4',
+            'PROBE_PATHS': '/health,/api/items',
+            'PROBE_CONCURRENCY': '2',
+            'LATENCY_BUDGET_PERCENT': '20',
+            'LATENCY_BUDGET_FLOOR_MS': '5'
+        })
+        self.env_patcher.start()
+
+        self.mock_lambda = Mock()
+        self.mock_codedeploy = Mock()
+        self.mock_cloudwatch = Mock()
+        self.mock_s3 = Mock()
+
+        self.lambda_patcher = patch('index.lambda_client', self.mock_lambda)
+        self.codedeploy_patcher = patch('index.codedeploy', self.mock_codedeploy)
+        self.cloudwatch_patcher = patch('index.cloudwatch', self.mock_cloudwatch)
+        self.s3_patcher = patch('index.s3_client', self.mock_s3)
+
+        self.lambda_patcher.start()
+        self.codedeploy_patcher.start()
+        self.cloudwatch_patcher.start()
+        self.s3_patcher.start()
+
+        self.context = Mock()
+        self.context.get_remaining_time_in_millis.return_value = 300000
+        self.event = {
+            'DeploymentId': 'd-TEST',
+            'LifecycleEventHookExecutionId': 'hook-1',
+            'TargetVersion': '7'
+        }
+
+    def tearDown(self):
+        """Clean up after tests."""
+        self.env_patcher.stop()
+        self.lambda_patcher.stop()
+        self.codedeploy_patcher.stop()
+        self.cloudwatch_patcher.stop()
+        self.s3_patcher.stop()
+
+    def hook_status(self):
+        return self.mock_codedeploy.put_lifecycle_event_hook_execution_status.call_args[1]['status']
+
+    def test_http_status_from_payload(self):
+        """Test the HTTP status comes from the payload, not the invoke API."""
+        self.assertEqual(index.http_status({'error': False, 'payload': {'statusCode': 503}}), 503)
+        self.assertEqual(index.http_status({'error': False, 'payload': {'statusCode': '201'}}), 201)
+        self.assertEqual(index.http_status({'error': False, 'payload': 'ok'}), 200)
+        self.assertEqual(index.http_status({'error': True, 'payload': None}), 502)
+
+    def test_http_request_payload_is_a_rest_proxy_event(self):
+        """Test probe requests have the REST API proxy integration (v1) shape the function receives."""
+        event = index.http_request_payload('/api/items')
+
+        self.assertEqual(event['httpMethod'], 'GET')
+        self.assertEqual(event['path'], '/api/items')
+        self.assertEqual(event['resource'], '/{proxy+}')
+        self.assertEqual(event['pathParameters'], {'proxy': 'api/items'})
+        self.assertIsInstance(event['headers'], dict)
+        self.assertEqual(event['requestContext']['resourcePath'], '/{proxy+}')
+        self.assertEqual(event['requestContext']['httpMethod'], 'GET')
+        self.assertNotIn('rawPath', event)
+        self.assertEqual(index.http_request_payload('/')['resource'], '/')
+
+    def test_percentiles(self):
+        """Test nearest-rank percentiles."""
+        values = list(range(1, 101))
+        self.assertEqual(replay.nearest_rank(values, 50), 50)
+        self.assertEqual(replay.nearest_rank(values, 95), 95)
+        self.assertEqual(replay.nearest_rank(values, 99), 99)
+        self.assertEqual(replay.nearest_rank([], 95), 0)
+
+    def test_evaluate_latency_budget(self):
+        """Test the latency budget and error-rate gate."""
+        live = {'count': 10, 'errors': 0, 'p50': 10, 'p95': 100, 'p99': 150}
+        within = {'count': 10, 'errors': 0, 'p50': 10, 'p95': 119, 'p99': 300}
+        slower = {'count': 10, 'errors': 0, 'p50': 10, 'p95': 121, 'p99': 150}
+        failing = {'count': 10, 'errors': 1, 'p50': 10, 'p95': 50, 'p99': 50}
+
+        self.assertTrue(index.evaluate_latency_budget(within, live, 20, 0)[0])
+        self.assertFalse(index.evaluate_latency_budget(slower, live, 20, 0)[0])
+        self.assertTrue(index.evaluate_latency_budget(slower, live, 20, 5)[0])
+        self.assertFalse(index.evaluate_latency_budget(within, live, 20, 0, percentile_key='p99')[0])
+        self.assertFalse(index.evaluate_latency_budget(failing, live, 20, 0)[0])
+
+    def test_handler_fails_on_unhealthy_payload(self):
+        """Test a 200 invoke with a 500 response payload fails the hook."""
+        self.mock_lambda.invoke.return_value = invoke_response({'statusCode': 500})
+
+        result = index.handler(self.event, self.context)
+
+        self.assertEqual(result['statusCode'], 500)
+        self.assertEqual(self.hook_status(), 'Failed')
+
+    def test_handler_probes_target_and_live_across_paths(self):
+        """Test the load probe hits both versions on every path and passes within budget."""
+        self.mock_lambda.invoke.side_effect = lambda **kwargs: invoke_response({'statusCode': 200})
+
+        result = index.handler(self.event, self.context)
+
+        self.assertEqual(result['statusCode'], 200)
+        self.assertEqual(self.hook_status(), 'Succeeded')
+        probe = json.loads(result['body'])['probe']
+        self.assertEqual(probe['target']['count'], 8)
+        self.assertEqual(probe['live']['count'], 8)
+
+        probed = [(c[1]['Qualifier'], json.loads(c[1]['Payload'])['path'])
+                  for c in self.mock_lambda.invoke.call_args_list[1:]]
+        self.assertEqual(probed.count(('7', '/api/items')), 4)
+        self.assertEqual(probed.count(('live', '/health')), 4)
+
+    def test_handler_fails_when_target_is_slower(self):
+        """Test the hook fails when the target's p95 exceeds the live p95 plus budget."""
+        latencies = {'7': 200.0, 'live': 100.0}
+
+        def probe(function_name, qualifier, payload=None):
+            return {'latencyMs': latencies[qualifier], 'initDuration': None,
+                    'payload': {'statusCode': 200}, 'error': False}
+
+        with patch('index.invoke_with_report', side_effect=probe):
+            result = index.handler(self.event, self.context)
+
+        self.assertEqual(result['statusCode'], 500)
+        self.assertEqual(self.hook_status(), 'Failed')
+        self.assertIn('exceeds live', json.loads(result['body'])['message'])
+
+    def test_handler_skips_gates_when_time_budget_runs_low(self):
+        """Test the load probe and replay are skipped near the timeout and the hook status is still reported."""
+        self.context.get_remaining_time_in_millis.return_value = 20000
+        self.mock_lambda.invoke.side_effect = lambda **kwargs: invoke_response({'statusCode': 200})
+
+        with patch.dict(os.environ, {'REPLAY_EVENTS': '10', 'CAPTURE_BUCKET': 'test-bucket'}):
+            result = index.handler(self.event, self.context)
+
+        self.assertEqual(self.hook_status(), 'Succeeded')
+        body = json.loads(result['body'])
+        self.assertTrue(body['probe']['skipped'])
+        self.assertTrue(body['replay']['skipped'])
+        self.assertEqual(self.mock_lambda.invoke.call_count, 1)
+        self.mock_s3.get_paginator.assert_not_called()
+
+    def test_load_probe_stops_sending_when_time_budget_runs_low(self):
+        """Test requests still queued once the budget runs low are dropped from the probe."""
+        self.context.get_remaining_time_in_millis.side_effect = [300000] * 3 + [1000] * 5
+        self.mock_lambda.invoke.side_effect = lambda **kwargs: invoke_response({'statusCode': 200})
+
+        samples = index.run_load_probe('test-function', ['7', 'live'], ['/health'], 4, 1, self.context)
+
+        self.assertEqual(self.mock_lambda.invoke.call_count, 3)
+        self.assertEqual((len(samples['7']), len(samples['live'])), (2, 1))
+
+    def test_prewarm_counts_new_environments(self):
+        """Test pre-warm sizes from live concurrency and stops once enough environments started."""
+        self.mock_cloudwatch.get_metric_statistics.return_value = {
+            'Datapoints': [{'Maximum': 1.0}, {'Maximum': 3.0}]
+        }
+        # First wave: one of three requests lands on a fresh environment; second wave: all three
+        init_durations = iter([None, 500.0, None, 700.0, 650.0, 600.0])
+        self.mock_lambda.invoke.side_effect = lambda **kwargs: invoke_response(
+            {'statusCode': 200}, init_duration=next(init_durations)
+        )
+
+        with patch.dict(os.environ, {'PREWARM_MAX_ENVIRONMENTS': '10'}):
+            result = index.prewarm_version('test-function', '7', self.context)
+
+        self.assertEqual(result['desired'], 3)
+        self.assertEqual(result['warm'], 4)
+        self.assertEqual(result['waves'], 2)
+        self.assertEqual(sorted(result['initDurations']), [500.0, 600.0, 650.0, 700.0])
+
+    def test_prewarm_target_is_scaled_and_clamped(self):
+        """Test the target is peak concurrency times PREWARM_FACTOR, rounded up and clamped."""
+        self.mock_lambda.invoke.side_effect = lambda **kwargs: invoke_response({'statusCode': 200}, init_duration=500.0)
+        env = {'PREWARM_MIN_ENVIRONMENTS': '2', 'PREWARM_MAX_ENVIRONMENTS': '8', 'PREWARM_FACTOR': '1.5'}
+
+        for peak, desired in ((3.0, 5), (0.0, 2), (20.0, 8)):
+            with self.subTest(peak=peak):
+                self.mock_cloudwatch.get_metric_statistics.return_value = {'Datapoints': [{'Maximum': peak}]}
+                with patch.dict(os.environ, env):
+                    result = index.prewarm_version('test-function', '7', self.context)
+                self.assertEqual(result['livePeakConcurrency'], peak)
+                self.assertEqual(result['desired'], desired)
+
+    def test_prewarm_stops_after_max_waves(self):
+        """Test pre-warm gives up after PREWARM_MAX_WAVES when no new environments start."""
+        self.mock_cloudwatch.get_metric_statistics.return_value = {'Datapoints': [{'Maximum': 2.0}]}
+        self.mock_lambda.invoke.side_effect = lambda **kwargs: invoke_response({'statusCode': 200})
+
+        with patch.dict(os.environ, {'PREWARM_MAX_ENVIRONMENTS': '10', 'PREWARM_MAX_WAVES': '3'}):
+            result = index.prewarm_version('test-function', '7', self.context)
+
+        self.assertEqual(result['waves'], 3)
+        self.assertEqual(result['warm'], 0)
+        self.assertFalse(result['passed'])
+        self.assertEqual(self.mock_lambda.invoke.call_count, 6)
+
+    def test_handler_fails_when_too_few_environments_warm(self):
+        """Test the hook fails below PREWARM_MIN_WARM_FRACTION, counting the health check's environment."""
+        self.mock_cloudwatch.get_metric_statistics.return_value = {'Datapoints': [{'Maximum': 4.0}]}
+        # The health check starts one environment and pre-warm only one more
+        init_durations = iter([500.0, 600.0])
+        self.mock_lambda.invoke.side_effect = lambda **kwargs: invoke_response(
+            {'statusCode': 200}, init_duration=next(init_durations, None)
+        )
+
+        with patch.dict(os.environ, {'PREWARM_MAX_ENVIRONMENTS': '10', 'PREWARM_MAX_WAVES': '1',
+                                     'PREWARM_MIN_WARM_FRACTION': '0.75'}):
+            result = index.handler(self.event, self.context)
+
+        self.assertEqual(self.hook_status(), 'Failed')
+        prewarm = json.loads(result['body'])['prewarm']
+        self.assertEqual((prewarm['warm'], prewarm['desired']), (2, 4))
+        self.assertIn('Only 2 of 4', json.loads(result['body'])['message'])
+        # No load probe runs once pre-warm has failed
+        self.assertEqual(self.mock_lambda.invoke.call_count, 5)
+
+    def test_prewarm_stops_when_time_budget_runs_low(self):
+        """Test no new wave starts once less than a minute of the hook's time remains."""
+        self.mock_cloudwatch.get_metric_statistics.return_value = {'Datapoints': [{'Maximum': 2.0}]}
+        self.mock_lambda.invoke.side_effect = lambda **kwargs: invoke_response({'statusCode': 200})
+        self.context.get_remaining_time_in_millis.side_effect = [120000, 90000, 59000]
+
+        with patch.dict(os.environ, {'PREWARM_MAX_ENVIRONMENTS': '10', 'PREWARM_MAX_WAVES': '5'}):
+            result = index.prewarm_version('test-function', '7', self.context)
+
+        self.assertEqual(result['waves'], 2)
+        self.assertEqual(self.mock_lambda.invoke.call_count, 4)
+
+    def test_cold_start_gate_fails_on_init_regression(self):
+        """Test the cold-start gate fails the hook when Init Duration regresses in fail mode."""
+        self.mock_s3.get_object.return_value = {'Body': io.BytesIO(json.dumps({
+            'schemaVersion': 1,
+            'versions': [{'version': '5', 'p50': 400.0}, {'version': '6', 'p50': 500.0},
+                         {'version': '4', 'p50': 450.0}]
+        }).encode())}
+        self.mock_lambda.invoke.side_effect = lambda **kwargs: invoke_response(
+            {'statusCode': 200}, init_duration=900.0
+        )
+
+        with patch.dict(os.environ, {'COLD_START_SAMPLES': '3', 'COLD_START_GATE_MODE': 'fail',
+                                     'BASELINE_BUCKET': 'test-bucket', 'PROBE_REQUESTS': '0'}):
+            result = index.handler(self.event, self.context)
+
+        self.assertEqual(result['statusCode'], 500)
+        self.assertEqual(self.hook_status(), 'Failed')
+        cold_start = json.loads(result['body'])['coldStart']
+        self.assertTrue(cold_start['regressed'])
+        self.assertEqual(cold_start['baselineP50'], 450.0)
+        self.assertGreaterEqual(cold_start['target']['count'], 3)
+        self.mock_s3.put_object.assert_not_called()
+
+    def test_cold_start_gate_records_baseline_when_passing(self):
+        """Test an accepted version's Init Duration is added to the rolling baseline."""
+        self.mock_s3.get_object.side_effect = Exception('NoSuchKey')
+        init_durations = iter([300.0, 320.0, 310.0, None, None, None])
+        self.mock_lambda.invoke.side_effect = lambda **kwargs: invoke_response(
+            {'statusCode': 200}, init_duration=next(init_durations, None)
+        )
+
+        with patch.dict(os.environ, {'COLD_START_SAMPLES': '3', 'BASELINE_BUCKET': 'test-bucket',
+                                     'PROBE_REQUESTS': '0'}):
+            result = index.handler(self.event, self.context)
+
+        self.assertEqual(result['statusCode'], 200)
+        put = self.mock_s3.put_object.call_args[1]
+        self.assertEqual(put['Key'], 'baselines/test-function/init-duration.json')
+        baseline = json.loads(put['Body'])
+        self.assertEqual(baseline['versions'][0]['version'], '7')
+        self.assertEqual(baseline['versions'][0]['count'], 3)
+
+    def test_compare_routes_flags_error_regressions(self):
+        """Test replay comparison fails only the route whose 5xx rate went up."""
+        results = {
+            'live': {'GET /items/{id}': [(200, 10.0)] * 4, 'GET /health': [(200, 5.0)] * 2},
+            '7': {'GET /items/{id}': [(200, 10.0), (500, 10.0), (200, 10.0), (200, 10.0)],
+                  'GET /health': [(200, 5.0)] * 2}
+        }
+
+        passed, routes = replay.compare_routes(results, 'live', '7', 0, 20, 5)
+
+        self.assertFalse(passed)
+        self.assertFalse(routes['GET /items/{id}']['passed'])
+        self.assertEqual(routes['GET /items/{id}']['errorDelta'], 0.25)
+        self.assertTrue(routes['GET /health']['passed'])
+
+    def test_replay_local_handlers(self):
+        """Test the replay engine against stand-in handlers, grouping routes by collapsed IDs."""
+        def baseline(event, context):
+            return {'statusCode': 200}
+
+        def candidate(event, context):
+            if event['path'].startswith('/orders'):
+                raise ValueError('boom')
+            return {'statusCode': 200}
+
+        events = [{'httpMethod': 'GET', 'path': f"/items/{n}"} for n in range(3)]
+        events.append({'httpMethod': 'GET', 'path': '/orders/5f1c2a3b4d5e6f7a8b9c0d1e'})
+        results = replay.replay_events(events, {
+            'baseline': replay.local_invoker(baseline),
+            'candidate': replay.local_invoker(candidate)
+        }, 2)
+
+        self.assertEqual(sorted(results['candidate']), ['GET /items/{id}', 'GET /orders/{id}'])
+        passed, routes = replay.compare_routes(results, 'baseline', 'candidate', 0, 20, 50)
+        self.assertFalse(passed)
+        self.assertTrue(routes['GET /items/{id}']['passed'])
+        self.assertEqual(routes['GET /orders/{id}']['candidate']['errorRate'], 1.0)
+
+    def test_handler_replays_captured_requests(self):
+        """Test the hook replays captured events against both versions and fails on new 5xx."""
+        captured = {'httpMethod': 'GET', 'path': '/items/42'}
+        self.mock_s3.get_paginator.return_value.paginate.return_value = [
+            {'Contents': [{'Key': 'captures/test-function/2026/10/17/1.json', 'LastModified': 1}]}
+        ]
+        self.mock_s3.get_object.side_effect = lambda **kwargs: {
+            'Body': io.BytesIO(json.dumps(captured).encode())
+        }
+
+        def invoke(**kwargs):
+            payload = json.loads(kwargs['Payload'])
+            if payload.get('path') == '/items/42' and kwargs['Qualifier'] == '7':
+                return invoke_response({'statusCode': 500})
+            return invoke_response({'statusCode': 200})
+        self.mock_lambda.invoke.side_effect = invoke
+
+        with patch.dict(os.environ, {'REPLAY_EVENTS': '10', 'CAPTURE_BUCKET': 'test-bucket',
+                                     'PROBE_REQUESTS': '0'}):
+            result = index.handler(self.event, self.context)
+
+        self.assertEqual(result['statusCode'], 500)
+        self.assertEqual(self.hook_status(), 'Failed')
+        routes = json.loads(result['body'])['replay']['routes']
+        self.assertFalse(routes['GET /items/{id}']['passed'])
+
+
+if __name__ == '__main__':
+    # Run the tests
+    unittest.main(verbosity=2)
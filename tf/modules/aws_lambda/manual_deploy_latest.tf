@@ -12,7 +12,9 @@ resource "aws_lambda_function" "manual_deploy" {
   environment {
     variables = {
       DEPLOY_FUNCTION_NAME = aws_lambda_function.deploy.function_name
-      ECR_REPOSITORY_NAME   = aws_ecr_repository.lambda_repository.name
+      ECR_REPOSITORY_NAME  = aws_ecr_repository.lambda_repository.name
+      APPSPEC_BUCKET       = aws_s3_bucket.codedeploy_appspec.bucket
+      LAMBDA_FUNCTION_NAME = aws_lambda_function.main.function_name
     }
   }
 
@@ -65,8 +67,8 @@ resource "aws_iam_role_policy" "manual_deploy" {
           "logs:PutLogEvents"
         ]
         Resource = [
-          "arn:aws:logs:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:log-group:/aws/lambda/${var.app}-${var.env}-manual-deploy-latest",
-          "arn:aws:logs:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:log-group:/aws/lambda/${var.app}-${var.env}-manual-deploy-latest:*"
+          "arn:aws:logs:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:log-group:/aws/lambda/${var.app}-${var.env}-manual-deploy",
+          "arn:aws:logs:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:log-group:/aws/lambda/${var.app}-${var.env}-manual-deploy:*"
         ]
       },
       {
@@ -87,14 +89,105 @@ resource "aws_iam_role_policy" "manual_deploy" {
         Resource = [
           aws_lambda_function.deploy.arn
         ]
+      },
+      {
+        # Latest-image pointer (written on push) and the deployment manifest
+        Effect = "Allow"
+        Action = [
+          "s3:GetObject",
+          "s3:PutObject"
+        ]
+        Resource = [
+          "${aws_s3_bucket.codedeploy_appspec.arn}/pointers/*"
+        ]
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "s3:GetObject"
+        ]
+        Resource = [
+          "${aws_s3_bucket.codedeploy_appspec.arn}/manifests/*"
+        ]
+      },
+      {
+        # Distinguish a missing pointer or manifest (NoSuchKey) from access denied
+        Effect = "Allow"
+        Action = [
+          "s3:ListBucket"
+        ]
+        Resource = [
+          aws_s3_bucket.codedeploy_appspec.arn
+        ]
       }
     ]
   })
 }
 
+# Keep the latest-image pointer current on every push
+resource "aws_cloudwatch_event_rule" "ecr_push_latest_pointer" {
+  name        = "${var.app}-${var.env}-ecr-push-latest-pointer"
+  description = "Record the latest pushed image for manual deploys"
+
+  event_pattern = jsonencode({
+    source      = ["aws.ecr"]
+    detail-type = ["ECR Image Action"]
+    detail = {
+      action-type     = ["PUSH"]
+      result          = ["SUCCESS"]
+      repository-name = [aws_ecr_repository.lambda_repository.name]
+    }
+  })
+
+  tags = {
+    Application = var.app
+    Environment = var.env
+    Module      = "aws_lambda"
+    Description = "Update latest-image pointer on ECR push"
+  }
+}
+
+resource "aws_cloudwatch_event_target" "ecr_push_latest_pointer" {
+  rule      = aws_cloudwatch_event_rule.ecr_push_latest_pointer.name
+  target_id = "ManualDeployPointer"
+  arn       = aws_lambda_function.manual_deploy.arn
+}
+
+resource "aws_lambda_permission" "ecr_push_latest_pointer" {
+  statement_id  = "AllowEventBridgePointerUpdate"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.manual_deploy.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.ecr_push_latest_pointer.arn
+}
+
 # Archive for manual deploy Lambda
 data "archive_file" "manual_deploy_lambda" {
   type        = "zip"
-  source_dir  = "${path.module}/manual_deploy_latest_lambda"
   output_path = "${path.module}/manual_deploy_lambda.zip"
+
+  source {
+    content  = file("${path.module}/manual_deploy_latest_lambda/index.py")
+    filename = "index.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/clients.py")
+    filename = "clients.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/instrumentation.py")
+    filename = "instrumentation.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/state_store.py")
+    filename = "state_store.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/manifest.py")
+    filename = "manifest.py"
+  }
 }
@@ -1,60 +1,56 @@
 import json
-import boto3
+import fnmatch
 import os
+from botocore.exceptions import ClientError
+from datetime import datetime
 
-# Initialize clients
-ecr_client = boto3.client('ecr')
-lambda_client = boto3.client('lambda')
+from clients import lazy_client
+from instrumentation import describe_event, instrumented, phase
+from manifest import load_manifest
+from state_store import S3JsonStore, update_json
 
+# Latest-pushed pointer per repository, kept in the AppSpec bucket
+POINTER_PREFIX = 'pointers'
+POINTER_SCHEMA_VERSION = 1
+POINTER_RECENT_IMAGES = 50
+POINTER_WRITE_ATTEMPTS = 5
+
+# Clients are built on first use (see lambda_shared/clients.py)
+ecr_client = lazy_client('ecr')
+lambda_client = lazy_client('lambda')
+s3_client = lazy_client('s3')
+
+@instrumented
 def handler(event, context):
     """
     Manual deployment trigger that finds the latest ECR image and triggers deployment.
-    
+
     Usage: Invoke this function with a test event (can be empty {})
+
+    Optional selectors in the event:
+      {"tagPattern": "v1.*"}   newest image with a tag matching the glob
+      {"select": "deployed"}   image of the last deployment that succeeded here
+
+    ECR push events (from the pointer rule) only update the latest-image pointer.
     """
-    print(f"Manual deploy triggered with event: {json.dumps(event)}")
-    
+    print(f"Manual deploy triggered with event: {describe_event(event)}")
+
+    if event.get('source') == 'aws.ecr':
+        return update_latest_pointer(event)
+
     try:
         repository_name = os.environ['ECR_REPOSITORY_NAME']
-        trigger_function_name = os.environ['TRIGGER_FUNCTION_NAME']
-        
-        print(f"Finding latest image in repository: {repository_name}")
-        
-        # Get the latest image from ECR
-        response = ecr_client.describe_images(
-            repositoryName=repository_name,
-            filter={
-                'tagStatus': 'TAGGED'
-            }
-        )
-        
-        if not response.get('imageDetails'):
-            raise ValueError(f"No images found in repository {repository_name}")
-        
-        # Sort by image pushed date to get the latest
-        latest_image = sorted(
-            response['imageDetails'],
-            key=lambda x: x['imagePushedAt'],
-            reverse=True
-        )[0]
-        
-        # Get the image tag (prefer non-latest tags)
-        image_tag = None
-        for tag in latest_image.get('imageTags', []):
-            if tag != 'latest':
-                image_tag = tag
-                break
-        
-        if not image_tag and latest_image.get('imageTags'):
-            image_tag = latest_image['imageTags'][0]
-        
-        if not image_tag:
-            raise ValueError("No image tags found for latest image")
-            
+        # DEPLOY_FUNCTION_NAME is what the module sets; TRIGGER_FUNCTION_NAME is the old name
+        trigger_function_name = os.environ.get('DEPLOY_FUNCTION_NAME') or os.environ['TRIGGER_FUNCTION_NAME']
+
+        with phase('select_image'):
+            latest_image = select_image(repository_name, event)
+        image_tag = latest_image['imageTag']
+
         print(f"Latest image tag: {image_tag}")
         print(f"Image digest: {latest_image['imageDigest']}")
         print(f"Pushed at: {latest_image['imagePushedAt']}")
-        
+
         # Create a synthetic ECR push event to trigger deployment
         synthetic_event = {
             "version": "0",
@@ -62,7 +58,7 @@ def handler(event, context):
             "detail-type": "ECR Image Action",
             "source": "aws.ecr",
             "account": context.invoked_function_arn.split(':')[4],
-            "time": latest_image['imagePushedAt'].isoformat(),
+            "time": latest_image['imagePushedAt'],
             "region": context.invoked_function_arn.split(':')[3],
             "detail": {
                 "action-type": "PUSH",
@@ -72,29 +68,41 @@ def handler(event, context):
                 "image-digest": latest_image['imageDigest']
             }
         }
-        
+
         print(f"Triggering deployment with synthetic event")
-        
+
         # Invoke the trigger function
-        trigger_response = lambda_client.invoke(
-            FunctionName=trigger_function_name,
-            InvocationType='RequestResponse',
-            Payload=json.dumps(synthetic_event)
-        )
-        
+        with phase('trigger'):
+            trigger_response = lambda_client.invoke(
+                FunctionName=trigger_function_name,
+                InvocationType='RequestResponse',
+                Payload=json.dumps(synthetic_event)
+            )
+
         trigger_result = json.loads(trigger_response['Payload'].read())
         print(f"Trigger function response: {json.dumps(trigger_result)}")
-        
+
+        # A slow code update comes back as a continuation; let it finish asynchronously
+        if trigger_result.get('statusCode') == 202:
+            continuation = json.loads(trigger_result['body'])['continuation']
+            print("Code update still in progress, continuing deployment asynchronously")
+            lambda_client.invoke(
+                FunctionName=trigger_function_name,
+                InvocationType='Event',
+                Payload=json.dumps({'continuation': continuation, 'continueAsync': True})
+            )
+
         return {
             'statusCode': 200,
             'body': json.dumps({
                 'message': 'Manual deployment triggered successfully',
                 'imageTag': image_tag,
                 'imageDigest': latest_image['imageDigest'],
+                'selectedBy': latest_image['selectedBy'],
                 'triggerResult': trigger_result
             })
         }
-        
+
     except Exception as e:
         print(f"Error triggering manual deployment: {str(e)}")
         return {
@@ -102,4 +110,128 @@ def handler(event, context):
             'body': json.dumps({
                 'error': str(e)
             })
-        }
\ No newline at end of file
+        }
+
+def select_image(repository_name, event):
+    """
+    Pick the image to deploy: {'imageDigest', 'imageTag', 'imagePushedAt', 'selectedBy'}.
+
+    The pointer answers the common cases with one S3 read; the paginated
+    repository scan is only a fallback when it has no answer.
+    """
+    if event.get('select') == 'deployed':
+        image = last_deployed_image()
+        if not image:
+            raise ValueError("No successful deployment recorded in the manifest")
+        return image
+
+    tag_pattern = event.get('tagPattern')
+    pointer = load_pointer(repository_name)
+    if pointer:
+        candidates = pointer['recent'] if tag_pattern else [pointer['latest']]
+        for image in candidates:
+            tag = pick_tag(image['tags'], tag_pattern)
+            if tag:
+                print(f"Selected {image['digest']} from the latest-image pointer")
+                return {'imageDigest': image['digest'], 'imageTag': tag,
+                        'imagePushedAt': image['pushedAt'], 'selectedBy': 'pointer'}
+
+    print(f"Pointer has no match, scanning repository {repository_name}")
+    image = scan_latest_image(repository_name, tag_pattern)
+    if not image:
+        pattern_note = f" with a tag matching {tag_pattern}" if tag_pattern else ""
+        raise ValueError(f"No images found in repository {repository_name}{pattern_note}")
+    return image
+
+def pick_tag(tags, tag_pattern=None):
+    """The tag to deploy by: the first matching the pattern, else the first non-latest tag."""
+    if tag_pattern:
+        return next((tag for tag in tags if fnmatch.fnmatchcase(tag, tag_pattern)), None)
+    return next((tag for tag in tags if tag != 'latest'), tags[0] if tags else None)
+
+def scan_latest_image(repository_name, tag_pattern=None):
+    """Newest tagged image (optionally with a tag matching tag_pattern), across all pages."""
+    newest = None
+    paginator = ecr_client.get_paginator('describe_images')
+    for page in paginator.paginate(repositoryName=repository_name, filter={'tagStatus': 'TAGGED'}):
+        for image in page.get('imageDetails', []):
+            tag = pick_tag(image.get('imageTags', []), tag_pattern)
+            if tag and (newest is None or image['imagePushedAt'] > newest['imagePushedAt']):
+                newest = dict(image, imageTag=tag)
+    if newest is None:
+        return None
+    return {'imageDigest': newest['imageDigest'], 'imageTag': newest['imageTag'],
+            'imagePushedAt': newest['imagePushedAt'].isoformat(), 'selectedBy': 'scan'}
+
+def last_deployed_image():
+    """Image of the most recent deployment cleanup_lambda marked as succeeded in the manifest."""
+    manifest = load_manifest(s3_client, os.environ['APPSPEC_BUCKET'], os.environ['LAMBDA_FUNCTION_NAME'])
+    for record in (manifest or {}).get('deployments', []):
+        if record.get('status') == 'Succeeded' and record.get('imageDigest'):
+            print(f"Last successful deployment {record['deploymentId']} ran {record['imageDigest']}")
+            # Older rollback records carry no tag; the deploy lambda deploys by tag
+            tag = record.get('imageTag') or current_tag(record['imageDigest'])
+            if not tag:
+                print(f"Image {record['imageDigest']} has no tag, looking further back")
+                continue
+            return {'imageDigest': record['imageDigest'], 'imageTag': tag,
+                    'imagePushedAt': record.get('createdAt'), 'selectedBy': 'manifest'}
+    return None
+
+def current_tag(image_digest):
+    """The tag image_digest carries in the function's repository now, or None."""
+    try:
+        response = ecr_client.describe_images(repositoryName=os.environ['ECR_REPOSITORY_NAME'],
+                                              imageIds=[{'imageDigest': image_digest}])
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ImageNotFoundException':
+            raise
+        return None
+    details = response.get('imageDetails', [])
+    return pick_tag(details[0].get('imageTags', [])) if details else None
+
+def pointer_store():
+    """Latest-image pointers in the AppSpec bucket, one object per repository under pointers/."""
+    return S3JsonStore(s3_client, os.environ['APPSPEC_BUCKET'], POINTER_PREFIX)
+
+def load_pointer(repository_name):
+    """The latest-image pointer, or None when it was never written."""
+    pointer, _ = pointer_store().get(repository_name)
+    return pointer if pointer and pointer.get('latest') else None
+
+def update_latest_pointer(event):
+    """
+    Record an ECR push in the repository's pointer: the newest image plus the
+    last POINTER_RECENT_IMAGES pushes for tag-pattern lookups. Tags pushed
+    separately for one digest are merged; an older push never moves latest back.
+    """
+    detail = event['detail']
+    if detail.get('result') != 'SUCCESS' or not detail.get('image-digest') or not detail.get('image-tag'):
+        print("Ignoring push without a digest and tag")
+        return {'statusCode': 200, 'body': json.dumps({'updated': False})}
+
+    repository_name = detail['repository-name']
+    digest = detail['image-digest']
+    tag = detail['image-tag']
+    pushed_at = event.get('time') or datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def record_push(pointer):
+        image = next((image for image in pointer['recent'] if image['digest'] == digest), None)
+        if image is None:
+            image = {'digest': digest, 'tags': [], 'pushedAt': pushed_at}
+            pointer['recent'].append(image)
+        if tag not in image['tags']:
+            image['tags'].append(tag)
+        image['pushedAt'] = max(image['pushedAt'], pushed_at)
+        pointer['recent'] = sorted(pointer['recent'], key=lambda i: i['pushedAt'], reverse=True)[:POINTER_RECENT_IMAGES]
+        pointer['latest'] = pointer['recent'][0]
+        return pointer
+
+    pointer = update_json(
+        pointer_store(), repository_name, record_push,
+        empty=lambda: {'schemaVersion': POINTER_SCHEMA_VERSION, 'repositoryName': repository_name,
+                       'latest': None, 'recent': []},
+        attempts=POINTER_WRITE_ATTEMPTS, label=f"Pointer for {repository_name}"
+    )
+    print(f"Pointer for {repository_name} now at {pointer['latest']['digest']}")
+    return {'statusCode': 200, 'body': json.dumps({'updated': True, 'latest': pointer['latest']})}
@@ -0,0 +1,144 @@
+import unittest
+from unittest.mock import Mock, patch
+import io
+import json
+import os
+import sys
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+
+# Add the current directory to the path so we can import the module
+sys.path.insert(0, os.path.dirname(__file__))
+# Shared modules Terraform packages alongside index.py
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lambda_shared'))
+
+# Import the module under test
+import index
+
+
+def push_event(digest, tag, time):
+    return {
+        'source': 'aws.ecr',
+        'detail-type': 'ECR Image Action',
+        'time': time,
+        'detail': {'action-type': 'PUSH', 'result': 'SUCCESS', 'repository-name': 'app-dev',
+                   'image-digest': digest, 'image-tag': tag}
+    }
+
+
+class TestManualDeployLatest(unittest.TestCase):
+    def setUp(self):
+        """Set up test fixtures."""
+        self.env_patcher = patch.dict(os.environ, {
+            'ECR_REPOSITORY_NAME': 'app-dev',
+            'DEPLOY_FUNCTION_NAME': 'app-dev-deploy',
+            'APPSPEC_BUCKET': 'appspec-bucket',
+            'LAMBDA_FUNCTION_NAME': 'app-dev'
+        })
+        self.env_patcher.start()
+
+        self.objects = {}
+        self.mock_s3 = Mock()
+        self.mock_s3.get_object.side_effect = self.get_object
+        self.mock_s3.put_object.side_effect = self.put_object
+        self.mock_ecr = Mock()
+        self.mock_lambda = Mock()
+        self.mock_lambda.invoke.side_effect = lambda **kwargs: {
+            'Payload': io.BytesIO(json.dumps({'statusCode': 200, 'body': '{}'}).encode())
+        }
+
+        self.patchers = [patch('index.s3_client', self.mock_s3), patch('index.ecr_client', self.mock_ecr),
+                         patch('index.lambda_client', self.mock_lambda)]
+        for patcher in self.patchers:
+            patcher.start()
+
+        self.context = Mock()
+        self.context.invoked_function_arn = 'arn:aws:lambda:us-east-1:111111111111:function:app-dev-manual-deploy'
+
+    def tearDown(self):
+        """Clean up after tests."""
+        self.env_patcher.stop()
+        for patcher in self.patchers:
+            patcher.stop()
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        return {'Body': io.BytesIO(self.objects[Key].encode()), 'ETag': '"1"'}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body
+
+    def deployed_event(self):
+        return json.loads(self.mock_lambda.invoke.call_args_list[0][1]['Payload'])['detail']
+
+    def test_pointer_tracks_newest_push_and_merges_tags(self):
+        """Test push events move the pointer forward only and merge tags of one digest."""
+        index.handler(push_event('sha256:a', 'latest', '2026-10-01T10:00:00Z'), self.context)
+        index.handler(push_event('sha256:a', 'v1.0.0', '2026-10-01T10:00:05Z'), self.context)
+        index.handler(push_event('sha256:b', 'v1.1.0', '2026-10-02T10:00:00Z'), self.context)
+        # A late event for an older push does not move latest back
+        index.handler(push_event('sha256:old', 'v0.9.0', '2026-09-01T10:00:00Z'), self.context)
+
+        pointer = json.loads(self.objects['pointers/app-dev.json'])
+        self.assertEqual(pointer['latest']['digest'], 'sha256:b')
+        self.assertEqual(pointer['recent'][1]['tags'], ['latest', 'v1.0.0'])
+
+    def test_deploys_from_pointer_without_scanning(self):
+        """Test the manual deploy reads the pointer instead of listing the repository."""
+        index.handler(push_event('sha256:a', 'latest', '2026-10-01T10:00:00Z'), self.context)
+        index.handler(push_event('sha256:a', 'v1.0.0', '2026-10-01T10:00:05Z'), self.context)
+
+        result = index.handler({}, self.context)
+
+        self.assertEqual(json.loads(result['body'])['selectedBy'], 'pointer')
+        self.assertEqual(self.deployed_event()['image-tag'], 'v1.0.0')
+        self.assertEqual(self.mock_lambda.invoke.call_args_list[0][1]['FunctionName'], 'app-dev-deploy')
+        self.mock_ecr.get_paginator.assert_not_called()
+
+    def test_scan_fallback_covers_every_page(self):
+        """Test the fallback scan finds the newest matching image on any page."""
+        def image(digest, tags, day):
+            return {'imageDigest': digest, 'imageTags': tags,
+                    'imagePushedAt': datetime(2026, 10, day, tzinfo=timezone.utc)}
+        self.mock_ecr.get_paginator.return_value.paginate.return_value = [
+            {'imageDetails': [image('sha256:a', ['v1.0.0'], 1), image('sha256:c', ['nightly-3'], 9)]},
+            {'imageDetails': [image('sha256:b', ['v1.2.0', 'latest'], 5)]}
+        ]
+
+        result = index.handler({'tagPattern': 'v1.*'}, self.context)
+
+        self.assertEqual(json.loads(result['body'])['selectedBy'], 'scan')
+        self.assertEqual(self.deployed_event()['image-digest'], 'sha256:b')
+        self.assertEqual(self.deployed_event()['image-tag'], 'v1.2.0')
+
+    def test_select_last_successful_deployment(self):
+        """Test the deployed selector redeploys the last image that passed deployment."""
+        self.objects['manifests/app-dev.json'] = json.dumps({'deployments': [
+            {'deploymentId': 'd-3', 'imageDigest': 'sha256:c', 'imageTag': 'v3', 'status': 'Created'},
+            {'deploymentId': 'd-2', 'imageDigest': 'sha256:b', 'imageTag': 'v2', 'status': 'Succeeded',
+             'createdAt': '2026-10-02T10:00:00Z'}
+        ]})
+
+        result = index.handler({'select': 'deployed'}, self.context)
+
+        self.assertEqual(json.loads(result['body'])['selectedBy'], 'manifest')
+        self.assertEqual(self.deployed_event()['image-digest'], 'sha256:b')
+
+        # Rollback records written before they carried a tag get the image's current one
+        self.objects['manifests/app-dev.json'] = json.dumps({'deployments': [
+            {'deploymentId': 'd-4', 'imageDigest': 'sha256:a', 'imageTag': None, 'status': 'Succeeded',
+             'rollback': True}
+        ]})
+        self.mock_ecr.describe_images.return_value = {'imageDetails': [{'imageTags': ['latest', 'v1']}]}
+        self.mock_lambda.invoke.reset_mock()
+
+        index.handler({'select': 'deployed'}, self.context)
+
+        self.assertEqual((self.deployed_event()['image-digest'], self.deployed_event()['image-tag']),
+                         ('sha256:a', 'v1'))
+
+
+if __name__ == '__main__':
+    # Run the tests
+    unittest.main(verbosity=2)
@@ -51,4 +51,8 @@ output "app_subnet_ids" {
 output "ecr_image_uri" {
   description = "The ECR image URI for the app's Docker image"
   value       = "${aws_ecr_repository.main.repository_url}:${var.env}"
-}
\ No newline at end of file
+}
+output "rollback_function_name" {
+  description = "Lambda that rolls the live alias back to the last known-good version (invoke with {} or {\"breakGlass\": true})"
+  value       = aws_lambda_function.rollback.function_name
+}
@@ -0,0 +1,166 @@
+# Request capture for shadow replay in the BeforeAllowTraffic hook.
+# Applications opt in by logging `HOIST_CAPTURE <event json>` for incoming
+# API Gateway proxy events; a subscription on the function's log group samples
+# those lines into the AppSpec bucket under captures/.
+locals {
+  request_capture_enabled = var.request_capture_sample_rate > 0
+  request_capture_name    = "${var.app}-${var.env}-request-capture"
+}
+
+resource "aws_lambda_function" "request_capture" {
+  count = local.request_capture_enabled ? 1 : 0
+
+  function_name = local.request_capture_name
+  role          = aws_iam_role.request_capture[0].arn
+  handler       = "index.handler"
+  runtime       = "python3.11"
+  timeout       = 60
+
+  filename         = data.archive_file.request_capture_lambda.output_path
+  source_code_hash = data.archive_file.request_capture_lambda.output_base64sha256
+
+  environment {
+    variables = {
+      FUNCTION_NAME          = aws_lambda_function.main.function_name
+      CAPTURE_BUCKET         = aws_s3_bucket.codedeploy_appspec.bucket
+      CAPTURE_SAMPLE_RATE    = tostring(var.request_capture_sample_rate)
+      CAPTURE_METHODS        = join(",", var.request_capture_methods)
+      CAPTURE_REDACT_HEADERS = join(",", var.request_capture_redact_headers)
+      CAPTURE_REDACT_QUERY   = join(",", var.request_capture_redact_query)
+      CAPTURE_REDACT_FIELDS  = join(",", var.request_capture_redact_fields)
+    }
+  }
+
+  tags = {
+    Application = var.app
+    Environment = var.env
+    Module      = "aws_lambda"
+    Description = "Samples captured requests of ${var.app}-${var.env} for shadow replay"
+  }
+}
+
+resource "aws_iam_role" "request_capture" {
+  count = local.request_capture_enabled ? 1 : 0
+
+  name = local.request_capture_name
+
+  assume_role_policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Action = "sts:AssumeRole"
+        Effect = "Allow"
+        Principal = {
+          Service = "lambda.amazonaws.com"
+        }
+      }
+    ]
+  })
+
+  tags = {
+    Application = var.app
+    Environment = var.env
+    Module      = "aws_lambda"
+    Description = "Role for request capture Lambda"
+  }
+}
+
+resource "aws_iam_role_policy" "request_capture" {
+  count = local.request_capture_enabled ? 1 : 0
+
+  name = local.request_capture_name
+  role = aws_iam_role.request_capture[0].id
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect = "Allow"
+        Action = [
+          "logs:CreateLogGroup",
+          "logs:CreateLogStream",
+          "logs:PutLogEvents"
+        ]
+        Resource = [
+          "arn:aws:logs:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:log-group:/aws/lambda/${local.request_capture_name}",
+          "arn:aws:logs:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:log-group:/aws/lambda/${local.request_capture_name}:*"
+        ]
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "s3:PutObject"
+        ]
+        Resource = [
+          "${aws_s3_bucket.codedeploy_appspec.arn}/captures/*"
+        ]
+      }
+    ]
+  })
+}
+
+resource "aws_lambda_permission" "request_capture_logs" {
+  count = local.request_capture_enabled ? 1 : 0
+
+  statement_id  = "AllowExecutionFromCloudWatchLogs"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.request_capture[0].function_name
+  principal     = "logs.amazonaws.com"
+  source_arn    = "arn:aws:logs:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:log-group:/aws/lambda/${aws_lambda_function.main.function_name}:*"
+}
+
+# The log group is created by Lambda on the function's first invocation
+resource "aws_cloudwatch_log_subscription_filter" "request_capture" {
+  count = local.request_capture_enabled ? 1 : 0
+
+  name            = local.request_capture_name
+  log_group_name  = "/aws/lambda/${aws_lambda_function.main.function_name}"
+  filter_pattern  = "\"HOIST_CAPTURE\""
+  destination_arn = aws_lambda_function.request_capture[0].arn
+
+  depends_on = [aws_lambda_permission.request_capture_logs]
+}
+
+# Captured requests are only useful for the next few deployments
+resource "aws_s3_bucket_lifecycle_configuration" "codedeploy_appspec_captures" {
+  count = local.request_capture_enabled ? 1 : 0
+
+  bucket = aws_s3_bucket.codedeploy_appspec.id
+
+  rule {
+    id     = "expire-captures"
+    status = "Enabled"
+
+    filter {
+      prefix = "captures/"
+    }
+
+    expiration {
+      days = var.request_capture_retention_days
+    }
+
+    noncurrent_version_expiration {
+      noncurrent_days = 1
+    }
+  }
+}
+
+data "archive_file" "request_capture_lambda" {
+  type        = "zip"
+  output_path = "${path.module}/request_capture_lambda.zip"
+
+  source {
+    content  = file("${path.module}/request_capture_lambda/index.py")
+    filename = "index.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/clients.py")
+    filename = "clients.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/instrumentation.py")
+    filename = "instrumentation.py"
+  }
+}
@@ -0,0 +1,129 @@
+import base64
+import gzip
+import hashlib
+import json
+import os
+import random
+from datetime import datetime
+
+from clients import lazy_client
+from instrumentation import instrumented
+
+# Applications opt in by logging `HOIST_CAPTURE <event json>` for requests they received
+CAPTURE_MARKER = 'HOIST_CAPTURE '
+REDACTED = '[REDACTED]'
+
+# Always redacted, on top of CAPTURE_REDACT_HEADERS
+DEFAULT_REDACT_HEADERS = ('authorization', 'cookie', 'x-api-key', 'x-amz-security-token', 'proxy-authorization')
+
+# Clients are built on first use (see lambda_shared/clients.py)
+s3_client = lazy_client('s3')
+
+@instrumented
+def handler(event, context):
+    """
+    CloudWatch Logs subscription target that samples captured API Gateway proxy
+    events into S3 for replay by the BeforeAllowTraffic hook.
+    """
+    log_data = json.loads(gzip.decompress(base64.b64decode(event['awslogs']['data'])))
+    if log_data.get('messageType') != 'DATA_MESSAGE':
+        return {'statusCode': 200, 'body': json.dumps({'captured': 0})}
+
+    function_name = os.environ['FUNCTION_NAME']
+    bucket_name = os.environ['CAPTURE_BUCKET']
+    sample_rate = float(os.environ.get('CAPTURE_SAMPLE_RATE', '0.01'))
+    methods = {m.strip().upper() for m in os.environ.get('CAPTURE_METHODS', 'GET,HEAD').split(',') if m.strip()}
+    rules = redaction_rules_from_environment()
+
+    captured = 0
+    skipped = 0
+    for log_event in log_data.get('logEvents', []):
+        proxy_event = parse_capture_line(log_event['message'])
+        if proxy_event is None:
+            continue
+        if proxy_event.get('httpMethod', '').upper() not in methods or random.random() >= sample_rate:
+            skipped += 1
+            continue
+
+        redacted = redact_event(proxy_event, rules)
+        key = capture_key(function_name, log_event['timestamp'], log_event['id'])
+        s3_client.put_object(
+            Bucket=bucket_name,
+            Key=key,
+            Body=json.dumps(redacted, separators=(',', ':')),
+            ContentType='application/json'
+        )
+        captured += 1
+
+    print(f"Captured {captured} requests, skipped {skipped}")
+    return {'statusCode': 200, 'body': json.dumps({'captured': captured, 'skipped': skipped})}
+
+def parse_capture_line(message):
+    """Return the proxy event logged on a capture line, or None for any other line."""
+    start = message.find(CAPTURE_MARKER)
+    if start < 0:
+        return None
+    try:
+        proxy_event = json.loads(message[start + len(CAPTURE_MARKER):])
+    except ValueError:
+        print("Ignoring malformed capture line")
+        return None
+    return proxy_event if isinstance(proxy_event, dict) else None
+
+def capture_key(function_name, timestamp_ms, event_id):
+    """S3 key for a captured request, partitioned by day."""
+    when = datetime.utcfromtimestamp(timestamp_ms / 1000)
+    digest = hashlib.sha256(event_id.encode()).hexdigest()[:16]
+    return f"captures/{function_name}/{when.strftime('%Y/%m/%d')}/{when.strftime('%H%M%S')}-{digest}.json"
+
+def redaction_rules_from_environment():
+    """Header, query parameter and JSON body field names to redact (lower-cased)."""
+    def names(variable):
+        return {name.strip().lower() for name in os.environ.get(variable, '').split(',') if name.strip()}
+    return {
+        'headers': names('CAPTURE_REDACT_HEADERS') | set(DEFAULT_REDACT_HEADERS),
+        'query': names('CAPTURE_REDACT_QUERY'),
+        'fields': names('CAPTURE_REDACT_FIELDS')
+    }
+
+def redact_event(proxy_event, rules):
+    """
+    Copy a REST API proxy event with sensitive values replaced.
+
+    Headers and query parameters named in the rules are redacted (single and
+    multi-value forms), JSON bodies have matching fields redacted at any depth,
+    non-JSON bodies are dropped, and caller identity is removed from
+    requestContext.
+    """
+    redacted = dict(proxy_event)
+    for key, names in (('headers', rules['headers']), ('queryStringParameters', rules['query'])):
+        if redacted.get(key):
+            redacted[key] = {k: REDACTED if k.lower() in names else v for k, v in redacted[key].items()}
+        multi_key = 'multiValue' + key[0].upper() + key[1:]
+        if redacted.get(multi_key):
+            redacted[multi_key] = {
+                k: [REDACTED] * len(v) if k.lower() in names else v for k, v in redacted[multi_key].items()
+            }
+
+    if redacted.get('requestContext'):
+        request_context = dict(redacted['requestContext'])
+        request_context.pop('identity', None)
+        request_context.pop('authorizer', None)
+        redacted['requestContext'] = request_context
+
+    body = redacted.get('body')
+    if body:
+        try:
+            redacted['body'] = json.dumps(redact_fields(json.loads(body), rules['fields']))
+        except (TypeError, ValueError):
+            redacted['body'] = None
+        redacted['isBase64Encoded'] = False
+    return redacted
+
+def redact_fields(value, names):
+    """Recursively redact dict entries whose key is in names."""
+    if isinstance(value, dict):
+        return {k: REDACTED if k.lower() in names else redact_fields(v, names) for k, v in value.items()}
+    if isinstance(value, list):
+        return [redact_fields(item, names) for item in value]
+    return value
@@ -0,0 +1,104 @@
+import unittest
+from unittest.mock import Mock, patch
+import base64
+import gzip
+import json
+import os
+import sys
+
+# Add the current directory to the path so we can import the module
+sys.path.insert(0, os.path.dirname(__file__))
+# Shared modules Terraform packages alongside index.py
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lambda_shared'))
+
+# Import the module under test
+import index
+
+
+def subscription_event(messages):
+    """Build a CloudWatch Logs subscription event for the given log lines."""
+    data = {
+        'messageType': 'DATA_MESSAGE',
+        'logEvents': [
+            {'id': f"event-{n}", 'timestamp': 1792195200000 + n, 'message': message}
+            for n, message in enumerate(messages)
+        ]
+    }
+    return {'awslogs': {'data': base64.b64encode(gzip.compress(json.dumps(data).encode())).decode()}}
+
+
+class TestRequestCaptureLambda(unittest.TestCase):
+    def setUp(self):
+        """Set up test fixtures."""
+        self.env_patcher = patch.dict(os.environ, {
+            'FUNCTION_NAME': 'test-function',
+            'CAPTURE_BUCKET': 'test-bucket',
+            'CAPTURE_SAMPLE_RATE': '1',
+            'CAPTURE_REDACT_QUERY': 'token',
+            'CAPTURE_REDACT_FIELDS': 'password'
+        })
+        self.env_patcher.start()
+
+        self.mock_s3 = Mock()
+        self.s3_patcher = patch('index.s3_client', self.mock_s3)
+        self.s3_patcher.start()
+
+    def tearDown(self):
+        """Clean up after tests."""
+        self.env_patcher.stop()
+        self.s3_patcher.stop()
+
+    def test_redact_event(self):
+        """Test credentials, identity and configured fields are removed before storage."""
+        proxy_event = {
+            'httpMethod': 'GET',
+            'path': '/items/1',
+            'headers': {'Authorization': 'Bearer secret', 'Accept': 'application/json'},
+            'multiValueHeaders': {'Cookie': ['a=1', 'b=2']},
+            'queryStringParameters': {'token': 'abc', 'page': '2'},
+            'requestContext': {'stage': 'live', 'identity': {'sourceIp': '10.0.0.1'}},
+            'body': json.dumps({'user': {'password': 'hunter2', 'name': 'x'}})
+        }
+
+        with patch.dict(os.environ, {'CAPTURE_REDACT_HEADERS': ''}):
+            redacted = index.redact_event(proxy_event, index.redaction_rules_from_environment())
+
+        self.assertEqual(redacted['headers'], {'Authorization': '[REDACTED]', 'Accept': 'application/json'})
+        self.assertEqual(redacted['multiValueHeaders']['Cookie'], ['[REDACTED]', '[REDACTED]'])
+        self.assertEqual(redacted['queryStringParameters'], {'token': '[REDACTED]', 'page': '2'})
+        self.assertEqual(redacted['requestContext'], {'stage': 'live'})
+        self.assertEqual(json.loads(redacted['body']), {'user': {'password': '[REDACTED]', 'name': 'x'}})
+        # The original event is left untouched
+        self.assertEqual(proxy_event['headers']['Authorization'], 'Bearer secret')
+
+    def test_handler_captures_safe_methods_only(self):
+        """Test only marked GET/HEAD lines are stored, partitioned by function and day."""
+        event = subscription_event([
+            'START RequestId: abc',
+            'HOIST_CAPTURE ' + json.dumps({'httpMethod': 'GET', 'path': '/items/1'}),
+            'HOIST_CAPTURE ' + json.dumps({'httpMethod': 'POST', 'path': '/items'}),
+            'HOIST_CAPTURE {not json'
+        ])
+
+        result = index.handler(event, None)
+
+        self.assertEqual(json.loads(result['body']), {'captured': 1, 'skipped': 1})
+        put = self.mock_s3.put_object.call_args[1]
+        self.assertEqual(put['Bucket'], 'test-bucket')
+        self.assertTrue(put['Key'].startswith('captures/test-function/2026/10/'))
+        self.assertEqual(json.loads(put['Body'])['path'], '/items/1')
+
+    def test_handler_samples(self):
+        """Test a zero sample rate stores nothing."""
+        event = subscription_event(['HOIST_CAPTURE ' + json.dumps({'httpMethod': 'GET', 'path': '/'})])
+
+        with patch.dict(os.environ, {'CAPTURE_SAMPLE_RATE': '0'}):
+            result = index.handler(event, None)
+
+        self.assertEqual(json.loads(result['body'])['captured'], 0)
+        self.mock_s3.put_object.assert_not_called()
+
+
+if __name__ == '__main__':
+    # Run the tests
+    unittest.main(verbosity=2)
@@ -0,0 +1,175 @@
+# Rollback Lambda function: restores the last known-good version behind the live alias
+resource "aws_lambda_function" "rollback" {
+  function_name = "${var.app}-${var.env}-rollback"
+  role          = aws_iam_role.rollback.arn
+  handler       = "index.handler"
+  runtime       = "python3.11"
+  timeout       = 300  # waits for the AllAtOnce rollback deployment to finish
+
+  filename         = data.archive_file.rollback_lambda.output_path
+  source_code_hash = data.archive_file.rollback_lambda.output_base64sha256
+
+  environment {
+    variables = {
+      LAMBDA_FUNCTION_NAME  = aws_lambda_function.main.function_name
+      CODEDEPLOY_APP_NAME   = aws_codedeploy_app.lambda.name
+      DEPLOYMENT_GROUP_NAME = aws_codedeploy_deployment_group.lambda.deployment_group_name
+      ECR_REPOSITORY_NAME   = aws_ecr_repository.lambda_repository.name
+      APPSPEC_BUCKET        = aws_s3_bucket.codedeploy_appspec.bucket
+      APPSPEC_KEY_LAYOUT    = var.appspec_key_layout
+    }
+  }
+
+  tags = {
+    Application = var.app
+    Environment = var.env
+    Module      = "aws_lambda"
+    Description = "Rollback of ${var.app}-${var.env} to the last known-good version"
+  }
+}
+
+# IAM role for rollback Lambda
+resource "aws_iam_role" "rollback" {
+  name = "${var.app}-${var.env}-rollback"
+
+  assume_role_policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Action = "sts:AssumeRole"
+        Effect = "Allow"
+        Principal = {
+          Service = "lambda.amazonaws.com"
+        }
+      }
+    ]
+  })
+
+  tags = {
+    Application = var.app
+    Environment = var.env
+    Module      = "aws_lambda"
+    Description = "Role for rollback Lambda"
+  }
+}
+
+# Policy for rollback Lambda
+resource "aws_iam_role_policy" "rollback" {
+  name = "${var.app}-${var.env}-rollback"
+  role = aws_iam_role.rollback.id
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect = "Allow"
+        Action = [
+          "logs:CreateLogGroup",
+          "logs:CreateLogStream",
+          "logs:PutLogEvents"
+        ]
+        Resource = [
+          "arn:aws:logs:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:log-group:/aws/lambda/${var.app}-${var.env}-rollback",
+          "arn:aws:logs:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:log-group:/aws/lambda/${var.app}-${var.env}-rollback:*"
+        ]
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "lambda:GetAlias",
+          "lambda:GetFunction",
+          "lambda:UpdateAlias"
+        ]
+        Resource = [
+          aws_lambda_function.main.arn,
+          "${aws_lambda_function.main.arn}:*"
+        ]
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "codedeploy:CreateDeployment",
+          "codedeploy:GetDeployment",
+          "codedeploy:ListDeployments",
+          "codedeploy:BatchGetDeployments",
+          "codedeploy:StopDeployment",
+          "codedeploy:GetDeploymentConfig",
+          "codedeploy:GetApplicationRevision",
+          "codedeploy:RegisterApplicationRevision"
+        ]
+        Resource = [
+          aws_codedeploy_app.lambda.arn,
+          "arn:aws:codedeploy:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:deploymentgroup:${aws_codedeploy_app.lambda.name}/${aws_codedeploy_deployment_group.lambda.deployment_group_name}",
+          "arn:aws:codedeploy:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:deploymentconfig:CodeDeployDefault.LambdaAllAtOnce"
+        ]
+      },
+      {
+        # The image of a rollback candidate must still exist
+        Effect = "Allow"
+        Action = [
+          "ecr:DescribeImages"
+        ]
+        Resource = [
+          aws_ecr_repository.lambda_repository.arn
+        ]
+      },
+      {
+        # Manifest, deploy queue lease, AppSpec files of past deployments and the rollback's own AppSpec
+        Effect = "Allow"
+        Action = [
+          "s3:GetObject",
+          "s3:PutObject"
+        ]
+        Resource = [
+          "${aws_s3_bucket.codedeploy_appspec.arn}/*"
+        ]
+      },
+      {
+        # Distinguish a missing manifest (NoSuchKey) from access denied
+        Effect = "Allow"
+        Action = [
+          "s3:ListBucket"
+        ]
+        Resource = [
+          aws_s3_bucket.codedeploy_appspec.arn
+        ]
+      }
+    ]
+  })
+}
+
+# Archive for rollback Lambda
+data "archive_file" "rollback_lambda" {
+  type        = "zip"
+  output_path = "${path.module}/rollback_lambda.zip"
+
+  source {
+    content  = file("${path.module}/rollback_lambda/index.py")
+    filename = "index.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/clients.py")
+    filename = "clients.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/instrumentation.py")
+    filename = "instrumentation.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/state_store.py")
+    filename = "state_store.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/manifest.py")
+    filename = "manifest.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/deploy_train.py")
+    filename = "deploy_train.py"
+  }
+}
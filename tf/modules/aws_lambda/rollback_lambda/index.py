@@ -0,0 +1,408 @@
+"""
+Roll the live alias back to the last known-good version without the pipeline.
+
+Invoked as a Lambda (event options below) or from a shell with the caller's
+credentials:
+
+    python index.py --app myapp --env prod [--version 41] [--break-glass] [--dry-run] [--detected-at ...]
+
+Event options:
+  {"version": "41"}                   roll back to this version instead of searching
+  {"breakGlass": true}                update the alias directly instead of a CodeDeploy deployment
+  {"dryRun": true}                    only report the version that would be restored
+  {"detectedAt": "2026-01-01T10:00:00Z"}  also report time-to-restore from detection
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from botocore.exceptions import ClientError
+from datetime import datetime
+
+try:
+    from clients import get_client, lazy_client
+except ImportError:
+    # Run from the source tree as a CLI: the shared modules are not packaged next to this file
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'lambda_shared'))
+    from clients import get_client, lazy_client
+from deploy_train import codedeploy_deploy_train
+from instrumentation import describe_event, emit_metrics, instrumented, phase, set_dimensions
+from manifest import build_appspec_key, load_manifest, record_deployment_manifest
+
+CODEDEPLOY_BATCH_GET_LIMIT = 25
+
+# A rollback only considers this many recent successful deployments
+ROLLBACK_HISTORY = 20
+ROLLBACK_DEPLOYMENT_CONFIG = 'CodeDeployDefault.LambdaAllAtOnce'
+ACTIVE_DEPLOYMENT_STATUSES = ['Created', 'Queued', 'InProgress', 'Ready']
+FINISHED_DEPLOYMENT_STATUSES = ('Succeeded', 'Failed', 'Stopped')
+POLL_SECONDS = 2
+# Time kept free to report the result after waiting on the deployment
+REPORT_BUFFER_SECONDS = 5
+
+codedeploy = lazy_client('codedeploy')
+ecr_client = lazy_client('ecr')
+lambda_client = lazy_client('lambda')
+s3_client = lazy_client('s3')
+
+@instrumented
+def handler(event, context):
+    """
+    Restore the last known-good version of the function behind the live alias.
+
+    Candidates come from the successful deployments in the manifest (falling
+    back to CodeDeploy's history, as cleanup_lambda does), newest first,
+    skipping the version that is live now. A candidate is used only if the
+    version still exists and its image is still in ECR. The rollback preempts
+    the deploy train's lease, superseding queued requests, and in-flight
+    deployments are stopped so it is not queued behind them.
+    """
+    started_at = time.monotonic()
+    print(f"Rollback triggered with event: {describe_event(event)}")
+
+    function_name = os.environ['LAMBDA_FUNCTION_NAME']
+    break_glass = bool(event.get('breakGlass'))
+
+    try:
+        current_version = lambda_client.get_alias(FunctionName=function_name, Name='live')['FunctionVersion']
+        print(f"Alias 'live' points to version {current_version}")
+
+        with phase('select'):
+            if event.get('version'):
+                candidates = [{'lambdaVersion': str(event['version']), 'deploymentId': None}]
+            else:
+                candidates = known_good_deployments()
+            target = find_restorable_version(function_name, candidates, current_version)
+        if not target:
+            raise ValueError(f"No restorable known-good version of {function_name} found")
+        print(f"Rolling back {function_name} from version {current_version} to {target['lambdaVersion']} "
+              f"({target['imageDigest']})")
+
+        if event.get('dryRun'):
+            return {
+                'statusCode': 200,
+                'body': json.dumps({'dryRun': True, 'currentVersion': current_version, 'target': target})
+            }
+
+        with phase('restore'):
+            ticket = uuid.uuid4().hex
+            superseded = preempt_deploy_lease(ticket, target)
+            result = {}
+            try:
+                stopped = stop_active_deployments(auto_rollback=False)
+                if break_glass:
+                    result = repoint_alias(function_name, target['lambdaVersion'])
+                else:
+                    result = rollback_deployment(function_name, current_version, target, context, ticket)
+            finally:
+                # Without a deployment of its own no state-change event will free the group
+                if not result.get('deploymentId'):
+                    deploy_train_from_environment().release(deploy_group_key(), ticket=ticket)
+        set_dimensions(deployment_id=result.get('deploymentId'))
+
+        result.update(currentVersion=current_version, target=target, stoppedDeployments=stopped,
+                      supersededRequests=superseded, mode='breakGlass' if break_glass else 'codedeploy')
+        if result['status'] == 'Succeeded':
+            result['timeToRestoreSeconds'] = round(time.monotonic() - started_at, 3)
+            if event.get('detectedAt'):
+                detected_at = datetime.strptime(event['detectedAt'], '%Y-%m-%dT%H:%M:%SZ')
+                result['timeToRestoreFromDetectionSeconds'] = round(
+                    (datetime.utcnow() - detected_at).total_seconds(), 3
+                )
+            print(f"Restored version {target['lambdaVersion']} in {result['timeToRestoreSeconds']}s")
+            emit_restore_metrics(function_name, result)
+        return {
+            'statusCode': 200 if result['status'] == 'Succeeded' else 202,
+            'body': json.dumps(result)
+        }
+
+    except Exception as e:
+        print(f"Error rolling back: {str(e)}")
+        return {
+            'statusCode': 500,
+            'body': json.dumps({'error': str(e)})
+        }
+
+def known_good_deployments():
+    """Successful deployments, newest first, from the manifest or CodeDeploy's history."""
+    manifest = load_manifest(s3_client, os.environ['APPSPEC_BUCKET'], os.environ['LAMBDA_FUNCTION_NAME'])
+    if manifest:
+        succeeded = [r for r in manifest.get('deployments', [])
+                     if r.get('status') == 'Succeeded' and r.get('lambdaVersion')]
+        if succeeded:
+            return succeeded[:ROLLBACK_HISTORY]
+    print("No successful deployments in the manifest, reading CodeDeploy history")
+    return codedeploy_successful_deployments()
+
+def codedeploy_successful_deployments():
+    """
+    Recent successful deployments with the target version read from their
+    AppSpec revision, newest first.
+    """
+    deployment_ids = []
+    request = {
+        'applicationName': os.environ['CODEDEPLOY_APP_NAME'],
+        'deploymentGroupName': os.environ['DEPLOYMENT_GROUP_NAME'],
+        'includeOnlyStatuses': ['Succeeded']
+    }
+    while len(deployment_ids) < ROLLBACK_HISTORY:
+        response = codedeploy.list_deployments(**request)
+        deployment_ids.extend(response.get('deployments', []))
+        if not response.get('nextToken'):
+            break
+        request['nextToken'] = response['nextToken']
+
+    deployments = []
+    for i in range(0, len(deployment_ids[:ROLLBACK_HISTORY]), CODEDEPLOY_BATCH_GET_LIMIT):
+        response = codedeploy.batch_get_deployments(deploymentIds=deployment_ids[i:i + CODEDEPLOY_BATCH_GET_LIMIT])
+        deployments.extend(response.get('deploymentsInfo', []))
+    deployments.sort(key=lambda d: d['createTime'].timestamp() if d.get('createTime') else 0, reverse=True)
+
+    records = []
+    for deployment in deployments:
+        location = deployment.get('revision', {}).get('s3Location', {})
+        if not location.get('key'):
+            continue
+        try:
+            appspec = json.loads(s3_client.get_object(Bucket=location['bucket'], Key=location['key'])['Body'].read())
+            version = appspec['Resources'][0]['TargetService']['Properties']['TargetVersion']
+        except Exception as e:
+            print(f"Skipping deployment {deployment['deploymentId']}: could not read its AppSpec ({str(e)})")
+            continue
+        records.append({'deploymentId': deployment['deploymentId'], 'lambdaVersion': str(version)})
+    return records
+
+def find_restorable_version(function_name, candidates, current_version):
+    """
+    First candidate that is not live, still exists as a version and whose
+    image is still in ECR. Returns {'lambdaVersion', 'imageDigest', 'imageTag',
+    'imageUri', 'deploymentId'} or None; imageTag is None for an untagged image.
+    """
+    seen = {str(current_version)}
+    for candidate in candidates:
+        version = str(candidate['lambdaVersion'])
+        if version in seen:
+            continue
+        seen.add(version)
+
+        try:
+            function = lambda_client.get_function(FunctionName=function_name, Qualifier=version)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ResourceNotFoundException':
+                raise
+            print(f"Version {version} no longer exists, skipping it")
+            continue
+        if function['Configuration'].get('State', 'Active') != 'Active':
+            print(f"Version {version} is {function['Configuration'].get('State')}, skipping it")
+            continue
+
+        image_uri = function['Code'].get('ResolvedImageUri') or function['Code'].get('ImageUri', '')
+        image_digest = image_uri.rpartition('@')[2] if '@' in image_uri else candidate.get('imageDigest')
+        image = describe_image(image_digest)
+        if image is None:
+            print(f"Image {image_digest} of version {version} is gone from ECR, skipping it")
+            continue
+        return {'lambdaVersion': version, 'imageDigest': image_digest, 'imageTag': image_tag(image),
+                'imageUri': image_uri, 'deploymentId': candidate.get('deploymentId')}
+    return None
+
+def describe_image(image_digest):
+    """ECR's details of image_digest in the function's repository, or None when it is gone."""
+    if not image_digest:
+        return None
+    try:
+        response = ecr_client.describe_images(
+            repositoryName=os.environ['ECR_REPOSITORY_NAME'],
+            imageIds=[{'imageDigest': image_digest}]
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ImageNotFoundException':
+            raise
+        return None
+    return response['imageDetails'][0] if response.get('imageDetails') else None
+
+def image_tag(image):
+    """The tag to record for an image: the first one other than latest, or None when untagged."""
+    tags = image.get('imageTags', [])
+    return next((tag for tag in tags if tag != 'latest'), tags[0] if tags else None)
+
+def deploy_group_key():
+    """Deploy train key of the function's CodeDeploy deployment group (as deploy_lambda uses it)."""
+    return f"{os.environ['CODEDEPLOY_APP_NAME']}/{os.environ['DEPLOYMENT_GROUP_NAME']}"
+
+def deploy_train_from_environment():
+    """The deploy train deploy_lambda queues behind, with its lock state in the AppSpec bucket."""
+    return codedeploy_deploy_train(s3_client, codedeploy, os.environ['APPSPEC_BUCKET'])
+
+def preempt_deploy_lease(ticket, target):
+    """
+    Take the deployment group's lease ahead of the queue before anything is stopped.
+
+    Queued requests are superseded, so the release that follows a stopped
+    deployment hands the lease to nobody instead of redeploying a newer
+    image over the rollback. Returns how many requests were superseded.
+    """
+    outcome = deploy_train_from_environment().preempt(
+        deploy_group_key(), {'ticket': ticket, 'imageDigest': target['imageDigest'], 'rollback': True}
+    )
+    if outcome['preempted']:
+        print(f"Took the deploy lease from {outcome['preempted']['imageDigest']}")
+    if outcome['superseded']:
+        print(f"Superseded {outcome['superseded']} queued deploy requests")
+    return outcome['superseded']
+
+def stop_active_deployments(auto_rollback):
+    """Stop deployments still running in the group; returns their IDs."""
+    response = codedeploy.list_deployments(
+        applicationName=os.environ['CODEDEPLOY_APP_NAME'],
+        deploymentGroupName=os.environ['DEPLOYMENT_GROUP_NAME'],
+        includeOnlyStatuses=ACTIVE_DEPLOYMENT_STATUSES
+    )
+    stopped = []
+    for deployment_id in response.get('deployments', []):
+        try:
+            codedeploy.stop_deployment(deploymentId=deployment_id, autoRollbackEnabled=auto_rollback)
+            stopped.append(deployment_id)
+            print(f"Stopped in-flight deployment {deployment_id}")
+        except ClientError as e:
+            # e.g. it finished between the list and the stop
+            print(f"Warning: could not stop deployment {deployment_id}: {str(e)}")
+    return stopped
+
+def repoint_alias(function_name, version):
+    """Break-glass: point live at version directly, dropping any weighted routing."""
+    lambda_client.update_alias(
+        FunctionName=function_name,
+        Name='live',
+        FunctionVersion=version,
+        RoutingConfig={'AdditionalVersionWeights': {}}
+    )
+    print(f"Alias 'live' repointed to version {version}")
+    return {'status': 'Succeeded', 'deploymentId': None}
+
+def rollback_deployment(function_name, current_version, target, context, ticket):
+    """
+    Shift all traffic to the target version in one CodeDeploy step and wait for it.
+
+    The AppSpec has no hooks: the version already passed them when it was first
+    deployed, and skipping them is what lets the rollback finish in seconds.
+    The deployment is recorded on the lease held by ticket, which deploy_lambda
+    releases on its state-change event.
+    """
+    bucket_name = os.environ['APPSPEC_BUCKET']
+    now = datetime.utcnow()
+    appspec_key = build_appspec_key(function_name, target['lambdaVersion'], now,
+                                    os.environ.get('APPSPEC_KEY_LAYOUT', 'flat'))
+    s3_client.put_object(
+        Bucket=bucket_name,
+        Key=appspec_key,
+        Body=json.dumps({
+            'version': 0.0,
+            'Resources': [{
+                'TargetService': {
+                    'Type': 'AWS::Lambda::Function',
+                    'Properties': {
+                        'Name': function_name,
+                        'Alias': 'live',
+                        'CurrentVersion': current_version,
+                        'TargetVersion': target['lambdaVersion']
+                    }
+                }
+            }]
+        }, indent=2),
+        ContentType='application/json'
+    )
+
+    response = codedeploy.create_deployment(
+        applicationName=os.environ['CODEDEPLOY_APP_NAME'],
+        deploymentGroupName=os.environ['DEPLOYMENT_GROUP_NAME'],
+        deploymentConfigName=ROLLBACK_DEPLOYMENT_CONFIG,
+        description=f"Rollback from version {current_version} to {target['lambdaVersion']}: {target['imageUri']}",
+        revision={
+            'revisionType': 'S3',
+            's3Location': {'bucket': bucket_name, 'key': appspec_key, 'bundleType': 'JSON'}
+        }
+    )
+    deployment_id = response['deploymentId']
+    print(f"Started rollback deployment {deployment_id}")
+    deploy_train_from_environment().started(deploy_group_key(), ticket, deployment_id)
+
+    record_deployment_manifest(s3_client, bucket_name, function_name, {
+        'deploymentId': deployment_id,
+        'imageUri': target['imageUri'],
+        'imageTag': target['imageTag'],
+        'imageDigest': target['imageDigest'],
+        'lambdaVersion': target['lambdaVersion'],
+        'appspecKey': appspec_key,
+        'createdAt': now.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'status': 'Created',
+        'rollback': True
+    })
+
+    status = wait_for_deployment(deployment_id, context)
+    if status in ('Failed', 'Stopped'):
+        raise RuntimeError(f"Rollback deployment {deployment_id} {status.lower()}")
+    return {'status': status, 'deploymentId': deployment_id}
+
+def wait_for_deployment(deployment_id, context):
+    """Poll the deployment until it finishes or the invocation's time runs out; returns its status."""
+    while True:
+        status = codedeploy.get_deployment(deploymentId=deployment_id)['deploymentInfo']['status']
+        if status in FINISHED_DEPLOYMENT_STATUSES:
+            return status
+        if context.get_remaining_time_in_millis() / 1000 - POLL_SECONDS < REPORT_BUFFER_SECONDS:
+            print(f"Rollback deployment {deployment_id} still {status}")
+            return status
+        time.sleep(POLL_SECONDS)
+
+def emit_restore_metrics(function_name, result):
+    """Record the time to restore of a finished rollback."""
+    metrics = {'RollbackTimeToRestore': result['timeToRestoreSeconds'] * 1000}
+    if 'timeToRestoreFromDetectionSeconds' in result:
+        metrics['RollbackTimeToRestoreFromDetection'] = result['timeToRestoreFromDetectionSeconds'] * 1000
+    emit_metrics(metrics, [['FunctionName'], ['FunctionName', 'Mode']],
+                 {'Mode': result['mode'], 'TargetFunction': function_name},
+                 units={name: 'Milliseconds' for name in metrics})
+
+class LocalContext:
+    """Stand-in for the Lambda context when run from a shell; waits up to ten minutes."""
+    function_name = 'local'
+
+    def __init__(self):
+        self.deadline = time.monotonic() + 600
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Roll the live alias back to the last known-good version')
+    parser.add_argument('--app', required=True)
+    parser.add_argument('--env', required=True)
+    parser.add_argument('--version', help='version to restore instead of the last known-good one')
+    parser.add_argument('--break-glass', action='store_true', help='update the alias directly, skipping CodeDeploy')
+    parser.add_argument('--dry-run', action='store_true', help='only report the version that would be restored')
+    parser.add_argument('--detected-at', help='when the bad release was detected (YYYY-MM-DDTHH:MM:SSZ)')
+    args = parser.parse_args(argv)
+
+    # Resource names follow the aws_lambda module's conventions
+    name = f"{args.app}-{args.env}"
+    account_id = get_client('sts').get_caller_identity()['Account']
+    os.environ.setdefault('LAMBDA_FUNCTION_NAME', name)
+    os.environ.setdefault('CODEDEPLOY_APP_NAME', name)
+    os.environ.setdefault('DEPLOYMENT_GROUP_NAME', name)
+    os.environ.setdefault('ECR_REPOSITORY_NAME', name)
+    os.environ.setdefault('APPSPEC_BUCKET', f"{name}-codedeploy-appspec-{account_id}")
+
+    event = {'breakGlass': args.break_glass, 'dryRun': args.dry_run}
+    if args.version:
+        event['version'] = args.version
+    if args.detected_at:
+        event['detectedAt'] = args.detected_at
+    result = handler(event, LocalContext())
+    print(json.dumps(json.loads(result['body']), indent=2))
+    return 0 if result['statusCode'] < 300 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+import unittest
+from unittest.mock import Mock, patch
+import io
+import json
+import os
+import sys
+from botocore.exceptions import ClientError
+
+# Add the current directory to the path so we can import the module
+sys.path.insert(0, os.path.dirname(__file__))
+# Shared modules Terraform packages alongside index.py
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lambda_shared'))
+
+# Import the module under test
+import index
+import deploy_train
+import state_store
+
+
+def client_error(code):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'operation')
+
+
+def function_version(version, digest):
+    return {
+        'Configuration': {'Version': version, 'State': 'Active'},
+        'Code': {'ResolvedImageUri': f"123.dkr.ecr.us-east-1.amazonaws.com/app-prod@{digest}"}
+    }
+
+
+class TestRollbackLambda(unittest.TestCase):
+    def setUp(self):
+        """Set up test fixtures."""
+        self.env_patcher = patch.dict(os.environ, {
+            'LAMBDA_FUNCTION_NAME': 'app-prod',
+            'CODEDEPLOY_APP_NAME': 'app-prod',
+            'DEPLOYMENT_GROUP_NAME': 'app-prod',
+            'ECR_REPOSITORY_NAME': 'app-prod',
+            'APPSPEC_BUCKET': 'appspec-bucket'
+        })
+        self.env_patcher.start()
+        self.patchers = [patch.object(index, name, Mock())
+                         for name in ('lambda_client', 'codedeploy', 'ecr_client', 's3_client')]
+        self.mock_lambda, self.mock_codedeploy, self.mock_ecr, self.mock_s3 = [p.start() for p in self.patchers]
+        self.train = deploy_train.DeployTrain(state_store.MemoryJsonStore(), state_store.SystemClock())
+        self.train_patcher = patch.object(index, 'deploy_train_from_environment', return_value=self.train)
+        self.train_patcher.start()
+
+        self.mock_lambda.get_alias.return_value = {'FunctionVersion': '12'}
+        self.mock_lambda.get_function.side_effect = lambda FunctionName, Qualifier: function_version(
+            Qualifier, f"sha256:v{Qualifier}")
+        manifest = {'deployments': [
+            {'deploymentId': 'd-12', 'lambdaVersion': '12', 'status': 'Succeeded'},
+            {'deploymentId': 'd-11', 'lambdaVersion': '11', 'status': 'Failed'},
+            {'deploymentId': 'd-10', 'lambdaVersion': '10', 'status': 'Succeeded'},
+            {'deploymentId': 'd-9', 'lambdaVersion': '9', 'status': 'Succeeded'}
+        ]}
+        self.mock_s3.get_object.side_effect = lambda Bucket, Key: {
+            'Body': io.BytesIO(json.dumps(manifest).encode()), 'ETag': '"e"'}
+        # Images are tagged v<version> (and sometimes latest)
+        self.mock_ecr.describe_images.side_effect = lambda repositoryName, imageIds: {'imageDetails': [
+            {'imageTags': ['latest', imageIds[0]['imageDigest'].replace('sha256:', '')]}
+        ]}
+        self.mock_codedeploy.list_deployments.return_value = {'deployments': []}
+        self.context = Mock()
+        self.context.get_remaining_time_in_millis.return_value = 60000
+
+    def tearDown(self):
+        """Clean up test fixtures."""
+        self.env_patcher.stop()
+        self.train_patcher.stop()
+        for patcher in self.patchers:
+            patcher.stop()
+
+    def test_picks_newest_successful_version_with_an_image(self):
+        """Test the live version and versions whose image is gone are skipped."""
+        def describe_images(repositoryName, imageIds):
+            if imageIds[0]['imageDigest'] == 'sha256:v10':
+                raise client_error('ImageNotFoundException')
+            return {'imageDetails': [{'imageTags': ['v9']}]}
+        self.mock_ecr.describe_images.side_effect = describe_images
+
+        result = index.handler({'dryRun': True}, self.context)
+
+        body = json.loads(result['body'])
+        self.assertEqual(body['target']['lambdaVersion'], '9')
+        self.assertEqual(body['target']['imageDigest'], 'sha256:v9')
+        self.assertEqual(body['target']['imageTag'], 'v9')
+        self.mock_codedeploy.create_deployment.assert_not_called()
+
+    def test_rollback_deploys_all_at_once_and_reports_time_to_restore(self):
+        """Test the rollback is a hook-free AllAtOnce deployment waited on to completion."""
+        self.mock_codedeploy.create_deployment.return_value = {'deploymentId': 'd-rollback'}
+        self.mock_codedeploy.get_deployment.return_value = {'deploymentInfo': {'status': 'Succeeded'}}
+        self.train.join('app-prod/app-prod', {'ticket': 'bad', 'imageDigest': 'sha256:bad'})
+        self.train.started('app-prod/app-prod', 'bad', 'd-bad')
+        self.train.join('app-prod/app-prod', {'ticket': 'queued', 'imageDigest': 'sha256:newer'})
+
+        result = index.handler({}, self.context)
+
+        self.assertEqual(result['statusCode'], 200)
+        body = json.loads(result['body'])
+        self.assertEqual(body['deploymentId'], 'd-rollback')
+        self.assertIn('timeToRestoreSeconds', body)
+        call = self.mock_codedeploy.create_deployment.call_args[1]
+        self.assertEqual(call['deploymentConfigName'], 'CodeDeployDefault.LambdaAllAtOnce')
+        appspec = json.loads(self.mock_s3.put_object.call_args_list[0][1]['Body'])
+        self.assertNotIn('Hooks', appspec)
+        self.assertEqual(appspec['Resources'][0]['TargetService']['Properties']['TargetVersion'], '10')
+        record = json.loads(self.mock_s3.put_object.call_args_list[1][1]['Body'])['deployments'][0]
+        self.assertEqual((record['deploymentId'], record['imageTag']), ('d-rollback', 'v10'))
+        # The rollback holds the deploy lease and the queued request will not deploy over it
+        self.assertEqual(body['supersededRequests'], 1)
+        self.assertFalse(self.train.release('app-prod/app-prod', deployment_id='d-bad')['released'])
+        self.assertEqual(self.train.join('app-prod/app-prod', {'ticket': 'queued', 'imageDigest': 'sha256:newer'})
+                         ['result'], 'superseded')
+        self.assertTrue(self.train.release('app-prod/app-prod', deployment_id='d-rollback')['released'])
+
+    def test_break_glass_repoints_alias_directly(self):
+        """Test break-glass mode stops in-flight deployments and updates the alias itself."""
+        self.mock_codedeploy.list_deployments.return_value = {'deployments': ['d-running']}
+
+        result = index.handler({'breakGlass': True, 'version': '9'}, self.context)
+
+        body = json.loads(result['body'])
+        self.assertEqual(body['mode'], 'breakGlass')
+        self.assertEqual(body['stoppedDeployments'], ['d-running'])
+        self.mock_codedeploy.stop_deployment.assert_called_once_with(deploymentId='d-running', autoRollbackEnabled=False)
+        self.mock_lambda.update_alias.assert_called_once_with(
+            FunctionName='app-prod', Name='live', FunctionVersion='9', RoutingConfig={'AdditionalVersionWeights': {}}
+        )
+        self.mock_codedeploy.create_deployment.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
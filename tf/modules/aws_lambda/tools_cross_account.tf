@@ -57,6 +57,9 @@ resource "aws_iam_role_policy" "tools_access" {
         Action = [
           "codedeploy:CreateDeployment",
           "codedeploy:GetDeployment",
+          "codedeploy:ListDeploymentTargets",
+          "codedeploy:GetDeploymentTarget",
+          "codedeploy:StopDeployment",
           "codedeploy:GetDeploymentConfig",
           "codedeploy:GetApplicationRevision",
           "codedeploy:RegisterApplicationRevision"
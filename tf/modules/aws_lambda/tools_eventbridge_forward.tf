@@ -1,4 +1,4 @@
-# Forward ECR push events to tools account
+# Forward ECR push and CodeDeploy state change events to tools account
 
 # IAM role for EventBridge to send events to tools account
 resource "aws_iam_role" "eventbridge_cross_account" {
@@ -74,4 +74,33 @@ resource "aws_cloudwatch_event_target" "to_tools_bus" {
   target_id = "ToolsBus"
   arn       = "arn:aws:events:${data.aws_region.current.name}:${local.tools_account_id}:event-bus/default"
   role_arn  = aws_iam_role.eventbridge_cross_account.arn
-}
\ No newline at end of file
+}
+
+# EventBridge rule to forward finished deployments, which complete the pipeline's deploy action
+resource "aws_cloudwatch_event_rule" "codedeploy_state_forward" {
+  name        = "${var.app}-${var.env}-codedeploy-state-forward"
+  description = "Forward CodeDeploy deployment completion to Tools account"
+
+  event_pattern = jsonencode({
+    source      = ["aws.codedeploy"]
+    detail-type = ["CodeDeploy Deployment State-change Notification"]
+    detail = {
+      state       = ["SUCCESS", "FAILURE", "STOP"]
+      application = [aws_codedeploy_app.lambda.name]
+    }
+  })
+
+  tags = {
+    Application = var.app
+    Environment = var.env
+    Module      = "aws_lambda"
+    Description = "Forward CodeDeploy state change events to tools account"
+  }
+}
+
+resource "aws_cloudwatch_event_target" "codedeploy_state_to_tools_bus" {
+  rule      = aws_cloudwatch_event_rule.codedeploy_state_forward.name
+  target_id = "ToolsBus"
+  arn       = "arn:aws:events:${data.aws_region.current.name}:${local.tools_account_id}:event-bus/default"
+  role_arn  = aws_iam_role.eventbridge_cross_account.arn
+}
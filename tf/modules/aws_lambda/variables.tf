@@ -66,3 +66,217 @@ variable "enable_migrations" {
   type        = bool
   default     = false
 }
+
+variable "appspec_key_layout" {
+  description = "S3 key layout for CodeDeploy AppSpec files: 'flat' (appspec-<function>-...) or 'partitioned' (appspec/<function>/<yyyy>/<mm>/...). Partitioned lets cleanup prune month by month instead of listing the whole bucket."
+  type        = string
+  default     = "flat"
+
+  validation {
+    condition     = contains(["flat", "partitioned"], var.appspec_key_layout)
+    error_message = "appspec_key_layout must be 'flat' or 'partitioned'."
+  }
+}
+
+variable "cleanup_mode" {
+  description = "Cleanup strategy after each successful deployment: 'full' re-lists the ECR repository and AppSpec bucket every run, 'incremental' only processes artifacts deployed since the last run and does a full reconcile periodically."
+  type        = string
+  default     = "full"
+
+  validation {
+    condition     = contains(["full", "incremental"], var.cleanup_mode)
+    error_message = "cleanup_mode must be 'full' or 'incremental'."
+  }
+}
+
+variable "cleanup_full_reconcile_interval_hours" {
+  description = "In incremental cleanup mode, how often (in hours) a full reconcile runs to correct drift"
+  type        = number
+  default     = 24
+}
+
+variable "cleanup_dry_run" {
+  description = "When true, the cleanup Lambda only logs what it would delete"
+  type        = bool
+  default     = false
+}
+
+variable "cleanup_untagged_images" {
+  description = "Whether full cleanup runs also delete untagged ECR images (superseded pushes, children of deleted multi-arch indexes) that no tagged or protected image index references"
+  type        = bool
+  default     = true
+}
+
+variable "cleanup_untagged_grace_hours" {
+  description = "Minimum age (in hours) of an untagged ECR image before cleanup may delete it, so in-progress multi-arch pushes are not collected"
+  type        = number
+  default     = 24
+}
+
+variable "cleanup_lambda_versions" {
+  description = "Whether cleanup deletes old published versions of the app function (alias, recent and successfully deployed versions are kept)"
+  type        = bool
+  default     = true
+}
+
+variable "cleanup_sweeper_enabled" {
+  description = "Deploy the account-wide cleanup sweeper with this stack. It cleans every hoist stack in the account and region whose ECR repository matches cleanup_sweeper_tag_filter, so enable it in one stack per account and region."
+  type        = bool
+  default     = false
+}
+
+variable "cleanup_sweeper_tag_filter" {
+  description = "Tags an ECR repository must have for the cleanup sweeper to clean its stack. The sweeper's ECR permissions are limited to repositories with these tags."
+  type        = map(string)
+  default = {
+    Module = "hoist_lambda"
+  }
+}
+
+variable "cleanup_sweeper_schedule" {
+  description = "Schedule expression for a full cleanup sweeper run"
+  type        = string
+  default     = "rate(1 day)"
+}
+
+variable "cleanup_sweeper_max_workers" {
+  description = "Number of stacks the cleanup sweeper cleans concurrently"
+  type        = number
+  default     = 4
+}
+
+variable "cleanup_sweeper_max_calls_per_second" {
+  description = "Limit on the cleanup sweeper's ECR, S3 and CodeDeploy calls per second, per account"
+  type        = number
+  default     = 10
+}
+
+variable "prewarm_max_environments" {
+  description = "Upper bound on execution environments the BeforeAllowTraffic hook warms on a new version before traffic shifts to it (0 disables pre-warming). The actual count follows the live alias's recent peak ConcurrentExecutions."
+  type        = number
+  default     = 10
+}
+
+variable "prewarm_factor" {
+  description = "Multiplier applied to the live alias's recent peak ConcurrentExecutions to get the number of environments to pre-warm"
+  type        = number
+  default     = 1.0
+}
+
+variable "prewarm_min_warm_fraction" {
+  description = "Fraction of the pre-warm target that must have started before the BeforeAllowTraffic hook passes; below it the deployment fails instead of shifting traffic onto cold environments (0 only warns)"
+  type        = number
+  default     = 0.5
+}
+
+variable "probe_requests" {
+  description = "Requests per path the BeforeAllowTraffic hook sends to both the new and the live version to compare latency (0 disables the load probe)"
+  type        = number
+  default     = 10
+}
+
+variable "probe_paths" {
+  description = "HTTP paths (GET) the load probe requests on both versions"
+  type        = list(string)
+  default     = ["/health"]
+}
+
+variable "probe_concurrency" {
+  description = "Concurrent requests in flight during the load probe"
+  type        = number
+  default     = 5
+}
+
+variable "latency_budget_percent" {
+  description = "How much slower (in percent, at the gate percentile) the new version may be than the live version before the deployment fails"
+  type        = number
+  default     = 20
+}
+
+variable "latency_gate_percentile" {
+  description = "Latency percentile the load probe gates on: p50, p95 or p99"
+  type        = string
+  default     = "p95"
+
+  validation {
+    condition     = contains(["p50", "p95", "p99"], var.latency_gate_percentile)
+    error_message = "latency_gate_percentile must be 'p50', 'p95' or 'p99'."
+  }
+}
+
+variable "cold_start_samples" {
+  description = "Cold starts of the new version the BeforeAllowTraffic hook measures (Init Duration) before comparing with the rolling baseline (0 disables the cold-start gate)"
+  type        = number
+  default     = 5
+}
+
+variable "cold_start_budget_percent" {
+  description = "How much higher (in percent) the new version's median Init Duration may be than the rolling baseline"
+  type        = number
+  default     = 25
+}
+
+variable "cold_start_gate_mode" {
+  description = "What an Init Duration regression does to the deployment: 'warn' logs it, 'fail' fails the BeforeAllowTraffic hook"
+  type        = string
+  default     = "warn"
+
+  validation {
+    condition     = contains(["warn", "fail"], var.cold_start_gate_mode)
+    error_message = "cold_start_gate_mode must be 'warn' or 'fail'."
+  }
+}
+
+variable "request_capture_sample_rate" {
+  description = "Fraction (0-1) of requests logged with the HOIST_CAPTURE marker that are stored for shadow replay (0 disables capture)"
+  type        = number
+  default     = 0
+}
+
+variable "request_capture_methods" {
+  description = "HTTP methods eligible for capture; replay re-sends them to the live version, so keep this to side-effect-free methods"
+  type        = list(string)
+  default     = ["GET", "HEAD"]
+}
+
+variable "request_capture_redact_headers" {
+  description = "Request headers redacted before storage, in addition to Authorization, Cookie, X-Api-Key and AWS security tokens"
+  type        = list(string)
+  default     = []
+}
+
+variable "request_capture_redact_query" {
+  description = "Query string parameters redacted before storage"
+  type        = list(string)
+  default     = []
+}
+
+variable "request_capture_redact_fields" {
+  description = "JSON body field names redacted (at any depth) before storage"
+  type        = list(string)
+  default     = []
+}
+
+variable "request_capture_retention_days" {
+  description = "Days captured requests are kept"
+  type        = number
+  default     = 7
+}
+
+variable "replay_events" {
+  description = "Most recent captured requests the BeforeAllowTraffic hook replays against the new and live versions (0 disables replay)"
+  type        = number
+  default     = 50
+}
+
+variable "replay_max_error_delta" {
+  description = "Largest allowed increase in a route's 5xx rate (0-1) on the new version during replay"
+  type        = number
+  default     = 0
+}
+
+variable "deploy_queue_max_wait_seconds" {
+  description = "Longest a deploy request waits behind a running deployment of the same group before failing; keep it below the pipeline deploy action's timeout"
+  type        = number
+  default     = 600
+}
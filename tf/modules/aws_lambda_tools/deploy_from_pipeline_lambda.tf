@@ -61,9 +61,30 @@ resource "aws_iam_role_policy" "deploy_from_pipeline_lambda" {
         Action = [
           "sts:AssumeRole"
         ]
-        Resource = [
+        Resource = concat([
           local.dev_tools_cross_account_role_arn,
           local.prod_tools_cross_account_role_arn
+        ], [for target in var.additional_prod_targets : target.cross_account_role_arn])
+      },
+      {
+        # Deployment state records for event-driven completion
+        Effect = "Allow"
+        Action = [
+          "s3:GetObject",
+          "s3:PutObject",
+          "s3:DeleteObject"
+        ]
+        Resource = [
+          "${aws_s3_bucket.pipeline_artifacts.arn}/deployment-state/*"
+        ]
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "s3:ListBucket"
+        ]
+        Resource = [
+          aws_s3_bucket.pipeline_artifacts.arn
         ]
       }
     ]
@@ -82,7 +103,10 @@ resource "aws_lambda_function" "deploy_from_pipeline" {
 
   environment {
     variables = {
-      APP_NAME = var.app
+      APP_NAME              = var.app
+      COMPLETION_MODE       = var.deploy_completion_mode
+      STATE_BUCKET          = aws_s3_bucket.pipeline_artifacts.bucket
+      FALLBACK_POLL_MINUTES = tostring(var.deploy_fallback_poll_minutes)
     }
   }
 
@@ -103,6 +127,96 @@ resource "aws_lambda_permission" "codepipeline_invoke" {
   source_arn    = aws_codepipeline.deployment_pipeline.arn
 }
 
+# CodeDeploy state changes forwarded from the dev and prod accounts resolve parked jobs
+resource "aws_cloudwatch_event_rule" "deployment_state_change" {
+  name        = "${var.app}-from-envs-codedeploy-state"
+  description = "Dev/Prod → Tools: CodeDeploy deployment finished"
+
+  event_pattern = jsonencode({
+    account     = [local.dev_account_id, local.prod_account_id]
+    source      = ["aws.codedeploy"]
+    detail-type = ["CodeDeploy Deployment State-change Notification"]
+    detail = {
+      state       = ["SUCCESS", "FAILURE", "STOP"]
+      application = [local.dev_codedeploy_app_name, local.prod_codedeploy_app_name]
+    }
+  })
+
+  tags = {
+    Application = var.app
+    Environment = "tools"
+    Module      = "aws_lambda_tools"
+    Description = "CodeDeploy state change rule from dev and prod accounts"
+  }
+}
+
+resource "aws_cloudwatch_event_target" "deployment_state_change" {
+  rule      = aws_cloudwatch_event_rule.deployment_state_change.name
+  target_id = "DeployFromPipeline"
+  arn       = aws_lambda_function.deploy_from_pipeline.arn
+}
+
+resource "aws_lambda_permission" "eventbridge_deployment_state_change" {
+  statement_id  = "AllowEventBridgeStateChange"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.deploy_from_pipeline.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.deployment_state_change.arn
+}
+
+# Slow fallback poll of parked deployments, in case a state change event is lost
+resource "aws_cloudwatch_event_rule" "deployment_sweep" {
+  name                = "${var.app}-tools-deployment-sweep"
+  description         = "Poll deployments still waiting for a completion event"
+  schedule_expression = "rate(${var.deploy_fallback_poll_minutes} minutes)"
+  state               = var.deploy_completion_mode == "event" ? "ENABLED" : "DISABLED"
+
+  tags = {
+    Application = var.app
+    Environment = "tools"
+    Module      = "aws_lambda_tools"
+    Description = "Fallback poll for event-driven deployment completion"
+  }
+}
+
+resource "aws_cloudwatch_event_target" "deployment_sweep" {
+  rule      = aws_cloudwatch_event_rule.deployment_sweep.name
+  target_id = "DeployFromPipelineSweep"
+  arn       = aws_lambda_function.deploy_from_pipeline.arn
+  input     = jsonencode({ sweep = true })
+}
+
+resource "aws_lambda_permission" "eventbridge_deployment_sweep" {
+  statement_id  = "AllowEventBridgeSweep"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.deploy_from_pipeline.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.deployment_sweep.arn
+}
+
+# Finished deployments' state records are never read again
+resource "aws_s3_bucket_lifecycle_configuration" "pipeline_artifacts_deployment_state" {
+  bucket = aws_s3_bucket.pipeline_artifacts.id
+
+  rule {
+    id     = "expire-deployment-state"
+    status = "Enabled"
+
+    filter {
+      prefix = "deployment-state/deployments/"
+    }
+
+    expiration {
+      days = 30
+    }
+
+    # Every conditional update leaves a noncurrent version behind
+    noncurrent_version_expiration {
+      noncurrent_days = 1
+    }
+  }
+}
+
 # Archive the Lambda function
 data "archive_file" "deploy_from_pipeline_lambda" {
   type        = "zip"
@@ -112,4 +226,19 @@ data "archive_file" "deploy_from_pipeline_lambda" {
     content  = file("${path.module}/deploy_from_pipeline_lambda/index.py")
     filename = "index.py"
   }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/clients.py")
+    filename = "clients.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/instrumentation.py")
+    filename = "instrumentation.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/state_store.py")
+    filename = "state_store.py"
+  }
 }
@@ -1,11 +1,54 @@
 import boto3
+import botocore.session
 import json
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.credentials import (AssumeRoleCredentialFetcher, CredentialProvider, CredentialResolver,
+                                  RefreshableCredentials)
 from datetime import datetime, timedelta
 
-codepipeline = boto3.client("codepipeline")
-sts = boto3.client("sts")
+from clients import client_config, lazy_client
+from instrumentation import describe_event, instrument_client, instrumented, phase, set_dimensions
+from state_store import S3JsonStore, update_json
+
+codepipeline = lazy_client("codepipeline")
+s3_client = lazy_client("s3")
+
+# How many times a slow function code update may be handed back by the deploy lambda
+MAX_DEPLOY_CONTINUATIONS = 10
+
+# Fan-out: "all" waits for every target, "fail_fast" stops the rest on the first failure
+FANOUT_POLICIES = ("all", "fail_fast")
+FANOUT_TOKEN_FIELDS = ("name", "deploymentId", "targetRegion", "crossAccountRoleArn", "status")
+# Carried only by targets whose deploy lambda handed back a continuation (see start_target_deployment)
+START_TOKEN_FIELDS = ("target", "imageTag", "continuation", "continuations")
+
+# Cross-account sessions and clients, cached per container by (role ARN, region).
+# Credentials refresh themselves ahead of expiry and are never put in a continuation token.
+CROSS_ACCOUNT_SESSION_SECONDS = 3600
+_sessions = {}
+_clients = {}
+_cache_lock = threading.Lock()
+
+# Event-driven completion: CodeDeploy state changes forwarded from the target accounts
+DEPLOYMENT_STATE_CHANGE = "CodeDeploy Deployment State-change Notification"
+TERMINAL_STATES = {"SUCCESS": "Succeeded", "FAILURE": "Failed", "STOP": "Stopped"}
+STATE_PREFIX = "deployment-state"
+
+# Polling mode: each lifecycle hook's band of the progress bar, in order
+LIFECYCLE_BANDS = [
+    ("BeforeAllowTraffic", (50, 60)),
+    ("AllowTraffic", (60, 90)),
+    ("AfterAllowTraffic", (90, 95))
+]
+PROGRESS_REPORT_STEP = 10
+FAST_POLL_SECONDS = 5
+DEFAULT_POLL_SECONDS = 10
+SLOW_POLL_SECONDS = 30
+# Leave this much time to report before the invocation times out
+CONTINUATION_BUFFER_SECONDS = 90
 
 def report_progress(job_id, context, succeeded=True, msg="ok", pct=100, cont=None, external_id=None):
     """
@@ -42,6 +85,88 @@ def report_progress(job_id, context, succeeded=True, msg="ok", pct=100, cont=Non
             print(f"Unexpected error reporting progress: {error_str}")
             raise
 
+def sts_client(service_name, **credentials):
+    """STS client on the source credentials AssumeRoleCredentialFetcher passes in."""
+    return instrument_client(boto3.client(service_name, config=client_config(service_name), **credentials))
+
+class AssumedRoleProvider(CredentialProvider):
+    """Credential provider for a cross-account role, assumed with this function's own credentials."""
+    METHOD = "assume-role"
+    CANONICAL_NAME = "hoist-cross-account"
+
+    def __init__(self, role_arn):
+        super().__init__()
+        self.role_arn = role_arn
+        self.fetcher = AssumeRoleCredentialFetcher(
+            client_creator=sts_client,
+            source_credentials=boto3.Session().get_credentials(),
+            role_arn=role_arn,
+            extra_args={
+                "RoleSessionName": f"deploy-from-pipeline-{role_arn.split(':')[4]}",
+                "DurationSeconds": CROSS_ACCOUNT_SESSION_SECONDS
+            }
+        )
+
+    def fetch(self):
+        credentials = self.fetcher.fetch_credentials()
+        print(f"Assumed {self.role_arn}, credentials expire at {credentials['expiry_time']}")
+        return credentials
+
+    def load(self):
+        return RefreshableCredentials.create_from_metadata(
+            metadata=self.fetch(), refresh_using=self.fetch, method=self.METHOD
+        )
+
+def cross_account_session(role_arn, region):
+    """
+    Return a boto3 session for role_arn in region, shared across warm invocations.
+
+    The session resolves its credentials through AssumedRoleProvider alone, so
+    they are RefreshableCredentials renewed before they expire (botocore
+    refreshes 15 minutes ahead) instead of failing a long deployment after an hour.
+    """
+    key = (role_arn, region)
+    with _cache_lock:
+        session = _sessions.get(key)
+        if session is None:
+            botocore_session = botocore.session.Session()
+            botocore_session.register_component(
+                "credential_provider", CredentialResolver([AssumedRoleProvider(role_arn)])
+            )
+            session = boto3.Session(botocore_session=botocore_session, region_name=region)
+            _sessions[key] = session
+        return session
+
+def cross_account_client(service, role_arn, region):
+    """Return a cached client for service in the role's account, reusing its connection pool."""
+    key = (service, role_arn, region)
+    client = _clients.get(key)
+    if client is None:
+        session = cross_account_session(role_arn, region)
+        with _cache_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = instrument_client(session.client(service, config=client_config(service)))
+                _clients[key] = client
+    return client
+
+def deployment_codedeploy_client(deployment_data):
+    """CodeDeploy client for the account a continuation token's deployment runs in."""
+    if "crossAccountRoleArn" in deployment_data:
+        return cross_account_client("codedeploy", deployment_data["crossAccountRoleArn"],
+                                    deployment_data["targetRegion"])
+    # Tokens issued before the client cache carried the assumed credentials
+    credentials = deployment_data["credentials"]
+    return instrument_client(boto3.client(
+        "codedeploy",
+        aws_access_key_id=credentials["AccessKeyId"],
+        aws_secret_access_key=credentials["SecretAccessKey"],
+        aws_session_token=credentials["SessionToken"],
+        region_name=deployment_data["targetRegion"],
+        config=client_config("codedeploy")
+    ))
+
+@instrumented
 def handler(event, context):
     """
     Deploy from pipeline Lambda that:
@@ -49,7 +174,13 @@ def handler(event, context):
     2. Polls CodeDeploy deployment until completion
     3. Reports success/failure back to CodePipeline
     """
-    print(f"Received event: {json.dumps(event)}")
+    print(f"Received event: {describe_event(event)}")
+    
+    # Deployment state changes and the fallback sweep are not CodePipeline jobs
+    if event.get("detail-type") == DEPLOYMENT_STATE_CHANGE:
+        return handle_deployment_state_change(event, context)
+    if event.get("sweep"):
+        return sweep_parked_deployments(context)
     
     # Extract CodePipeline job data
     job_id = event["CodePipeline.job"]["id"]
@@ -60,12 +191,23 @@ def handler(event, context):
         continuation_token = job_data.get("continuationToken")
         
         if continuation_token:
-            # This is a continuation - resume polling deployment
+            # This is a continuation - wait for the completion event or resume polling
             deployment_data = json.loads(continuation_token)
+            set_dimensions(pipeline_execution_id=deployment_data.get("pipelineExecutionId"),
+                           deployment_id=deployment_data.get("deploymentId"))
+            if deployment_data.get("mode") == "start":
+                with phase("start_deployment"):
+                    deployment_data = resume_target_deployment(deployment_data)
+                return follow_deployment(job_id, context, deployment_data)
+            if deployment_data.get("mode") == "event":
+                return park_job(job_id, context, deployment_data)
+            if deployment_data.get("mode") == "fanout":
+                return poll_fanout(job_id, context, deployment_data)
             return resume_deployment_polling(job_id, context, deployment_data)
         
-        # Initial invocation - start deployment
-        report_progress(job_id, context, msg="Starting deployment", pct=5)
+        # Initial invocation - start deployment. Progress is not reported until the
+        # deployment exists: a success result without a continuation token completes the job.
+        print("Starting deployment")
         
         # Get UserParameters with simplified deployment info
         user_params = job_data.get("actionConfiguration", {}).get("configuration", {}).get("UserParameters", "{}")
@@ -73,111 +215,21 @@ def handler(event, context):
         
         print(f"Deployment parameters: {json.dumps(params)}")
         
-        # Extract deployment info
-        target_account = params["accountId"]
-        target_region = params["region"]
-        repository_name = params["repositoryName"]
-        cross_account_role_arn = params["crossAccountRoleArn"]
-        deploy_lambda_name = params["deployLambdaName"]
         image_tag = params["imageTag"]
         image_digest = params.get("imageDigest", "")
+        targets = deployment_targets(params)
+        # Passed as #{codepipeline.PipelineExecutionId}; tags the metrics of every Lambda in the deploy
+        pipeline_execution_id = params.get("pipelineExecutionId")
+        set_dimensions(pipeline_execution_id=pipeline_execution_id)
         
-        print(f"Calling deploy lambda: {deploy_lambda_name} in account {target_account}")
-        
-        report_progress(job_id, context, msg=f"Assuming role in {target_account}", pct=10)
-        
-        # Create synthetic ECR event for deploy lambda
-        synthetic_event = {
-            "account": target_account,
-            "region": target_region,
-            "detail": {
-                "repository-name": repository_name,
-                "image-tag": image_tag,
-                "action-type": ["PUSH"],
-                "result": ["SUCCESS"]
-            }
-        }
-        
-        if image_digest:
-            synthetic_event["detail"]["image-digest"] = image_digest
-        
-        # Assume cross-account role
-        assumed_role = sts.assume_role(
-            RoleArn=cross_account_role_arn,
-            RoleSessionName=f"deploy-from-pipeline-{target_account}"
-        )
-        
-        # Create Lambda client with assumed role credentials
-        credentials = assumed_role["Credentials"]
-        target_lambda = boto3.client(
-            "lambda",
-            aws_access_key_id=credentials["AccessKeyId"],
-            aws_secret_access_key=credentials["SecretAccessKey"],
-            aws_session_token=credentials["SessionToken"],
-            region_name=target_region
-        )
-        
-        report_progress(job_id, context, msg=f"Triggering deployment for {image_tag}", pct=30)
-        
-        # Call deploy lambda in target account
-        deploy_response = target_lambda.invoke(
-            FunctionName=deploy_lambda_name,
-            InvocationType="RequestResponse",
-            Payload=json.dumps(synthetic_event)
-        )
-        
-        # Parse response from deploy lambda
-        deploy_result = json.loads(deploy_response["Payload"].read())
-        
-        print(f"Deploy lambda response: {json.dumps(deploy_result)}")
-        
-        if deploy_response["StatusCode"] != 200:
-            raise Exception(f"Deploy lambda failed with status {deploy_response['StatusCode']}: {deploy_result}")
-        
-        # Check if deploy lambda returned an error
-        if "errorType" in deploy_result:
-            error_msg = deploy_result.get("errorMessage", "Unknown error")
-            raise Exception(f"Deploy lambda failed: {error_msg}")
-        
-        # Check for expected response format
-        if "body" not in deploy_result:
-            raise Exception(f"Deploy lambda response missing 'body' field: {deploy_result}")
-        
-        deploy_body = json.loads(deploy_result["body"])
-        deployment_id = deploy_body["deploymentId"]
-        
-        print(f"Deploy lambda succeeded, deployment ID: {deployment_id}")
-        
-        # Create deployment console link
-        deployment_link = f"https://{target_region}.console.aws.amazon.com/codesuite/codedeploy/deployments/{deployment_id}"
-        
-        report_progress(job_id, context, msg=f"Deployment {deployment_id} started", pct=40, external_id=deployment_link)
-        
-        # Create CodeDeploy client with assumed role
-        target_codedeploy = boto3.client(
-            "codedeploy",
-            aws_access_key_id=credentials["AccessKeyId"],
-            aws_secret_access_key=credentials["SecretAccessKey"],
-            aws_session_token=credentials["SessionToken"],
-            region_name=target_region
-        )
-        
-        # Start polling - package data for continuation
-        deployment_data = {
-            "deploymentId": deployment_id,
-            "targetAccount": target_account,
-            "targetRegion": target_region,
-            "deploymentLink": deployment_link,
-            "credentials": {
-                "AccessKeyId": credentials["AccessKeyId"],
-                "SecretAccessKey": credentials["SecretAccessKey"],
-                "SessionToken": credentials["SessionToken"]
-            },
-            "startTime": datetime.utcnow().isoformat()
-        }
+        # Several targets roll out concurrently and are tracked together
+        if len(targets) > 1:
+            return start_fanout(job_id, context, targets, image_tag, image_digest, params.get("policy", "all"),
+                                pipeline_execution_id)
         
-        # Start initial polling
-        return poll_deployment_with_continuation(job_id, context, deployment_data)
+        with phase("start_deployment"):
+            deployment_data = start_target_deployment(targets[0], image_tag, image_digest, pipeline_execution_id)
+        return follow_deployment(job_id, context, deployment_data)
         
     except Exception as e:
         print(f"Error in deploy-from-pipeline: {str(e)}")
@@ -193,112 +245,683 @@ def handler(event, context):
         
         raise
 
+def follow_deployment(job_id, context, deployment_data):
+    """Carry on with a target's deployment once its deploy lambda has answered."""
+    set_dimensions(deployment_id=deployment_data["deploymentId"])
+    
+    # Queued behind another deployment or mid code update: ask again on the next job poll
+    if deployment_data["status"] == "Starting":
+        token = dict({field: deployment_data[field] for field in START_TOKEN_FIELDS}, mode="start",
+                     pipelineExecutionId=deployment_data.get("pipelineExecutionId"))
+        report_progress(job_id, context, msg=deployment_data["message"], pct=5, cont=json.dumps(token))
+        return
+    
+    # The image is already published and live, so there is nothing to roll out
+    if deployment_data["status"] == "Succeeded":
+        report_progress(job_id, context, succeeded=True, msg=deployment_data["message"])
+        return
+    
+    if os.environ.get("COMPLETION_MODE", "poll") == "event" and os.environ.get("STATE_BUCKET"):
+        return start_event_wait(job_id, context, deployment_data)
+    
+    # Start initial polling
+    return poll_deployment_with_continuation(job_id, context, deployment_data)
+
+def deployment_targets(params):
+    """
+    The targets of a deploy action: UserParameters either describe one target
+    inline (accountId, region, ...) or list several under "targets".
+    """
+    keys = ("accountId", "region", "repositoryName", "crossAccountRoleArn", "deployLambdaName")
+    targets = params.get("targets") or [{key: params[key] for key in keys}]
+    for target in targets:
+        missing = [key for key in keys if not target.get(key)]
+        if missing:
+            raise Exception(f"Deploy target is missing {', '.join(missing)}: {json.dumps(target)}")
+        target.setdefault("name", f"{target['accountId']}/{target['region']}")
+    return targets
+
+def start_target_deployment(target, image_tag, image_digest, pipeline_execution_id=None):
+    """
+    Have a target's deploy lambda roll out the image and return its tracking data.
+
+    The result names the role to assume rather than carrying credentials, which
+    would expire mid-deployment. Its status is None while the CodeDeploy
+    deployment runs, "Succeeded" when the image was already live, or
+    "Starting" when the deploy lambda handed back a continuation (see
+    resume_target_deployment).
+    """
+    target_account = target["accountId"]
+    target_region = target["region"]
+    deploy_lambda_name = target["deployLambdaName"]
+    
+    print(f"Calling deploy lambda: {deploy_lambda_name} in account {target_account} ({target_region})")
+    
+    # Create synthetic ECR event for deploy lambda. It must not wait in its deploy
+    # queue: a queued request comes straight back and is re-checked on the next job poll.
+    synthetic_event = {
+        "account": target_account,
+        "region": target_region,
+        "detail": {
+            "repository-name": target["repositoryName"],
+            "image-tag": image_tag,
+            "action-type": ["PUSH"],
+            "result": ["SUCCESS"]
+        },
+        "waitInQueue": False
+    }
+    
+    if image_digest:
+        synthetic_event["detail"]["image-digest"] = image_digest
+    if pipeline_execution_id:
+        synthetic_event["pipelineExecutionId"] = pipeline_execution_id
+    
+    # Lambda client in the target account (cached, with auto-refreshing credentials)
+    target_lambda = cross_account_client("lambda", target["crossAccountRoleArn"], target_region)
+    
+    print(f"Triggering deployment for {image_tag}")
+    
+    # Call deploy lambda in target account
+    deploy_body = invoke_deploy_lambda(target_lambda, deploy_lambda_name, synthetic_event)
+    return target_deployment_data(target, image_tag, deploy_body, pipeline_execution_id)
+
+def resume_target_deployment(starting):
+    """
+    Hand a "Starting" target's continuation back to its deploy lambda once.
+
+    Called on the next job poll, so waiting in the target's deploy queue or for
+    a long code update never blocks an invocation.
+    """
+    target = starting["target"]
+    target_lambda = cross_account_client("lambda", target["crossAccountRoleArn"], target["region"])
+    deploy_body = invoke_deploy_lambda(target_lambda, target["deployLambdaName"],
+                                       {"continuation": starting["continuation"], "waitInQueue": False})
+    return target_deployment_data(target, starting["imageTag"], deploy_body, starting.get("pipelineExecutionId"),
+                                  starting.get("continuations", 0))
+
+def target_deployment_data(target, image_tag, deploy_body, pipeline_execution_id, continuations=0):
+    """Tracking data for a target from its deploy lambda's response body."""
+    deployment_data = {
+        "name": target["name"],
+        "deploymentId": deploy_body.get("deploymentId"),
+        "targetAccount": target["accountId"],
+        "targetRegion": target["region"],
+        "crossAccountRoleArn": target["crossAccountRoleArn"],
+        "deploymentLink": None,
+        "status": None,
+        "startTime": datetime.utcnow().isoformat(),
+        "pipelineExecutionId": pipeline_execution_id
+    }
+    
+    # A wait in the target's deploy queue or a long code update. Queue waits are
+    # bounded by the deploy lambda itself, so only code update continuations count here.
+    if "continuation" in deploy_body:
+        if deploy_body.get("queued"):
+            print(f"Waiting in the deploy queue: {deploy_body.get('message')}")
+        else:
+            continuations += 1
+            if continuations > MAX_DEPLOY_CONTINUATIONS:
+                raise Exception(f"Function code update did not finish after {MAX_DEPLOY_CONTINUATIONS} continuations")
+            print(f"Waiting for function code update ({continuations})")
+        return dict(deployment_data, status="Starting", message=deploy_body.get("message", "Starting deployment"),
+                    target={key: target[key] for key in ("name", "accountId", "region", "crossAccountRoleArn",
+                                                         "deployLambdaName")},
+                    imageTag=image_tag, continuation=deploy_body["continuation"], continuations=continuations)
+    
+    # A newer image took this one's place in the queue; it must not be promoted further
+    if deploy_body.get("superseded"):
+        raise Exception(f"Superseded in the deploy queue by {deploy_body.get('supersededBy')}")
+    
+    if deploy_body.get("alreadyDeployed"):
+        print(f"Image already live as version {deploy_body.get('lambdaVersion')}, nothing to deploy")
+        deployment_data["status"] = "Succeeded"
+        deployment_data["message"] = f"{image_tag} already live as version {deploy_body.get('lambdaVersion')}"
+        return deployment_data
+    
+    deployment_id = deploy_body["deploymentId"]
+    print(f"Deploy lambda succeeded, deployment ID: {deployment_id}")
+    
+    # Create deployment console link
+    deployment_data["deploymentLink"] = f"https://{target['region']}.console.aws.amazon.com/codesuite/codedeploy/deployments/{deployment_id}"
+    return deployment_data
+
+def start_fanout(job_id, context, targets, image_tag, image_digest, policy, pipeline_execution_id=None):
+    """
+    Start the deployment on every target at once and track them together.
+
+    policy "all" waits for every target and fails if any failed; "fail_fast"
+    stops the remaining deployments (with rollback) on the first failure.
+    """
+    if policy not in FANOUT_POLICIES:
+        raise Exception(f"Unknown deploy policy {policy}, expected one of {', '.join(FANOUT_POLICIES)}")
+    print(f"Deploying {image_tag} to {len(targets)} targets ({policy})")
+    
+    with phase("start_deployment"), ThreadPoolExecutor(max_workers=len(targets)) as pool:
+        futures = [pool.submit(start_target_deployment, target, image_tag, image_digest, pipeline_execution_id)
+                   for target in targets]
+    
+    deployments = []
+    for target, future in zip(targets, futures):
+        try:
+            deployments.append(future.result())
+        except Exception as e:
+            deployments.append(start_failure(target, e))
+    
+    fanout_data = {"mode": "fanout", "policy": policy, "deployments": deployments,
+                   "pipelineExecutionId": pipeline_execution_id}
+    return poll_fanout(job_id, context, fanout_data, resume=False)
+
+def start_failure(target, error):
+    """Fan-out entry for a target whose deployment could not be started."""
+    print(f"Could not start deployment on {target['name']}: {str(error)}")
+    return {
+        "name": target["name"],
+        "deploymentId": None,
+        "targetRegion": target["region"],
+        "crossAccountRoleArn": target["crossAccountRoleArn"],
+        "status": "Failed",
+        "message": f"Could not start: {str(error)}"
+    }
+
+def resume_starting(deployments):
+    """Ask the deploy lambda of every "Starting" fan-out target once more, concurrently."""
+    starting = [i for i, d in enumerate(deployments) if d["status"] == "Starting"]
+    if not starting:
+        return
+    with phase("start_deployment"), ThreadPoolExecutor(max_workers=len(starting)) as pool:
+        futures = [pool.submit(resume_target_deployment, deployments[i]) for i in starting]
+    for i, future in zip(starting, futures):
+        try:
+            deployments[i] = future.result()
+        except Exception as e:
+            deployments[i] = start_failure(deployments[i]["target"], e)
+
+def poll_fanout(job_id, context, fanout_data, resume=True):
+    """
+    Poll every running deployment of a fan-out concurrently until all finish.
+
+    Reports like poll_deployment_with_continuation: only when the combined
+    progress changes, always with a continuation while any target runs.
+    "Starting" targets are asked again on every poll (start_fanout, which has
+    just asked them, passes resume=False); with nothing else running they wait
+    for the next job poll.
+    """
+    deployments = fanout_data["deployments"]
+    policy = fanout_data["policy"]
+    try:
+        while True:
+            if resume:
+                resume_starting(deployments)
+            running = [d for d in deployments if d["status"] is None]
+            if running:
+                with ThreadPoolExecutor(max_workers=len(running)) as pool:
+                    progresses = list(pool.map(poll_target, running))
+                for deployment, progress in zip(running, progresses):
+                    deployment["progress"] = progress
+                    if progress["status"] in ("Succeeded", "Failed", "Stopped"):
+                        deployment["status"] = progress["status"]
+                        deployment["message"] = progress["message"]
+            
+            failed = [d for d in deployments if d["status"] in ("Failed", "Stopped")]
+            running = [d for d in deployments if d["status"] is None]
+            starting = [d for d in deployments if d["status"] == "Starting"]
+            if failed and (policy == "fail_fast" or not (running or starting)):
+                if running:
+                    stop_deployments(running)
+                if starting:
+                    withdraw_deployments(starting)
+                summary = "; ".join(f"{d['name']}: {d.get('message', d['status'])}" for d in failed)
+                report_progress(job_id, context, succeeded=False,
+                              msg=f"{len(failed)}/{len(deployments)} targets failed: {summary}")
+                return
+            if not (running or starting):
+                report_progress(job_id, context, succeeded=True,
+                              msg=f"Deployed to all {len(deployments)} targets", pct=100)
+                return
+            
+            progress = fanout_progress(deployments)
+            key = "|".join(progress_key(d["progress"]) if d["status"] is None else d["status"] for d in deployments)
+            interval = min(poll_interval(d["progress"]) for d in running) if running else 0
+            remaining_time = context.get_remaining_time_in_millis() / 1000
+            # Queued targets are asked again on the next job poll rather than waited for here
+            if (key != fanout_data.get("lastReported") or not running
+                    or remaining_time - interval < CONTINUATION_BUFFER_SECONDS):
+                # Continuation tokens are limited to 2048 characters, so only tracking fields travel
+                token = dict(fanout_data, deployments=[
+                    {field: d[field] for field in FANOUT_TOKEN_FIELDS + START_TOKEN_FIELDS if field in d}
+                    for d in deployments
+                ])
+                report_running(job_id, context, token, progress, key)
+                return
+            
+            with phase("poll_wait"):
+                time.sleep(interval)
+            resume = True
+    
+    except Exception as e:
+        print(f"Error polling fan-out deployments: {str(e)}")
+        report_progress(job_id, context, succeeded=False,
+                      msg=f"Error polling deployments: {str(e)}")
+        return
+
+def poll_target(deployment):
+    """Current progress of one fan-out deployment."""
+    codedeploy_client = deployment_codedeploy_client(deployment)
+    deployment_info = codedeploy_client.get_deployment(deploymentId=deployment["deploymentId"])["deploymentInfo"]
+    lambda_target = None
+    if deployment_info["status"] == "InProgress":
+        lambda_target = get_lambda_target(codedeploy_client, deployment["deploymentId"])
+    progress = compute_progress(deployment_info, lambda_target)
+    print(f"{deployment['name']} {deployment['deploymentId']}: {progress['message']} ({progress['pct']}%)")
+    return progress
+
+def fanout_progress(deployments):
+    """Combined progress: the mean percentage and a short per-target summary."""
+    pcts = [0 if d["status"] == "Starting" else 100 if d["status"] else d["progress"]["pct"] for d in deployments]
+    succeeded = sum(1 for d in deployments if d["status"] == "Succeeded")
+    running = ", ".join(f"{d['name']} {d['progress']['pct']}%" if d["status"] is None else f"{d['name']} queued"
+                        for d in deployments if d["status"] in (None, "Starting"))
+    return {
+        "pct": sum(pcts) // len(pcts),
+        "message": f"{succeeded}/{len(deployments)} done; {running}"
+    }
+
+def stop_deployments(deployments):
+    """Stop running deployments, rolling them back to the live version."""
+    for deployment in deployments:
+        try:
+            deployment_codedeploy_client(deployment).stop_deployment(
+                deploymentId=deployment["deploymentId"],
+                autoRollbackEnabled=True
+            )
+            deployment["status"] = "Stopped"
+            print(f"Stopped deployment {deployment['deploymentId']} on {deployment['name']}")
+        except Exception as e:
+            print(f"Warning: could not stop deployment {deployment['deploymentId']} on {deployment['name']}: {str(e)}")
+
+def withdraw_deployments(deployments):
+    """Take "Starting" targets out of their deploy queues so they never create a deployment."""
+    for deployment in deployments:
+        target = deployment["target"]
+        try:
+            target_lambda = cross_account_client("lambda", target["crossAccountRoleArn"], target["region"])
+            invoke_deploy_lambda(target_lambda, target["deployLambdaName"], {"withdraw": deployment["continuation"]})
+            deployment["status"] = "Stopped"
+            print(f"Withdrew the queued deployment on {deployment['name']}")
+        except Exception as e:
+            print(f"Warning: could not withdraw the queued deployment on {deployment['name']}: {str(e)}")
+
+def invoke_deploy_lambda(target_lambda, deploy_lambda_name, payload):
+    """
+    Invoke the deploy lambda synchronously and return its parsed response body.
+    """
+    deploy_response = target_lambda.invoke(
+        FunctionName=deploy_lambda_name,
+        InvocationType="RequestResponse",
+        Payload=json.dumps(payload)
+    )
+    
+    # Parse response from deploy lambda
+    deploy_result = json.loads(deploy_response["Payload"].read())
+    
+    print(f"Deploy lambda response: {json.dumps(deploy_result)}")
+    
+    if deploy_response["StatusCode"] != 200:
+        raise Exception(f"Deploy lambda failed with status {deploy_response['StatusCode']}: {deploy_result}")
+    
+    # Check if deploy lambda returned an error
+    if "errorType" in deploy_result:
+        error_msg = deploy_result.get("errorMessage", "Unknown error")
+        raise Exception(f"Deploy lambda failed: {error_msg}")
+    
+    # Check for expected response format
+    if "body" not in deploy_result:
+        raise Exception(f"Deploy lambda response missing 'body' field: {deploy_result}")
+    
+    return json.loads(deploy_result["body"])
+
 def resume_deployment_polling(job_id, context, deployment_data):
     """
     Resume polling an existing deployment from continuation token.
     """
     print(f"Resuming deployment polling for {deployment_data['deploymentId']}")
     
-    # Recreate CodeDeploy client with stored credentials
-    credentials = deployment_data["credentials"]
-    codedeploy_client = boto3.client(
-        "codedeploy",
-        aws_access_key_id=credentials["AccessKeyId"],
-        aws_secret_access_key=credentials["SecretAccessKey"],
-        aws_session_token=credentials["SessionToken"],
-        region_name=deployment_data["targetRegion"]
-    )
+    # Reuses this container's cached client for the target account when warm
+    codedeploy_client = deployment_codedeploy_client(deployment_data)
     
     # Continue polling
     return poll_deployment_with_continuation(job_id, context, deployment_data, codedeploy_client)
 
 def poll_deployment_with_continuation(job_id, context, deployment_data, codedeploy_client=None):
     """
-    Poll deployment status with progress reporting and continuation tokens.
+    Poll a deployment until it finishes, its progress changes, or time runs out.
+
+    Every report on a running deployment carries a continuation token, which
+    ends this job and has CodePipeline re-invoke the action to carry on. Progress
+    is therefore only reported when it changes (see progress_key), and the last
+    reported state travels in the token so the next invocation stays quiet until
+    something actually moves.
     """
     deployment_id = deployment_data["deploymentId"]
     deployment_link = deployment_data["deploymentLink"]
     
     # Create CodeDeploy client if not provided
     if not codedeploy_client:
-        credentials = deployment_data["credentials"]
-        codedeploy_client = boto3.client(
-            "codedeploy",
-            aws_access_key_id=credentials["AccessKeyId"],
-            aws_secret_access_key=credentials["SecretAccessKey"],
-            aws_session_token=credentials["SessionToken"],
-            region_name=deployment_data["targetRegion"]
-        )
-    
-    # Calculate elapsed time for progress estimation
-    start_time = datetime.fromisoformat(deployment_data["startTime"])
-    elapsed_minutes = (datetime.utcnow() - start_time).total_seconds() / 60
+        codedeploy_client = deployment_codedeploy_client(deployment_data)
     
     try:
-        # Get deployment status
-        response = codedeploy_client.get_deployment(deploymentId=deployment_id)
-        deployment_info = response["deploymentInfo"]
-        
-        status = deployment_info["status"]
-        print(f"Deployment {deployment_id} status: {status}")
-        
-        # Calculate progress percentage based on status and elapsed time
-        if status == "Created":
-            progress_pct = 45
-            status_msg = "Deployment created, waiting to start"
-        elif status == "Queued":
-            progress_pct = 50
-            status_msg = "Deployment queued for execution"
-        elif status == "InProgress":
-            # Estimate progress based on elapsed time (typical deployment takes 5-10 minutes)
-            estimated_progress = min(85, 55 + (elapsed_minutes * 6))  # 6% per minute, max 85%
-            progress_pct = int(estimated_progress)
-            status_msg = f"Deployment in progress ({elapsed_minutes:.1f}m elapsed)"
-        elif status == "Succeeded":
-            progress_pct = 100
-            status_msg = "Deployment completed successfully"
+        while True:
+            deployment_info = codedeploy_client.get_deployment(deploymentId=deployment_id)["deploymentInfo"]
+            lambda_target = None
+            if deployment_info["status"] == "InProgress":
+                lambda_target = get_lambda_target(codedeploy_client, deployment_id)
+            progress = compute_progress(deployment_info, lambda_target)
+            print(f"Deployment {deployment_id}: {progress['message']} ({progress['pct']}%)")
             
-            # Report final success
-            report_progress(job_id, context, succeeded=True, msg=status_msg, 
-                          pct=progress_pct, external_id=deployment_link)
-            return
-        elif status in ["Failed", "Stopped"]:
-            # Get error information
-            error_info = deployment_info.get("errorInformation", {})
-            error_message = error_info.get("message", f"Deployment {status}")
+            if progress["status"] == "Succeeded":
+                report_progress(job_id, context, succeeded=True, msg=progress["message"],
+                              pct=100, external_id=deployment_link)
+                return
+            if progress["status"] in ("Failed", "Stopped"):
+                report_progress(job_id, context, succeeded=False, msg=progress["message"])
+                return
             
-            # Report failure
-            report_progress(job_id, context, succeeded=False, 
-                          msg=f"Deployment {status}: {error_message}")
-            return
-        else:
-            # Unknown status
-            progress_pct = 60
-            status_msg = f"Deployment status: {status}"
-        
-        # Check if Lambda is about to timeout (leave 90 seconds buffer)
-        remaining_time = context.get_remaining_time_in_millis() / 1000
-        if remaining_time < 90:
-            print(f"Lambda timeout approaching ({remaining_time}s remaining), using continuation")
+            key = progress_key(progress)
+            interval = poll_interval(progress)
+            remaining_time = context.get_remaining_time_in_millis() / 1000
+            if key != deployment_data.get("lastReported") or remaining_time - interval < CONTINUATION_BUFFER_SECONDS:
+                report_running(job_id, context, deployment_data, progress, key)
+                return
             
-            # Report progress with continuation token
-            continuation_token = json.dumps(deployment_data)
-            report_progress(job_id, context, succeeded=True, msg=status_msg, 
-                          pct=progress_pct, cont=continuation_token, external_id=deployment_link)
-            return
-        
-        # Report progress without continuation (keep polling)
-        report_progress(job_id, context, succeeded=True, msg=status_msg, 
-                      pct=progress_pct, external_id=deployment_link)
-        
-        # Sleep before next poll
-        time.sleep(10)
-        
-        # Continue polling
-        return poll_deployment_with_continuation(job_id, context, deployment_data, codedeploy_client)
+            with phase("poll_wait"):
+                time.sleep(interval)
         
     except Exception as e:
         print(f"Error polling deployment status: {str(e)}")
         report_progress(job_id, context, succeeded=False, 
                       msg=f"Error polling deployment: {str(e)}")
         return
+
+def report_running(job_id, context, deployment_data, progress, key):
+    """Report a running deployment's progress and continue the action."""
+    deployment_data = dict(deployment_data, lastReported=key)
+    report_progress(job_id, context, succeeded=True, msg=progress["message"], pct=progress["pct"],
+                  cont=json.dumps(deployment_data), external_id=deployment_data.get("deploymentLink"))
+
+def get_lambda_target(codedeploy_client, deployment_id):
+    """Return the Lambda target of a deployment (lifecycle events, traffic weight), or None."""
+    target_ids = codedeploy_client.list_deployment_targets(deploymentId=deployment_id).get("targetIds", [])
+    if not target_ids:
+        return None
+    response = codedeploy_client.get_deployment_target(deploymentId=deployment_id, targetId=target_ids[0])
+    return response.get("deploymentTarget", {}).get("lambdaTarget")
+
+def compute_progress(deployment_info, lambda_target=None):
+    """
+    Derive progress from a deployment and its Lambda target.
+
+    Returns status, phase, percent complete and a summary. Before the target
+    exists, progress comes from the deployment status and deploymentOverview.
+    While it runs, each lifecycle hook owns a band of the bar and the
+    AllowTraffic band fills with the new version's traffic weight.
+    """
+    status = deployment_info["status"]
+    if status == "Succeeded":
+        return {"status": status, "phase": "Done", "pct": 100, "message": "Deployment completed successfully"}
+    if status in ("Failed", "Stopped"):
+        error_message = deployment_info.get("errorInformation", {}).get("message", f"Deployment {status}")
+        return {"status": status, "phase": "Done", "pct": 100, "message": f"Deployment {status}: {error_message}"}
+    if status in ("Created", "Queued", "Baking", "Ready") or not lambda_target:
+        overview = deployment_info.get("deploymentOverview", {})
+        messages = {"Created": "Deployment created, waiting to start",
+                    "Queued": "Deployment queued behind another deployment",
+                    "InProgress": f"Deployment in progress ({overview.get('InProgress', 0)} target(s) started)"}
+        return {"status": status, "phase": status, "pct": 50 if status == "InProgress" else 45,
+                "message": messages.get(status, f"Deployment status: {status}")}
+    
+    events = {event["lifecycleEventName"]: event["status"] for event in lambda_target.get("lifecycleEvents", [])}
+    weight = lambda_target.get("lambdaFunctionInfo", {}).get("targetVersionWeight") or 0
+    for phase, (low, high) in LIFECYCLE_BANDS:
+        phase_status = events.get(phase, "Pending")
+        if phase_status in ("Succeeded", "Skipped"):
+            continue
+        if phase == "AllowTraffic":
+            pct = low + int((high - low) * weight)
+            message = f"Shifting traffic: {weight:.0%} on new version"
+        else:
+            pct = low if phase_status == "Pending" else (low + high) // 2
+            message = f"{phase} hook {phase_status.lower()}"
+        return {"status": status, "phase": phase, "phaseStatus": phase_status, "pct": pct, "message": message}
+    return {"status": status, "phase": "Finishing", "pct": 95, "message": "Lifecycle hooks complete, finishing"}
+
+def progress_key(progress):
+    """
+    The part of progress that is worth a CodePipeline update: the phase and
+    hook status, and the percent complete in PROGRESS_REPORT_STEP steps.
+    """
+    return f"{progress['phase']}:{progress.get('phaseStatus', '')}:{progress['pct'] // PROGRESS_REPORT_STEP}"
+
+def poll_interval(progress):
+    """Poll fast while a lifecycle hook runs and slowly through the canary/linear traffic wait."""
+    if progress["phase"] in ("BeforeAllowTraffic", "AfterAllowTraffic") and progress.get("phaseStatus") == "InProgress":
+        return FAST_POLL_SECONDS
+    if progress["phase"] == "AllowTraffic":
+        return SLOW_POLL_SECONDS
+    return DEFAULT_POLL_SECONDS
+
+def state_key(deployment_id):
+    """S3 key of the completion state record for a deployment."""
+    return f"{STATE_PREFIX}/deployments/{deployment_id}.json"
+
+def parked_key(deployment_id):
+    """S3 key of the marker listing a deployment whose job waits for its completion event."""
+    return f"{STATE_PREFIX}/parked/{deployment_id}"
+
+def state_store():
+    """Completion state records in the state bucket, one object per deployment."""
+    return S3JsonStore(s3_client, os.environ["STATE_BUCKET"], f"{STATE_PREFIX}/deployments")
+
+def load_state(deployment_id):
+    """Return (record, etag) for a deployment, or (None, None) if there is none."""
+    return state_store().get(deployment_id)
+
+def update_state(deployment_id, change):
+    """
+    Apply change(record) to a deployment's state record with optimistic concurrency.
+
+    change gets None when there is no record yet and returns the updated record,
+    or None to leave it as is. Returns the record as written (or as left),
+    retrying when another invocation raced us.
+    """
+    return update_json(state_store(), deployment_id, change, label=f"State of {deployment_id}")
+
+def start_event_wait(job_id, context, deployment_data):
+    """
+    Record the deployment and hand the job back with a continuation token.
+
+    CodePipeline re-invokes the action with the token right away; that
+    invocation parks the new job in the state record, where the forwarded
+    CodeDeploy state-change event (or the fallback sweep) resolves it.
+    """
+    deployment_id = deployment_data["deploymentId"]
+    
+    def create(record):
+        if record is not None:
+            return None
+        return {
+            "schemaVersion": 1,
+            "deploymentId": deployment_id,
+            "status": "Pending",
+            "message": None,
+            "jobId": None,
+            "resolved": False,
+            "targetAccount": deployment_data["targetAccount"],
+            "targetRegion": deployment_data["targetRegion"],
+            "crossAccountRoleArn": deployment_data["crossAccountRoleArn"],
+            "deploymentLink": deployment_data["deploymentLink"],
+            "startTime": deployment_data["startTime"]
+        }
+    
+    update_state(deployment_id, create)
+    
+    token = {
+        "mode": "event",
+        "deploymentId": deployment_id,
+        "deploymentLink": deployment_data["deploymentLink"],
+        "pipelineExecutionId": deployment_data.get("pipelineExecutionId")
+    }
+    report_progress(job_id, context, msg=f"Deployment {deployment_id} started", pct=40,
+                  cont=json.dumps(token), external_id=deployment_data["deploymentLink"])
+
+def park_job(job_id, context, token):
+    """
+    Leave a continuation job In Progress until its deployment completes.
+
+    If the deployment already finished, the job is resolved right away.
+    Otherwise the job ID is stored for the state-change event and the
+    invocation returns without reporting to CodePipeline.
+    """
+    deployment_id = token["deploymentId"]
+    outcome = {}
+    
+    def park(record):
+        if record is None:
+            raise Exception(f"No state record for deployment {deployment_id}")
+        outcome["resolves"] = False
+        if record["resolved"]:
+            return None
+        record = dict(record, jobId=job_id, parkedAt=datetime.utcnow().isoformat())
+        if record["status"] != "Pending":
+            record["resolved"] = outcome["resolves"] = True
+        return record
+    
+    record = update_state(deployment_id, park)
+    if outcome["resolves"]:
+        return resolve_job(record, context)
+    if record["resolved"]:
+        print(f"Deployment {deployment_id} already resolved, ignoring job {job_id}")
+        return
+    
+    s3_client.put_object(Bucket=os.environ["STATE_BUCKET"], Key=parked_key(deployment_id), Body=b"")
+    print(f"Job {job_id} waiting for completion event of deployment {deployment_id}")
+
+def handle_deployment_state_change(event, context):
+    """
+    Resolve the job waiting on a forwarded CodeDeploy state-change event.
+
+    Non-terminal states are ignored. Duplicate and late events are no-ops
+    because the outcome is recorded once under a conditional write; an event
+    that arrives before the job is parked only records the outcome.
+    """
+    detail = event.get("detail", {})
+    deployment_id = detail.get("deploymentId")
+    status = TERMINAL_STATES.get(detail.get("state"))
+    if not deployment_id or not status:
+        print(f"Ignoring state {detail.get('state')} of deployment {deployment_id}")
+        return
+    return apply_outcome(deployment_id, status, f"Deployment {status.lower()}", context)
+
+def apply_outcome(deployment_id, status, message, context):
+    """
+    Record a deployment's outcome and resolve its parked job, exactly once.
+
+    Only deployments start_event_wait recorded are tracked. Events for any
+    other deployment (manual deploys, rollbacks) leave no record behind.
+    """
+    outcome = {}
+    
+    def complete(record):
+        outcome["resolves"] = False
+        if record is None or record["resolved"] or record["status"] != "Pending":
+            return None
+        outcome["resolves"] = bool(record["jobId"])
+        return dict(record, status=status, message=message, resolved=outcome["resolves"])
+    
+    record = update_state(deployment_id, complete)
+    if record is None:
+        print(f"Deployment {deployment_id} was not started by this pipeline, ignoring {status}")
+        return
+    if outcome["resolves"]:
+        return resolve_job(record, context)
+    print(f"Recorded {record['status']} for deployment {deployment_id}")
+
+def resolve_job(record, context):
+    """Report a resolved deployment's outcome on its parked job."""
+    deployment_id = record["deploymentId"]
+    link = record.get("deploymentLink")
+    if record["status"] == "Succeeded":
+        report_progress(record["jobId"], context, succeeded=True, msg="Deployment completed successfully",
+                      pct=100, external_id=link)
+    else:
+        report_progress(record["jobId"], context, succeeded=False,
+                      msg=f"Deployment {record['status']}: {record.get('message') or ''}".strip())
+    try:
+        s3_client.delete_object(Bucket=os.environ["STATE_BUCKET"], Key=parked_key(deployment_id))
+    except Exception as e:
+        print(f"Warning: could not remove parked marker for {deployment_id}: {str(e)}")
+    print(f"Resolved job {record['jobId']} for deployment {deployment_id}: {record['status']}")
+
+def sweep_parked_deployments(context):
+    """
+    Fallback for lost events: poll each parked deployment once.
+
+    Runs on a schedule. A deployment parked for longer than
+    FALLBACK_POLL_MINUTES is checked with get_deployment in its target
+    account and resolved if it finished. A job parked for longer than
+    JOB_HANDOFF_MINUTES is handed to a fresh job with a continuation token
+    before CodePipeline times it out.
+    """
+    bucket_name = os.environ["STATE_BUCKET"]
+    poll_after = timedelta(minutes=float(os.environ.get("FALLBACK_POLL_MINUTES", "5")))
+    handoff_after = timedelta(minutes=float(os.environ.get("JOB_HANDOFF_MINUTES", "45")))
+    now = datetime.utcnow()
+    
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=f"{STATE_PREFIX}/parked/"):
+        for obj in page.get("Contents", []):
+            deployment_id = obj["Key"].rsplit("/", 1)[-1]
+            try:
+                record, _ = load_state(deployment_id)
+                if record is None or record["resolved"] or not record.get("parkedAt"):
+                    s3_client.delete_object(Bucket=bucket_name, Key=obj["Key"])
+                    continue
+                parked_for = now - datetime.fromisoformat(record["parkedAt"])
+                if parked_for >= poll_after:
+                    deployment_info = get_deployment_info(record)
+                    if deployment_info["status"] in ("Succeeded", "Failed", "Stopped"):
+                        message = deployment_info.get("errorInformation", {}).get("message",
+                                                                                  f"Deployment {deployment_info['status'].lower()}")
+                        print(f"Fallback poll found deployment {deployment_id} {deployment_info['status']}")
+                        apply_outcome(deployment_id, deployment_info["status"], message, context)
+                        continue
+                if parked_for >= handoff_after:
+                    hand_off_job(record, context)
+            except Exception as e:
+                print(f"Error sweeping deployment {deployment_id}: {str(e)}")
+
+def get_deployment_info(record):
+    """Fetch a deployment from its target account."""
+    codedeploy_client = cross_account_client("codedeploy", record["crossAccountRoleArn"], record["targetRegion"])
+    return codedeploy_client.get_deployment(deploymentId=record["deploymentId"])["deploymentInfo"]
+
+def hand_off_job(record, context):
+    """Unpark a long-waiting job and continue it, so CodePipeline re-parks a fresh job."""
+    deployment_id = record["deploymentId"]
+    job_id = record["jobId"]
+    outcome = {}
+    
+    def unpark(current):
+        outcome["unparked"] = False
+        if current is None or current["resolved"] or current.get("jobId") != job_id:
+            return None
+        outcome["unparked"] = True
+        return dict(current, jobId=None, parkedAt=None)
+    
+    update_state(deployment_id, unpark)
+    if not outcome["unparked"]:
+        return
+    token = {"mode": "event", "deploymentId": deployment_id, "deploymentLink": record.get("deploymentLink")}
+    report_progress(job_id, context, msg=f"Deployment {deployment_id} in progress", pct=60,
+                  cont=json.dumps(token), external_id=record.get("deploymentLink"))
+    s3_client.delete_object(Bucket=os.environ["STATE_BUCKET"], Key=parked_key(deployment_id))
+    print(f"Handed off job {job_id} for deployment {deployment_id}")
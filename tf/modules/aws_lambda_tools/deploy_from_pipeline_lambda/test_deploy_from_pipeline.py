@@ -0,0 +1,425 @@
+import unittest
+from unittest.mock import Mock, patch
+import io
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from botocore.exceptions import ClientError
+
+# Add the current directory to the path so we can import the module
+sys.path.insert(0, os.path.dirname(__file__))
+# Shared modules Terraform packages alongside index.py
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lambda_shared'))
+
+# Import the module under test
+import index
+
+
+class FakeS3:
+    """In-memory S3 with the conditional writes the state record relies on."""
+
+    def __init__(self):
+        self.objects = {}
+        self.writes = 0
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        body, etag = self.objects[Key]
+        return {'Body': io.BytesIO(body if isinstance(body, bytes) else body.encode()), 'ETag': etag}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        current = self.objects.get(Key)
+        if (IfNoneMatch and current) or (IfMatch and (not current or current[1] != IfMatch)):
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+        self.writes += 1
+        self.objects[Key] = (Body, f'"etag-{self.writes}"')
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def get_paginator(self, name):
+        paginator = Mock()
+        paginator.paginate.side_effect = lambda Bucket, Prefix: [
+            {'Contents': [{'Key': key} for key in sorted(self.objects) if key.startswith(Prefix)]}
+        ]
+        return paginator
+
+    def record(self, deployment_id):
+        return json.loads(self.objects[index.state_key(deployment_id)][0])
+
+
+def state_change(deployment_id, state):
+    return {
+        'detail-type': index.DEPLOYMENT_STATE_CHANGE,
+        'source': 'aws.codedeploy',
+        'detail': {'deploymentId': deployment_id, 'state': state, 'application': 'app-dev'}
+    }
+
+
+class TestEventDrivenCompletion(unittest.TestCase):
+    def setUp(self):
+        """Set up test fixtures."""
+        self.env_patcher = patch.dict(os.environ, {'STATE_BUCKET': 'state-bucket', 'COMPLETION_MODE': 'event'})
+        self.env_patcher.start()
+
+        self.s3 = FakeS3()
+        self.mock_codepipeline = Mock()
+        self.s3_patcher = patch('index.s3_client', self.s3)
+        self.codepipeline_patcher = patch('index.codepipeline', self.mock_codepipeline)
+        self.s3_patcher.start()
+        self.codepipeline_patcher.start()
+
+        self.context = Mock()
+        self.context.aws_request_id = 'request-1'
+        self.deployment_data = {
+            'deploymentId': 'd-1',
+            'targetAccount': '111111111111',
+            'targetRegion': 'us-east-1',
+            'crossAccountRoleArn': 'arn:aws:iam::111111111111:role/tools',
+            'deploymentLink': 'https://console/d-1',
+            'startTime': datetime.utcnow().isoformat()
+        }
+
+    def tearDown(self):
+        """Clean up after tests."""
+        self.env_patcher.stop()
+        self.s3_patcher.stop()
+        self.codepipeline_patcher.stop()
+
+    def continuation_job(self, job_id, token):
+        return {'CodePipeline.job': {'id': job_id, 'data': {'continuationToken': token}}}
+
+    def start(self):
+        index.start_event_wait('job-1', self.context, self.deployment_data)
+        return self.mock_codepipeline.put_job_success_result.call_args[1]['continuationToken']
+
+    def test_event_resolves_parked_job_once(self):
+        """Test the state-change event resolves the parked job and duplicates are ignored."""
+        token = self.start()
+        self.assertNotIn('credentials', json.loads(token))
+
+        index.handler(self.continuation_job('job-2', token), self.context)
+        self.assertEqual(self.mock_codepipeline.put_job_success_result.call_count, 1)
+        self.assertIn(index.parked_key('d-1'), self.s3.objects)
+
+        index.handler(state_change('d-1', 'SUCCESS'), self.context)
+        index.handler(state_change('d-1', 'SUCCESS'), self.context)
+
+        self.assertEqual(self.mock_codepipeline.put_job_success_result.call_count, 2)
+        final = self.mock_codepipeline.put_job_success_result.call_args[1]
+        self.assertEqual(final['jobId'], 'job-2')
+        self.assertNotIn('continuationToken', final)
+        self.assertNotIn(index.parked_key('d-1'), self.s3.objects)
+        self.assertTrue(self.s3.record('d-1')['resolved'])
+
+    def test_event_before_park_is_kept_for_the_job(self):
+        """Test an event arriving before the job is parked is applied when it parks."""
+        token = self.start()
+
+        index.handler(state_change('d-1', 'START'), self.context)
+        index.handler(state_change('d-1', 'FAILURE'), self.context)
+        self.mock_codepipeline.put_job_failure_result.assert_not_called()
+
+        index.handler(self.continuation_job('job-2', token), self.context)
+
+        failure = self.mock_codepipeline.put_job_failure_result.call_args[1]
+        self.assertEqual(failure['jobId'], 'job-2')
+        self.assertIn('Failed', failure['failureDetails']['message'])
+
+    def test_event_for_unknown_deployment_writes_nothing(self):
+        """Test state changes of deployments this pipeline did not start leave no state record."""
+        index.handler(state_change('d-manual', 'SUCCESS'), self.context)
+
+        self.assertEqual(self.s3.objects, {})
+        self.mock_codepipeline.put_job_success_result.assert_not_called()
+
+    def test_sweep_polls_and_hands_off(self):
+        """Test the fallback sweep resolves finished deployments and hands off long waits."""
+        token = self.start()
+        index.handler(self.continuation_job('job-2', token), self.context)
+        self.deployment_data['deploymentId'] = 'd-2'
+        token_2 = self.start()
+        index.handler(self.continuation_job('job-3', token_2), self.context)
+
+        # Age both parked jobs past the fallback and hand-off thresholds
+        for deployment_id in ('d-1', 'd-2'):
+            key = index.state_key(deployment_id)
+            record = self.s3.record(deployment_id)
+            record['parkedAt'] = (datetime.utcnow() - timedelta(minutes=50)).isoformat()
+            self.s3.objects[key] = (json.dumps(record), self.s3.objects[key][1])
+
+        statuses = {'d-1': {'status': 'Succeeded'}, 'd-2': {'status': 'InProgress'}}
+        with patch('index.get_deployment_info', side_effect=lambda record: statuses[record['deploymentId']]):
+            index.handler({'sweep': True}, self.context)
+
+        calls = {c[1]['jobId']: c[1] for c in self.mock_codepipeline.put_job_success_result.call_args_list}
+        self.assertNotIn('continuationToken', calls['job-2'])
+        self.assertIn('continuationToken', calls['job-3'])
+        self.assertIsNone(self.s3.record('d-2')['jobId'])
+        self.assertFalse(any(key.startswith(f"{index.STATE_PREFIX}/parked/") for key in self.s3.objects))
+
+
+def lambda_target(events, weight=0.0):
+    return {
+        'lifecycleEvents': [{'lifecycleEventName': name, 'status': status} for name, status in events],
+        'lambdaFunctionInfo': {'targetVersionWeight': weight}
+    }
+
+
+class TestPollingProgress(unittest.TestCase):
+    def setUp(self):
+        """Set up test fixtures."""
+        self.mock_codepipeline = Mock()
+        self.codepipeline_patcher = patch('index.codepipeline', self.mock_codepipeline)
+        self.sleep_patcher = patch('index.time.sleep')
+        self.codepipeline_patcher.start()
+        self.mock_sleep = self.sleep_patcher.start()
+
+        self.context = Mock()
+        self.context.aws_request_id = 'request-1'
+        self.context.get_remaining_time_in_millis.return_value = 600000
+        self.mock_codedeploy = Mock()
+        self.mock_codedeploy.list_deployment_targets.return_value = {'targetIds': ['fn:live']}
+        self.deployment_data = {'deploymentId': 'd-1', 'deploymentLink': 'https://console/d-1'}
+
+    def tearDown(self):
+        """Clean up after tests."""
+        self.codepipeline_patcher.stop()
+        self.sleep_patcher.stop()
+
+    def poll(self, deployment_data):
+        index.poll_deployment_with_continuation('job-1', self.context, deployment_data, self.mock_codedeploy)
+
+    def test_compute_progress_from_lifecycle(self):
+        """Test progress follows lifecycle hooks and the traffic weight rather than elapsed time."""
+        in_progress = {'status': 'InProgress'}
+        hook = index.compute_progress(in_progress, lambda_target([('BeforeAllowTraffic', 'InProgress')]))
+        shifting = index.compute_progress(in_progress, lambda_target(
+            [('BeforeAllowTraffic', 'Succeeded'), ('AllowTraffic', 'InProgress')], weight=0.5))
+        after = index.compute_progress(in_progress, lambda_target(
+            [('BeforeAllowTraffic', 'Succeeded'), ('AllowTraffic', 'Succeeded'), ('AfterAllowTraffic', 'Pending')]))
+
+        self.assertEqual((hook['phase'], hook['pct']), ('BeforeAllowTraffic', 55))
+        self.assertEqual((shifting['phase'], shifting['pct']), ('AllowTraffic', 75))
+        self.assertEqual((after['phase'], after['pct']), ('AfterAllowTraffic', 90))
+        self.assertEqual(index.poll_interval(hook), index.FAST_POLL_SECONDS)
+        self.assertEqual(index.poll_interval(shifting), index.SLOW_POLL_SECONDS)
+
+        failed = index.compute_progress({'status': 'Failed', 'errorInformation': {'message': 'hook failed'}})
+        self.assertEqual(failed['message'], 'Deployment Failed: hook failed')
+
+    def test_reports_only_on_change_with_continuation(self):
+        """Test unchanged progress is polled quietly and a change is reported with a continuation."""
+        targets = iter([
+            lambda_target([('BeforeAllowTraffic', 'InProgress')]),
+            lambda_target([('BeforeAllowTraffic', 'InProgress')]),
+            lambda_target([('BeforeAllowTraffic', 'Succeeded'), ('AllowTraffic', 'InProgress')], weight=0.1)
+        ])
+        self.mock_codedeploy.get_deployment.return_value = {'deploymentInfo': {'status': 'InProgress'}}
+        self.mock_codedeploy.get_deployment_target.side_effect = lambda **kwargs: {
+            'deploymentTarget': {'lambdaTarget': next(targets)}
+        }
+        first = index.progress_key(index.compute_progress(
+            {'status': 'InProgress'}, lambda_target([('BeforeAllowTraffic', 'InProgress')])))
+
+        self.poll(dict(self.deployment_data, lastReported=first))
+
+        self.assertEqual(self.mock_codepipeline.put_job_success_result.call_count, 1)
+        report = self.mock_codepipeline.put_job_success_result.call_args[1]
+        self.assertEqual(report['executionDetails']['percentComplete'], 63)
+        token = json.loads(report['continuationToken'])
+        self.assertTrue(token['lastReported'].startswith('AllowTraffic'))
+        self.assertEqual([c[0][0] for c in self.mock_sleep.call_args_list], [index.FAST_POLL_SECONDS] * 2)
+
+    def test_success_is_reported_without_continuation(self):
+        """Test a finished deployment completes the job."""
+        self.mock_codedeploy.get_deployment.return_value = {'deploymentInfo': {'status': 'Succeeded'}}
+
+        self.poll(dict(self.deployment_data, lastReported='x'))
+
+        report = self.mock_codepipeline.put_job_success_result.call_args[1]
+        self.assertNotIn('continuationToken', report)
+        self.assertEqual(report['executionDetails']['percentComplete'], 100)
+
+
+class TestFanout(unittest.TestCase):
+    def setUp(self):
+        """Set up test fixtures."""
+        self.mock_codepipeline = Mock()
+        self.codepipeline_patcher = patch('index.codepipeline', self.mock_codepipeline)
+        self.sleep_patcher = patch('index.time.sleep')
+        self.codepipeline_patcher.start()
+        self.sleep_patcher.start()
+
+        self.context = Mock()
+        self.context.aws_request_id = 'request-1'
+        self.context.get_remaining_time_in_millis.return_value = 600000
+        self.regions = ['us-east-1', 'us-west-2', 'eu-west-1']
+        self.clients = {region: Mock() for region in self.regions}
+        for region, client in self.clients.items():
+            client.list_deployment_targets.return_value = {'targetIds': []}
+        self.client_patcher = patch('index.cross_account_client',
+                                    side_effect=lambda service, role, region: self.clients[region])
+        self.client_patcher.start()
+
+    def tearDown(self):
+        """Clean up after tests."""
+        self.codepipeline_patcher.stop()
+        self.sleep_patcher.stop()
+        self.client_patcher.stop()
+
+    def job(self, policy):
+        params = {
+            'imageTag': 'v1',
+            'policy': policy,
+            'targets': [{
+                'accountId': '111111111111', 'region': region, 'repositoryName': 'app-prod',
+                'crossAccountRoleArn': 'arn:aws:iam::111111111111:role/tools', 'deployLambdaName': 'app-prod-deploy'
+            } for region in self.regions]
+        }
+        return {'CodePipeline.job': {'id': 'job-1', 'data': {
+            'actionConfiguration': {'configuration': {'UserParameters': json.dumps(params)}}
+        }}}
+
+    def start(self, policy, statuses):
+        for region, client in self.clients.items():
+            client.invoke.return_value = {'StatusCode': 200, 'Payload': io.BytesIO(json.dumps({
+                'statusCode': 200, 'body': json.dumps({'deploymentId': f"d-{region}"})
+            }).encode())}
+            client.get_deployment.return_value = {'deploymentInfo': statuses[region]}
+        index.handler(self.job(policy), self.context)
+
+    def test_all_targets_deploy_concurrently(self):
+        """Test every target is deployed and tracked in one compact continuation."""
+        self.start('all', {
+            'us-east-1': {'status': 'Succeeded'},
+            'us-west-2': {'status': 'InProgress'},
+            'eu-west-1': {'status': 'Queued'}
+        })
+
+        for client in self.clients.values():
+            client.invoke.assert_called_once()
+        report = self.mock_codepipeline.put_job_success_result.call_args[1]
+        token = json.loads(report['continuationToken'])
+        self.assertEqual(token['mode'], 'fanout')
+        self.assertEqual([d['status'] for d in token['deployments']], ['Succeeded', None, None])
+        self.assertLess(len(report['continuationToken']), 2048)
+
+        # Resume with every target finished
+        for client in self.clients.values():
+            client.get_deployment.return_value = {'deploymentInfo': {'status': 'Succeeded'}}
+        index.handler({'CodePipeline.job': {'id': 'job-2', 'data': {
+            'continuationToken': report['continuationToken']
+        }}}, self.context)
+
+        final = self.mock_codepipeline.put_job_success_result.call_args[1]
+        self.assertEqual(final['jobId'], 'job-2')
+        self.assertNotIn('continuationToken', final)
+        self.clients['us-east-1'].get_deployment.assert_called_once()
+
+    def test_fail_fast_stops_remaining_targets(self):
+        """Test the first failure stops and rolls back the other running deployments."""
+        self.start('fail_fast', {
+            'us-east-1': {'status': 'Failed', 'errorInformation': {'message': 'hook failed'}},
+            'us-west-2': {'status': 'InProgress'},
+            'eu-west-1': {'status': 'Succeeded'}
+        })
+
+        self.clients['us-west-2'].stop_deployment.assert_called_once_with(
+            deploymentId='d-us-west-2', autoRollbackEnabled=True
+        )
+        self.clients['eu-west-1'].stop_deployment.assert_not_called()
+        failure = self.mock_codepipeline.put_job_failure_result.call_args[1]
+        self.assertIn('us-east-1', failure['failureDetails']['message'])
+
+
+    def test_queued_targets_are_resumed_on_the_next_job_poll(self):
+        """Test a target queued behind another deployment is handed back as a continuation, never waited on."""
+        queued = {'phase': 'queue', 'ticket': 't-1', 'imageUri': 'app-prod:v1'}
+        for region, client in self.clients.items():
+            body = ({'continuation': queued, 'queued': True, 'message': 'queued behind v0'}
+                    if region == 'us-east-1' else {'deploymentId': f"d-{region}"})
+            client.invoke.return_value = {'StatusCode': 200, 'Payload': io.BytesIO(json.dumps({
+                'statusCode': 202 if region == 'us-east-1' else 200, 'body': json.dumps(body)
+            }).encode())}
+            client.get_deployment.return_value = {'deploymentInfo': {'status': 'Succeeded'}}
+        index.handler(self.job('all'), self.context)
+
+        start_event = json.loads(self.clients['us-east-1'].invoke.call_args[1]['Payload'])
+        self.assertFalse(start_event['waitInQueue'])
+        index.time.sleep.assert_not_called()
+        report = self.mock_codepipeline.put_job_success_result.call_args[1]
+        token = json.loads(report['continuationToken'])
+        self.assertEqual([d['status'] for d in token['deployments']], ['Starting', 'Succeeded', 'Succeeded'])
+        self.assertEqual(token['deployments'][0]['continuation'], queued)
+        self.assertLess(len(report['continuationToken']), 2048)
+
+        # The lease came free: the next job poll starts the deployment and follows it
+        self.clients['us-east-1'].invoke.return_value = {'StatusCode': 200, 'Payload': io.BytesIO(json.dumps({
+            'statusCode': 200, 'body': json.dumps({'deploymentId': 'd-us-east-1'})
+        }).encode())}
+        index.handler({'CodePipeline.job': {'id': 'job-2', 'data': {
+            'continuationToken': report['continuationToken']
+        }}}, self.context)
+
+        resumed = json.loads(self.clients['us-east-1'].invoke.call_args[1]['Payload'])
+        self.assertEqual(resumed, {'continuation': queued, 'waitInQueue': False})
+        final = self.mock_codepipeline.put_job_success_result.call_args[1]
+        self.assertEqual(final['jobId'], 'job-2')
+        self.assertNotIn('continuationToken', final)
+
+
+class TestCrossAccountClientCache(unittest.TestCase):
+    def setUp(self):
+        """Set up test fixtures."""
+        index._sessions.clear()
+        index._clients.clear()
+        self.expirations = []
+        self.mock_sts = Mock()
+
+        def assume_role(**kwargs):
+            expiration = self.expirations.pop(0)
+            return {'Credentials': {'AccessKeyId': f"AKIA{len(self.expirations)}", 'SecretAccessKey': 'secret',
+                                    'SessionToken': 'token', 'Expiration': expiration}}
+        self.mock_sts.assume_role.side_effect = assume_role
+        # Source credentials of the function itself, handed to the STS client
+        self.env_patcher = patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'source', 'AWS_SECRET_ACCESS_KEY': 'secret'})
+        self.sts_patcher = patch('index.sts_client', return_value=self.mock_sts)
+        self.env_patcher.start()
+        self.mock_sts_client = self.sts_patcher.start()
+
+    def tearDown(self):
+        """Clean up after tests."""
+        self.env_patcher.stop()
+        self.sts_patcher.stop()
+        index._sessions.clear()
+        index._clients.clear()
+
+    def test_clients_are_shared_and_credentials_refresh_before_expiry(self):
+        """Test one STS call and one client per role and region, with refresh near expiry."""
+        role = 'arn:aws:iam::111111111111:role/tools'
+        now = datetime.now(timezone.utc)
+        self.expirations = [now + timedelta(minutes=5), now + timedelta(hours=1)]
+
+        first = index.cross_account_client('codedeploy', role, 'us-east-1')
+        second = index.cross_account_client('codedeploy', role, 'us-east-1')
+        other_region = index.cross_account_client('codedeploy', role, 'us-west-2')
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, other_region)
+        self.assertEqual(self.mock_sts.assume_role.call_count, 2)
+        self.assertEqual(self.mock_sts_client.call_args[1]['aws_access_key_id'], 'source')
+        self.assertEqual(self.mock_sts.assume_role.call_args[1]['RoleArn'], role)
+
+        # Credentials five minutes from expiry are refreshed on next use
+        self.expirations = [now + timedelta(hours=1)]
+        credentials = index.cross_account_session(role, 'us-east-1').get_credentials()
+        credentials.get_frozen_credentials()
+        self.assertEqual(self.mock_sts.assume_role.call_count, 3)
+
+
+if __name__ == '__main__':
+    # Run the tests
+    unittest.main(verbosity=2)
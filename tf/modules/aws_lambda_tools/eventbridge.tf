@@ -1,4 +1,4 @@
-# Allow dev account to put events to tools account default event bus
+# Allow dev and prod accounts to put events to tools account default event bus
 resource "aws_cloudwatch_event_bus_policy" "allow_dev_put" {
   event_bus_name = "default"
 
@@ -10,6 +10,14 @@ resource "aws_cloudwatch_event_bus_policy" "allow_dev_put" {
       Principal = { AWS = "arn:aws:iam::${local.dev_account_id}:root" }
       Action    = "events:PutEvents"
       Resource  = "arn:aws:events:${local.region}:${local.tools_account_id}:event-bus/default"
+    },
+    {
+      # Prod forwards CodeDeploy state changes for event-driven deploy completion
+      Sid       = "AllowProdToPut"
+      Effect    = "Allow"
+      Principal = { AWS = "arn:aws:iam::${local.prod_account_id}:root" }
+      Action    = "events:PutEvents"
+      Resource  = "arn:aws:events:${local.region}:${local.tools_account_id}:event-bus/default"
     }]
   })
 }
@@ -132,7 +132,8 @@ resource "aws_codepipeline" "deployment_pipeline" {
           "crossAccountRoleArn" : local.dev_tools_cross_account_role_arn,
           "deployLambdaName" : local.dev_deploy_lambda_name,
           "imageTag" : "#{variables.DEV_IMAGE_TAG}",
-          "imageDigest" : "#{variables.DEV_IMAGE_DIGEST}"
+          "imageDigest" : "#{variables.DEV_IMAGE_DIGEST}",
+          "pipelineExecutionId" : "#{codepipeline.PipelineExecutionId}"
         })
       }
     }
@@ -211,15 +212,32 @@ resource "aws_codepipeline" "deployment_pipeline" {
 
       configuration = {
         FunctionName   = aws_lambda_function.deploy_from_pipeline.function_name
-        UserParameters = jsonencode({
+        UserParameters = jsonencode(merge({
           "accountId" : local.prod_account_id,
           "region" : var.prod_region,
           "repositoryName" : local.prod_ecr_repository_name,
           "crossAccountRoleArn" : local.prod_tools_cross_account_role_arn,
           "deployLambdaName" : local.prod_deploy_lambda_name,
           "imageTag" : "#{variables.PROD_IMAGE_TAG}",
-          "imageDigest" : "#{variables.PROD_IMAGE_DIGEST}"
-        })
+          "imageDigest" : "#{variables.PROD_IMAGE_DIGEST}",
+          "pipelineExecutionId" : "#{codepipeline.PipelineExecutionId}"
+          }, length(var.additional_prod_targets) == 0 ? {} : {
+          # Roll out to the primary and additional prod stacks concurrently
+          "policy" : var.prod_deploy_policy,
+          "targets" : concat([{
+            "accountId" : local.prod_account_id,
+            "region" : var.prod_region,
+            "repositoryName" : local.prod_ecr_repository_name,
+            "crossAccountRoleArn" : local.prod_tools_cross_account_role_arn,
+            "deployLambdaName" : local.prod_deploy_lambda_name
+            }], [for target in var.additional_prod_targets : {
+            "accountId" : target.account_id,
+            "region" : target.region,
+            "repositoryName" : target.repository_name,
+            "crossAccountRoleArn" : target.cross_account_role_arn,
+            "deployLambdaName" : target.deploy_lambda_name
+          }])
+        }))
       }
     }
   }
@@ -51,10 +51,38 @@ resource "aws_iam_role_policy" "prepare_deployment_lambda" {
       {
         Effect = "Allow"
         Action = [
-          "codepipeline:StartPipelineExecution"
+          "codepipeline:StartPipelineExecution",
+          "codepipeline:GetPipelineExecution",
+          "codepipeline:StopPipelineExecution"
         ]
         Resource = aws_codepipeline.deployment_pipeline.arn
       },
+      {
+        # Push coalescing state
+        Effect = "Allow"
+        Action = [
+          "s3:GetObject",
+          "s3:PutObject"
+        ]
+        Resource = [
+          "${aws_s3_bucket.pipeline_artifacts.arn}/coalesce/*"
+        ]
+      },
+      {
+        # Without it a missing coalescing record reads as AccessDenied instead of NoSuchKey
+        Effect = "Allow"
+        Action = [
+          "s3:ListBucket"
+        ]
+        Resource = [
+          aws_s3_bucket.pipeline_artifacts.arn
+        ]
+        Condition = {
+          StringLike = {
+            "s3:prefix" = ["coalesce/*"]
+          }
+        }
+      },
       {
         Effect = "Allow"
         Action = [
@@ -92,6 +120,8 @@ resource "aws_lambda_function" "prepare_deployment" {
       DEV_ACCOUNT_ID = local.dev_account_id
       PROD_ACCOUNT_ID = local.prod_account_id
       APP_NAME = var.app
+      COALESCE_WINDOW_SECONDS = tostring(var.push_coalesce_window_seconds)
+      COALESCE_DEDUPE_SECONDS = tostring(var.push_dedupe_seconds)
     }
   }
 
@@ -112,4 +142,19 @@ data "archive_file" "prepare_deployment_lambda" {
     content  = file("${path.module}/prepare_deployment_lambda/index.py")
     filename = "index.py"
   }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/clients.py")
+    filename = "clients.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/instrumentation.py")
+    filename = "instrumentation.py"
+  }
+
+  source {
+    content  = file("${path.module}/../lambda_shared/state_store.py")
+    filename = "state_store.py"
+  }
 }
\ No newline at end of file
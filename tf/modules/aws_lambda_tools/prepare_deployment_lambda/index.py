@@ -1,16 +1,30 @@
-import boto3
 import json
 import os
+import uuid
 from datetime import datetime
 
-codepipeline = boto3.client("codepipeline")
+from clients import lazy_client
+from instrumentation import describe_event, instrumented, phase, set_dimensions
+from state_store import MemoryJsonStore, S3JsonStore, SystemClock, update_json
 
+codepipeline = lazy_client("codepipeline")
+s3_client = lazy_client("s3")
+
+# Pushes are coalesced per repository: a push waits COALESCE_WINDOW_SECONDS and only
+# starts a run if no newer digest arrived meanwhile; a digest started within
+# COALESCE_DEDUPE_SECONDS is not started again (CI pushing several tags for one image).
+COALESCE_PREFIX = "coalesce"
+COALESCE_HISTORY = 10
+# A pending push older than its window plus this was lost (e.g. the invocation timed out)
+COALESCE_STALE_SECONDS = 300
+
+@instrumented
 def handler(event, context):
     """
     Start deployment pipeline from ECR push event.
     Extracts image tag/digest from ECR event and starts pipeline with variables.
     """
-    print(f"Received event: {json.dumps(event)}")
+    print(f"Received event: {describe_event(event)}")
 
     # Extract ECR event details
     detail = event["detail"]
@@ -28,6 +42,46 @@ def handler(event, context):
 
     print(f"Processing ECR push from dev: {image_uri}")
 
+    try:
+        coalescer = Coalescer(
+            store=coalesce_store_from_environment(),
+            clock=SystemClock(),
+            window_seconds=float(os.environ.get("COALESCE_WINDOW_SECONDS", "30")),
+            dedupe_seconds=float(os.environ.get("COALESCE_DEDUPE_SECONDS", "600"))
+        )
+        with phase("coalesce"):
+            outcome = coalescer.submit(repo, digest or f"tag:{tag}", tag,
+                                       lambda: start_pipeline(tag, digest), stop_superseded_execution)
+        if outcome["result"] != "started":
+            return {
+                "statusCode": 200,
+                "body": json.dumps({
+                    "message": f"Push of {image_uri} coalesced: {outcome['result']}",
+                    "coalesced": outcome["result"],
+                    "imageTag": tag,
+                    "imageDigest": digest
+                })
+            }
+
+        execution_id = outcome["executionId"]
+        set_dimensions(pipeline_execution_id=execution_id)
+        return {
+            "statusCode": 200,
+            "body": json.dumps({
+                "message": f"Deployment pipeline started for {image_uri}",
+                "pipelineExecutionId": execution_id,
+                "imageTag": tag,
+                "imageDigest": digest,
+                "supersededExecutions": outcome["stopped"]
+            })
+        }
+
+    except Exception as e:
+        print(f"Error preparing deployment: {str(e)}")
+        raise
+
+def start_pipeline(tag, digest):
+    """Start the deployment pipeline for an image and return the execution ID."""
     # Get function names and role ARNs
     dev_lambda_function = os.environ["DEV_LAMBDA_FUNCTION"]
     prod_lambda_function = os.environ["PROD_LAMBDA_FUNCTION"]
@@ -51,46 +105,168 @@ def handler(event, context):
         dev_image_uri = f"{dev_account_id}.dkr.ecr.{dev_region}.amazonaws.com/{dev_repo_name}:{tag}"
         prod_image_uri = f"{prod_account_id}.dkr.ecr.{prod_region}.amazonaws.com/{prod_repo_name}:{tag}"
 
+    # Start pipeline execution with variables
+    pipeline_name = os.environ["PIPELINE_NAME"]
+    print(f"Starting pipeline: {pipeline_name}")
+
+    response = codepipeline.start_pipeline_execution(
+        name=pipeline_name,
+        variables=[
+            {
+                'name': 'DEV_IMAGE_TAG',
+                'value': tag
+            },
+            {
+                'name': 'PROD_IMAGE_TAG',
+                'value': tag
+            },
+            {
+                'name': 'DEV_IMAGE_DIGEST',
+                'value': digest or ''
+            },
+            {
+                'name': 'PROD_IMAGE_DIGEST',
+                'value': digest or ''
+            }
+        ]
+    )
+
+    execution_id = response["pipelineExecutionId"]
+    print(f"Started pipeline execution: {execution_id}")
+    return execution_id
+
+def stop_superseded_execution(execution_id, digest):
+    """
+    Stop an older run that is still in progress. Running actions are allowed to
+    finish (abandon=False), so no deployment is cut off halfway.
+    Returns True if the execution was stopped.
+    """
+    pipeline_name = os.environ["PIPELINE_NAME"]
     try:
-        # Start pipeline execution with variables
-        pipeline_name = os.environ["PIPELINE_NAME"]
-        print(f"Starting pipeline: {pipeline_name}")
-
-        response = codepipeline.start_pipeline_execution(
-            name=pipeline_name,
-            variables=[
-                {
-                    'name': 'DEV_IMAGE_TAG',
-                    'value': tag
-                },
-                {
-                    'name': 'PROD_IMAGE_TAG', 
-                    'value': tag
-                },
-                {
-                    'name': 'DEV_IMAGE_DIGEST',
-                    'value': digest or ''
-                },
-                {
-                    'name': 'PROD_IMAGE_DIGEST',
-                    'value': digest or ''
-                }
-            ]
+        status = codepipeline.get_pipeline_execution(
+            pipelineName=pipeline_name,
+            pipelineExecutionId=execution_id
+        )["pipelineExecution"]["status"]
+        if status != "InProgress":
+            return False
+        codepipeline.stop_pipeline_execution(
+            pipelineName=pipeline_name,
+            pipelineExecutionId=execution_id,
+            abandon=False,
+            reason=f"Superseded by a newer image than {digest}"
         )
+        print(f"Stopped superseded execution {execution_id} ({digest})")
+        return True
+    except Exception as e:
+        # e.g. the execution finished between the status check and the stop
+        print(f"Warning: could not stop superseded execution {execution_id}: {str(e)}")
+        return False
 
-        execution_id = response["pipelineExecutionId"]
-        print(f"Started pipeline execution: {execution_id}")
+class Coalescer:
+    """
+    Debounce ECR pushes per repository, keyed by image digest.
 
-        return {
-            "statusCode": 200,
-            "body": json.dumps({
-                "message": f"Deployment pipeline started for {image_uri}",
-                "pipelineExecutionId": execution_id,
-                "imageTag": tag,
-                "imageDigest": digest
-            })
-        }
+    submit() records the push as the repository's pending digest, waits out the
+    window on the clock, and starts a run only if the push is still the pending
+    one afterwards (latest-wins). A push for the digest already pending, or one
+    started within dedupe_seconds, is dropped as a duplicate tag event. After a
+    start, runs of older digests that are still in progress are stopped.
 
-    except Exception as e:
-        print(f"Error preparing deployment: {str(e)}")
-        raise
+    The store and clock are injected so the behaviour can be tested with a
+    simulated clock and an in-memory store.
+    """
+
+    def __init__(self, store, clock, window_seconds, dedupe_seconds):
+        self.store = store
+        self.clock = clock
+        self.window_seconds = window_seconds
+        self.dedupe_seconds = dedupe_seconds
+
+    def submit(self, repository, digest, tag, start, stop):
+        """
+        Coalesce one push. start() starts a run and returns its execution ID;
+        stop(execution_id, digest) stops a superseded run and returns whether it did.
+        Returns {"result": "started" | "duplicate" | "superseded", ...}.
+        """
+        token = uuid.uuid4().hex
+        outcome = {}
+
+        def register(state):
+            now = self.clock.now()
+            recent = [run for run in state["started"] if now - run["startedAt"] < self.dedupe_seconds]
+            pending = state["pending"]
+            if any(run["digest"] == digest for run in recent):
+                outcome["result"] = "duplicate"
+                return None
+            if pending and pending["digest"] == digest and now - pending["pushedAt"] < self.window_seconds + COALESCE_STALE_SECONDS:
+                outcome["result"] = "duplicate"
+                if tag in pending["tags"]:
+                    return None
+                pending["tags"].append(tag)
+                return state
+            outcome["result"] = "pending"
+            if pending:
+                print(f"Push of {digest} supersedes pending {pending['digest']}")
+            state["pending"] = {"digest": digest, "tags": [tag], "pushedAt": now, "token": token}
+            return state
+
+        self.update(repository, register)
+        if outcome["result"] == "duplicate":
+            print(f"Dropping duplicate push of {digest} ({tag})")
+            return {"result": "duplicate"}
+
+        self.clock.sleep(self.window_seconds)
+
+        def claim(state):
+            pending = state["pending"]
+            if not pending or pending["token"] != token:
+                outcome["result"] = "superseded"
+                return None
+            outcome["result"] = "claimed"
+            state["pending"] = None
+            return state
+
+        self.update(repository, claim)
+        if outcome["result"] == "superseded":
+            print(f"Push of {digest} superseded during the {self.window_seconds}s window")
+            return {"result": "superseded"}
+
+        execution_id = start()
+        stopped = []
+
+        def record(state):
+            older = [run for run in state["started"] if run["digest"] != digest and run.get("executionId")]
+            outcome["older"] = older
+            run = {"digest": digest, "executionId": execution_id, "startedAt": self.clock.now()}
+            state["started"] = ([run] + state["started"])[:COALESCE_HISTORY]
+            return state
+
+        self.update(repository, record)
+        for run in outcome["older"]:
+            if run.get("stopped"):
+                continue
+            if stop(run["executionId"], run["digest"]):
+                stopped.append(run["executionId"])
+
+        if stopped:
+            def mark_stopped(state):
+                for run in state["started"]:
+                    if run["executionId"] in stopped:
+                        run["stopped"] = True
+                return state
+            self.update(repository, mark_stopped)
+
+        return {"result": "started", "executionId": execution_id, "stopped": stopped}
+
+    def update(self, repository, change):
+        """Apply change(state) with optimistic concurrency; change returns None for no write."""
+        update_json(self.store, repository, change, empty=lambda: {"pending": None, "started": []},
+                    label=f"Coalescing state of {repository}")
+
+def coalesce_store_from_environment():
+    """S3 store in the artifacts bucket, or in-memory when no bucket is configured."""
+    bucket_name = os.environ.get("ARTIFACTS_BUCKET")
+    if bucket_name:
+        return S3JsonStore(s3_client, bucket_name, COALESCE_PREFIX)
+    print("ARTIFACTS_BUCKET not set, coalescing within this container only")
+    return MemoryJsonStore()
@@ -0,0 +1,97 @@
+import unittest
+from unittest.mock import Mock, patch
+import os
+import sys
+
+# Add the current directory to the path so we can import the module
+sys.path.insert(0, os.path.dirname(__file__))
+# Shared modules Terraform packages alongside index.py
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lambda_shared'))
+
+# Import the module under test
+import index
+import state_store
+
+
+class SimulatedClock:
+    """Clock whose sleep advances time and runs whatever was scheduled for the wait."""
+
+    def __init__(self):
+        self.time = 1000.0
+        self.during_sleep = []
+
+    def now(self):
+        return self.time
+
+    def sleep(self, seconds):
+        self.time += seconds
+        while self.during_sleep:
+            self.during_sleep.pop(0)()
+
+
+class TestCoalescer(unittest.TestCase):
+    def setUp(self):
+        """Set up test fixtures."""
+        self.clock = SimulatedClock()
+        self.store = state_store.MemoryJsonStore()
+        self.coalescer = index.Coalescer(self.store, self.clock, window_seconds=30, dedupe_seconds=600)
+        self.started = []
+        self.stop = Mock(return_value=True)
+
+    def push(self, digest, tag='latest'):
+        def start():
+            self.started.append((digest, self.clock.now()))
+            return f"exec-{digest}"
+        return self.coalescer.submit('app-dev', digest, tag, start, self.stop)
+
+    def test_push_starts_after_window(self):
+        """Test a lone push starts a run once the window has passed."""
+        outcome = self.push('sha256:a')
+
+        self.assertEqual(outcome['result'], 'started')
+        self.assertEqual(self.started, [('sha256:a', 1030.0)])
+
+    def test_duplicate_tags_for_one_digest_start_once(self):
+        """Test several tag events for the same digest are coalesced into one run."""
+        results = []
+        self.clock.during_sleep.append(lambda: results.append(self.push('sha256:a', 'v1.2.3')['result']))
+
+        outcome = self.push('sha256:a', 'latest')
+
+        self.assertEqual(outcome['result'], 'started')
+        self.assertEqual(results, ['duplicate'])
+        self.assertEqual(len(self.started), 1)
+        # A later re-push of the started digest is dropped too
+        self.assertEqual(self.push('sha256:a', 'stable')['result'], 'duplicate')
+        self.assertEqual(len(self.started), 1)
+
+    def test_newest_digest_wins_and_stops_older_runs(self):
+        """Test a newer push within the window supersedes the pending one and older runs are stopped."""
+        self.assertEqual(self.push('sha256:a')['result'], 'started')
+
+        later = []
+        self.clock.during_sleep.append(lambda: later.append(self.push('sha256:c')))
+        outcome = self.push('sha256:b')
+
+        self.assertEqual(outcome['result'], 'superseded')
+        self.assertEqual(later[0]['result'], 'started')
+        self.assertEqual([digest for digest, _ in self.started], ['sha256:a', 'sha256:c'])
+        self.stop.assert_called_once_with('exec-sha256:a', 'sha256:a')
+        self.assertEqual(later[0]['stopped'], ['exec-sha256:a'])
+
+        # Runs that were already stopped are not stopped again
+        self.clock.time += 600
+        self.push('sha256:d')
+        self.assertEqual([c[0][0] for c in self.stop.call_args_list],
+                         ['exec-sha256:a', 'exec-sha256:c'])
+
+    def test_store_rejects_stale_writes(self):
+        """Test the in-memory store's optimistic concurrency."""
+        state, version = self.store.get('repo')
+        self.assertTrue(self.store.put('repo', {'pending': None, 'started': []}, version))
+        self.assertFalse(self.store.put('repo', {'pending': None, 'started': []}, version))
+
+
+if __name__ == '__main__':
+    # Run the tests
+    unittest.main(verbosity=2)
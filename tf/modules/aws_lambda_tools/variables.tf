@@ -46,4 +46,61 @@ variable "enable_migrations" {
   description = "Enable database migrations in the pipeline"
   type        = bool
   default     = false
-}
\ No newline at end of file
+}
+
+variable "deploy_completion_mode" {
+  description = "How the deploy action learns a CodeDeploy deployment finished: \"event\" (forwarded state-change events, with a slow fallback poll) or \"poll\" (poll until done)"
+  type        = string
+  default     = "event"
+
+  validation {
+    condition     = contains(["event", "poll"], var.deploy_completion_mode)
+    error_message = "deploy_completion_mode must be \"event\" or \"poll\"."
+  }
+}
+
+variable "deploy_fallback_poll_minutes" {
+  description = "Minutes between fallback polls of deployments still waiting for a completion event"
+  type        = number
+  default     = 5
+}
+
+variable "additional_prod_targets" {
+  description = "Further prod stacks (e.g. other regions) that the prod deploy action rolls the same image out to, concurrently with the primary one"
+  type = list(object({
+    account_id             = string
+    region                 = string
+    repository_name        = string
+    cross_account_role_arn = string
+    deploy_lambda_name     = string
+  }))
+  default = []
+}
+
+variable "prod_deploy_policy" {
+  description = "How a multi-target prod deploy handles failures: \"all\" (wait for every target, fail if any failed) or \"fail_fast\" (stop and roll back the rest on the first failure)"
+  type        = string
+  default     = "all"
+
+  validation {
+    condition     = contains(["all", "fail_fast"], var.prod_deploy_policy)
+    error_message = "prod_deploy_policy must be \"all\" or \"fail_fast\"."
+  }
+}
+
+variable "push_coalesce_window_seconds" {
+  description = "Seconds an ECR push waits for a newer one before starting the pipeline; only the newest digest in a burst is deployed"
+  type        = number
+  default     = 30
+
+  validation {
+    condition     = var.push_coalesce_window_seconds >= 0 && var.push_coalesce_window_seconds <= 240
+    error_message = "push_coalesce_window_seconds must be between 0 and 240 (the prepare-deployment Lambda times out at 300)."
+  }
+}
+
+variable "push_dedupe_seconds" {
+  description = "Seconds during which further pushes (e.g. extra tags) of an already started digest are ignored"
+  type        = number
+  default     = 600
+}
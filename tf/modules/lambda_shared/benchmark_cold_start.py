@@ -0,0 +1,273 @@
+"""
+Cold-start benchmark for the hoist Lambda handlers.
+
+Each handler is imported and invoked once in a fresh Python process, the way a
+new Lambda execution environment would run it, and the benchmark reports:
+
+  import_ms   time to import index.py (module init, what Lambda bills as Init Duration)
+  invoke_ms   time of the first invocation, including building the clients it uses
+  clients     services whose clients the first invocation actually built
+
+No request leaves the machine: a botocore before-send hook answers every call
+as an empty account would (reads find nothing, lists are empty, writes succeed),
+so the numbers measure our code and botocore, not AWS.
+
+Usage:
+    python benchmark_cold_start.py [--runs 5] [--handler deploy_lambda ...]
+                                   [--json results.json] [--baseline old.json]
+"""
+import argparse
+import base64
+import contextlib
+import gzip
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+MODULES_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SHARED_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ACCOUNT_ID = '123456789012'
+REGION = 'us-east-1'
+CHILD_TIMEOUT_SECONDS = 60
+RESULT_MARKER = 'BENCHMARK_RESULT '
+
+# Services whose errors come back as XML (rest-xml and query protocols)
+XML_SERVICES = {'s3', 'sts'}
+# Operations answered with an empty success instead of a not-found error
+SUCCESS_PREFIXES = ('List', 'Put', 'Create', 'Update', 'Delete', 'Start', 'Stop', 'Invoke',
+                    'Batch', 'Register', 'Tag', 'Untag')
+# Success bodies for operations whose callers read fields of the response
+SUCCESS_BODIES = {'StartPipelineExecution': b'{"pipelineExecutionId": "benchmark"}'}
+
+
+def ecr_push_event():
+    return {
+        'version': '0',
+        'id': 'benchmark',
+        'detail-type': 'ECR Image Action',
+        'source': 'aws.ecr',
+        'account': ACCOUNT_ID,
+        'time': '2025-01-01T00:00:00Z',
+        'region': REGION,
+        'detail': {
+            'action-type': 'PUSH',
+            'result': 'SUCCESS',
+            'repository-name': 'app',
+            'image-tag': 'benchmark',
+            'image-digest': 'sha256:' + '0' * 64
+        }
+    }
+
+
+def capture_log_event():
+    log_data = {
+        'messageType': 'DATA_MESSAGE',
+        'logEvents': [{
+            'id': '1',
+            'timestamp': 1735689600000,
+            'message': 'HOIST_CAPTURE ' + json.dumps({'httpMethod': 'GET', 'path': '/', 'headers': {}})
+        }]
+    }
+    return {'awslogs': {'data': base64.b64encode(gzip.compress(json.dumps(log_data).encode())).decode()}}
+
+
+# Handler directory (relative to tf/modules), environment and a representative first event
+HANDLERS = {
+    'deploy_lambda': {
+        'dir': 'aws_lambda/deploy_lambda',
+        'env': {'LAMBDA_FUNCTION_NAME': 'app-dev', 'APPSPEC_BUCKET': 'appspec',
+                'CODEDEPLOY_APP_NAME': 'app', 'DEPLOYMENT_GROUP_NAME': 'app-dev'},
+        'event': {'detail-type': 'CodeDeploy Deployment State-change Notification',
+                  'detail': {'deploymentId': 'd-BENCHMARK', 'state': 'SUCCESS',
+                             'application': 'app', 'deploymentGroup': 'app-dev'}}
+    },
+    'cleanup_lambda': {
+        'dir': 'aws_lambda/cleanup_lambda',
+        'env': {'ECR_REPOSITORY_NAME': 'app', 'APPSPEC_BUCKET_NAME': 'appspec',
+                'CODEDEPLOY_APP_NAME': 'app', 'CODEDEPLOY_GROUP_NAME': 'app-dev',
+                'LAMBDA_FUNCTION_NAME': 'app-dev'},
+        'event': {'dryRun': True}
+    },
+    'rollback_lambda': {
+        'dir': 'aws_lambda/rollback_lambda',
+        'env': {'LAMBDA_FUNCTION_NAME': 'app-dev', 'APPSPEC_BUCKET': 'appspec', 'ECR_REPOSITORY_NAME': 'app',
+                'CODEDEPLOY_APP_NAME': 'app', 'DEPLOYMENT_GROUP_NAME': 'app-dev'},
+        'event': {'dryRun': True}
+    },
+    'manual_deploy_latest_lambda': {
+        'dir': 'aws_lambda/manual_deploy_latest_lambda',
+        'env': {'ECR_REPOSITORY_NAME': 'app', 'APPSPEC_BUCKET': 'appspec',
+                'LAMBDA_FUNCTION_NAME': 'app-dev', 'DEPLOY_FUNCTION_NAME': 'app-dev-deploy'},
+        'event': ecr_push_event()
+    },
+    'health_check_lambda': {
+        'dir': 'aws_lambda/health_check_lambda',
+        'env': {'FUNCTION_NAME': 'app-dev'},
+        'event': {'DeploymentId': 'd-BENCHMARK', 'LifecycleEventHookExecutionId': 'benchmark'}
+    },
+    'request_capture_lambda': {
+        'dir': 'aws_lambda/request_capture_lambda',
+        'env': {'FUNCTION_NAME': 'app-dev', 'CAPTURE_BUCKET': 'captures', 'CAPTURE_SAMPLE_RATE': '1'},
+        'event': capture_log_event()
+    },
+    'prepare_deployment_lambda': {
+        'dir': 'aws_lambda_tools/prepare_deployment_lambda',
+        'env': {'PIPELINE_NAME': 'app', 'APP_NAME': 'app', 'ARTIFACTS_BUCKET': 'artifacts',
+                'COALESCE_WINDOW_SECONDS': '0', 'DEV_LAMBDA_FUNCTION': 'app-dev', 'PROD_LAMBDA_FUNCTION': 'app-prod',
+                'DEV_CROSS_ACCOUNT_ROLE': 'dev-role', 'PROD_CROSS_ACCOUNT_ROLE': 'prod-role',
+                'DEV_ACCOUNT_ID': ACCOUNT_ID, 'PROD_ACCOUNT_ID': ACCOUNT_ID,
+                'DEV_REGION': REGION, 'PROD_REGION': REGION},
+        'event': ecr_push_event()
+    },
+    'deploy_from_pipeline_lambda': {
+        'dir': 'aws_lambda_tools/deploy_from_pipeline_lambda',
+        'env': {'STATE_BUCKET': 'state'},
+        'event': {'sweep': True}
+    }
+}
+
+
+class BenchmarkContext:
+    """Just enough of the Lambda context object for the handlers."""
+
+    def __init__(self, timeout_seconds=CHILD_TIMEOUT_SECONDS):
+        self.function_name = 'benchmark'
+        self.invoked_function_arn = f"arn:aws:lambda:{REGION}:{ACCOUNT_ID}:function:benchmark"
+        self.aws_request_id = 'benchmark'
+        self.deadline = time.time() + timeout_seconds
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.time()) * 1000)
+
+
+def canned_response(request, event_name, **kwargs):
+    """Answer a request as an empty account would, without sending it."""
+    from botocore.awsrequest import AWSResponse
+
+    _, service, operation = event_name.split('.', 2)
+    if operation.startswith(SUCCESS_PREFIXES):
+        status = 200
+        body = SUCCESS_BODIES.get(operation, b'' if service in XML_SERVICES else b'{}')
+    elif service in XML_SERVICES:
+        status, body = 404, b'<Error><Code>NoSuchKey</Code><Message>benchmark</Message></Error>'
+    else:
+        status, body = 400, b'{"__type": "ResourceNotFoundException", "message": "benchmark"}'
+    return AWSResponse(request.url, status, {}, CannedBody(body))
+
+
+class CannedBody:
+    """Raw response body as botocore reads it."""
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+def run_child(handler_dir):
+    """Import and invoke one handler in this (fresh) process and print its timings."""
+    spec = next(s for s in HANDLERS.values() if s['dir'] == handler_dir)
+    sys.path.insert(0, os.path.join(MODULES_DIR, handler_dir))
+    sys.path.insert(0, SHARED_DIR)
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        started = time.perf_counter()
+        import index
+        imported = time.perf_counter()
+
+        # Hooks registered on the default session are copied into every client built from
+        # it, so this must happen before the first client (i.e. not at import time)
+        import boto3
+        from clients import created_clients
+        if created_clients():
+            raise RuntimeError(f"{handler_dir} built clients at import time: {created_clients()}")
+        boto3.setup_default_session()
+        boto3.DEFAULT_SESSION.events.register('before-send', canned_response)
+
+        invoking = time.perf_counter()
+        try:
+            response = index.handler(spec['event'], BenchmarkContext())
+            outcome = f"status {response.get('statusCode')}" if isinstance(response, dict) else 'ok'
+        except Exception as e:
+            outcome = f"raised {type(e).__name__}"
+        invoked = time.perf_counter()
+
+    print(RESULT_MARKER + json.dumps({
+        'importMs': round((imported - started) * 1000, 1),
+        'invokeMs': round((invoked - invoking) * 1000, 1),
+        'clients': created_clients(),
+        'outcome': outcome
+    }))
+
+
+def measure(name, runs):
+    """Median import and first-invoke times of a handler over runs fresh processes."""
+    spec = HANDLERS[name]
+    env = dict(os.environ, AWS_ACCESS_KEY_ID='benchmark', AWS_SECRET_ACCESS_KEY='benchmark',
+               AWS_DEFAULT_REGION=REGION, AWS_EC2_METADATA_DISABLED='true', **spec['env'])
+    env.pop('AWS_PROFILE', None)
+    samples = []
+    for _ in range(runs):
+        completed = subprocess.run([sys.executable, __file__, '--child', spec['dir']], env=env,
+                                   capture_output=True, text=True, timeout=CHILD_TIMEOUT_SECONDS)
+        line = next((l for l in completed.stdout.splitlines() if l.startswith(RESULT_MARKER)), None)
+        if line is None:
+            raise RuntimeError(f"{name} produced no result:\n{completed.stderr}")
+        samples.append(json.loads(line[len(RESULT_MARKER):]))
+    return {
+        'importMs': statistics.median(s['importMs'] for s in samples),
+        'invokeMs': statistics.median(s['invokeMs'] for s in samples),
+        'clients': samples[-1]['clients'],
+        'outcome': samples[-1]['outcome'],
+        'runs': runs
+    }
+
+
+def delta(current, baseline, field):
+    if not baseline or field not in baseline:
+        return ''
+    return f" ({current[field] - baseline[field]:+.1f})"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure import and first-invoke time of each hoist handler.")
+    parser.add_argument('--runs', type=int, default=5, help="Fresh processes per handler (the median is reported)")
+    parser.add_argument('--handler', action='append', choices=sorted(HANDLERS), help="Only benchmark these handlers")
+    parser.add_argument('--json', help="Write the results to this file")
+    parser.add_argument('--baseline', help="Results file of an earlier run to compare against")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child)
+        return
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    print(f"{'handler':<30} {'import ms':>16} {'invoke ms':>16}  clients / outcome")
+    for name in args.handler or sorted(HANDLERS):
+        result = measure(name, args.runs)
+        results[name] = result
+        previous = baseline.get(name)
+        print(f"{name:<30} {result['importMs']:>8.1f}{delta(result, previous, 'importMs'):<8} "
+              f"{result['invokeMs']:>8.1f}{delta(result, previous, 'invokeMs'):<8}  "
+              f"{','.join(result['clients']) or '-'} / {result['outcome']}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Lazily created boto3 clients shared by the hoist Lambdas.
+
+Handlers declare their clients at module level as before:
+
+    s3_client = lazy_client('s3')
+
+Declaring one costs nothing at import time. The real client is built on first
+use and then shared by every lazy client of the same service and settings in
+the process, so an invocation that only touches S3 never pays for the others.
+All clients use the same tuned botocore configuration (see client_config) and
+report their API calls to instrumentation.py.
+
+Terraform packages this file next to each function's index.py; tests and
+local runs add this directory to sys.path.
+"""
+import threading
+import boto3
+from botocore.config import Config
+
+from instrumentation import instrument_client
+
+CONNECT_TIMEOUT_SECONDS = 5
+READ_TIMEOUT_SECONDS = 30
+# Synchronous invokes wait for the invoked function, which may run up to 15 minutes
+SERVICE_READ_TIMEOUTS = {'lambda': 900}
+# Enough for the thread pools in the health check, fan-out and cleanup sweeper
+MAX_POOL_CONNECTIONS = 25
+# Adaptive mode adds client-side rate limiting on top of standard retries
+RETRY_MODE = 'adaptive'
+RETRY_MAX_ATTEMPTS = 5
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def client_config(service, **overrides):
+    """The botocore Config for service; overrides replace individual settings."""
+    settings = {
+        'connect_timeout': CONNECT_TIMEOUT_SECONDS,
+        'read_timeout': SERVICE_READ_TIMEOUTS.get(service, READ_TIMEOUT_SECONDS),
+        'max_pool_connections': MAX_POOL_CONNECTIONS,
+        'retries': {'mode': RETRY_MODE, 'max_attempts': RETRY_MAX_ATTEMPTS}
+    }
+    settings.update(overrides)
+    return Config(**settings)
+
+def get_client(service, **overrides):
+    """The process-wide client for service and overrides, created on first request."""
+    key = (service, repr(sorted(overrides.items())))
+    client = _clients.get(key)
+    if client is None:
+        # boto3's default session is not safe for concurrent client creation
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = instrument_client(boto3.client(service, config=client_config(service, **overrides)))
+                _clients[key] = client
+    return client
+
+def lazy_client(service, **overrides):
+    """A stand-in for a boto3 client that builds the real one on first attribute access."""
+    return LazyClient(service, overrides)
+
+def created_clients():
+    """Services whose clients have been built so far (for benchmarks and tests)."""
+    return sorted({service for service, _ in _clients})
+
+def reset_clients():
+    """Forget every built client."""
+    with _clients_lock:
+        _clients.clear()
+
+class LazyClient:
+    """Forwards every attribute to the shared client for its service."""
+    __slots__ = ('_service', '_overrides')
+
+    def __init__(self, service, overrides):
+        self._service = service
+        self._overrides = overrides
+
+    def __getattr__(self, name):
+        return getattr(get_client(self._service, **self._overrides), name)
+
+    def __repr__(self):
+        return f"LazyClient({self._service!r})"
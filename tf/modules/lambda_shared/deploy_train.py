@@ -0,0 +1,211 @@
+"""
+The deploy train: one CodeDeploy deployment per deployment group at a time.
+
+Requests wait behind a lease kept in the AppSpec bucket at
+queues/<app>/<group>.json and only the newest waiting one is deployed next.
+deploy_lambda joins the train for every image it deploys and releases the
+lease on the CodeDeploy state-change event; rollback_lambda preempts it.
+
+Terraform packages this file next to each function's index.py; tests and
+local runs add this directory to sys.path.
+"""
+from state_store import S3JsonStore, SystemClock, update_json
+
+DEPLOY_QUEUE_PREFIX = 'queues'
+DEPLOY_QUEUE_HISTORY = 20
+# A granted lease must produce a deployment within this (code updates included)
+DEPLOY_LEASE_START_SECONDS = 900
+# Backstop for a running deployment whose state-change event never arrives
+DEPLOY_LEASE_SECONDS = 3600
+FINISHED_DEPLOYMENT_STATUSES = ('Succeeded', 'Failed', 'Stopped')
+
+def deploy_queue_store(s3_client, bucket_name):
+    """Lock state in S3, one object per deployment group under queues/."""
+    return S3JsonStore(s3_client, bucket_name, DEPLOY_QUEUE_PREFIX)
+
+def codedeploy_deploy_train(s3_client, codedeploy, bucket_name):
+    """
+    Deploy train with its lock state in bucket_name; a lease whose deployment
+    CodeDeploy reports as finished is reclaimed.
+    """
+    def deployment_finished(deployment_id):
+        status = codedeploy.get_deployment(deploymentId=deployment_id)['deploymentInfo']['status']
+        return status in FINISHED_DEPLOYMENT_STATUSES
+    return DeployTrain(deploy_queue_store(s3_client, bucket_name), SystemClock(),
+                       deployment_finished=deployment_finished)
+
+class DeployTrain:
+    """
+    Serialize deployments per CodeDeploy deployment group behind a lease.
+
+    join() grants the lease when the group is idle and queues the request
+    otherwise. When the active deployment finishes, release() hands the lease
+    to the newest waiting request only (latest-wins) and marks the older ones
+    superseded. A lease whose holder never created a deployment, or whose
+    deployment finished without a release, is reclaimed on the next join.
+    preempt() takes the lease at once for a rollback, ahead of the queue.
+
+    The store and clock are injected so the train can be tested with an
+    in-memory store and a simulated clock.
+    """
+
+    def __init__(self, store, clock, start_seconds=DEPLOY_LEASE_START_SECONDS,
+                 lease_seconds=DEPLOY_LEASE_SECONDS, deployment_finished=None):
+        self.store = store
+        self.clock = clock
+        self.start_seconds = start_seconds
+        self.lease_seconds = lease_seconds
+        self.deployment_finished = deployment_finished or (lambda deployment_id: False)
+
+    def join(self, group, entry):
+        """
+        Join the queue with entry ({'ticket', 'imageDigest'}), or check on an
+        earlier join with the same ticket. Returns {"result": "granted" |
+        "queued" | "superseded", "queueDepth", "waitSeconds", ...}.
+        """
+        self.reclaim(group)
+        ticket = entry['ticket']
+        outcome = {}
+
+        def change(state):
+            now = self.clock.now()
+            active = state['active']
+            if active and active['ticket'] == ticket:
+                outcome.update(result='granted', waitSeconds=active['waitSeconds'])
+                return None
+            finished = next((f for f in state['finished'] if f['ticket'] == ticket), None)
+            if finished:
+                outcome.update(result='superseded', supersededBy=finished['supersededBy'],
+                               waitSeconds=finished['waitSeconds'])
+                return None
+            if any(waiting['ticket'] == ticket for waiting in state['waiting']):
+                outcome['result'] = 'queued'
+                return None
+
+            queued = dict(entry, enqueuedAt=now)
+            if active is None:
+                state['active'] = self.lease(queued, now)
+                outcome.update(result='granted', waitSeconds=0)
+                return state
+            # A newer request for an image that is already waiting takes its place
+            for older in [w for w in state['waiting'] if w['imageDigest'] == entry['imageDigest']]:
+                self.supersede(state, older, queued, now)
+            state['waiting'].append(queued)
+            outcome['result'] = 'queued'
+            return state
+
+        state = self.update(group, change)
+        outcome['queueDepth'] = len(state['waiting'])
+        outcome['activeDeploymentId'] = state['active'] and state['active'].get('deploymentId')
+        return outcome
+
+    def started(self, group, ticket, deployment_id):
+        """
+        Record the deployment created under a lease; it is held until that
+        deployment finishes. Returns False if the lease was reclaimed or
+        preempted first.
+        """
+        outcome = {'held': False}
+
+        def change(state):
+            active = state['active']
+            if not active or active['ticket'] != ticket:
+                print(f"Lease of {group} was reclaimed or preempted before deployment {deployment_id} started")
+                return None
+            outcome['held'] = True
+            active['deploymentId'] = deployment_id
+            active['expiresAt'] = self.clock.now() + self.lease_seconds
+            return state
+        self.update(group, change)
+        return outcome['held']
+
+    def preempt(self, group, entry):
+        """
+        Take the lease for entry ({'ticket', 'imageDigest'}) at once, whoever
+        holds it. Every waiting request is superseded by entry, so the release
+        of the preempted deployment promotes nothing. Stopping that deployment
+        is up to the caller. Returns {"preempted": the previous lease or None,
+        "superseded": count}.
+        """
+        outcome = {}
+
+        def change(state):
+            now = self.clock.now()
+            preempting = dict(entry, enqueuedAt=now)
+            outcome['preempted'] = state['active']
+            outcome['superseded'] = len(state['waiting'])
+            for waiting in list(state['waiting']):
+                self.supersede(state, waiting, preempting, now)
+            state['active'] = self.lease(preempting, now)
+            return state
+
+        self.update(group, change)
+        return outcome
+
+    def release(self, group, ticket=None, deployment_id=None):
+        """
+        Release the lease held by ticket or deployment_id and pass it to the
+        newest waiting request, or withdraw ticket from the queue.
+        Returns {"released": bool, "promoted": entry or None, "superseded": count}.
+        """
+        outcome = {'released': False, 'promoted': None, 'superseded': 0}
+
+        def change(state):
+            active = state['active']
+            if active and ((ticket and active['ticket'] == ticket) or
+                           (deployment_id and active.get('deploymentId') == deployment_id)):
+                outcome['released'] = True
+                outcome['superseded'] = max(0, len(state['waiting']) - 1)
+                outcome['promoted'] = self.promote(state, self.clock.now())
+                return state
+            if ticket and any(waiting['ticket'] == ticket for waiting in state['waiting']):
+                state['waiting'] = [waiting for waiting in state['waiting'] if waiting['ticket'] != ticket]
+                return state
+            return None
+
+        self.update(group, change)
+        return outcome
+
+    def reclaim(self, group):
+        """Release an active lease that expired or whose deployment already finished."""
+        state, _ = self.store.get(group)
+        active = state and state['active']
+        if not active:
+            return
+        if active['expiresAt'] < self.clock.now():
+            print(f"Lease of {group} held by {active['imageDigest']} expired, reclaiming it")
+        elif not (active.get('deploymentId') and self.deployment_finished(active['deploymentId'])):
+            return
+        self.release(group, ticket=active['ticket'])
+
+    def promote(self, state, now):
+        """Lease the group to the newest waiting request; the others are superseded."""
+        state['active'] = None
+        if not state['waiting']:
+            return None
+        newest = state['waiting'][-1]
+        for older in state['waiting'][:-1]:
+            self.supersede(state, older, newest, now)
+        state['waiting'] = []
+        state['active'] = self.lease(newest, now)
+        return state['active']
+
+    def supersede(self, state, older, newer, now):
+        """Drop older from the queue and remember why for its next join."""
+        state['waiting'] = [waiting for waiting in state['waiting'] if waiting['ticket'] != older['ticket']]
+        record = {'ticket': older['ticket'], 'supersededBy': newer['imageDigest'],
+                  'waitSeconds': round(now - older['enqueuedAt'], 3)}
+        state['finished'] = ([record] + state['finished'])[:DEPLOY_QUEUE_HISTORY]
+
+    def lease(self, entry, now):
+        """Active lease for entry; it has start_seconds to create its deployment."""
+        return dict(entry, grantedAt=now, waitSeconds=round(now - entry['enqueuedAt'], 3),
+                    expiresAt=now + self.start_seconds, deploymentId=None)
+
+    def update(self, group, change):
+        """
+        Apply change(state) with optimistic concurrency; change returns None for
+        no write. Returns the state as written (or as read, without a write).
+        """
+        return update_json(self.store, group, change, empty=lambda: {'active': None, 'waiting': [], 'finished': []},
+                           label=f"Deploy queue of {group}")
@@ -0,0 +1,263 @@
+"""
+Timing and AWS API call metrics for the hoist Lambdas.
+
+Handlers are wrapped with @instrumented. At the end of each invocation it prints
+CloudWatch embedded metric format (EMF) records to stdout, so they need no agent
+or API call and can be read locally. There are two kinds of record:
+
+  - one invocation record: Duration, the phases timed with phase() or
+    record_phase(), and the total number and time of AWS API calls
+  - one record per AWS operation called: ApiCalls, ApiErrors, ApiThrottles,
+    ApiRetries and ApiLatency
+
+Metrics about what the handler works on rather than the invocation (deploy
+queue depth, cold starts, time to restore) are printed with emit_metrics.
+
+Every client built by clients.get_client is hooked through botocore's events
+(see instrument_client). A call's latency covers all of its attempts and
+retry backoff.
+
+The pipeline execution ID and the CodeDeploy deployment ID become dimensions
+as soon as the handler knows them (event_dimensions, set_dimensions). That
+makes one deploy traceable across all the Lambdas it touches.
+"""
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_NAMESPACE = 'Hoist/Deploy'
+
+# Dimensions that identify one pipeline run or deployment across functions
+ID_DIMENSIONS = ('PipelineExecutionId', 'DeploymentId')
+
+# Error codes AWS services use for throttling (botocore retries the same set)
+THROTTLE_ERROR_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+    'TooManyRequestsException', 'ProvisionedThroughputExceededException', 'TransactionInProgressException',
+    'RequestLimitExceeded', 'BandwidthLimitExceeded', 'LimitExceededException', 'RequestThrottled',
+    'SlowDown', 'PriorRequestNotComplete', 'EC2ThrottledException'
+}
+
+# Longest event summary written to the logs
+EVENT_SUMMARY_MAX_LENGTH = 300
+
+class Invocation:
+    """Metrics collected during one invocation; API calls may come from worker threads."""
+
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.started_at = time.monotonic()
+        self.dimensions = {}
+        self.phases = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def record_call(self, service, operation, latency_ms, attempts, throttles, error):
+        with self.lock:
+            stats = self.calls.setdefault((service, operation), {
+                'ApiCalls': 0, 'ApiErrors': 0, 'ApiThrottles': 0, 'ApiRetries': 0, 'ApiLatency': 0.0
+            })
+            stats['ApiCalls'] += 1
+            stats['ApiErrors'] += 1 if error else 0
+            stats['ApiThrottles'] += throttles
+            stats['ApiRetries'] += max(attempts - 1, 0)
+            stats['ApiLatency'] += latency_ms
+
+    def record_phase(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def records(self):
+        """The EMF records for everything collected so far."""
+        ids = {name: self.dimensions[name] for name in ID_DIMENSIONS if self.dimensions.get(name)}
+        timestamp = int(time.time() * 1000)
+        with self.lock:
+            calls = sorted(self.calls.items())
+            phases = dict(self.phases)
+
+        metrics = {'Duration': round((time.monotonic() - self.started_at) * 1000, 1)}
+        metrics.update({f"{name}_duration": round(seconds * 1000, 1) for name, seconds in phases.items()})
+        metrics['ApiCalls'] = sum(stats['ApiCalls'] for _, stats in calls)
+        metrics['ApiLatency'] = round(sum(stats['ApiLatency'] for _, stats in calls), 1)
+        yield emf_record(timestamp, [['FunctionName']] + [['FunctionName', name] for name in ids], metrics,
+                         {'FunctionName': self.function_name, **ids})
+
+        for (service, operation), stats in calls:
+            dimensions = [['FunctionName', 'Service', 'Operation'], ['Service', 'Operation']]
+            dimensions += [[name, 'Service', 'Operation'] for name in ids]
+            stats = dict(stats, ApiLatency=round(stats['ApiLatency'], 1))
+            yield emf_record(timestamp, dimensions, stats, {
+                'FunctionName': self.function_name, 'Service': service, 'Operation': operation, **ids
+            })
+
+def emf_record(timestamp, dimensions, metrics, values, units=None):
+    """An embedded metric format record; units default to metric_unit."""
+    units = units or {}
+    return {
+        '_aws': {
+            'Timestamp': timestamp,
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': dimensions,
+                'Metrics': [{'Name': name, 'Unit': units.get(name) or metric_unit(name)} for name in metrics]
+            }]
+        },
+        **values,
+        **metrics
+    }
+
+def metric_unit(name):
+    """EMF unit of a metric, by naming convention."""
+    return 'Milliseconds' if name in ('Duration', 'ApiLatency') or name.endswith('_duration') else 'Count'
+
+# The invocation being measured; calls made outside of one (tests, local runs) go to a default
+_current = Invocation(os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local'))
+
+def current_invocation():
+    """The Invocation collecting metrics right now."""
+    return _current
+
+def instrumented(handler):
+    """
+    Wrap a Lambda handler so each invocation is measured and its metrics are
+    printed when it returns or raises.
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global _current
+        function_name = getattr(context, 'function_name', None)
+        if not isinstance(function_name, str):
+            function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+        _current = Invocation(function_name)
+        set_dimensions(**event_dimensions(event))
+        try:
+            return handler(event, context)
+        finally:
+            flush()
+    return wrapper
+
+def flush():
+    """Print the current invocation's records and start collecting afresh."""
+    global _current
+    invocation = _current
+    _current = Invocation(invocation.function_name)
+    for record in invocation.records():
+        print(json.dumps(record))
+
+def set_dimensions(pipeline_execution_id=None, deployment_id=None):
+    """Attach the IDs of the pipeline run and deployment this invocation works on."""
+    if pipeline_execution_id:
+        _current.dimensions['PipelineExecutionId'] = pipeline_execution_id
+    if deployment_id:
+        _current.dimensions['DeploymentId'] = deployment_id
+
+def id_dimensions():
+    """The pipeline execution and deployment IDs known so far, by dimension name."""
+    return {name: _current.dimensions[name] for name in ID_DIMENSIONS if _current.dimensions.get(name)}
+
+def event_dimensions(event):
+    """The IDs an event carries in any of the shapes the hoist Lambdas receive."""
+    if not isinstance(event, dict):
+        return {}
+    detail = event.get('detail') if isinstance(event.get('detail'), dict) else {}
+    continuation = event.get('continuation') if isinstance(event.get('continuation'), dict) else {}
+    return {
+        # CodeDeploy lifecycle hooks and state-change events; deploy lambda continuations
+        'deployment_id': event.get('DeploymentId') or detail.get('deploymentId') or continuation.get('deploymentId'),
+        # Deploy lambda requests from the pipeline and their continuations
+        'pipeline_execution_id': event.get('pipelineExecutionId') or continuation.get('pipelineExecutionId')
+    }
+
+def emit_metrics(metrics, dimensions, values, units=None):
+    """
+    Print a record for metrics about what the invocation worked on (a deploy
+    queue, a version's cold starts, a restore) rather than the invocation
+    itself. values holds the dimension values and any extra properties;
+    FunctionName is the measured function's and the known IDs are added as
+    properties, so the record can be traced like the invocation record.
+    """
+    values = {'FunctionName': _current.function_name, **id_dimensions(), **values}
+    print(json.dumps(emf_record(int(time.time() * 1000), dimensions, metrics, values, units)))
+
+def record_phase(name, seconds):
+    """Add seconds to the duration of a phase of the current invocation."""
+    _current.record_phase(name, seconds)
+
+@contextmanager
+def phase(name):
+    """Time the block as a phase of the current invocation."""
+    started_at = time.monotonic()
+    try:
+        yield
+    finally:
+        record_phase(name, time.monotonic() - started_at)
+
+def instrument_client(client):
+    """Count and time every API call made with a boto3 client; returns the client."""
+    events = client.meta.events
+    events.register('before-call', _before_call, unique_id='hoist-instrumentation-before-call')
+    events.register('response-received', _response_received, unique_id='hoist-instrumentation-response')
+    events.register('after-call', _after_call, unique_id='hoist-instrumentation-after-call')
+    events.register('after-call-error', _after_call_error, unique_id='hoist-instrumentation-after-call-error')
+    return client
+
+def _before_call(context, **kwargs):
+    context['hoist_started_at'] = time.monotonic()
+    context['hoist_attempts'] = 0
+    context['hoist_throttles'] = 0
+
+def _response_received(context, parsed_response=None, response_dict=None, **kwargs):
+    # Emitted once per HTTP attempt, retries included
+    context['hoist_attempts'] = context.get('hoist_attempts', 0) + 1
+    error_code = (parsed_response or {}).get('Error', {}).get('Code')
+    status = (response_dict or {}).get('status_code')
+    if error_code in THROTTLE_ERROR_CODES or status == 429:
+        context['hoist_throttles'] = context.get('hoist_throttles', 0) + 1
+
+def _after_call(http_response, parsed, context, event_name, **kwargs):
+    error = None
+    if http_response.status_code >= 300:
+        error = parsed.get('Error', {}).get('Code') or str(http_response.status_code)
+    _record_call(event_name, context, error)
+
+def _after_call_error(exception, context, event_name, **kwargs):
+    _record_call(event_name, context, type(exception).__name__)
+
+def _record_call(event_name, context, error):
+    started_at = context.get('hoist_started_at')
+    if started_at is None:
+        return
+    # event_name is <event>.<service id>.<operation>
+    _, service, operation = event_name.split('.', 2)
+    _current.record_call(service, operation, (time.monotonic() - started_at) * 1000,
+                         context.get('hoist_attempts', 1), context.get('hoist_throttles', 0), error)
+
+def describe_event(event):
+    """
+    One line describing an invocation event for the logs. Full events are not
+    logged: they can be large, and CodePipeline jobs carry artifact credentials.
+    """
+    if not isinstance(event, dict):
+        return type(event).__name__
+    if 'CodePipeline.job' in event:
+        job = event['CodePipeline.job']
+        resumed = ' (continuation)' if job.get('data', {}).get('continuationToken') else ''
+        summary = f"CodePipeline job {job.get('id')}{resumed}"
+    elif 'detail-type' in event:
+        detail = event.get('detail') or {}
+        facts = [f"{key}={detail[key]}" for key in ('deploymentId', 'state', 'repository-name', 'image-tag',
+                                                      'image-digest', 'result') if isinstance(detail.get(key), str)]
+        summary = f"{event['detail-type']} from {event.get('source', 'unknown')} {' '.join(facts)}".strip()
+    elif 'LifecycleEventHookExecutionId' in event:
+        summary = f"lifecycle hook for deployment {event.get('DeploymentId')}"
+    elif 'continuation' in event:
+        continuation = event['continuation'] or {}
+        summary = f"continuation of {continuation.get('imageUri')} at phase '{continuation.get('phase')}'"
+    elif 'awslogs' in event:
+        summary = f"CloudWatch Logs batch ({len(event['awslogs'].get('data', ''))} bytes compressed)"
+    else:
+        summary = json.dumps(event, default=str)
+    return summary[:EVENT_SUMMARY_MAX_LENGTH]
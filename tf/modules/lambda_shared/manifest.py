@@ -0,0 +1,64 @@
+"""
+The deployment manifest and AppSpec keys shared by the hoist Lambdas.
+
+deploy_lambda and rollback_lambda prepend a record for every deployment they
+create to manifests/<function>.json in the AppSpec bucket, newest first.
+cleanup_lambda marks records as succeeded on the CodeDeploy success event and
+protects their artifacts; rollback_lambda and manual_deploy_latest_lambda
+read the successful ones back.
+
+Terraform packages this file next to each function's index.py; tests and
+local runs add this directory to sys.path.
+"""
+from state_store import S3JsonStore, update_json
+
+MANIFEST_PREFIX = 'manifests'
+MANIFEST_SCHEMA_VERSION = 1
+MANIFEST_MAX_RECORDS = 500
+MANIFEST_WRITE_ATTEMPTS = 5
+
+def manifest_key(function_name):
+    """S3 key of the deployment manifest for function_name."""
+    return f"{MANIFEST_PREFIX}/{function_name}.json"
+
+def manifest_store(s3_client, bucket_name):
+    """Manifests in the AppSpec bucket, one object per function."""
+    return S3JsonStore(s3_client, bucket_name, MANIFEST_PREFIX)
+
+def load_manifest(s3_client, bucket_name, function_name):
+    """The deployment manifest, or None when there is none."""
+    manifest, _ = manifest_store(s3_client, bucket_name).get(function_name)
+    return manifest
+
+def build_appspec_key(function_name, version, now, layout='flat'):
+    """
+    Build the S3 key for an AppSpec file.
+
+    The flat layout writes appspec-<function>-<version>-<timestamp>.json at the
+    bucket root. The partitioned layout nests the same file name under
+    appspec/<function>/<yyyy>/<mm>/ so cleanup can walk one month at a time.
+    """
+    file_name = f"appspec-{function_name}-{version}-{now.strftime('%Y%m%d-%H%M%S')}.json"
+    if layout == 'partitioned':
+        return f"appspec/{function_name}/{now.strftime('%Y')}/{now.strftime('%m')}/{file_name}"
+    return file_name
+
+def record_deployment_manifest(s3_client, bucket_name, function_name, record):
+    """
+    Prepend a deployment record to the function's manifest.
+
+    A failure here only costs cleanup a CodeDeploy history scan, so it is
+    logged rather than failing the deployment.
+    """
+    def prepend(manifest):
+        manifest['deployments'] = ([record] + manifest.get('deployments', []))[:MANIFEST_MAX_RECORDS]
+        return manifest
+
+    try:
+        update_json(manifest_store(s3_client, bucket_name), function_name, prepend,
+                    empty=lambda: {'schemaVersion': MANIFEST_SCHEMA_VERSION, 'functionName': function_name,
+                                   'deployments': []},
+                    attempts=MANIFEST_WRITE_ATTEMPTS, label=f"Manifest of {function_name}")
+        print(f"Recorded deployment {record['deploymentId']} in s3://{bucket_name}/{manifest_key(function_name)}")
+    except Exception as e:
+        print(f"Warning: could not record deployment {record['deploymentId']} in manifest: {str(e)}")
@@ -0,0 +1,114 @@
+"""
+Small JSON state documents changed with optimistic concurrency.
+
+The deploy train, push coalescing, the deployment manifest, the latest-image
+pointer and the pipeline's completion records each keep one JSON object per
+key and change it read-modify-write:
+
+    store = S3JsonStore(s3_client, bucket_name, 'queues')
+    state = update_json(store, 'app/app-dev', change, empty=lambda: {...})
+
+S3JsonStore writes with If-Match on the ETag it read (If-None-Match for a new
+object), so a concurrent writer makes the put fail and update_json re-reads
+and re-applies the change. MemoryJsonStore behaves the same in-process, for
+tests and local runs. The store takes the caller's S3 client so tests that
+patch a handler's client cover its state too.
+
+Terraform packages this file next to each function's index.py; tests and
+local runs add this directory to sys.path.
+"""
+import json
+import threading
+import time
+from botocore.exceptions import ClientError
+
+STATE_WRITE_ATTEMPTS = 5
+# Error codes of a conditional put that lost a race
+CONDITIONAL_WRITE_CONFLICTS = ('PreconditionFailed', 'ConditionalRequestConflict')
+
+def update_json(store, key, change, empty=None, attempts=STATE_WRITE_ATTEMPTS, label=None):
+    """
+    Apply change(state) to the document at key with optimistic concurrency.
+
+    change gets the stored state (empty() when there is none, else None) and
+    returns the state to write, or None for no write. Returns the state as
+    written, or as read without a write. Raises after attempts lost races.
+    """
+    label = label or key
+    for attempt in range(attempts):
+        state, version = store.get(key)
+        if state is None and empty:
+            state = empty()
+        updated = change(state)
+        if updated is None:
+            return state
+        if store.put(key, updated, version):
+            return updated
+        print(f"{label} changed concurrently, retrying ({attempt + 1}/{attempts})")
+    raise Exception(f"Could not update {label} after {attempts} attempts")
+
+class SystemClock:
+    """Wall clock; tests inject a simulated one instead."""
+
+    def now(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+class MemoryJsonStore:
+    """In-process JSON documents, for tests and local runs."""
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            state, version = self.items.get(key, (None, None))
+            return json.loads(state) if state else None, version
+
+    def put(self, key, state, version):
+        with self.lock:
+            if self.items.get(key, (None, None))[1] != version:
+                return False
+            self.items[key] = (json.dumps(state), (version or 0) + 1)
+            return True
+
+class S3JsonStore:
+    """JSON documents in S3 at <prefix>/<key>.json, written conditionally."""
+
+    def __init__(self, s3_client, bucket_name, prefix):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+
+    def object_key(self, key):
+        return f"{self.prefix}/{key}.json"
+
+    def get(self, key):
+        """Return (state, etag), or (None, None) when there is no document."""
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.object_key(key))
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            return None, None
+        return json.loads(response['Body'].read()), response['ETag']
+
+    def put(self, key, state, version):
+        """Write state if the document is unchanged since version was read; False when it changed."""
+        condition = {'IfMatch': version} if version else {'IfNoneMatch': '*'}
+        try:
+            self.s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key=self.object_key(key),
+                Body=json.dumps(state, separators=(',', ':')),
+                ContentType='application/json',
+                **condition
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] not in CONDITIONAL_WRITE_CONFLICTS:
+                raise
+            return False
@@ -0,0 +1,52 @@
+import unittest
+from unittest.mock import Mock, patch
+import os
+import sys
+
+# Add the current directory to the path so we can import the module
+sys.path.insert(0, os.path.dirname(__file__))
+
+# Import the module under test
+import clients
+
+
+class TestClients(unittest.TestCase):
+    def setUp(self):
+        """Set up test fixtures."""
+        clients.reset_clients()
+        self.boto3_patcher = patch.object(clients.boto3, 'client', side_effect=lambda service, config: Mock())
+        self.mock_boto3_client = self.boto3_patcher.start()
+
+    def tearDown(self):
+        """Clean up test fixtures."""
+        self.boto3_patcher.stop()
+        clients.reset_clients()
+
+    def test_lazy_client_is_built_on_first_use_and_shared(self):
+        """Test declaring a client costs nothing and every declaration shares one client."""
+        s3_a = clients.lazy_client('s3')
+        s3_b = clients.lazy_client('s3')
+        self.mock_boto3_client.assert_not_called()
+        self.assertEqual(clients.created_clients(), [])
+
+        s3_a.get_object(Bucket='b', Key='k')
+        s3_b.put_object(Bucket='b', Key='k')
+
+        self.mock_boto3_client.assert_called_once()
+        self.assertEqual(clients.created_clients(), ['s3'])
+        self.assertIs(clients.get_client('s3'), clients.get_client('s3'))
+        self.assertIsNot(clients.get_client('s3', read_timeout=1), clients.get_client('s3'))
+
+    def test_client_config(self):
+        """Test the tuned settings, the long Lambda read timeout and overrides."""
+        config = clients.client_config('s3')
+        self.assertEqual(config.connect_timeout, clients.CONNECT_TIMEOUT_SECONDS)
+        self.assertEqual(config.read_timeout, clients.READ_TIMEOUT_SECONDS)
+        self.assertEqual(config.max_pool_connections, clients.MAX_POOL_CONNECTIONS)
+        self.assertEqual(config.retries, {'mode': 'adaptive', 'max_attempts': clients.RETRY_MAX_ATTEMPTS})
+        self.assertEqual(clients.client_config('lambda').read_timeout, 900)
+        self.assertEqual(clients.client_config('s3', read_timeout=3).read_timeout, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import unittest
+from unittest.mock import Mock, patch
+import io
+import json
+import os
+import sys
+from contextlib import redirect_stdout
+
+import boto3
+from botocore.awsrequest import AWSResponse
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# Add the current directory to the path so we can import the module
+sys.path.insert(0, os.path.dirname(__file__))
+
+# Import the module under test
+import instrumentation
+
+
+class CannedBody:
+    """Raw response body as botocore reads it."""
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+def s3_with_responses(*responses):
+    """An instrumented S3 client that answers each attempt with the next (status, body)."""
+    client = boto3.client('s3', region_name='us-east-1', aws_access_key_id='test', aws_secret_access_key='test',
+                          config=Config(retries={'mode': 'standard', 'max_attempts': 3}))
+    pending = list(responses)
+    client.meta.events.register('before-send', lambda request, **kwargs: AWSResponse(
+        request.url, pending[0][0], {}, CannedBody(pending.pop(0)[1])))
+    return instrumentation.instrument_client(client)
+
+
+def run_instrumented(handler, event, context=None):
+    """Run handler through @instrumented and return its EMF records."""
+    output = io.StringIO()
+    with redirect_stdout(output), patch('time.sleep'):
+        try:
+            instrumentation.instrumented(handler)(event, context or Mock(function_name='app-dev-deploy'))
+        except ClientError:
+            pass
+    return [json.loads(line) for line in output.getvalue().splitlines() if line.startswith('{"_aws"')]
+
+
+class TestInstrumentation(unittest.TestCase):
+    def test_api_calls_are_counted_with_throttles_and_retries(self):
+        """Test a throttled then successful call and a failed call end up in per-operation records."""
+        throttled = b'<Error><Code>SlowDown</Code><Message>slow down</Message></Error>'
+        missing = b'<Error><Code>NoSuchKey</Code><Message>missing</Message></Error>'
+        s3 = s3_with_responses((503, throttled), (200, b''), (404, missing))
+
+        def handler(event, context):
+            s3.put_object(Bucket='bucket', Key='key', Body=b'')
+            s3.get_object(Bucket='bucket', Key='key')
+
+        records = run_instrumented(handler, {'DeploymentId': 'd-1'})
+
+        invocation, get_object, put_object = records
+        self.assertEqual(invocation['FunctionName'], 'app-dev-deploy')
+        self.assertEqual(invocation['DeploymentId'], 'd-1')
+        self.assertEqual(invocation['ApiCalls'], 2)
+        self.assertIn(['FunctionName', 'DeploymentId'], invocation['_aws']['CloudWatchMetrics'][0]['Dimensions'])
+        self.assertEqual((put_object['Operation'], put_object['ApiCalls'], put_object['ApiThrottles'],
+                          put_object['ApiRetries'], put_object['ApiErrors']), ('PutObject', 1, 1, 1, 0))
+        self.assertEqual((get_object['Operation'], get_object['ApiErrors'], get_object['ApiRetries']),
+                         ('GetObject', 1, 0))
+        self.assertIn(['DeploymentId', 'Service', 'Operation'], get_object['_aws']['CloudWatchMetrics'][0]['Dimensions'])
+
+    def test_phases_and_dimensions_set_during_the_invocation(self):
+        """Test timed phases and IDs learned mid-invocation are in the invocation record."""
+        def handler(event, context):
+            with instrumentation.phase('publish'):
+                pass
+            instrumentation.set_dimensions(deployment_id='d-2')
+
+        invocation, = run_instrumented(handler, {'continuation': {'pipelineExecutionId': 'exec-1'}})
+
+        self.assertEqual(invocation['PipelineExecutionId'], 'exec-1')
+        self.assertEqual(invocation['DeploymentId'], 'd-2')
+        self.assertIn('publish_duration', invocation)
+        units = {m['Name']: m['Unit'] for m in invocation['_aws']['CloudWatchMetrics'][0]['Metrics']}
+        self.assertEqual(units['publish_duration'], 'Milliseconds')
+        self.assertEqual(units['ApiCalls'], 'Count')
+
+    def test_emit_metrics_records_under_the_measured_function(self):
+        """Test emitted metrics carry the invocation's FunctionName, known IDs and unit overrides."""
+        def handler(event, context):
+            instrumentation.emit_metrics({'DeployQueueDepth': 2, 'DeployQueueWait': 1500.0},
+                                         [['DeploymentGroup']], {'DeploymentGroup': 'app/app-dev'},
+                                         units={'DeployQueueWait': 'Milliseconds'})
+
+        queue, invocation = run_instrumented(handler, {'pipelineExecutionId': 'exec-2'})
+
+        self.assertEqual(queue['FunctionName'], invocation['FunctionName'])
+        self.assertEqual(queue['PipelineExecutionId'], 'exec-2')
+        self.assertEqual(queue['DeploymentGroup'], 'app/app-dev')
+        metrics = queue['_aws']['CloudWatchMetrics'][0]
+        self.assertEqual(metrics['Namespace'], instrumentation.METRICS_NAMESPACE)
+        self.assertEqual(metrics['Dimensions'], [['DeploymentGroup']])
+        self.assertEqual({m['Name']: m['Unit'] for m in metrics['Metrics']},
+                         {'DeployQueueDepth': 'Count', 'DeployQueueWait': 'Milliseconds'})
+
+    def test_describe_event_leaves_out_payloads(self):
+        """Test event summaries name the event without its credentials or bodies."""
+        job = {'CodePipeline.job': {'id': 'job-1', 'data': {
+            'artifactCredentials': {'secretAccessKey': 'secret'}, 'continuationToken': '{}'}}}
+        self.assertEqual(instrumentation.describe_event(job), 'CodePipeline job job-1 (continuation)')
+        push = {'detail-type': 'ECR Image Action', 'source': 'aws.ecr',
+                'detail': {'repository-name': 'app', 'image-tag': 'v1', 'action-type': ['PUSH']}}
+        self.assertEqual(instrumentation.describe_event(push),
+                         'ECR Image Action from aws.ecr repository-name=app image-tag=v1')
+
+
+if __name__ == '__main__':
+    unittest.main()
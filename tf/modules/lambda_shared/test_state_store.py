@@ -0,0 +1,58 @@
+import unittest
+from unittest.mock import Mock
+import io
+import json
+import os
+import sys
+
+from botocore.exceptions import ClientError
+
+# Add the current directory to the path so we can import the module
+sys.path.insert(0, os.path.dirname(__file__))
+
+# Import the module under test
+import state_store
+
+
+def client_error(code):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'operation')
+
+
+class TestStateStore(unittest.TestCase):
+    def test_lost_race_is_reapplied_on_the_newer_state(self):
+        """Test a conditional put that loses a race re-reads and re-applies the change."""
+        s3 = Mock()
+        s3.get_object.side_effect = [
+            client_error('NoSuchKey'),
+            {'Body': io.BytesIO(json.dumps({'count': 5}).encode()), 'ETag': '"e1"'}
+        ]
+        s3.put_object.side_effect = [client_error('PreconditionFailed'), {}]
+        store = state_store.S3JsonStore(s3, 'bucket', 'counters')
+
+        state = state_store.update_json(store, 'app', lambda state: dict(state, count=state['count'] + 1),
+                                        empty=lambda: {'count': 0})
+
+        self.assertEqual(state, {'count': 6})
+        first, second = [call[1] for call in s3.put_object.call_args_list]
+        self.assertEqual((first['Key'], first['IfNoneMatch']), ('counters/app.json', '*'))
+        self.assertEqual(second['IfMatch'], '"e1"')
+
+    def test_unchanged_state_is_not_written(self):
+        """Test a change returning None leaves the document alone and returns it as read."""
+        store = state_store.MemoryJsonStore()
+        state_store.update_json(store, 'app', lambda state: {'count': 1})
+
+        self.assertEqual(state_store.update_json(store, 'app', lambda state: None), {'count': 1})
+        self.assertEqual(store.get('app'), ({'count': 1}, 1))
+
+    def test_other_errors_are_raised(self):
+        """Test an S3 error other than a lost race is not mistaken for one."""
+        s3 = Mock()
+        s3.get_object.side_effect = client_error('AccessDenied')
+
+        with self.assertRaises(ClientError):
+            state_store.update_json(state_store.S3JsonStore(s3, 'bucket', 'counters'), 'app', lambda state: state)
+
+
+if __name__ == '__main__':
+    unittest.main()